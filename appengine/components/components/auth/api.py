@@ -36,6 +36,7 @@ from components.datastore_utils import config as ds_config
 from components import utils
 
 from . import config
+from . import globmatch
 from . import ipaddr
 from . import model
 from . import realms
@@ -200,6 +201,14 @@ PrincipalsSet = collections.namedtuple('PrincipalsSet', [
 ])
 
 
+# Transitive closure of a group, see AuthDB._build_group_closures().
+GroupClosure = collections.namedtuple('GroupClosure', [
+  'members',       # frozenset with Identity.to_bytes() of all members
+  'globs',         # frozenset with all IdentityGlob
+  'includes_all',  # True if model.GROUP_ALL is reachable
+])
+
+
 class AuthDB(object):
   """A read only in-memory database of auth configuration of a service.
 
@@ -209,6 +218,16 @@ class AuthDB(object):
   all requests, occasionally refetching it from Datastore.
   """
 
+  # Maximum number of (group, identity) results memoized by is_group_member.
+  # 0 disables the memo.
+  MEMBERSHIP_CACHE_SIZE = 10000
+
+  # Groups with at most this many transitive members, globs and nested groups
+  # get their transitive closure precomputed when the AuthDB is built, so that
+  # is_group_member doesn't have to walk the group graph for them. 0 disables
+  # the closures.
+  GROUP_CLOSURE_MAX_SIZE = 0
+
   @staticmethod
   def empty():
     """Returns empty AuthDB suitable for tests."""
@@ -382,6 +401,21 @@ class AuthDB(object):
     self._globs_idx = None
     self._nested_idx = None
     self._owned_idx = None
+    self._globs_by_kind = None
+    self._ip_whitelist_idx = {}  # {str -> ipaddr.SubnetIndex}
+
+    # Memo of is_group_member results, see _membership_cache_get().
+    # (group name, Identity.to_bytes()) => bool, in LRU order.
+    self._membership_lock = threading.Lock()
+    self._membership_cache = collections.OrderedDict()
+    self._membership_hits = 0
+    self._membership_misses = 0
+    self._closure_hits = 0
+
+    # group name => GroupClosure, see _build_group_closures().
+    self._closures = {}
+    if self.GROUP_CLOSURE_MAX_SIZE:
+      self._closures = self._build_group_closures(self.GROUP_CLOSURE_MAX_SIZE)
 
   def _init_realms(self, realms_pb, registered_perms):
     """Preprocesses realms_pb2.Realms into a slightly more efficient form.
@@ -515,6 +549,122 @@ class AuthDB(object):
       self._owned_idx = owned_idx
       return members_idx, globs_idx, nested_idx, owned_idx
 
+  def _matching_globs(self, identity):
+    """Returns a frozenset with all IdentityGlob in the DB matching |identity|.
+
+    Lazily builds an index of all globs per identity kind, see
+    globmatch.GlobIndex.
+    """
+    globs_by_kind = self._globs_by_kind
+    if globs_by_kind is None:
+      with self._lock:
+        if self._globs_by_kind is None:
+          per_kind = collections.defaultdict(set)
+          for group in self._groups.values():
+            for glob in group.globs:
+              per_kind[glob.kind].add(glob)
+          self._globs_by_kind = {
+            kind: globmatch.GlobIndex((g.pattern, g) for g in globs)
+            for kind, globs in per_kind.items()
+          }
+        globs_by_kind = self._globs_by_kind
+    idx = globs_by_kind.get(identity.kind)
+    if not idx:
+      return frozenset()
+    return frozenset(idx.match(identity.name))
+
+  def _build_group_closures(self, max_size):
+    """Returns the transitive closures of the groups that are small enough.
+
+    A group is skipped if the total number of members, globs and groups
+    reachable from it exceeds |max_size|.
+
+    Returns:
+      dict(group name => GroupClosure).
+    """
+    logging.info('Building group closures...')
+    closures = {}
+    for name in self._groups:
+      members = set()
+      globs = set()
+      includes_all = False
+      visited = set()
+      stack = [name]
+      size = 0
+      while stack and size <= max_size:
+        current = stack.pop()
+        if current in visited:
+          continue
+        visited.add(current)
+        if current == model.GROUP_ALL:
+          includes_all = True
+          break
+        group_obj = self._groups.get(current)
+        if group_obj:
+          members.update(group_obj.members)
+          globs.update(group_obj.globs)
+          stack.extend(group_obj.nested)
+        size = len(members) + len(globs) + len(visited)
+      if size <= max_size:
+        closures[name] = GroupClosure(
+            frozenset(members), frozenset(globs), includes_all)
+    logging.info(
+        'Finished building group closures: %d of %d groups',
+        len(closures), len(self._groups))
+    return closures
+
+  def _membership_cache_get(self, key):
+    """Returns the memoized is_group_member result for |key| or None."""
+    with self._membership_lock:
+      value = self._membership_cache.pop(key, None)
+      if value is None:
+        self._membership_misses += 1
+        return None
+      # Move to the most recently used end.
+      self._membership_cache[key] = value
+      self._membership_hits += 1
+      return value
+
+  def _membership_cache_set(self, key, value):
+    """Memoizes an is_group_member result, evicting the least recently used."""
+    with self._membership_lock:
+      self._membership_cache.pop(key, None)
+      self._membership_cache[key] = value
+      while len(self._membership_cache) > self.MEMBERSHIP_CACHE_SIZE:
+        self._membership_cache.popitem(last=False)
+
+  def clear_membership_cache(self):
+    """Drops the memoized is_group_member results."""
+    with self._membership_lock:
+      self._membership_cache.clear()
+
+  def membership_cache_stats(self):
+    """Returns statistics about is_group_member memoization.
+
+    Returns:
+      dict with:
+        'hits': number of lookups answered by the memo.
+        'misses': number of lookups that walked the group graph.
+        'closure_hits': number of lookups answered by a group closure.
+        'hit_rate': fraction of the lookups not walking the group graph.
+        'size': number of memoized results.
+        'closures': number of groups with a precomputed closure.
+    """
+    with self._membership_lock:
+      hits = self._membership_hits
+      misses = self._membership_misses
+      closure_hits = self._closure_hits
+      size = len(self._membership_cache)
+    total = hits + misses + closure_hits
+    return {
+      'hits': hits,
+      'misses': misses,
+      'closure_hits': closure_hits,
+      'hit_rate': float(hits + closure_hits) / total if total else 0.,
+      'size': size,
+      'closures': len(self._closures),
+    }
+
   @property
   def auth_db_rev(self):
     """Returns the revision number of groups database."""
@@ -539,10 +689,37 @@ class AuthDB(object):
     """Returns True if |identity| belongs to group |group_name|.
 
     Unknown groups are considered empty.
+
+    The results are memoized for the lifetime of this AuthDB, see
+    MEMBERSHIP_CACHE_SIZE and GROUP_CLOSURE_MAX_SIZE.
     """
     # Will be used when checking self._groups[...].members sets.
     ident_as_bytes = identity.to_bytes()
 
+    closure = self._closures.get(group_name)
+    if closure is not None:
+      with self._membership_lock:
+        self._closure_hits += 1
+      return (
+          closure.includes_all or
+          ident_as_bytes in closure.members or
+          (bool(closure.globs) and
+           not self._matching_globs(identity).isdisjoint(closure.globs)))
+
+    if not self.MEMBERSHIP_CACHE_SIZE:
+      return self._is_group_member_uncached(
+          group_name, identity, ident_as_bytes)
+    key = (group_name, ident_as_bytes)
+    result = self._membership_cache_get(key)
+    if result is None:
+      result = self._is_group_member_uncached(
+          group_name, identity, ident_as_bytes)
+      self._membership_cache_set(key, result)
+    return result
+
+  def _is_group_member_uncached(self, group_name, identity, ident_as_bytes):
+    """Implements is_group_member by walking the group graph."""
+
     # While the code to add groups refuses to add cycle, this code ensures that
     # it doesn't go in a cycle by keeping track of the groups currently being
     # visited via |current| stack.
@@ -552,6 +729,10 @@ class AuthDB(object):
     # diamond-like graphs, e.g. A->B, A->C, B->D, C->D.
     visited = set()
 
+    # Globs matching |identity|, looked up once the first group with globs is
+    # visited.
+    matching_globs = []
+
     def is_member(group_name):
       # Wildcard group that matches all identities (including anonymous!).
       if group_name == model.GROUP_ALL:
@@ -584,8 +765,11 @@ class AuthDB(object):
         if ident_as_bytes in group_obj.members:
           return True
 
-        if any(glob.match(identity) for glob in group_obj.globs):
-          return True
+        if group_obj.globs:
+          if not matching_globs:
+            matching_globs.append(self._matching_globs(identity))
+          if not matching_globs[0].isdisjoint(group_obj.globs):
+            return True
 
         return any(is_member(nested) for nested in group_obj.nested)
       finally:
@@ -789,11 +973,19 @@ class AuthDB(object):
       if warn_if_missing:
         logging.error('Unknown IP whitelist: %s', whitelist_name)
       return False
-    # TODO(vadimsh): If number of subnets to check grows it makes sense to add
-    # an internal cache to 'subnet_from_string' (sort of like in re.compile).
-    return any(
-        ipaddr.is_in_subnet(ip, ipaddr.subnet_from_string(net))
-        for net in subnets)
+    return ip in self._ip_whitelist_index(whitelist_name, subnets)
+
+  def _ip_whitelist_index(self, whitelist_name, subnets):
+    """Lazily builds and returns ipaddr.SubnetIndex of an IP whitelist."""
+    idx = self._ip_whitelist_idx.get(whitelist_name)
+    if idx is None:
+      with self._lock:
+        idx = self._ip_whitelist_idx.get(whitelist_name)
+        if idx is None:
+          idx = ipaddr.SubnetIndex(
+              ipaddr.subnet_from_string(net) for net in subnets)
+          self._ip_whitelist_idx[whitelist_name] = idx
+    return idx
 
   def verify_ip_whitelisted(self, identity, ip):
     """Verifies IP is in a whitelist assigned to the Identity.
@@ -1658,6 +1850,7 @@ def _roll_auth_db_cache(candidate):
         'AuthDB primary changed %s (rev %d) -> %s (rev %d)',
         _auth_db.primary_id, _auth_db.auth_db_rev,
         candidate.primary_id, candidate.auth_db_rev)
+    _auth_db.clear_membership_cache()
     _auth_db = candidate
     _auth_db_expiration = time.time() + _process_cache_expiration_sec
     return _auth_db
@@ -1675,6 +1868,10 @@ def _roll_auth_db_cache(candidate):
   # some internal caches we want to keep. So update _auth_db only if candidate
   # is strictly fresher.
   if candidate.auth_db_rev > _auth_db.auth_db_rev:
+    # Memoized is_group_member results are only valid for the revision they
+    # were computed at. Requests still holding the old AuthDB just recompute
+    # them.
+    _auth_db.clear_membership_cache()
     _auth_db = candidate
     logging.info(
         'Updated cached AuthDB: rev %d->%d',
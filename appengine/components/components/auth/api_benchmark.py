@@ -0,0 +1,125 @@
+#!/usr/bin/env vpython
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Micro-benchmark of AuthDB.is_group_member() over a synthetic AuthDB."""
+
+import argparse
+import logging
+import random
+import sys
+import time
+
+from test_support import test_env
+test_env.setup_test_env()
+
+from components.auth import api
+from components.auth import model
+
+
+def gen_groups(nb_groups, nb_globs, rnd):
+  """Returns a list of AuthGroup forming a DAG.
+
+  Each group nests up to 3 groups with a higher index and has on average
+  nb_globs / nb_groups globs.
+  """
+  groups = []
+  for i in range(nb_groups):
+    g = model.AuthGroup(id='group-%d' % i)
+    for _ in range(rnd.randint(0, 3)):
+      j = rnd.randint(i + 1, nb_groups)
+      if j < nb_groups:
+        g.nested.append('group-%d' % j)
+    g.members.append(model.Identity(model.IDENTITY_USER, 'u%d@example.com' % i))
+    groups.append(g)
+  patterns = [
+    lambda n: 'user:*@domain%d.com' % n,
+    lambda n: 'user:p-%d-*@example.com' % n,
+    lambda n: 'user:*-sa@project%d.iam.gserviceaccount.com' % n,
+    lambda n: 'bot:vm%d-*' % n,
+    lambda n: 'bot:*-m%d.example.com' % n,
+  ]
+  for i in range(nb_globs):
+    glob = rnd.choice(patterns)(i)
+    rnd.choice(groups).globs.append(model.IdentityGlob.from_bytes(glob))
+  return groups
+
+
+def gen_identities(nb_globs, count, rnd):
+  patterns = [
+    lambda n: 'user:joe@domain%d.com' % n,
+    lambda n: 'user:p-%d-joe@example.com' % n,
+    lambda n: 'user:joe-sa@project%d.iam.gserviceaccount.com' % n,
+    lambda n: 'bot:vm%d-abc' % n,
+    lambda n: 'bot:vm1-m%d.example.com' % n,
+    lambda n: 'user:u%d@example.com' % n,
+  ]
+  return [
+    model.Identity.from_bytes(rnd.choice(patterns)(rnd.randint(0, nb_globs)))
+    for _ in range(count)
+  ]
+
+
+def run(nb_groups, nb_globs, nb_checks, closure_max_size):
+  api.AuthDB.GROUP_CLOSURE_MAX_SIZE = closure_max_size
+  rnd = random.Random(0)
+  groups = gen_groups(nb_groups, nb_globs, rnd)
+  start = time.time()
+  db = api.AuthDB.from_entities(
+      replication_state=model.AuthReplicationState(),
+      global_config=model.AuthGlobalConfig(),
+      groups=groups,
+      ip_whitelist_assignments=model.AuthIPWhitelistAssignments(),
+      ip_whitelists=[],
+      additional_client_ids=[])
+  build = time.time() - start
+  identities = gen_identities(nb_globs, nb_checks, rnd)
+  checks = [
+    ('group-%d' % rnd.randint(0, nb_groups // 10), ident)
+    for ident in identities
+  ]
+
+  start = time.time()
+  db.is_group_member('group-0', identities[0])
+  first = time.time() - start
+
+  print('%d groups, %d globs:' % (nb_groups, nb_globs))
+  print('  AuthDB creation:                %7.1fms' % (build * 1000.))
+  print('  first check (builds the index): %7.1fms' % (first * 1000.))
+  # The second pass is answered by the memo.
+  for name in ('cold', 'warm'):
+    start = time.time()
+    found = sum(
+        1 for group, ident in checks if db.is_group_member(group, ident))
+    duration = time.time() - start
+    print('  %d %s checks (%d hits): %7.1fms, %.1fus/check' % (
+        nb_checks, name, found, duration * 1000., duration * 1e6 / nb_checks))
+  stats = db.membership_cache_stats()
+  print('  memo: %d hits, %d misses, %d closure hits, hit rate %.1f%%' % (
+      stats['hits'], stats['misses'], stats['closure_hits'],
+      stats['hit_rate'] * 100.))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+  parser.add_argument(
+      '--groups', type=int, default=10000, help='Number of groups')
+  parser.add_argument(
+      '--globs', type=int, default=50000, help='Number of globs')
+  parser.add_argument(
+      '--checks', type=int, default=10000,
+      help='Number of is_group_member() calls')
+  parser.add_argument(
+      '--closure-max-size', type=int, default=0,
+      help='Value for AuthDB.GROUP_CLOSURE_MAX_SIZE')
+  parser.add_argument('-v', '--verbose', action='store_true')
+  args = parser.parse_args()
+  logging.basicConfig(
+      level=logging.DEBUG if args.verbose else logging.ERROR)
+  run(args.groups, args.globs, args.checks, args.closure_max_size)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -144,6 +144,105 @@ class AuthDBTest(test_case.TestCase):
     self.assertFalse(
         is_member([with_nesting, with_listing], model.Anonymous, 'WithNesting'))
 
+  def test_is_group_member_globs(self):
+    def group(name, globs, nested=()):
+      return model.AuthGroup(
+          id=name,
+          globs=[model.IdentityGlob.from_bytes(g) for g in globs],
+          nested=list(nested))
+
+    db = new_auth_db(groups=[
+      group('Prefix', ['user:p-*', 'user:q-*@example.com']),
+      group('Suffix', ['user:*@example.com', 'bot:*.example.com']),
+      group('Exact', ['user:exact@example.com']),
+      group('Middle', ['user:a*b*c']),
+      group('AllBots', ['bot:*']),
+      group('Nested', [], nested=['Middle']),
+    ])
+    def check(ident, expected):
+      ident = model.Identity.from_bytes(ident)
+      actual = sorted(
+          g for g in ('Prefix', 'Suffix', 'Exact', 'Middle', 'AllBots',
+                      'Nested')
+          if db.is_group_member(g, ident))
+      self.assertEqual(expected, actual)
+
+    check('user:p-joe@example.com', ['Prefix', 'Suffix'])
+    check('user:q-joe@example.org', [])
+    check('user:exact@example.com', ['Exact', 'Suffix'])
+    check('user:abbc', ['Middle', 'Nested'])
+    check('user:abcd', [])
+    check('bot:vm1.example.com', ['AllBots', 'Suffix'])
+    check('bot:vm1', ['AllBots'])
+    check('service:p-joe', [])
+    self.assertEqual([], list(db._matching_globs(model.Anonymous)))
+
+  def test_is_group_member_memoized(self):
+    self.mock(api.AuthDB, 'MEMBERSHIP_CACHE_SIZE', 2)
+    joe = model.Identity.from_bytes('user:joe@example.com')
+    db = new_auth_db(groups=[
+      model.AuthGroup(id='A', members=[joe]),
+      model.AuthGroup(id='B', nested=['A']),
+    ])
+    self.assertTrue(db.is_group_member('B', joe))
+    self.assertFalse(db.is_group_member('B', model.Anonymous))
+    self.assertTrue(db.is_group_member('B', joe))
+    self.assertFalse(db.is_group_member('B', model.Anonymous))
+    expected = {
+      'hits': 2,
+      'misses': 2,
+      'closure_hits': 0,
+      'hit_rate': 0.5,
+      'size': 2,
+      'closures': 0,
+    }
+    self.assertEqual(expected, db.membership_cache_stats())
+
+    # The least recently used result is evicted.
+    self.assertTrue(db.is_group_member('A', joe))
+    self.assertEqual(
+        [('B', 'anonymous:anonymous'), ('A', 'user:joe@example.com')],
+        list(db._membership_cache))
+
+    db.clear_membership_cache()
+    self.assertEqual(0, db.membership_cache_stats()['size'])
+
+  def test_is_group_member_closures(self):
+    self.mock(api.AuthDB, 'GROUP_CLOSURE_MAX_SIZE', 6)
+    joe = model.Identity.from_bytes('user:joe@example.com')
+    bob = model.Identity.from_bytes('user:bob@example.com')
+    db = new_auth_db(groups=[
+      model.AuthGroup(id='A', members=[joe]),
+      model.AuthGroup(
+          id='B', nested=['A', 'C', 'Missing'],
+          globs=[model.IdentityGlob.from_bytes('bot:*')]),
+      # Cycle.
+      model.AuthGroup(id='C', nested=['B']),
+      model.AuthGroup(id='All', nested=['*']),
+      model.AuthGroup(
+          id='Big', members=[joe, bob], nested=['A', 'B', 'C']),
+    ])
+    self.assertEqual(
+        ['A', 'All', 'B', 'C'], sorted(db._closures))
+    self.assertEqual(
+        api.GroupClosure(
+            frozenset(['user:joe@example.com']),
+            frozenset([model.IdentityGlob.from_bytes('bot:*')]),
+            False),
+        db._closures['C'])
+    self.assertTrue(db._closures['All'].includes_all)
+
+    self.assertTrue(db.is_group_member('C', joe))
+    self.assertTrue(
+        db.is_group_member('C', model.Identity.from_bytes('bot:vm1')))
+    self.assertFalse(db.is_group_member('C', bob))
+    self.assertTrue(db.is_group_member('All', model.Anonymous))
+    self.assertTrue(db.is_group_member('Big', bob))
+    stats = db.membership_cache_stats()
+    self.assertEqual(4, stats['closure_hits'])
+    self.assertEqual(1, stats['misses'])
+    self.assertEqual(4, stats['closures'])
+
   def test_list_group(self):
     def list_group(groups, group, recursive):
       l = new_auth_db(groups=groups).list_group(group, recursive)
@@ -641,6 +740,25 @@ class TestAuthDBCache(test_case.TestCase):
     self.set_fetched_auth_db(auth_db_v0_again)
     self.assertTrue(api.get_process_auth_db() is auth_db_v0)
 
+  def test_get_process_auth_db_clears_membership_cache(self):
+    """Ensure the memoized group membership of an old AuthDB is dropped."""
+    joe = model.Identity.from_bytes('user:joe@example.com')
+    auth_db_v0 = new_auth_db(
+        replication_state=mock_replication_state(0),
+        groups=[model.AuthGroup(id='A', members=[joe])])
+    auth_db_v1 = new_auth_db(replication_state=mock_replication_state(1))
+
+    self.set_time(0)
+    self.set_fetched_auth_db(auth_db_v0)
+    self.assertTrue(api.get_process_auth_db().is_group_member('A', joe))
+    self.assertEqual(1, auth_db_v0.membership_cache_stats()['size'])
+
+    self.set_time(api.get_process_cache_expiration_sec() + 1)
+    self.set_fetched_auth_db(auth_db_v1)
+    self.assertFalse(api.get_process_auth_db().is_group_member('A', joe))
+    self.assertEqual(0, auth_db_v0.membership_cache_stats()['size'])
+    self.assertEqual(1, auth_db_v1.membership_cache_stats()['size'])
+
   def test_get_process_auth_db_multithreading(self):
     """Ensure get_process_auth_db() plays nice with multiple threads."""
 
@@ -7,6 +7,13 @@
 import re
 
 
+# Maximum number of compiled patterns kept by _compile.
+_CACHE_MAX_SIZE = 10000
+
+# Pattern => compiled regexp.
+_cache = {}
+
+
 def match(s, pat):
   """Returns True if string 's' matches glob-like pattern 'pat'.
 
@@ -17,7 +24,80 @@ def match(s, pat):
   """
   if '\n' in s or '\n' in pat:
     raise ValueError('Multiline strings are not supported')
-  return bool(re.match(_translate(pat), s))
+  return bool(_compile(pat).match(s))
+
+
+class GlobIndex(object):
+  """Finds the patterns matching a string among a large set of patterns.
+
+  The patterns are indexed by their literal prefix (before the first '*') and
+  their literal suffix (after the last '*'). A lookup only considers the
+  patterns whose prefix and suffix match the string, which are the matching
+  ones unless the pattern has more than one '*'. Only those are matched with a
+  regexp, compiled on first use.
+  """
+
+  def __init__(self, items):
+    """Builds the index.
+
+    Args:
+      items: iterable of (pattern, value).
+    """
+    # prefix => suffix => [(min length, exact, pattern, value)]
+    idx = {}
+    for pat, value in items:
+      if '\n' in pat:
+        raise ValueError('Multiline strings are not supported')
+      prefix, star, rest = pat.partition('*')
+      suffix = rest.rpartition('*')[2] if star else ''
+      idx.setdefault(prefix, {}).setdefault(suffix, []).append(
+          (len(prefix) + len(suffix), not star, pat, value))
+    # Keep the lengths of the prefixes and suffixes present in the index, to
+    # only look them up.
+    self._idx = {
+      prefix: (suffixes, sorted(set(len(x) for x in suffixes)))
+      for prefix, suffixes in idx.items()
+    }
+    self._prefix_lens = sorted(set(len(x) for x in idx))
+
+  def match(self, s):
+    """Returns the list of values of the patterns matching string 's'."""
+    if '\n' in s:
+      raise ValueError('Multiline strings are not supported')
+    out = []
+    for lp in self._prefix_lens:
+      if lp > len(s):
+        break
+      entry = self._idx.get(s[:lp])
+      if not entry:
+        continue
+      suffixes, suffix_lens = entry
+      for ls in suffix_lens:
+        if ls > len(s):
+          break
+        for min_len, exact, pat, value in suffixes.get(s[len(s)-ls:], ()):
+          if exact:
+            matched = s == pat
+          elif len(s) < min_len:
+            matched = False
+          elif pat.count('*') == 1:
+            matched = True
+          else:
+            matched = bool(_compile(pat).match(s))
+          if matched:
+            out.append(value)
+    return out
+
+
+def _compile(pat):
+  """Returns the compiled regexp for a pattern, memoized."""
+  regexp = _cache.get(pat)
+  if regexp is None:
+    if len(_cache) >= _CACHE_MAX_SIZE:
+      _cache.clear()
+    regexp = re.compile(_translate(pat))
+    _cache[pat] = regexp
+  return regexp
 
 
 def _translate(pat):
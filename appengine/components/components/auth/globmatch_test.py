@@ -37,6 +37,30 @@ class GlobMatchTest(unittest.TestCase):
     self.assertTrue(globmatch.match('p-abc', 'p-*'))
     self.assertFalse(globmatch.match('not-p-abc', 'p-*'))
 
+  def test_glob_index(self):
+    pats = [
+      '',
+      '*',
+      'abc',
+      'a*',
+      '*c',
+      'a*c',
+      'ab*bc',
+      '*@domain.com',
+      'p-*@domain.com',
+      'p-*@*',
+      'a*b*c',
+      'ab**',
+    ]
+    idx = globmatch.GlobIndex((p, p) for p in pats)
+    for s in ('', 'a', 'ab', 'ac', 'abc', 'abbc', 'abc@domain.com',
+              'p-@domain.com', 'p-abc@domain.com', 'p-abc@other.com', 'zzz'):
+      self.assertEqual(
+          sorted(p for p in pats if globmatch.match(s, p)),
+          sorted(idx.match(s)), s)
+    with self.assertRaises(ValueError):
+      idx.match('a\nb')
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
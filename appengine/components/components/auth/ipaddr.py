@@ -4,6 +4,7 @@
 
 """Utilities for working with IPv4 and IPv6 addresses."""
 
+import bisect
 import collections
 
 
@@ -16,6 +17,7 @@ __all__ = [
   'normalize_ip',
   'normalize_subnet',
   'Subnet',
+  'SubnetIndex',
   'subnet_from_string',
   'subnet_to_string',
 ]
@@ -166,3 +168,45 @@ def normalize_subnet(subnet_str):
 def is_in_subnet(ip, subnet):
   """True if given IP instance belongs to Subnet."""
   return ip.bits == subnet.bits and (ip.value & subnet.mask) == subnet.base
+
+
+class SubnetIndex(object):
+  """A set of subnets supporting O(log n) membership checks.
+
+  Each subnet is converted to the range of IPs it covers. Overlapping and
+  adjacent ranges are merged, so that an IP belongs to the set if the closest
+  range starting at or before it also ends at or after it.
+  """
+
+  def __init__(self, subnets):
+    """Builds the index.
+
+    Args:
+      subnets: iterable of Subnet instances.
+    """
+    ranges = collections.defaultdict(list)
+    for subnet in subnets:
+      full = (1 << subnet.bits) - 1
+      ranges[subnet.bits].append(
+          (subnet.base, subnet.base | (full & ~subnet.mask)))
+    # bits => ([first IP of each range], [last IP of each range]).
+    self._ranges = {}
+    for bits, items in ranges.items():
+      starts = []
+      ends = []
+      for start, end in sorted(items):
+        if ends and start <= ends[-1] + 1:
+          ends[-1] = max(ends[-1], end)
+        else:
+          starts.append(start)
+          ends.append(end)
+      self._ranges[bits] = (starts, ends)
+
+  def __contains__(self, ip):
+    """True if the given IP instance belongs to one of the subnets."""
+    ranges = self._ranges.get(ip.bits)
+    if not ranges:
+      return False
+    starts, ends = ranges
+    i = bisect.bisect_right(starts, ip.value) - 1
+    return i >= 0 and ip.value <= ends[i]
@@ -0,0 +1,91 @@
+#!/usr/bin/env vpython
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Micro-benchmark of IP whitelist checks over a large number of subnets.
+
+Compares parsing and scanning every subnet on each check, as
+AuthDB.is_in_ip_whitelist() used to do, with a lookup in ipaddr.SubnetIndex.
+"""
+
+import argparse
+import random
+import sys
+import time
+
+from test_support import test_env
+test_env.setup_test_env()
+
+from components.auth import ipaddr
+
+
+def gen_subnets(count, rnd):
+  """Returns a list of IPv4 and IPv6 subnet strings."""
+  out = []
+  for _ in range(count):
+    if rnd.random() < 0.8:
+      ip = ipaddr.IP(32, rnd.getrandbits(32))
+      prefix = rnd.randint(16, 32)
+    else:
+      ip = ipaddr.IP(128, rnd.getrandbits(128))
+      prefix = rnd.randint(32, 128)
+    out.append('%s/%d' % (ipaddr.ip_to_string(ip), prefix))
+  return out
+
+
+def gen_ips(subnets, count, rnd):
+  """Returns a list of IPs, half of them in one of the subnets."""
+  out = []
+  for _ in range(count):
+    if rnd.random() < 0.5:
+      s = ipaddr.subnet_from_string(rnd.choice(subnets))
+      host = rnd.getrandbits(s.bits) & ((1 << s.bits) - 1) & ~s.mask
+      out.append(ipaddr.IP(s.bits, s.base | host))
+    else:
+      out.append(ipaddr.IP(32, rnd.getrandbits(32)))
+  return out
+
+
+def run(nb_subnets, nb_checks):
+  rnd = random.Random(0)
+  subnets = gen_subnets(nb_subnets, rnd)
+  ips = gen_ips(subnets, nb_checks, rnd)
+
+  start = time.time()
+  linear = sum(
+      1 for ip in ips
+      if any(
+          ipaddr.is_in_subnet(ip, ipaddr.subnet_from_string(net))
+          for net in subnets))
+  linear_duration = time.time() - start
+
+  start = time.time()
+  idx = ipaddr.SubnetIndex(ipaddr.subnet_from_string(net) for net in subnets)
+  build = time.time() - start
+  start = time.time()
+  indexed = sum(1 for ip in ips if ip in idx)
+  indexed_duration = time.time() - start
+  assert linear == indexed, (linear, indexed)
+
+  print('%d subnets, %d checks (%d hits):' % (nb_subnets, nb_checks, indexed))
+  print('  linear scan: %9.1fms, %8.1fus/check' % (
+      linear_duration * 1000., linear_duration * 1e6 / nb_checks))
+  print('  index build: %9.1fms' % (build * 1000.))
+  print('  index:       %9.1fms, %8.1fus/check' % (
+      indexed_duration * 1000., indexed_duration * 1e6 / nb_checks))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+  parser.add_argument(
+      '--subnets', type=int, default=5000, help='Number of subnets')
+  parser.add_argument(
+      '--checks', type=int, default=200, help='Number of IPs checked')
+  args = parser.parse_args()
+  run(args.subnets, args.checks)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
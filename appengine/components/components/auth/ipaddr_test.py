@@ -201,6 +201,37 @@ class IpAddrTest(test_case.TestCase):
 
     self.assertFalse(call('0:0:0:0:0:0:0:0', '0.0.0.0/32'))
 
+  def test_subnet_index(self):
+    idx = ipaddr.SubnetIndex(
+        ipaddr.subnet_from_string(s) for s in [
+          '127.0.0.1',
+          '192.168.0.0/24',
+          '192.168.0.128/25',  # Contained in the previous one.
+          '192.168.1.0/24',    # Adjacent to the previous one.
+          '10.0.0.0/8',
+          '::1',
+          'ffff:fffe::/32',
+        ])
+    check = lambda ip: ipaddr.ip_from_string(ip) in idx
+    self.assertTrue(check('127.0.0.1'))
+    self.assertFalse(check('127.0.0.2'))
+    self.assertFalse(check('127.0.0.0'))
+    self.assertTrue(check('192.168.0.0'))
+    self.assertTrue(check('192.168.0.200'))
+    self.assertTrue(check('192.168.1.255'))
+    self.assertFalse(check('192.168.2.0'))
+    self.assertFalse(check('192.167.255.255'))
+    self.assertTrue(check('10.255.255.255'))
+    self.assertFalse(check('11.0.0.0'))
+    self.assertFalse(check('0.0.0.0'))
+    self.assertTrue(check('::1'))
+    self.assertFalse(check('::2'))
+    self.assertTrue(check('ffff:fffe:1::1'))
+    self.assertFalse(check('ffff:ffff::'))
+    # An IPv4 address is never in an IPv6 subnet and vice versa.
+    self.assertFalse(check('0.0.0.1'))
+    self.assertFalse(ipaddr.ip_from_string('::1') in ipaddr.SubnetIndex([]))
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
@@ -291,6 +291,12 @@ class _ProcessResult(object):
   quarantined_msg = None
   # Bot maintenance message (or None if the bot is not under maintenance).
   maintenance_msg = None
+  # BotInfo of the bot as fetched at the start of the request, or None. It is
+  # passed to bot_management.bot_event() so it is not fetched again.
+  bot_info = None
+  # task_queues.BotDimensions of the bot as fetched at the start of the request,
+  # or None.
+  bot_dimensions_obj = None
 
   def __init__(self, **kwargs):
     for k, v in kwargs.items():
@@ -369,15 +375,23 @@ class _BotBaseHandler(_BotApiHandler):
           isinstance(dimension_id[0], unicode)):
         bot_id = dimensions['id'][0]
 
+    # Fetch all the entities of the bot needed by the handlers in a single
+    # batch, while the bot config is fetched.
+    futures = []
     if bot_id:
-      logging.debug('Fetching bot settings for bot id: %s', bot_id)
-      bot_settings = bot_management.get_settings_key(bot_id).get()
+      logging.debug('Fetching bot state for bot id: %s', bot_id)
+      futures = bot_management.get_bot_state_async(bot_id)
 
     # Make sure bot self-reported ID matches the authentication token. Raises
     # auth.AuthorizationError if not.
     bot_group_cfg = bot_auth.validate_bot_id_and_fetch_config(bot_id)
     logging.debug('Feched bot_group_cfg for %s: %s', bot_id, bot_group_cfg)
 
+    bot_settings = bot_info = bot_dimensions_obj = None
+    if futures:
+      bot_settings, bot_info, bot_dimensions_obj = [
+          f.get_result() for f in futures]
+
     # The server side dimensions from bot_group_cfg override bot-provided ones.
     # If both server side config and bot report some dimension, server side
     # config wins. We still emit an warning if bot tries to supply the dimension
@@ -404,7 +418,9 @@ class _BotBaseHandler(_BotApiHandler):
         state=state,
         dimensions=dimensions,
         bot_group_cfg=bot_group_cfg,
-        maintenance_msg=state.get('maintenance'))
+        maintenance_msg=state.get('maintenance'),
+        bot_info=bot_info,
+        bot_dimensions_obj=bot_dimensions_obj)
 
     # The bot may decide to "self-quarantine" itself. Accept both via
     # dimensions or via state. See bot_management._BotCommon.quarantined for
@@ -489,7 +505,8 @@ class BotHandshakeHandler(_BotBaseHandler):
         task_id=None,
         task_name=None,
         message=res.quarantined_msg,
-        register_dimensions=False)
+        register_dimensions=False,
+        bot_info=res.bot_info)
 
     bot_ver, _, bot_config_rev = bot_code.get_bot_version(self.request.host_url)
     data = {
@@ -565,7 +582,8 @@ class BotPollHandler(_BotBaseHandler):
             task_id=task_id,
             task_name=task_name,
             message=res.quarantined_msg,
-            register_dimensions=True)
+            register_dimensions=True,
+            bot_info=res.bot_info)
       except runtime.DeadlineExceededError as e:
         # Ignore runtime.DeadlineExceededError at the following events
         # and return 429 for the bot to retry later
@@ -628,19 +646,20 @@ class BotPollHandler(_BotBaseHandler):
       self._cmd_sleep(sleep_streak, True)
       return
 
-    bot_info = bot_management.get_info_key(res.bot_id).get()
     # TODO(crbug.com/1077188):
     #   avoid assigning to bots with another task assigned.
-    if bot_info and bot_info.task_id:
+    if res.bot_info and res.bot_info.task_id:
       logging.error('Task %s is already assigned to the bot %s',
-                    bot_info.task_id, res.bot_id)
+                    res.bot_info.task_id, res.bot_id)
 
     # The bot is in good shape.
 
     try:
       # Prepare BotTaskDimensions
       bot_root_key = bot_management.get_root_key(res.bot_id)
-      task_queues.assert_bot_async(bot_root_key, res.dimensions).get_result()
+      task_queues.assert_bot_async(
+          bot_root_key, res.dimensions,
+          bot_dimensions_obj=res.bot_dimensions_obj).get_result()
     except runtime.DeadlineExceededError as e:
       # TODO(crbug.com/1027431): assert_bot_async().get_result()
       # takes longer than 60 sec which ends up with "DeadlineExceededError".
@@ -0,0 +1,93 @@
+#!/usr/bin/env vpython
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Counts the RPCs done by /bot/poll on the dev_appserver API stubs.
+
+Every bot of the fleet polls continuously, so the RPCs done per poll dominate
+the load of the server. A poll of an idle bot, which is told to sleep, is
+measured. Run it on two revisions to compare them.
+"""
+
+import argparse
+import collections
+import logging
+import os
+import sys
+import time
+import unittest
+
+# Setups environment.
+import test_env_handlers
+
+from google.appengine.api import apiproxy_stub_map
+
+import webapp2
+import webtest
+
+import handlers_bot
+from components import utils
+
+
+class PollBenchmark(test_env_handlers.AppTestBase):
+  """Runs the polls on the stubs set up by AppTestBase."""
+
+  # Set by main().
+  args = None
+
+  def setUp(self):
+    super(PollBenchmark, self).setUp()
+    self.app = webtest.TestApp(
+        webapp2.WSGIApplication(handlers_bot.get_routes(), debug=True),
+        extra_environ={
+            'REMOTE_ADDR': self.source_ip,
+            'SERVER_SOFTWARE': os.environ['SERVER_SOFTWARE'],
+        })
+    self.set_as_bot()
+    self.mock(utils, 'enqueue_task', lambda *_args, **_kwargs: True)
+    self.mock_default_pool_acl([])
+
+  def runTest(self):
+    bots = [
+        self.do_handshake('bot%d' % i, do_first_poll=True)
+        for i in range(self.args.bots)
+    ]
+    rpcs = collections.Counter()
+
+    def count(service, call, _request, _response):
+      rpcs['%s.%s' % (service, call)] += 1
+
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('count', count)
+    start = time.time()
+    for _ in range(self.args.polls):
+      for params in bots:
+        params['state']['sleep_streak'] += 1
+        response = self.post_json('/swarming/api/v1/bot/poll', params)
+        self.assertEqual(u'sleep', response[u'cmd'])
+    duration = time.time() - start
+
+    nb_polls = self.args.polls * len(bots)
+    print('%d polls of %d bots in %.2fs, %.1fms per poll' % (
+        nb_polls, len(bots), duration, duration * 1000. / nb_polls))
+    print('RPCs per poll: %.2f' % (sum(rpcs.values()) / float(nb_polls)))
+    for name, value in sorted(rpcs.items()):
+      print('  %-28s %6.2f' % (name, value / float(nb_polls)))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+  parser.add_argument(
+      '--bots', type=int, default=10, help='Number of bots polling')
+  parser.add_argument(
+      '--polls', type=int, default=10, help='Number of polls per bot')
+  parser.add_argument('-v', '--verbose', action='store_true')
+  PollBenchmark.args = parser.parse_args()
+  logging.basicConfig(
+      level=logging.DEBUG if PollBenchmark.args.verbose else logging.ERROR)
+  result = unittest.TextTestRunner(verbosity=0).run(PollBenchmark())
+  return 0 if result.wasSuccessful() else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
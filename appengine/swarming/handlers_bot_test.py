@@ -468,6 +468,23 @@ class BotApiTest(test_env_handlers.AppTestBase):
     }
     self.assertEqual(expected, response)
 
+  def test_poll_sleep_fetches_bot_state_once(self):
+    params = self.do_handshake(do_first_poll=True)
+    fetched = []
+    get_async = ndb.Key.get_async
+
+    def mocked_get_async(key, **kwargs):
+      fetched.append(key.kind())
+      return get_async(key, **kwargs)
+
+    self.mock(ndb.Key, 'get_async', mocked_get_async)
+    response = self.post_json('/swarming/api/v1/bot/poll', params)
+    self.assertEqual(u'sleep', response[u'cmd'])
+    # The entities of the bot are fetched in a single batch at the start of the
+    # request, then shared.
+    for kind in ('BotSettings', 'BotInfo', 'BotDimensions'):
+      self.assertEqual(1, fetched.count(kind), (kind, fetched))
+
   def test_poll_update(self):
     params = self.do_handshake()
     old_version = params['version']
@@ -5,6 +5,7 @@
 """Functions to fetch and interpret bots.cfg file with list of bot groups."""
 
 import ast
+import bisect
 import collections
 import hashlib
 import logging
@@ -125,9 +126,13 @@ def get_bot_group_config(bot_id):
   if gr is not None:
     return gr
 
-  for prefix, gr in cfg.prefix_matches:
-    if bot_id.startswith(prefix):
-      return gr
+  gr = cfg.range_matches.get(bot_id)
+  if gr is not None:
+    return gr
+
+  gr = cfg.prefix_trie.get(bot_id)
+  if gr is not None:
+    return gr
 
   return cfg.default_group
 
@@ -465,11 +470,222 @@ _BotGroups = collections.namedtuple(
         'digest',  # a digest of corresponding ExpandedBotsCfg
         'rev',  # a revision of root bots.cfg config file
         'direct_matches',  # dict bot_id => BotGroupConfig
+        'range_matches',  # _BotIdRanges bot_id range => BotGroupConfig
         'prefix_matches',  # list of pairs (bot_id_prefix, BotGroupConfig)
+        'prefix_trie',  # _PrefixTrie bot_id_prefix => BotGroupConfig
         'default_group',  # fallback BotGroupConfig or None if not defined
     ])
 
 
+class _PrefixTrie(object):
+  """Compressed trie mapping bot_id prefixes to values.
+
+  The lookup of the longest prefix of a bot_id is done in O(len(bot_id)),
+  independently of the number of prefixes.
+  """
+
+  def __init__(self, items=()):
+    # A node is a list [value or None, {first char of an edge: (edge, node)}].
+    self._root = [None, {}]
+    for prefix, value in items:
+      self.add(prefix, value)
+
+  def add(self, prefix, value):
+    """Adds a prefix. The value of a prefix already added is kept."""
+    node = self._root
+    i = 0
+    while i < len(prefix):
+      edge = node[1].get(prefix[i])
+      if not edge:
+        node[1][prefix[i]] = (prefix[i:], [value, {}])
+        return
+      label, child = edge
+      # Length of the part common to the edge and the rest of the prefix.
+      n = 1
+      while (n < len(label) and i + n < len(prefix) and
+             label[n] == prefix[i + n]):
+        n += 1
+      if n < len(label):
+        # Split the edge.
+        child = [None, {label[n]: (label[n:], child)}]
+        node[1][prefix[i]] = (label[:n], child)
+      node = child
+      i += n
+    if node[0] is None:
+      node[0] = value
+
+  def get(self, key):
+    """Returns the value of the longest prefix of key or None."""
+    found = None
+    node = self._root
+    i = 0
+    while True:
+      if node[0] is not None:
+        found = node[0]
+      if i == len(key):
+        return found
+      edge = node[1].get(key[i])
+      if not edge or not key.startswith(edge[0], i):
+        return found
+      node = edge[1]
+      i += len(edge[0])
+
+
+# A bot_id range expression, e.g. "vm{1..20000}-m1", kept unexpanded. It matches
+# the bot ids prefix + str(i) + suffix for start <= i <= end.
+_BotIdRange = collections.namedtuple(
+    '_BotIdRange', ['prefix', 'start', 'end', 'suffix'])
+
+
+_DIGITS = frozenset('0123456789')
+
+
+class _BotIdRanges(object):
+  """Maps the bot ids of _BotIdRange to values without expanding them.
+
+  The ranges are kept as intervals per (prefix, suffix), a bot id is matched
+  with arithmetic.
+  """
+
+  def __init__(self):
+    # (prefix, suffix) => list of (start, end, value) sorted by start, the
+    # intervals don't overlap.
+    self._intervals = {}
+    self._prefixes = set()
+
+  def add(self, r, value):
+    """Adds a range. The values of the bot ids already added are kept."""
+    if r.start > r.end:
+      return
+    key = (r.prefix, r.suffix)
+    intervals = self._intervals.setdefault(key, [])
+    self._prefixes.add(r.prefix)
+    # Only add the parts of the range not yet covered.
+    start = r.start
+    for s, e, _ in intervals:
+      if e < start:
+        continue
+      if s > r.end:
+        break
+      if s > start:
+        bisect.insort(intervals, (start, s - 1, value))
+      start = e + 1
+    if start <= r.end:
+      bisect.insort(intervals, (start, r.end, value))
+
+  def get(self, bot_id):
+    """Returns the value of the range containing bot_id or None."""
+    if not self._prefixes:
+      return None
+    # The number is within a run of digits of the bot id. The prefix or the
+    # suffix of the range may also end or start with digits.
+    n = len(bot_id)
+    i = 0
+    while i < n:
+      if bot_id[i] not in _DIGITS:
+        i += 1
+        continue
+      j = i + 1
+      while j < n and bot_id[j] in _DIGITS:
+        j += 1
+      for p in range(i, j):
+        prefix = bot_id[:p]
+        if prefix not in self._prefixes:
+          continue
+        for q in range(p + 1, j + 1):
+          intervals = self._intervals.get((prefix, bot_id[q:]))
+          # Numbers are formatted without leading zeros.
+          if not intervals or (q - p > 1 and bot_id[p] == '0'):
+            continue
+          number = int(bot_id[p:q])
+          # The value is never compared since the end is never float('inf').
+          k = bisect.bisect_right(intervals, (number, float('inf'))) - 1
+          if k >= 0 and intervals[k][1] >= number:
+            return intervals[k][2]
+      i = j
+    return None
+
+  def find(self, r):
+    """Returns (bot_id, value) of a bot id of r already added or None."""
+    if r.start > r.end:
+      return None
+    for (prefix, suffix), intervals in sorted(self._intervals.items()):
+      if (prefix, suffix) == (r.prefix, r.suffix):
+        # Intervals of the same prefix and suffix.
+        for s, e, value in intervals:
+          if s <= r.end and e >= r.start:
+            return _format_range_bot_id(r, max(s, r.start)), value
+        continue
+      if (not _can_overlap(prefix, r.prefix) or
+          not _can_overlap(suffix[::-1], r.suffix[::-1])):
+        continue
+      # e.g. "vm{1..20}" and "vm1{0..9}", compare the bot ids.
+      for s, e, value in intervals:
+        bot_id = _find_range_bot_id(r, _BotIdRange(prefix, s, e, suffix))
+        if bot_id is not None:
+          return bot_id, value
+    return None
+
+
+def _can_overlap(a, b):
+  """Returns True if the bot ids of ranges starting with a and b can be equal.
+
+  They can only if one is the other followed by digits.
+  """
+  if len(a) < len(b):
+    a, b = b, a
+  return a.startswith(b) and all(c in _DIGITS for c in a[len(b):])
+
+
+def _format_range_bot_id(r, i):
+  return r.prefix + str(i) + r.suffix
+
+
+def _iter_range_bot_ids(r):
+  """Yields the bot ids of a _BotIdRange."""
+  for i in range(r.start, r.end + 1):
+    yield _format_range_bot_id(r, i)
+
+
+def _is_in_range(r, bot_id):
+  """Returns True if bot_id is a bot id of the _BotIdRange r."""
+  if (len(bot_id) <= len(r.prefix) + len(r.suffix) or
+      not bot_id.startswith(r.prefix) or not bot_id.endswith(r.suffix)):
+    return False
+  number = bot_id[len(r.prefix):len(bot_id) - len(r.suffix)]
+  if (any(c not in _DIGITS for c in number) or
+      (len(number) > 1 and number[0] == '0')):
+    return False
+  return r.start <= int(number) <= r.end
+
+
+def _find_range_bot_id(r, bot_ids):
+  """Returns the first bot id of the _BotIdRange r in bot_ids or None.
+
+  Arguments:
+    r: _BotIdRange.
+    bot_ids: dict or set of bot ids, or another _BotIdRange.
+  """
+  if isinstance(bot_ids, _BotIdRange):
+    size = bot_ids.end - bot_ids.start + 1
+    contains = lambda bot_id: _is_in_range(bot_ids, bot_id)
+  else:
+    size = len(bot_ids)
+    contains = bot_ids.__contains__
+  # Enumerate the smallest of both.
+  if r.end - r.start + 1 <= size:
+    for bot_id in _iter_range_bot_ids(r):
+      if contains(bot_id):
+        return bot_id
+    return None
+  if isinstance(bot_ids, _BotIdRange):
+    bot_ids = _iter_range_bot_ids(bot_ids)
+  found = [i for i in bot_ids if _is_in_range(r, i)]
+  if not found:
+    return None
+  return min(found, key=lambda i: int(i[len(r.prefix):len(i)-len(r.suffix)]))
+
+
 class _BotGroupsCache(object):
   """State of _BotGroups in-process cache, see _fetch_bot_groups()."""
 
@@ -510,7 +726,9 @@ def _default_bot_groups():
       digest='none',
       rev='none',
       direct_matches={},
+      range_matches=_BotIdRanges(),
       prefix_matches=[],
+      prefix_trie=_PrefixTrie(),
       default_group=BotGroupConfig(
           version='default',
           owners=(),
@@ -600,6 +818,22 @@ def _expand_bot_id_expr(expr):
 
   Yields original string if it doesn't have '{...}' section.
 
+  Raises ValueError if expression has invalid format.
+  """
+  parsed = _parse_bot_id_expr(expr)
+  if isinstance(parsed, _BotIdRange):
+    parsed = _iter_range_bot_ids(parsed)
+  for bot_id in parsed:
+    yield bot_id
+
+
+def _parse_bot_id_expr(expr):
+  """Parses string with bash-like sets, see _expand_bot_id_expr().
+
+  Returns:
+    _BotIdRange for a range of non negative numbers, e.g. "vm{1..3}-m1", to not
+    expand it, otherwise the list of bot ids.
+
   Raises ValueError if expression has invalid format.
   """
   if not expr:
@@ -609,8 +843,7 @@ def _expand_bot_id_expr(expr):
   right = expr.rfind('}')
 
   if left == -1 and right == -1:
-    yield expr
-    return
+    return [expr]
 
   if expr.count('{') > 1 or expr.count('}') > 1 or left > right:
     raise ValueError('bad bot_id set expression')
@@ -623,9 +856,7 @@ def _expand_bot_id_expr(expr):
     if '..' in body:
       raise ValueError(
           '".." is appearing alongside "," in "%s", probably a mistake' % body)
-    for itm in body.split(','):
-      yield prefix + itm + suffix
-    return
+    return [prefix + itm + suffix for itm in body.split(',')]
 
   # A range then ('<start>..<end>').
   start, sep, end = body.partition('..')
@@ -639,8 +870,10 @@ def _expand_bot_id_expr(expr):
     end = int(end)
   except ValueError:
     raise ValueError('Not a valid range end "%s"' % end)
-  for i in range(start, end + 1):
-    yield prefix + str(i) + suffix
+  r = _BotIdRange(prefix, start, end, suffix)
+  if start < 0:
+    return list(_iter_range_bot_ids(r))
+  return r
 
 
 def _fetch_bot_groups():
@@ -736,20 +969,43 @@ def _do_fetch_bot_groups(known_cfg=None):
   cfg = expanded_cfg.bots
 
   direct_matches = {}
+  range_matches = _BotIdRanges()
   prefix_matches = []
   default_group = None
 
   known_prefixes = set()
 
+  def get_bot_id(bot_id):
+    gr = direct_matches.get(bot_id)
+    return gr if gr is not None else range_matches.get(bot_id)
+
   for entry in cfg.bot_group:
     group_cfg = _bot_group_proto_to_tuple(entry, cfg.trusted_dimensions or [])
 
     for bot_id_expr in entry.bot_id:
       try:
-        for bot_id in _expand_bot_id_expr(bot_id_expr):
+        parsed = _parse_bot_id_expr(bot_id_expr)
+        if isinstance(parsed, _BotIdRange):
+          # Ranges are not expanded, the bot ids already specified explicitly
+          # have precedence in get_bot_group_config().
+          found = range_matches.find(parsed)
+          dup = (
+              found[0] if found else
+              _find_range_bot_id(parsed, direct_matches))
+          if dup is not None:
+            logging.error(
+                'Bot "%s" is specified in two different bot groups', dup)
+          dup = _find_range_bot_id(parsed, known_prefixes)
+          if dup is not None:
+            logging.warning(
+                'bot_id "%s" is equal to existing bot_id_prefix of other group',
+                dup)
+          range_matches.add(parsed, group_cfg)
+          continue
+        for bot_id in parsed:
           # This should not happen in validated config. If it does, log the
           # error, but carry on, since dying here will bring service offline.
-          if bot_id in direct_matches:
+          if get_bot_id(bot_id) is not None:
             logging.error(
                 'Bot "%s" is specified in two different bot groups', bot_id)
             continue
@@ -767,13 +1023,13 @@ def _do_fetch_bot_groups(known_cfg=None):
       if not bot_id_prefix:
         logging.error('Skipping empty bot_id_prefix')
         continue
-      if bot_id_prefix in direct_matches:
+      gr = get_bot_id(bot_id_prefix)
+      if gr is not None:
         # TODO(tandrii): change to error and skip this prefix
         # https://crbug.com/781087.
         logging.warning(
             'bot_id_prefix "%s" is equal to existing bot of %s', bot_id_prefix,
-            'the same group '
-            if group_cfg == direct_matches[bot_id_prefix] else 'another group')
+            'the same group ' if group_cfg == gr else 'another group')
       prefix_matches.append((bot_id_prefix, group_cfg))
       known_prefixes.add(bot_id_prefix)
 
@@ -785,7 +1041,8 @@ def _do_fetch_bot_groups(known_cfg=None):
         default_group = group_cfg
 
   return _BotGroups(expanded_cfg.digest, expanded_cfg.rev, direct_matches,
-                    prefix_matches, default_group)
+                    range_matches, prefix_matches, _PrefixTrie(prefix_matches),
+                    default_group)
 
 
 ### Config validation.
@@ -799,15 +1056,40 @@ def _validate_email(ctx, email, designation):
 
 
 def _validate_group_bot_ids(
-    ctx, group_bot_ids, group_idx, known_bot_ids, known_bot_id_prefixes):
-  """Validates bot_id sections of a group and updates known_bot_ids."""
+    ctx, group_bot_ids, group_idx, known_bot_ids, known_bot_id_ranges,
+    known_bot_id_prefixes):
+  """Validates bot_id sections of a group and updates known_bot_ids and
+  known_bot_id_ranges.
+  """
   for bot_id_expr in group_bot_ids:
     try:
-      for bot_id in _expand_bot_id_expr(bot_id_expr):
+      parsed = _parse_bot_id_expr(bot_id_expr)
+      if isinstance(parsed, _BotIdRange):
+        # Check the overlaps without expanding the range.
+        found = known_bot_id_ranges.find(parsed)
+        if found:
+          ctx.error('bot_id "%s" was already mentioned in group #%d', *found)
+        bot_id = _find_range_bot_id(parsed, known_bot_ids)
+        if bot_id is not None:
+          ctx.error('bot_id "%s" was already mentioned in group #%d', bot_id,
+                    known_bot_ids[bot_id])
+        bot_id = _find_range_bot_id(parsed, known_bot_id_prefixes)
+        if bot_id is not None:
+          ctx.error(
+              'bot_id "%s" was already mentioned as bot_id_prefix in group #%d',
+              bot_id, known_bot_id_prefixes[bot_id])
+        known_bot_id_ranges.add(parsed, group_idx)
+        continue
+      for bot_id in parsed:
         if bot_id in known_bot_ids:
           ctx.error('bot_id "%s" was already mentioned in group #%d', bot_id,
                     known_bot_ids[bot_id])
           continue
+        idx = known_bot_id_ranges.get(bot_id)
+        if idx is not None:
+          ctx.error('bot_id "%s" was already mentioned in group #%d', bot_id,
+                    idx)
+          continue
         if bot_id in known_bot_id_prefixes:
           ctx.error(
               'bot_id "%s" was already mentioned as bot_id_prefix in group #%d',
@@ -820,7 +1102,7 @@ def _validate_group_bot_ids(
 
 def _validate_group_bot_id_prefixes(
     ctx, group_bot_id_prefixes, group_idx, known_bot_id_prefixes,
-    known_bot_ids):
+    known_bot_ids, known_bot_id_ranges):
   """Validates bot_id_prefixes and updates known_bot_id_prefixes."""
   for bot_id_prefix in group_bot_id_prefixes:
     if not bot_id_prefix:
@@ -836,6 +1118,12 @@ def _validate_group_bot_id_prefixes(
           'bot_id_prefix "%s" is already specified as bot_id in group #%d',
           bot_id_prefix, known_bot_ids[bot_id_prefix])
       continue
+    idx = known_bot_id_ranges.get(bot_id_prefix)
+    if idx is not None:
+      ctx.error(
+          'bot_id_prefix "%s" is already specified as bot_id in group #%d',
+          bot_id_prefix, idx)
+      continue
 
     for p, idx in known_bot_id_prefixes.items():
       # Inefficient, but robust code wrt variable char length.
@@ -904,6 +1192,8 @@ def _validate_bots_cfg(cfg, ctx):
 
   # Explicitly mentioned bot_id => index of a group where it was mentioned.
   bot_ids = {}
+  # Same for the bot_id ranges, e.g. "vm{1..20000}-m1".
+  bot_id_ranges = _BotIdRanges()
   # bot_id_prefix => index of a group where it was defined.
   bot_id_prefixes = {}
   # Index of a group to use as default fallback (there can be only one).
@@ -912,12 +1202,13 @@ def _validate_bots_cfg(cfg, ctx):
   for i, entry in enumerate(cfg.bot_group):
     with ctx.prefix('bot_group #%d: ', i):
       # Validate bot_id field and make sure bot_id groups do not intersect.
-      _validate_group_bot_ids(ctx, entry.bot_id, i, bot_ids, bot_id_prefixes)
+      _validate_group_bot_ids(
+          ctx, entry.bot_id, i, bot_ids, bot_id_ranges, bot_id_prefixes)
 
       # Validate bot_id_prefix and make sure bot_id_prefix groups do not
       # intersect.
       _validate_group_bot_id_prefixes(
-          ctx, entry.bot_id_prefix, i, bot_id_prefixes, bot_ids)
+          ctx, entry.bot_id_prefix, i, bot_id_prefixes, bot_ids, bot_id_ranges)
 
       # A group without bot_id and bot_id_prefix is applied to bots that don't
       # fit any other groups. There should be at most one such group.
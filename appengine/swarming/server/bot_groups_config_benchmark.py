@@ -0,0 +1,164 @@
+#!/usr/bin/env vpython
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Benchmarks the lookup of the bot group of a bot on a synthetic bots.cfg.
+
+The bot ids matched by bot_id_prefix are looked up with the prefix trie and
+with a linear scan over the prefixes, for an increasing number of prefixes.
+
+Then a bots.cfg with bot_id ranges, e.g. "vm{1..20000}-m1", is loaded with the
+ranges kept unexpanded and with the ranges expanded in a dict.
+"""
+
+import argparse
+import random
+import sys
+import time
+
+import test_env
+test_env.setup_test_env()
+
+from proto.config import bots_pb2
+from server import bot_groups_config
+
+
+def gen_bots_cfg(nb_groups, nb_prefixes, nb_ids, ranged):
+  """Returns a bots_pb2.BotsCfg with bot groups sharing the prefixes and ids.
+
+  The bot ids are listed explicitly or as ranges if ranged is True.
+  """
+  groups = []
+  nb = nb_ids // nb_groups
+  for g in range(nb_groups):
+    prefixes = range(g, nb_prefixes, nb_groups)
+    if ranged:
+      bot_id = 'vm%d-{0..%d}-m1' % (g, nb - 1)
+    else:
+      bot_id = 'vm%d-{%s}-m1' % (g, ','.join(str(i) for i in range(nb)))
+    groups.append(
+        bots_pb2.BotGroup(
+            bot_id=[bot_id],
+            bot_id_prefix=['build%d-' % p for p in prefixes],
+            auth=[bots_pb2.BotAuth(ip_whitelist='bots')],
+            dimensions=['pool:pool%d' % g]))
+  return bots_pb2.BotsCfg(bot_group=groups)
+
+
+def expand(bots_cfg):
+  """Returns the _BotGroups of bots_cfg."""
+  expanded = bot_groups_config.ExpandedBotsCfg(bots_cfg, 'rev', 'digest')
+  bot_groups_config._get_expanded_bots_cfg = (
+      lambda known_digest: (True, expanded))
+  return bot_groups_config._do_fetch_bot_groups()
+
+
+def expand_ranges(bots_cfg):
+  """Returns the bot ids of bots_cfg in a dict, as done before the ranges."""
+  out = {}
+  for entry in bots_cfg.bot_group:
+    group_cfg = bot_groups_config._bot_group_proto_to_tuple(entry, [])
+    for bot_id_expr in entry.bot_id:
+      for bot_id in bot_groups_config._expand_bot_id_expr(bot_id_expr):
+        out[bot_id] = group_cfg
+  return out
+
+
+def sizeof(obj, seen=None):
+  """Returns the bytes used by obj and the objects it refers to."""
+  if seen is None:
+    seen = set()
+  if id(obj) in seen:
+    return 0
+  seen.add(id(obj))
+  size = sys.getsizeof(obj)
+  if isinstance(obj, dict):
+    size += sum(sizeof(k, seen) + sizeof(v, seen) for k, v in obj.items())
+  elif isinstance(obj, (list, tuple, set, frozenset)):
+    size += sum(sizeof(i, seen) for i in obj)
+  elif hasattr(obj, '__dict__'):
+    size += sizeof(obj.__dict__, seen)
+  return size
+
+
+def linear_scan(cfg, bot_id):
+  """Looks up the bot group as done before the prefix trie."""
+  for prefix, gr in cfg.prefix_matches:
+    if bot_id.startswith(prefix):
+      return gr
+  return None
+
+
+def measure(lookup, bot_ids):
+  """Returns the microseconds per lookup."""
+  start = time.time()
+  for bot_id in bot_ids:
+    lookup(bot_id)
+  return (time.time() - start) * 1000000. / len(bot_ids)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+  parser.add_argument(
+      '--prefixes', type=lambda x: [int(i) for i in x.split(',')],
+      default=[10, 100, 1000, 5000],
+      help='Comma separated numbers of prefixes, default: %(default)s')
+  parser.add_argument(
+      '--ids', type=int, default=100000, help='Number of explicit bot ids')
+  parser.add_argument(
+      '--groups', type=int, default=50, help='Number of bot groups')
+  parser.add_argument(
+      '--lookups', type=int, default=10000, help='Number of lookups')
+  parser.add_argument(
+      '--range-ids', type=int, default=1000000,
+      help='Number of bot ids in the ranges')
+  args = parser.parse_args()
+
+  random.seed(0)
+  print('%8s %8s  %12s %12s %12s' % (
+      'prefixes', 'build', 'direct', 'trie', 'linear'))
+  for nb_prefixes in args.prefixes:
+    start = time.time()
+    cfg = expand(gen_bots_cfg(args.groups, nb_prefixes, args.ids, False))
+    build = time.time() - start
+    direct_ids = random.sample(sorted(cfg.direct_matches), args.lookups)
+    prefix_ids = [
+        'build%d-bot%d' % (random.randrange(nb_prefixes), i)
+        for i in range(args.lookups)
+    ]
+    assert all(cfg.prefix_trie.get(i) for i in prefix_ids)
+    assert all(cfg.direct_matches.get(i) for i in direct_ids)
+    print('%8d %7.2fs  %10.2fus %10.2fus %10.2fus' % (
+        nb_prefixes, build,
+        measure(cfg.direct_matches.get, direct_ids),
+        measure(cfg.prefix_trie.get, prefix_ids),
+        measure(lambda bot_id: linear_scan(cfg, bot_id), prefix_ids)))
+
+  bots_cfg = gen_bots_cfg(args.groups, 0, args.range_ids, True)
+  nb = args.range_ids // args.groups
+  range_ids = [
+      'vm%d-%d-m1' % (random.randrange(args.groups), random.randrange(nb))
+      for _ in range(args.lookups)
+  ]
+  print('')
+  print('%d bot ids in %d ranges' % (nb * args.groups, args.groups))
+  print('%-10s %8s %10s %10s' % ('', 'load', 'memory', 'lookup'))
+  start = time.time()
+  cfg = expand(bots_cfg)
+  load = time.time() - start
+  assert all(cfg.range_matches.get(i) for i in range_ids)
+  print('%-10s %7.2fs %8.1fMiB %8.2fus' % (
+      'ranges', load, sizeof(cfg.range_matches) / 1024. / 1024.,
+      measure(cfg.range_matches.get, range_ids)))
+  start = time.time()
+  expanded = expand_ranges(bots_cfg)
+  load = time.time() - start
+  print('%-10s %7.2fs %8.1fMiB %8.2fus' % (
+      'expanded', load, sizeof(expanded) / 1024. / 1024.,
+      measure(expanded.get, range_ids)))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
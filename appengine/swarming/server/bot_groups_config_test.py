@@ -174,16 +174,28 @@ class BotGroupsConfigTest(test_case.TestCase):
     check_fail('abc{1..}')
     check_fail('abc{..2}')
 
+  def test_parse_bot_id_expr(self):
+    def check(expected, expr):
+      self.assertEquals(expected, bot_groups_config._parse_bot_id_expr(expr))
+
+    check(['abc'], 'abc')
+    check(['abc1def', 'abc2def'], 'abc{1,2}def')
+    check(bot_groups_config._BotIdRange('abc', 1, 20000, 'def'),
+          'abc{1..20000}def')
+    # Ranges of negative numbers are expanded.
+    check(['abc-1', 'abc0'], 'abc{-1..0}')
+
   def test_fetch_bot_groups(self):
     self.mock_config(TEST_CONFIG)
     cfg = bot_groups_config._fetch_bot_groups()
 
     self.assertEquals({
         u'bot1': EXPECTED_GROUP_1,
-        u'bot2': EXPECTED_GROUP_1,
-        u'bot3': EXPECTED_GROUP_1,
         u'other_bot': EXPECTED_GROUP_2,
     }, cfg.direct_matches)
+    self.assertEquals(EXPECTED_GROUP_1, cfg.range_matches.get(u'bot2'))
+    self.assertEquals(EXPECTED_GROUP_1, cfg.range_matches.get(u'bot3'))
+    self.assertEquals(None, cfg.range_matches.get(u'bot4'))
     self.assertEquals([('bot', EXPECTED_GROUP_2)], cfg.prefix_matches)
     self.assertEquals(EXPECTED_GROUP_3, cfg.default_group)
 
@@ -193,6 +205,54 @@ class BotGroupsConfigTest(test_case.TestCase):
         EXPECTED_GROUP_1, bot_groups_config.get_bot_group_config('bot1'))
     self.assertEquals(EXPECTED_GROUP_3,
                       bot_groups_config.get_bot_group_config('?'))
+    self.assertEquals(
+        EXPECTED_GROUP_1, bot_groups_config.get_bot_group_config('bot3'))
+    self.assertEquals(
+        EXPECTED_GROUP_2, bot_groups_config.get_bot_group_config('bot4'))
+
+  def test_bot_id_ranges(self):
+    r = bot_groups_config._BotIdRange
+    ranges = bot_groups_config._BotIdRanges()
+    ranges.add(r('vm', 1, 20, '-m1'), 1)
+    ranges.add(r('vm', 10, 30, '-m1'), 2)
+    ranges.add(r('vm1', 0, 9, '0'), 3)
+    self.assertEqual(None, ranges.get('vm0-m1'))
+    self.assertEqual(1, ranges.get('vm1-m1'))
+    self.assertEqual(1, ranges.get('vm20-m1'))
+    self.assertEqual(2, ranges.get('vm21-m1'))
+    self.assertEqual(2, ranges.get('vm30-m1'))
+    self.assertEqual(None, ranges.get('vm31-m1'))
+    self.assertEqual(None, ranges.get('vm01-m1'))
+    self.assertEqual(None, ranges.get('vm1-m2'))
+    self.assertEqual(3, ranges.get('vm100'))
+    self.assertEqual(3, ranges.get('vm190'))
+    self.assertEqual(None, ranges.get('vm19'))
+
+    self.assertEqual(None, ranges.find(r('vm', 31, 40, '-m1')))
+    self.assertEqual(('vm20-m1', 1), ranges.find(r('vm', 20, 40, '-m1')))
+    self.assertEqual(('vm10-m1', 1), ranges.find(r('vm1', 0, 5, '-m1')))
+    self.assertEqual(('vm150', 3), ranges.find(r('vm15', 0, 9, '')))
+    self.assertEqual(None, ranges.find(r('vm-', 0, 50, '-m1')))
+
+  def test_prefix_trie(self):
+    trie = bot_groups_config._PrefixTrie([
+        ('bot', 1),
+        ('bo', 2),
+        ('bar', 3),
+        ('bottle-', 4),
+        ('bot', 5),
+    ])
+    self.assertEqual(None, trie.get(''))
+    self.assertEqual(None, trie.get('b'))
+    self.assertEqual(2, trie.get('bo'))
+    self.assertEqual(2, trie.get('boa'))
+    self.assertEqual(1, trie.get('bot'))
+    self.assertEqual(1, trie.get('bott'))
+    self.assertEqual(1, trie.get('bottle'))
+    self.assertEqual(4, trie.get('bottle-1'))
+    self.assertEqual(None, trie.get('ba'))
+    self.assertEqual(3, trie.get('bar1'))
+    self.assertEqual(None, trie.get('vm1'))
 
   def test_empty_config_is_valid(self):
     self.validator_test(bots_pb2.BotsCfg(), [])
@@ -227,6 +287,27 @@ class BotGroupsConfigTest(test_case.TestCase):
     self.validator_test(
         cfg, ['bot_group #1: bot_id "b5" was already mentioned in group #0'])
 
+  def test_bot_id_range_duplication(self):
+    cfg = bots_pb2.BotsCfg(bot_group=[
+        bots_pb2.BotGroup(
+            bot_id=['b{0..5}'], bot_id_prefix=['c5'], auth=DEFAULT_AUTH_CFG),
+        bots_pb2.BotGroup(bot_id=['b{5..9}', 'a3'], auth=DEFAULT_AUTH_CFG),
+        bots_pb2.BotGroup(
+            bot_id=['b{10..20}', 'a{0..9}', 'c{0..9}'],
+            bot_id_prefix=['b12'],
+            auth=DEFAULT_AUTH_CFG),
+        bots_pb2.BotGroup(bot_id=['b1{0..9}'], auth=DEFAULT_AUTH_CFG),
+    ])
+    self.validator_test(cfg, [
+        'bot_group #1: bot_id "b5" was already mentioned in group #0',
+        'bot_group #2: bot_id "a3" was already mentioned in group #1',
+        'bot_group #2: bot_id "c5" was already mentioned as bot_id_prefix in '
+        'group #0',
+        'bot_group #2: bot_id_prefix "b12" is already specified as bot_id in '
+        'group #2',
+        'bot_group #3: bot_id "b10" was already mentioned in group #2',
+    ])
+
   def test_empty_prefix(self):
     cfg = bots_pb2.BotsCfg(bot_group=[
         bots_pb2.BotGroup(bot_id_prefix=[''], auth=DEFAULT_AUTH_CFG)
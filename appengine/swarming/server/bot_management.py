@@ -51,7 +51,8 @@
 - BotInfo is a 'dump-only' entity used for UI, it permits quickly show the
   state of every bots in an single query. It is basically a cache of the last
   BotEvent and additionally updated on poll. It doesn't need to be updated in a
-  transaction.
+  transaction. The heartbeats of idle bots are recorded in memcache and stored
+  in BotInfo at most every bot_death_timeout_secs / 2.
 - BotSettings contains bot-specific settings. It must be updated in a
   transaction and contains admin-provided settings, contrary to the other
   entities which are generated from data provided by the bot itself.
@@ -80,6 +81,12 @@ from server.constants import OR_DIM_SEP
 # BotEvent entities are deleted when they are older than the cutoff.
 _OLD_BOT_EVENTS_CUT_OFF = datetime.timedelta(days=4 * 7)
 
+# Memcache namespace of the heartbeats of idle bots not yet stored in BotInfo.
+_HEARTBEAT_NAMESPACE = 'bot_heartbeats'
+
+# BotInfo properties updated by a heartbeat.
+_HEARTBEAT_FIELDS = ('last_seen_ts', 'external_ip', 'authenticated_as', 'state')
+
 
 ### Models.
 
@@ -314,6 +321,9 @@ class BotInfo(_BotCommon):
     more = True
     while more:
       bots, cursor, more = q.fetch_page(1000, start_cursor=cursor)
+      bots = [b for b in bots if b.should_be_dead]
+      # The heartbeats in memcache are more recent than the stored BotInfo.
+      _apply_heartbeats(bots)
       for b in bots:
         if not b.should_be_dead:
           continue
@@ -496,6 +506,24 @@ def get_settings_key(bot_id):
   return ndb.Key(BotSettings, 'settings', parent=get_root_key(bot_id))
 
 
+def get_bot_state_async(bot_id):
+  """Fetches the entities describing a bot in a single batch.
+
+  A bot poll needs all of them. Fetching them at once saves serial Datastore
+  round trips.
+
+  Returns:
+    list of ndb.Future for the BotSettings, BotInfo and
+    task_queues.BotDimensions entities of the bot. The result of a future is
+    None if the entity doesn't exist.
+  """
+  return ndb.get_multi_async([
+      get_settings_key(bot_id),
+      get_info_key(bot_id),
+      task_queues.get_bot_dimensions_key(get_root_key(bot_id)),
+  ])
+
+
 def get_aggregation_key(group):
   """Returns the DimensionAggregation ndb.Key for a group."""
   return ndb.Key(DimensionAggregation, group)
@@ -548,7 +576,7 @@ def filter_availability(q, quarantined, in_maintenance, is_dead, is_busy):
 def bot_event(
     event_type, bot_id, external_ip, authenticated_as, dimensions, state,
     version, quarantined, maintenance_msg, task_id, task_name,
-    register_dimensions, **kwargs):
+    register_dimensions, bot_info=None, **kwargs):
   """Records when a bot has queried for work.
 
   This event happening usually means the bot is alive (not dead), except for
@@ -576,6 +604,8 @@ def bot_event(
   - task_name: task name if relevant. Zapped when task_id is zapped.
   - register_dimensions: bool to specify whether to register dimensions to
     BotInfo.
+  - bot_info: BotInfo of the bot if the caller already fetched it, e.g. with
+    get_bot_state_async(). It is updated and stored. It is fetched if None.
   - kwargs: optional values to add to BotEvent relevant to event_type.
 
   Returns:
@@ -586,8 +616,15 @@ def bot_event(
 
   # Retrieve the previous BotInfo and update it.
   info_key = get_info_key(bot_id)
-  bot_info = info_key.get()
   if not bot_info:
+    bot_info = info_key.get()
+  # The stored values, to tell whether this event is only a heartbeat.
+  stored = None
+  if bot_info:
+    stored = (
+        bot_info.last_seen_ts, bot_info.composite,
+        _get_non_heartbeat_values(bot_info))
+  else:
     bot_info = BotInfo(key=info_key)
     if dimensions:
       dimensions_flat = task_queues.bot_dimensions_to_flat(dimensions)
@@ -657,6 +694,11 @@ def bot_event(
   skip_save_event = (not dimensions_updated and not quarantined and
                      event_type in ('request_sleep', 'task_update'))
   if skip_save_event:
+    # An idle bot polls every minute, only record its heartbeat in memcache
+    # if it was stored recently enough.
+    if (event_type == 'request_sleep' and
+        _is_heartbeat_only(bot_info, stored) and _record_heartbeat(bot_info)):
+      return
     bot_info.put()
     return
 
@@ -683,6 +725,73 @@ def bot_event(
   return event.key
 
 
+def _heartbeat_max_delay():
+  """Returns the maximum delay to store the heartbeat of a bot in BotInfo."""
+  return datetime.timedelta(
+      seconds=config.settings().bot_death_timeout_secs / 2)
+
+
+def _get_non_heartbeat_values(bot_info):
+  """Returns the values of BotInfo that bot_event() updates beside the
+  heartbeat.
+  """
+  return (
+      list(bot_info.dimensions_flat), bot_info.maintenance_msg,
+      bot_info.quarantined, bot_info.task_id, bot_info.task_name,
+      bot_info.version)
+
+
+def _is_heartbeat_only(bot_info, stored):
+  """Returns True if the only change to bot_info since it was fetched is its
+  heartbeat and the stored BotInfo is recent enough.
+
+  Arguments:
+  - bot_info: BotInfo updated by bot_event().
+  - stored: tuple of the stored last_seen_ts, composite and
+        _get_non_heartbeat_values() or None if there was no BotInfo.
+  """
+  if not stored:
+    return False
+  last_seen_ts, composite, values = stored
+  # A change of composite, e.g. a dead bot coming back, must be stored for
+  # the queries.
+  if (values != _get_non_heartbeat_values(bot_info) or
+      composite != bot_info._calc_composite()):
+    return False
+  return bool(
+      last_seen_ts and
+      last_seen_ts > utils.utcnow() - _heartbeat_max_delay())
+
+
+def _record_heartbeat(bot_info):
+  """Records the heartbeat of a bot in memcache instead of storing BotInfo.
+
+  Returns:
+    True if the heartbeat was recorded.
+  """
+  heartbeat = {f: getattr(bot_info, f) for f in _HEARTBEAT_FIELDS}
+  # Keep it long enough for cron_update_bot_info() to see it.
+  seconds = config.settings().bot_death_timeout_secs * 2
+  return memcache.set(
+      bot_info.id, heartbeat, time=seconds, namespace=_HEARTBEAT_NAMESPACE)
+
+
+def _apply_heartbeats(bots):
+  """Updates BotInfo entities with the heartbeats recorded in memcache.
+
+  The entities are not stored.
+  """
+  if not bots:
+    return
+  heartbeats = memcache.get_multi(
+      [b.id for b in bots], namespace=_HEARTBEAT_NAMESPACE)
+  for b in bots:
+    heartbeat = heartbeats.get(b.id)
+    if heartbeat and heartbeat['last_seen_ts'] > b.last_seen_ts:
+      for f in _HEARTBEAT_FIELDS:
+        setattr(b, f, heartbeat[f])
+
+
 def has_capacity(dimensions):
   """Returns True if there's a reasonable chance for this task request
   dimensions set to be serviced by a bot alive.
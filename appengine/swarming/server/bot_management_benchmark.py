@@ -0,0 +1,132 @@
+#!/usr/bin/env vpython
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Simulates a fleet of idle bots and reports the BotInfo writes per pool.
+
+Each bot polls at the interval the server tells it to sleep, as
+task_scheduler.exponential_backoff() does. The simulation is run on the
+dev_appserver API stubs with and without the heartbeats recorded in memcache.
+"""
+
+import argparse
+import collections
+import datetime
+import heapq
+import logging
+import random
+import sys
+import unittest
+
+import test_env
+test_env.setup_test_env()
+
+from test_support import test_case
+
+from server import bot_management
+from server import task_scheduler
+
+
+def _bot_event(bot_id, pool, sleep_streak):
+  bot_management.bot_event(
+      event_type='request_sleep',
+      bot_id=bot_id,
+      external_ip='8.8.4.4',
+      authenticated_as='bot:%s.domain' % bot_id,
+      dimensions={
+          u'id': [bot_id],
+          u'os': [u'Ubuntu', u'Ubuntu-16.04'],
+          u'pool': [pool],
+      },
+      state={'sleep_streak': sleep_streak},
+      version=u'1',
+      quarantined=False,
+      maintenance_msg=None,
+      task_id=None,
+      task_name=None,
+      register_dimensions=True)
+
+
+class FleetBenchmark(test_case.TestCase):
+  APP_DIR = test_env.APP_DIR
+
+  # Set by main().
+  args = None
+
+  def setUp(self):
+    super(FleetBenchmark, self).setUp()
+    self.now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.writes = collections.Counter()
+    pre_put_hook = bot_management.BotInfo._pre_put_hook
+
+    def count(bot_info):
+      for pool in bot_management.get_pools_from_dimensions_flat(
+          bot_info.dimensions_flat):
+        self.writes[pool] += 1
+      pre_put_hook(bot_info)
+
+    self.mock(bot_management.BotInfo, '_pre_put_hook', count)
+
+  def simulate(self, name):
+    """Returns the polls and the BotInfo writes per pool."""
+    random.seed(self.args.seed)
+    self.mock_now(self.now)
+    # The polls, as (time, bot id, pool, sleep streak).
+    polls = []
+    for i, size in enumerate(self.args.pools):
+      pool = u'pool%d' % i
+      for j in range(size):
+        bot_id = u'%s-%s-%d' % (name, pool, j)
+        # The first poll registers the bot. It is not counted.
+        _bot_event(bot_id, pool, 0)
+        polls.append((random.uniform(0, 60), bot_id, pool, 1))
+    heapq.heapify(polls)
+
+    self.writes.clear()
+    nb_polls = collections.Counter()
+    duration = self.args.minutes * 60
+    while polls[0][0] < duration:
+      t, bot_id, pool, sleep_streak = heapq.heappop(polls)
+      self.mock_now(self.now, t)
+      _bot_event(bot_id, pool, sleep_streak)
+      nb_polls[pool] += 1
+      t += task_scheduler.exponential_backoff(sleep_streak)
+      heapq.heappush(polls, (t, bot_id, pool, sleep_streak + 1))
+    return nb_polls, self.writes.copy()
+
+  def runTest(self):
+    duration = float(self.args.minutes * 60)
+    nb_polls, write_behind = self.simulate('write-behind')
+    self.mock(bot_management, '_is_heartbeat_only', lambda *_args: False)
+    _, always = self.simulate('always')
+
+    print('%d minutes of idle bots' % self.args.minutes)
+    print('%-8s %6s %8s  %16s %16s' % (
+        'pool', 'bots', 'polls/s', 'writes/s before', 'writes/s after'))
+    for i, size in enumerate(self.args.pools):
+      pool = u'pool%d' % i
+      print('%-8s %6d %8.2f  %16.2f %16.2f' % (
+          pool, size, nb_polls[pool] / duration, always[pool] / duration,
+          write_behind[pool] / duration))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+  parser.add_argument(
+      '--pools', type=lambda x: [int(i) for i in x.split(',')],
+      default=[200, 50, 10],
+      help='Comma separated number of bots in each pool, default: %(default)s')
+  parser.add_argument(
+      '--minutes', type=int, default=30, help='Duration of the simulation')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('-v', '--verbose', action='store_true')
+  FleetBenchmark.args = parser.parse_args()
+  logging.basicConfig(
+      level=logging.DEBUG if FleetBenchmark.args.verbose else logging.ERROR)
+  result = unittest.TextTestRunner(verbosity=0).run(FleetBenchmark())
+  return 0 if result.wasSuccessful() else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
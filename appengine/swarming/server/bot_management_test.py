@@ -461,6 +461,63 @@ class BotManagementTest(test_case.TestCase):
         bot_management.BotRoot, 'foo', bot_management.BotSettings, 'settings')
     self.assertEqual(expected, bot_management.get_settings_key('foo'))
 
+  def test_get_bot_state_async(self):
+    futures = bot_management.get_bot_state_async(u'id1')
+    self.assertEqual([None, None, None], [f.get_result() for f in futures])
+
+    _bot_event(event_type='request_sleep')
+    futures = bot_management.get_bot_state_async(u'id1')
+    settings, info, bot_dimensions = [f.get_result() for f in futures]
+    self.assertIsNone(settings)
+    self.assertEqual(bot_management.get_info_key(u'id1'), info.key)
+    self.assertIsNone(bot_dimensions)
+
+  def test_bot_event_prefetched(self):
+    bot_info = _ensure_bot_info()
+    get = ndb.Key.get
+    self.mock(
+        ndb.Key, 'get', lambda *_args, **_kw: self.fail('Unexpected get()'))
+    _bot_event(
+        event_type='request_sleep', version=u'124', bot_info=bot_info)
+    self.assertEqual(u'124', get(bot_management.get_info_key(u'id1')).version)
+
+  def test_bot_event_heartbeat(self):
+    _ensure_bot_info()
+    then = self.mock_now(self.now, 60)
+    _bot_event(
+        event_type='request_sleep', external_ip=u'8.8.8.8', state={'ram': 66})
+    # Only the heartbeat changed, it is recorded in memcache.
+    bot_info = bot_management.get_info_key(u'id1').get()
+    self.assertEqual(_gen_bot_info(), bot_info.to_dict())
+    bot_management._apply_heartbeats([bot_info])
+    expected = _gen_bot_info(
+        external_ip=u'8.8.8.8', last_seen_ts=then, state={u'ram': 66})
+    self.assertEqual(expected, bot_info.to_dict())
+
+  def test_bot_event_heartbeat_stored(self):
+    timeout = config.settings().bot_death_timeout_secs
+    _ensure_bot_info()
+    # The BotInfo is stored at least every timeout / 2.
+    then = self.mock_now(self.now, timeout // 2)
+    _bot_event(event_type='request_sleep')
+    bot_info = bot_management.get_info_key(u'id1').get()
+    self.assertEqual(then, bot_info.last_seen_ts)
+
+    # Changes beside the heartbeat are stored.
+    then = self.mock_now(self.now, timeout // 2 + 1)
+    _bot_event(event_type='request_sleep', maintenance_msg=u'very busy')
+    bot_info = bot_management.get_info_key(u'id1').get()
+    self.assertEqual(then, bot_info.last_seen_ts)
+    self.assertEqual(u'very busy', bot_info.maintenance_msg)
+
+  def test_bot_event_heartbeat_memcache_failure(self):
+    _ensure_bot_info()
+    self.mock(memcache, 'set', lambda *_args, **_kwargs: False)
+    then = self.mock_now(self.now, 60)
+    _bot_event(event_type='request_sleep')
+    bot_info = bot_management.get_info_key(u'id1').get()
+    self.assertEqual(then, bot_info.last_seen_ts)
+
   def test_get_aggregation_key(self):
     expected = ndb.Key(bot_management.DimensionAggregation, 'foo')
     self.assertEqual(expected, bot_management.get_aggregation_key('foo'))
@@ -603,6 +660,26 @@ class BotManagementTest(test_case.TestCase):
     last_seen_ts.FromDatetime(bot1_dead['last_seen_ts'])
     self.assertEqual(bq_event.bot.info.last_seen_ts, last_seen_ts)
 
+  def test_cron_update_bot_info_heartbeat(self):
+    timeout = config.settings().bot_death_timeout_secs
+    _ensure_bot_info()
+    then = self.mock_now(self.now, timeout // 2 - 1)
+    _bot_event(event_type='request_sleep', state={'ram': 66})
+
+    # The stored BotInfo is stale but the heartbeat keeps the bot alive.
+    self.mock_now(self.now, timeout)
+    self.assertEqual(0, bot_management.cron_update_bot_info())
+    bot_info = bot_management.get_info_key(u'id1').get()
+    self.assertFalse(bot_info.is_dead)
+
+    self.mock_now(then, timeout)
+    self.assertEqual(1, bot_management.cron_update_bot_info())
+    bot_info = bot_management.get_info_key(u'id1').get()
+    self.assertTrue(bot_info.is_dead)
+    # The heartbeat was stored.
+    self.assertEqual(then, bot_info.last_seen_ts)
+    self.assertEqual({u'ram': 66}, bot_info.state)
+
   def test_cron_delete_old_bot_events(self):
     # Create an old BotEvent right at the cron job cut off, and another one one
     # second later (that will be kept).
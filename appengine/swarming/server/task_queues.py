@@ -47,6 +47,11 @@ Used to optimize scheduling.
     |  +-----------------+ |     |  +-----------------+ |
     |id=<dimension_hash>   |     |id=<dimension_hash>   |
     +----------------------+     +----------------------+
+
+    +-------Root-----------------+     +-------Root-----------------+
+    |TaskDimensionsCounter       | ... |TaskDimensionsCounter       |
+    |id=<dimension_hash>:<shard> | ... |id=<dimension_hash>:<shard> |
+    +----------------------------+     +----------------------------+
 """
 
 import datetime
@@ -95,6 +100,12 @@ _KEEP_DEAD = datetime.timedelta(days=1, minutes=10)
 _EXPIRATION_TIME_TASK_QUEUES = 60 * 5
 
 
+# Number of TaskDimensionsCounter shards of a task queue. Each shard sustains
+# a few updates per second, so it bounds the rate of tasks scheduled, reaped and
+# completed in a single task queue.
+_COUNTER_SHARDS = 16
+
+
 class Error(Exception):
   pass
 
@@ -146,6 +157,10 @@ class BotTaskDimensions(ndb.Model):
   # 'key:value' strings. This is stored to enable the removal of stale entities
   # when the bot changes its dimensions.
   dimensions_flat = ndb.StringProperty(repeated=True, indexed=False)
+  # Copy of the key id, to count the bots that can run a task queue with
+  # count_bots_async().
+  dimensions_hash = ndb.ComputedProperty(
+      lambda self: self.key.integer_id() if self.key else None)
 
   def is_valid(self, bot_dimensions):
     """Returns true if this entity is still valid for the bot dimensions."""
@@ -311,6 +326,57 @@ class TaskDimensions(ndb.Model):
           '%s.sets must all be unique' % self.__class__.__name__)
 
 
+class TaskDimensionsCounter(ndb.Model):
+  """Counts the pending and running tasks of a task queue.
+
+  Key id is '<dimensions_hash>:<shard>'. It is a root entity.
+
+  The counts are updated by set_task_counted_async() as the tasks change state,
+  so the task queues with tasks are known without scanning the tasks. Each
+  update is done on a random shard out of _COUNTER_SHARDS to spread the writes
+  of a busy task queue. A shard may have a negative count, only the sum over the
+  shards is meaningful.
+
+  A task is counted once for each of its task slices, whether the slice is the
+  active one or not.
+  """
+  # The pool the tasks of this task queue run in, the first one in sorted order
+  # if there are many. It is an empty string if the dimensions have no pool.
+  pool = ndb.StringProperty(indexed=False)
+  # Number of tasks in PENDING and RUNNING state.
+  pending = ndb.IntegerProperty(indexed=False, default=0)
+  running = ndb.IntegerProperty(indexed=False, default=0)
+  # Last update, to delete the unused shards in cron_tidy_stale().
+  ts = ndb.DateTimeProperty(indexed=False)
+
+  @property
+  def dimensions_hash(self):
+    return int(self.key.string_id().split(':', 1)[0])
+
+  def _pre_put_hook(self):
+    super(TaskDimensionsCounter, self)._pre_put_hook()
+    if not self.ts:
+      raise datastore_errors.BadValueError(
+          '%s.ts is required' % self.__class__.__name__)
+
+
+class TaskDimensionsCounted(ndb.Model):
+  """Records how a task is counted in the TaskDimensionsCounter of its task
+  queues.
+
+  Parent is TaskRequest. Key id is 1. It is deleted along the task.
+
+  It only exists while the task is counted. set_task_counted_async() compares it
+  to the state of the task, so updating the counts is idempotent and a lost
+  update is repaired by the next one.
+  """
+  # 'pending' or 'running'.
+  state = ndb.StringProperty(indexed=False)
+  # Last time it was compared to the state of the task, to find the tasks whose
+  # counts may be stale.
+  ts = ndb.DateTimeProperty()
+
+
 ### Private APIs.
 
 
@@ -636,6 +702,46 @@ def _tidy_stale_TaskDimensions(now):
   raise ndb.Return(td)
 
 
+@ndb.tasklet
+def _tidy_stale_TaskDimensionsCounter(now):
+  """Removes the TaskDimensionsCounter shards of the task queues not updated
+  for _KEEP_DEAD and not counting any task.
+  """
+  cutoff = now - _KEEP_DEAD
+  stale = {}
+  active = set()
+  qit = TaskDimensionsCounter.query().iter(batch_size=256)
+  while (yield qit.has_next_async()):
+    obj = qit.next()
+    if obj.ts >= cutoff:
+      active.add(obj.dimensions_hash)
+    else:
+      stale.setdefault(obj.dimensions_hash, []).append(obj.key)
+
+  @ndb.tasklet
+  def tx(keys):
+    objs = yield ndb.get_multi_async(keys)
+    objs = [o for o in objs if o]
+    if (any(o.ts >= cutoff for o in objs) or
+        sum(o.pending for o in objs) or sum(o.running for o in objs)):
+      raise ndb.Return(False)
+    yield ndb.delete_multi_async([o.key for o in objs])
+    raise ndb.Return(True)
+
+  tdc = []
+  for dimensions_hash, keys in sorted(stale.items()):
+    if dimensions_hash in active:
+      continue
+    # The shards are distinct entity groups, up to _COUNTER_SHARDS of them.
+    res = yield datastore_utils.transaction_async(
+        lambda: tx(keys), xg=True,
+        propagation=ndb.TransactionOptions.INDEPENDENT)
+    tdc.append(res)
+    if res:
+      logging.info('- TDC: %d', dimensions_hash)
+  raise ndb.Return(tdc)
+
+
 @ndb.tasklet
 def _tidy_stale_BotTaskDimensions(now):
   """Removes all stale BotTaskDimensions entities.
@@ -659,6 +765,66 @@ def _tidy_stale_BotTaskDimensions(now):
   raise ndb.Return(btd)
 
 
+@ndb.tasklet
+def _backfill_BotTaskDimensions():
+  """Stores again the BotTaskDimensions stored before dimensions_hash was added.
+
+  Until then count_bots_async() doesn't count them, which can take up to
+  _EXTEND_VALIDITY when the bots don't refresh them. It does nothing once all
+  the BotTaskDimensions are indexed.
+
+  Returns:
+    list of the BotTaskDimensions ndb.Key stored again.
+  """
+  total, indexed = yield (
+      BotTaskDimensions.query().count_async(),
+      BotTaskDimensions.query(
+          BotTaskDimensions.dimensions_hash >= 0).count_async())
+  if total == indexed:
+    raise ndb.Return([])
+
+  @ndb.tasklet
+  def tx(key):
+    obj = yield key.get_async()
+    if obj:
+      # dimensions_hash is computed when storing it.
+      yield obj.put_async()
+      raise ndb.Return(key)
+
+  @ndb.tasklet
+  def backfill(bot_root_key):
+    # Ancestor queries are strongly consistent.
+    keys, indexed_keys = yield (
+        BotTaskDimensions.query(ancestor=bot_root_key).fetch_async(
+            keys_only=True),
+        BotTaskDimensions.query(
+            BotTaskDimensions.dimensions_hash >= 0,
+            ancestor=bot_root_key).fetch_async(keys_only=True))
+    missing = sorted(set(keys).difference(indexed_keys))
+    res = []
+    for key in missing:
+      res.append((yield datastore_utils.transaction_async(
+          lambda: tx(key), propagation=ndb.TransactionOptions.INDEPENDENT)))
+    raise ndb.Return([k for k in res if k])
+
+  btd = []
+  futures = []
+  qit = BotDimensions.query().iter(batch_size=64, keys_only=True)
+  while (yield qit.has_next_async()):
+    futures.append(backfill(qit.next().parent()))
+    if len(futures) == 64:
+      for keys in (yield futures):
+        btd.extend(keys)
+      futures = []
+  if futures:
+    for keys in (yield futures):
+      btd.extend(keys)
+  for key in btd:
+    logging.debug(
+        '+ BTD: %d for bot %s', key.integer_id(), key.parent().string_id())
+  raise ndb.Return(btd)
+
+
 @ndb.tasklet
 def _assert_task_props_async(properties, expiration_ts):
   """Asserts a TaskDimensions for a specific TaskProperties.
@@ -963,8 +1129,13 @@ def hash_dimensions(dimensions):
   return _hash_data(data)
 
 
+def get_bot_dimensions_key(bot_root_key):
+  """Returns the BotDimensions ndb.Key for a bot."""
+  return ndb.Key(BotDimensions, 1, parent=bot_root_key)
+
+
 @ndb.tasklet
-def assert_bot_async(bot_root_key, bot_dimensions):
+def assert_bot_async(bot_root_key, bot_dimensions, bot_dimensions_obj=None):
   """Prepares BotTaskDimensions entities as needed.
 
   Coupled with assert_task_async(), enables get_queues() to work by by knowing
@@ -973,6 +1144,9 @@ def assert_bot_async(bot_root_key, bot_dimensions):
   Arguments:
     bot_root_key: ndb.Key to bot_management.BotRoot
     bot_dimensions: dictionary of the bot dimensions
+    bot_dimensions_obj: BotDimensions entity of the bot if it was already
+        fetched, e.g. by bot_management.get_bot_state_async(). It is fetched
+        if None.
 
   Returns:
     Number of matches or None if hit the cache, thus nothing was updated.
@@ -983,7 +1157,9 @@ def assert_bot_async(bot_root_key, bot_dimensions):
   # _rebuild_bot_cache_async isn't an atomic operation, and also it takes time
   # for secondary indices to be ready since they are *eventually* consistent.
   now = utils.utcnow()
-  obj = yield ndb.Key(BotDimensions, 1, parent=bot_root_key).get_async()
+  obj = bot_dimensions_obj
+  if not obj:
+    obj = yield get_bot_dimensions_key(bot_root_key).get_async()
   if (obj and obj.dimensions_flat == bot_dimensions_to_flat(bot_dimensions) and
       obj.valid_until_ts > now):
     # Cache hit, no need to look further.
@@ -1012,7 +1188,7 @@ def cleanup_after_bot(bot_root_key):
   """
   q = BotTaskDimensions.query(ancestor=bot_root_key).iter(keys_only=True)
   futures = ndb.delete_multi_async(q)
-  futures.append(ndb.Key(BotDimensions, 1, parent=bot_root_key).delete_async())
+  futures.append(get_bot_dimensions_key(bot_root_key).delete_async())
   _flush_futures(futures)
 
 
@@ -1124,6 +1300,100 @@ def set_has_capacity(dimensions, seconds):
       dimensions_hash, True, time=seconds, namespace='task_queues_tasks')
 
 
+@ndb.tasklet
+def set_task_counted_async(request, state):
+  """Counts a task as pending or running in the TaskDimensionsCounter of its
+  task queues, or stops counting it.
+
+  The task is counted once in the task queue of each of its task slices. The
+  counts are only updated by the difference with how the task is currently
+  counted, as recorded in its TaskDimensionsCounted, so calling it again with
+  the same state is a no-op.
+
+  It must be called in a cross-group transaction that read the state of the
+  task, so the counts follow the task state even if an update is lost or the
+  calls are reordered. It uses up to 1 + the number of task slices entity
+  groups.
+
+  Arguments:
+    request: TaskRequest of the task.
+    state: 'pending', 'running' or None if the task is not counted.
+
+  Returns:
+    True if the counts were updated.
+  """
+  assert ndb.in_transaction()
+  assert state in (None, 'pending', 'running'), state
+  now = utils.utcnow()
+  key = ndb.Key(TaskDimensionsCounted, 1, parent=request.key)
+  counted = yield key.get_async()
+  prev = counted.state if counted else None
+  if prev == state:
+    if counted:
+      counted.ts = now
+      yield counted.put_async()
+    raise ndb.Return(False)
+
+  pending = int(state == 'pending') - int(prev == 'pending')
+  running = int(state == 'running') - int(prev == 'running')
+  # Task slices with the same dimensions share their task queue, and may pick
+  # the same shard.
+  slices = {}
+  pools = {}
+  for i in range(request.num_task_slices):
+    dimensions = request.task_slice(i).properties.dimensions
+    shard_key = ndb.Key(
+        TaskDimensionsCounter, '%d:%d' % (
+            hash_dimensions(dimensions), random.randrange(_COUNTER_SHARDS)))
+    slices[shard_key] = slices.get(shard_key, 0) + 1
+    pools[shard_key] = sorted(dimensions.get(u'pool', [u'']))[0]
+  shard_keys = list(slices)
+  shards = yield ndb.get_multi_async(shard_keys)
+  to_put = []
+  for shard_key, obj in zip(shard_keys, shards):
+    if not obj:
+      obj = TaskDimensionsCounter(key=shard_key, pool=pools[shard_key])
+    obj.pending += pending * slices[shard_key]
+    obj.running += running * slices[shard_key]
+    obj.ts = now
+    to_put.append(obj)
+  futures = []
+  if state:
+    to_put.append(TaskDimensionsCounted(key=key, state=state, ts=now))
+  else:
+    futures.append(key.delete_async())
+  futures.extend(ndb.put_multi_async(to_put))
+  yield futures
+  raise ndb.Return(True)
+
+
+def get_task_counts():
+  """Returns the number of pending and running tasks of each task queue.
+
+  Returns:
+    dict(dimensions_hash: (pool, number of tasks)) for the task queues that have
+    tasks.
+  """
+  pools = {}
+  counts = {}
+  for obj in TaskDimensionsCounter.query().iter(batch_size=256):
+    dimensions_hash = obj.dimensions_hash
+    pools[dimensions_hash] = obj.pool
+    counts[dimensions_hash] = (
+        counts.get(dimensions_hash, 0) + obj.pending + obj.running)
+  return {h: (pools[h], n) for h, n in counts.items() if n > 0}
+
+
+def count_bots_async(dimensions_hash):
+  """Returns a ndb.Future to the number of bots that can run a task queue.
+
+  These are the bots with a BotTaskDimensions for the task queue, including the
+  ones whose BotTaskDimensions is stale but not tidied yet.
+  """
+  return BotTaskDimensions.query(
+      BotTaskDimensions.dimensions_hash == dimensions_hash).count_async()
+
+
 @ndb.tasklet
 def rebuild_task_cache_async(payload):
   """Rebuilds the TaskDimensions cache.
@@ -1191,7 +1461,8 @@ def cron_tidy_stale():
   them.
 
   Their .valid_until_ts is compared to the current time and the entity is
-  deleted if it's older.
+  deleted if it's older. The unused TaskDimensionsCounter are deleted too. The
+  BotTaskDimensions missing from the dimensions_hash index are stored again.
 
   The number of entities processed is expected to be relatively low, in the few
   tens at most.
@@ -1199,14 +1470,22 @@ def cron_tidy_stale():
   now = utils.utcnow()
   td = []
   btd = []
+  tdc = []
+  backfilled = []
   try:
     future_tasks = _tidy_stale_TaskDimensions(now)
     future_bots = _tidy_stale_BotTaskDimensions(now)
+    future_counters = _tidy_stale_TaskDimensionsCounter(now)
+    future_backfill = _backfill_BotTaskDimensions()
     td = future_tasks.get_result()
     btd = future_bots.get_result()
+    tdc = future_counters.get_result()
+    backfilled = future_backfill.get_result()
   finally:
     logging.info(
         'cron_tidy_stale() in %.3fs; TaskDimensions: found %d, deleted %d; '
-        'BotTaskDimensions: found %d, deleted %d',
+        'BotTaskDimensions: found %d, deleted %d, backfilled %d; '
+        'TaskDimensionsCounter: found %d, deleted %d',
         (utils.utcnow() - now).total_seconds(),
-        len(td), sum(1 for i in td if i), len(btd), sum(1 for i in btd if i))
+        len(td), sum(1 for i in td if i), len(btd), sum(1 for i in btd if i),
+        len(backfilled), len(tdc), sum(1 for i in tdc if i))
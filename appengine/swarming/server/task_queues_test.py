@@ -23,6 +23,7 @@ from google.appengine.ext import ndb
 
 import handlers_backend
 
+from components import datastore_utils
 from components import utils
 from server import bot_management
 from server import task_queues
@@ -167,6 +168,7 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
 
     a = cls(valid_until_ts=now, dimensions_flat=['a:b'])
     a.put()
+    self.assertEqual(a.key.integer_id(), a.dimensions_hash)
     self.assertEqual(True, a.is_valid({'a': ['b']}))
     self.assertEqual(True, a.is_valid({'a': ['b', 'c']}))
     self.assertEqual(False, a.is_valid({'x': ['c']}))
@@ -194,6 +196,17 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
         ]).put()
     cls(sets=[setcls(valid_until_ts=now, dimensions_flat=['a:b'])]).put()
 
+  def test_TaskDimensionsCounter(self):
+    cls = task_queues.TaskDimensionsCounter
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5)
+    with self.assertRaises(datastore_errors.BadValueError):
+      cls(id='1:0').put()
+    a = cls(id='2980491642:3', pool=u'default', ts=now)
+    a.put()
+    self.assertEqual(2980491642, a.dimensions_hash)
+    self.assertEqual(0, a.pending)
+    self.assertEqual(0, a.running)
+
   def assert_count(self, count, entity):
     actual = entity.query().count()
     if actual != count:
@@ -254,6 +267,100 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
     # See more complex test below.
     pass
 
+  def _gen_request_two_slices(self):
+    request = _gen_request()
+    request.task_slices.append(
+        task_request.TaskSlice(
+            expiration_secs=60,
+            properties=_gen_properties(
+                dimensions={
+                    u'gpu': [u'none'],
+                    u'os': [u'Ubuntu-16.04'],
+                    u'pool': [u'default'],
+                })))
+    request.key = task_request.new_request_key()
+    return request
+
+  def _set_task_counted(self, request, state):
+    if not request.key:
+      request.key = task_request.new_request_key()
+    return datastore_utils.transaction(
+        lambda: task_queues.set_task_counted_async(request, state), xg=True)
+
+  def test_TaskDimensionsCounted(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5)
+    self.mock_now(now)
+    request = self._gen_request_two_slices()
+    self.assertTrue(self._set_task_counted(request, 'pending'))
+    counted = task_queues.TaskDimensionsCounted.query().get()
+    self.assertEqual(request.key, counted.key.parent())
+    self.assertEqual('pending', counted.state)
+    self.assertEqual(now, counted.ts)
+
+  def test_set_task_counted_async(self):
+    request = self._gen_request_two_slices()
+    self.assertTrue(self._set_task_counted(request, 'pending'))
+    # It is idempotent.
+    self.assertFalse(self._set_task_counted(request, 'pending'))
+    self.assertTrue(self._set_task_counted(request, 'running'))
+    counters = task_queues.TaskDimensionsCounter.query().fetch()
+    self.assertEqual(
+        sorted(
+            task_queues.hash_dimensions(t.properties.dimensions)
+            for t in request.task_slices),
+        sorted(set(c.dimensions_hash for c in counters)))
+    self.assertEqual(0, sum(c.pending for c in counters))
+    self.assertEqual(2, sum(c.running for c in counters))
+    self.assertEqual(set([u'default']), set(c.pool for c in counters))
+    self.assert_count(1, task_queues.TaskDimensionsCounted)
+
+    self.assertTrue(self._set_task_counted(request, None))
+    self.assertFalse(self._set_task_counted(request, None))
+    counters = task_queues.TaskDimensionsCounter.query().fetch()
+    self.assertEqual(0, sum(c.pending for c in counters))
+    self.assertEqual(0, sum(c.running for c in counters))
+    self.assert_count(0, task_queues.TaskDimensionsCounted)
+
+  def test_set_task_counted_async_not_counted(self):
+    # A task that was never counted, e.g. scheduled before the counters were
+    # added or whose first update was lost, is not decremented.
+    self.assertFalse(self._set_task_counted(_gen_request(), None))
+    self.assert_count(0, task_queues.TaskDimensionsCounter)
+
+  def test_get_task_counts(self):
+    self.assertEqual({}, task_queues.get_task_counts())
+    request = self._gen_request_two_slices()
+    h1, h2 = [
+        task_queues.hash_dimensions(t.properties.dimensions)
+        for t in request.task_slices
+    ]
+    # Each update is on a random shard.
+    requests = [self._gen_request_two_slices() for _ in range(10)]
+    for r in requests:
+      self._set_task_counted(r, 'pending')
+    self._set_task_counted(_gen_request(), 'running')
+    expected = {h1: (u'default', 11), h2: (u'default', 10)}
+    self.assertEqual(expected, task_queues.get_task_counts())
+
+    for r in requests:
+      self._set_task_counted(r, None)
+    # The task queues without tasks are skipped.
+    expected = {h1: (u'default', 1)}
+    self.assertEqual(expected, task_queues.get_task_counts())
+
+  def test_count_bots_async(self):
+    request = self._assert_task()
+    dimensions_hash = task_queues.hash_dimensions(
+        request.task_slice(0).properties.dimensions)
+    self.assertEqual(
+        0, task_queues.count_bots_async(dimensions_hash).get_result())
+    self.assertEqual(1, _assert_bot(u'bot1'))
+    self.assertEqual(1, _assert_bot(u'bot2'))
+    self.assertEqual(0, _assert_bot(u'bot3', {u'pool': [u'other']}))
+    self.assertEqual(
+        2, task_queues.count_bots_async(dimensions_hash).get_result())
+    self.assertEqual(0, task_queues.count_bots_async(1).get_result())
+
   def test_rebuild_task_cache_async(self):
     # Assert that expiration works.
     now = datetime.datetime(2010, 1, 2, 3, 4, 5)
@@ -836,6 +943,57 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
     self.assert_count(0, task_queues.TaskDimensions)
     self.assertEqual([], task_queues.get_queues(bot_root_key))
 
+  def test_cron_tidy_stale_backfill(self):
+    request = self._assert_task()
+    dimensions_hash = task_queues.hash_dimensions(
+        request.task_slice(0).properties.dimensions)
+    # The BotTaskDimensions stored before dimensions_hash was indexed.
+    orig = self.mock(
+        task_queues.BotTaskDimensions.dimensions_hash, '_func', lambda _: None)
+    self.assertEqual(1, _assert_bot(u'bot1'))
+    self.assertEqual(1, _assert_bot(u'bot2'))
+    self.mock(task_queues.BotTaskDimensions.dimensions_hash, '_func', orig)
+    self.assertEqual(1, _assert_bot(u'bot3'))
+    self.assertEqual(
+        1, task_queues.count_bots_async(dimensions_hash).get_result())
+
+    task_queues.cron_tidy_stale()
+    self.assert_count(3, task_queues.BotTaskDimensions)
+    self.assertEqual(
+        3, task_queues.count_bots_async(dimensions_hash).get_result())
+    # No-op.
+    self.assertEqual(
+        [], task_queues._backfill_BotTaskDimensions().get_result())
+
+  def test_cron_tidy_stale_counters(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5)
+    self.mock_now(now)
+    request = _gen_request()
+    other = self._gen_request_two_slices()
+    self._set_task_counted(request, 'pending')
+    self._set_task_counted(other, 'pending')
+    self._set_task_counted(other, 'running')
+    self.mock_now(now, 60)
+    self._set_task_counted(other, None)
+    h = task_queues.hash_dimensions(request.task_slices[0].properties.dimensions)
+    self.assertEqual({h: (u'default', 1)}, task_queues.get_task_counts())
+    n = task_queues.TaskDimensionsCounter.query().count()
+
+    # Just before _KEEP_DEAD.
+    self.mock_now(now, task_queues._KEEP_DEAD.total_seconds() + 60)
+    task_queues.cron_tidy_stale()
+    self.assert_count(n, task_queues.TaskDimensionsCounter)
+
+    # The task queue of the second slice of the pending task is idle and
+    # removed. The other one still counts a task.
+    self.mock_now(now, task_queues._KEEP_DEAD.total_seconds() + 61)
+    task_queues.cron_tidy_stale()
+    self.assertEqual(
+        set([h]),
+        set(c.dimensions_hash
+            for c in task_queues.TaskDimensionsCounter.query()))
+    self.assertEqual({h: (u'default', 1)}, task_queues.get_task_counts())
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
@@ -82,6 +82,7 @@ from server import bq_state
 from server import large
 from server import resultdb
 from server import task_pack
+from server import task_queues
 from server import task_request
 from server.constants import OR_DIM_SEP
 
@@ -1150,6 +1151,7 @@ class TaskResultSummary(_TaskResultCommon):
     future.check_success()
     self._send_job_completed_metric()
     self._call_finalize_invocation()
+    self._update_task_counts()
 
   def _call_finalize_invocation(self):
     """Call FinalizeInvocation to ResultDB."""
@@ -1167,6 +1169,18 @@ class TaskResultSummary(_TaskResultCommon):
       resultdb.finalize_invocation_async(
           run_id, self.request.resultdb_update_token).get_result()
 
+  def _update_task_counts(self):
+    """Removes the completed task from the counts of its task queues."""
+    if self.state in State.STATES_RUNNING:
+      return
+    if self._prev_state not in State.STATES_RUNNING:
+      # self._prev_state is None when the task was never pending.
+      return
+    request = self.request
+    # Runs immediately when not in a transaction.
+    ndb.get_context().call_on_commit(
+        lambda: update_task_counts_async(request).get_result())
+
   def _send_job_completed_metric(self):
     """Sends metric 'job/completed'"""
     # Skip when the current state is running or pending
@@ -1543,6 +1557,41 @@ def new_run_result(request, to_run, bot_id, bot_version, bot_dimensions,
       server_versions=[utils.get_app_version()])
 
 
+@ndb.tasklet
+def update_task_counts_async(request):
+  """Counts the task in the task queue counters according to its current state.
+
+  The counts are updated in an independent transaction, outside of the one
+  updating the task. A failed update is logged and repaired by the next call,
+  the counts are only used for monitoring.
+
+  Returns:
+    True if the counts were updated.
+  """
+  result_summary_key = task_pack.request_key_to_result_summary_key(request.key)
+
+  @ndb.tasklet
+  def tx():
+    result_summary = yield result_summary_key.get_async()
+    state = None
+    if result_summary and result_summary.state == State.PENDING:
+      state = 'pending'
+    elif result_summary and result_summary.state == State.RUNNING:
+      state = 'running'
+    res = yield task_queues.set_task_counted_async(request, state)
+    raise ndb.Return(res)
+
+  try:
+    res = yield datastore_utils.transaction_async(
+        tx, xg=True, propagation=ndb.TransactionOptions.INDEPENDENT)
+  except datastore_utils.CommitError as e:
+    logging.warning(
+        'Failed to update the task counts of %s: %s',
+        task_pack.pack_request_key(request.key), e)
+    raise ndb.Return(False)
+  raise ndb.Return(res)
+
+
 def yield_result_summary_by_parent_task_id(parent_task_id):
   """Yields child TaskResultSummary entities by parent task id."""
   q = task_request.yield_request_keys_by_parent_task_id(parent_task_id)
@@ -26,6 +26,7 @@ from google.appengine.ext import ndb
 import webtest
 
 from components import auth_testing
+from components import datastore_utils
 from components import utils
 from test_support import test_case
 
@@ -33,6 +34,7 @@ from proto.api import swarming_pb2  # pylint: disable=no-name-in-module
 from server import bq_state
 from server import large
 from server import task_pack
+from server import task_queues
 from server import task_request
 from server import task_result
 from server import task_to_run
@@ -587,6 +589,32 @@ class TaskResultApiTest(TestCase):
         task_pack.pack_run_result_key(run_result.key), run_result.task_id)
     self.assertEqual(complete_ts, run_result.ended_ts)
 
+  def test_update_task_counts_async(self):
+    request = _gen_summary_result().request_key.get()
+    counted_key = ndb.Key(
+        task_queues.TaskDimensionsCounted, 1, parent=request.key)
+    self.assertTrue(task_result.update_task_counts_async(request).get_result())
+    self.assertEqual('pending', counted_key.get().state)
+    # It is idempotent.
+    self.assertFalse(task_result.update_task_counts_async(request).get_result())
+
+    request = _gen_run_result().request_key.get()
+    counted_key = ndb.Key(
+        task_queues.TaskDimensionsCounted, 1, parent=request.key)
+    self.assertTrue(task_result.update_task_counts_async(request).get_result())
+    self.assertEqual('running', counted_key.get().state)
+
+  def test_update_task_counts_async_failure(self):
+    @ndb.tasklet
+    def transaction_async(*_args, **_kwargs):
+      raise datastore_utils.CommitError('Sorry')
+      yield  # pylint: disable=unreachable
+
+    request = _gen_summary_result().request_key.get()
+    self.mock(datastore_utils, 'transaction_async', transaction_async)
+    # It is not raised, as the counts are only used for monitoring.
+    self.assertFalse(task_result.update_task_counts_async(request).get_result())
+
   def test_yield_result_summary_by_parent_task_id(self):
     # prepare parent task
     parent_run_result = _gen_run_result()
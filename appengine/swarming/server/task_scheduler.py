@@ -7,7 +7,6 @@
 This is the interface closest to the HTTP handlers.
 """
 
-import collections
 import datetime
 import logging
 import math
@@ -49,6 +48,11 @@ _PROBABILITY_OF_QUICK_COMEBACK = 0.05
 # life. This number should be larger than the bot polling period.
 _ES_FALLBACK_SLACK = datetime.timedelta(minutes=6)
 
+# The tasks counted for longer than this are compared again with their state by
+# cron_task_bot_distribution(). It bounds how long the counts are off after a
+# lost update.
+_TASK_COUNTS_REPAIR_AGE = datetime.timedelta(hours=1)
+
 
 class Error(Exception):
   pass
@@ -221,6 +225,9 @@ def _expire_task(to_run_key, request, inline):
     logging.info(
         'Expired %s', task_pack.pack_result_summary_key(result_summary_key))
     ts_mon_metrics.on_task_expired(summary, to_run_key.get())
+    task_to_run.set_queue_pending(request, to_run_key, False)
+    if new_to_run:
+      task_to_run.set_queue_pending(request, new_to_run.key, True)
   return summary, new_to_run
 
 
@@ -327,9 +334,57 @@ def _reap_task(bot_dimensions, bot_version, to_run_key, request,
     # The bot will reap the next available task in case of failure, no big deal.
     run_result = None
     secret_bytes = None
+  if run_result:
+    # The task counts are not updated here to keep the bot poll fast. The task
+    # stays counted as pending until it completes or _repair_task_counts() runs.
+    task_to_run.set_queue_pending(request, to_run_key, False)
   return run_result, secret_bytes
 
 
+def _repair_task_counts(now):
+  """Updates the task counts of the tasks counted for more than
+  _TASK_COUNTS_REPAIR_AGE, and of the pending and running tasks not counted.
+
+  It moves the reaped tasks from pending to running, and repairs the counts
+  after an update was lost, e.g. when the task completion was committed but not
+  its count update. It also counts the tasks whose first update in
+  schedule_request() was lost, and the ones scheduled before the tasks were
+  counted.
+
+  Returns:
+    Number of tasks whose counts were updated.
+  """
+  cutoff = now - _TASK_COUNTS_REPAIR_AGE
+  q = task_queues.TaskDimensionsCounted.query(
+      task_queues.TaskDimensionsCounted.ts < cutoff)
+  request_keys = [k.parent() for k in q.fetch(keys_only=True)]
+
+  # The TaskDimensionsCounted of a counted task may not be stale yet, only look
+  # for the tasks that have none.
+  q = task_result.TaskResultSummary.query(
+      task_result.TaskResultSummary.state.IN(
+          [task_result.State.PENDING, task_result.State.RUNNING]),
+      default_options=ndb.QueryOptions(use_cache=False))
+  summary_keys = q.fetch(keys_only=True)
+  for i in range(0, len(summary_keys), 100):
+    keys = [
+        task_pack.result_summary_key_to_request_key(k)
+        for k in summary_keys[i:i+100]
+    ]
+    counted = ndb.get_multi(
+        [ndb.Key(task_queues.TaskDimensionsCounted, 1, parent=k) for k in keys])
+    request_keys.extend(k for k, c in zip(keys, counted) if not c)
+
+  repaired = 0
+  for i in range(0, len(request_keys), 100):
+    requests = ndb.get_multi(request_keys[i:i+100])
+    futures = [
+        task_result.update_task_counts_async(r) for r in requests if r
+    ]
+    repaired += sum(1 for f in futures if f.get_result())
+  return repaired
+
+
 def _handle_dead_bot(run_result_key):
   """Handles TaskRunResult where its bot has stopped showing sign of life.
 
@@ -1236,6 +1291,11 @@ def schedule_request(request, secret_bytes, enable_resultdb):
   _gen_key = lambda: _gen_new_keys(result_summary, to_run, secret_bytes)
   extra = filter(bool, [result_summary, to_run, secret_bytes])
   datastore_utils.insert(request, new_key_callback=_gen_key, extra=extra)
+  task_counts_future = None
+  if to_run:
+    task_to_run.set_queue_pending(request, to_run.key, True)
+    # Waited for at the end, it is only used for monitoring.
+    task_counts_future = task_result.update_task_counts_async(request)
 
   # Note: This external_scheduler call is blocking, and adds risk
   # of the HTTP handler being slow or dying after the task was already made
@@ -1263,6 +1323,8 @@ def schedule_request(request, secret_bytes, enable_resultdb):
   if result_summary.state != task_result.State.PENDING:
     _maybe_taskupdate_notify_via_tq(
         result_summary, request, es_cfg, transactional=False)
+  if task_counts_future:
+    task_counts_future.get_result()
   return result_summary
 
 
@@ -1785,71 +1847,36 @@ def cron_handle_get_callbacks():
 
 
 def cron_task_bot_distribution():
-  """Sends to TS mon data about the fleet size for each runnable task queues."""
-  # TODO(maruel): This should be rewritten in term of task queues.
+  """Sends to TS mon data about the fleet size for each runnable task queues.
 
-  # First, build a dictionary mapping dimensions to a count of how many
-  # tasks have those dimensions (exclude id from dimensions).
-  n_tasks_by_dimensions = collections.Counter()
-  q = task_result.TaskResultSummary.query(
-      task_result.TaskResultSummary.state.IN(task_result.State.STATES_RUNNING))
-  cnt = 0
-  logging.debug('Collecting task dimensions...')
-  try:
-    for result in q:
-      # Make dimensions immutable so they can be used to index a key.
-      req = result.request
-      for i in range(req.num_task_slices):
-        t = req.task_slice(i)
-        dimensions = tuple(
-            sorted((k, tuple(sorted(v)))
-                   for k, v in t.properties.dimensions.items()))
-        n_tasks_by_dimensions[dimensions] += 1
-      cnt += 1
-      if cnt % 1000 == 0:
-        logging.debug('Fetched dimensions from %d tasks', cnt)
-  except datastore_errors.Timeout as e:
-    # TODO(crbug.com/1174960):
-    # The last fetch from Datastore tends to fail for Timeout.
-    # Ignore timeout errors to contiune ts_mon metrics reporting.
-    logging.warning('Ignoring timeout %s', e, exc_info=True)
-
-  # Second, count how many bots have those dimensions for each set.
-  n_bots_by_dimensions = {}
-  for dimensions, n_tasks in n_tasks_by_dimensions.items():
-    filter_dimensions = []
-    for k, values in dimensions:
-      for v in values:
-        filter_dimensions.append(u'%s:%s' % (k, v))
-    q = bot_management.BotInfo.query()
-    try:
-      q = bot_management.filter_dimensions(q, filter_dimensions)
-    except ValueError as e:
-      # If there's a problem getting dimensions here, we just don't add the
-      # async result to n_bots_by_dimensions, then below treat it as zero
-      # (no bots could run this task).
-      # This results in overly-pessimistic monitoring, which means someone
-      # might look into it to and find the actual error here.
-      logging.error('%s', e)
-      continue
-    n_bots_by_dimensions[dimensions] = q.count_async()
+  The pending and running tasks are counted per task queue by task_queues, as
+  the tasks are scheduled and completed. The bots that can run a task queue are
+  the ones that registered to it.
+
+  Returns:
+    Number of task queues with pending or running tasks.
+  """
+  repaired = _repair_task_counts(utils.utcnow())
+  if repaired:
+    logging.info('Repaired the task counts of %d tasks', repaired)
+  counts = task_queues.get_task_counts()
+  logging.debug('Counting bots of %d task queues...', len(counts))
+  n_bots_futures = {
+      dimensions_hash: task_queues.count_bots_async(dimensions_hash)
+      for dimensions_hash in counts
+  }
 
-  # Third, multiply out, aggregating by fixed dimensions.
   cnt = 0
   logging.debug('Sending ts_mon metrics...')
-  for dimensions, n_tasks in n_tasks_by_dimensions.items():
-    n_bots = 0
-    if dimensions in n_bots_by_dimensions:
-      n_bots = n_bots_by_dimensions[dimensions].get_result()
-
-    dimensions = dict(dimensions)
-    fields = {'pool': dimensions.get('pool', [''])[0]}
+  for dimensions_hash, (pool, n_tasks) in counts.items():
+    n_bots = n_bots_futures[dimensions_hash].get_result()
+    fields = {'pool': pool}
     for _ in range(n_tasks):
       ts_mon_metrics._task_bots_runnable.add(n_bots, fields)
     cnt += 1
     if cnt % 1000 == 0:
-      logging.debug('Sent eligible bots count for %d dimensions sets', cnt)
-  return len(n_bots_by_dimensions)
+      logging.debug('Sent eligible bots count for %d task queues', cnt)
+  return len(counts)
 
 
 ## Task queue tasks.
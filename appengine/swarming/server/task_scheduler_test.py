@@ -21,9 +21,11 @@ import test_env_handlers
 from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
+import gae_ts_mon
 import webtest
 
 import handlers_backend
+import ts_mon_metrics
 
 from components import auth
 from components import auth_testing
@@ -116,6 +118,18 @@ def _run_result_to_to_run_key(run_result):
                                                 run_result.current_task_slice)
 
 
+def _is_in_negative_cache(to_run_key):
+  """Returns True if _validate_tasks_async() skips the TaskToRun because it is
+  in the negative cache.
+  """
+  stats = task_to_run._QueryStats()
+  # The other TaskToRun never match the empty bot dimensions.
+  task_to_run._validate_tasks_async(
+      {}, stats, utils.utcnow(),
+      [task_to_run.TaskToRun(key=to_run_key)]).get_result()
+  return bool(stats.cache_lookup)
+
+
 def _bot_update_task(run_result_key, **kwargs):
   args = {
       'bot_id': 'localhost',
@@ -1822,8 +1836,7 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     # Make sure the TaskToRun is added to the negative cache.
     request = result_summary.request_key.get()
     to_run_key = task_to_run.request_to_task_to_run_key(request, 1, 0)
-    actual = task_to_run._lookup_cache_is_taken_async(to_run_key).get_result()
-    self.assertEqual(True, actual)
+    self.assertEqual(True, _is_in_negative_cache(to_run_key))
 
   def test_cancel_task_with_id(self):
     # Cancel a pending task.
@@ -1847,8 +1860,7 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     # Make sure the TaskToRun is added to the negative cache.
     request = result_summary.request_key.get()
     to_run_key = task_to_run.request_to_task_to_run_key(request, 1, 0)
-    actual = task_to_run._lookup_cache_is_taken_async(to_run_key).get_result()
-    self.assertEqual(True, actual)
+    self.assertEqual(True, _is_in_negative_cache(to_run_key))
 
   def test_cancel_task_running(self):
     # Cancel a running task.
@@ -2159,8 +2171,8 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     request = run_result.request_key.get()
 
     def is_in_negative_cache(t):
-      to_run_key = task_to_run.request_to_task_to_run_key(request, t, 0)
-      return task_to_run._lookup_cache_is_taken_async(to_run_key).get_result()
+      return _is_in_negative_cache(
+          task_to_run.request_to_task_to_run_key(request, t, 0))
 
     self.assertEqual(True, is_in_negative_cache(1))  # Was just reaped.
     self.assertEqual(False, is_in_negative_cache(2))
@@ -2719,9 +2731,95 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
           properties=_gen_properties(dimensions={u'pool': [u'some-pool']}))
 
   def test_cron_task_bot_distribution(self):
-    # TODO(maruel): https://crbug.com/912154
     self.assertEqual(0, task_scheduler.cron_task_bot_distribution())
 
+  def test_cron_task_bot_distribution_tasks(self):
+    gae_ts_mon.reset_for_unittest()
+    fields = {'pool': u'default'}
+    # A running task and a pending task in the same task queue, that the bot
+    # can run.
+    run_result = self._quick_reap(1, 0)
+    result_summary = self._quick_schedule(0)
+    self.assertEqual(1, task_scheduler.cron_task_bot_distribution())
+    distribution = ts_mon_metrics._task_bots_runnable.get(fields=fields)
+    self.assertEqual(2, distribution.count)
+    self.assertEqual(2, distribution.sum)
+
+    # Another bot that can run the task queue.
+    self._register_bot(1, dict(self.bot_dimensions, id=[u'localhost2']))
+    self.assertEqual(1, task_scheduler.cron_task_bot_distribution())
+    distribution = ts_mon_metrics._task_bots_runnable.get(fields=fields)
+    self.assertEqual(4, distribution.count)
+    self.assertEqual(6, distribution.sum)
+
+    # The completed tasks are not counted anymore.
+    self.assertEqual(
+        State.COMPLETED,
+        _bot_update_task(run_result.key, exit_code=0, duration=0.1))
+    ok, was_running = task_scheduler.cancel_task(
+        result_summary.request_key.get(), result_summary.key, False, None)
+    self.assertEqual((True, False), (ok, was_running))
+    self.execute_tasks()
+    self.assertEqual(0, task_scheduler.cron_task_bot_distribution())
+    distribution = ts_mon_metrics._task_bots_runnable.get(fields=fields)
+    self.assertEqual(4, distribution.count)
+
+  def test_cron_task_bot_distribution_repair(self):
+    gae_ts_mon.reset_for_unittest()
+    run_result = self._quick_reap(1, 0)
+    counted = task_queues.TaskDimensionsCounted.query().get()
+    # The reap does not update the counts.
+    self.assertEqual('pending', counted.state)
+
+    # The reaped task is moved to running.
+    self.mock_now(self.now, 3601)
+    self.assertEqual(1, task_scheduler.cron_task_bot_distribution())
+    self.assertEqual('running', counted.key.get().state)
+
+    # The update of the counts on completion is lost.
+    @ndb.tasklet
+    def update_task_counts_async(_request):
+      raise ndb.Return(False)
+      yield  # pylint: disable=unreachable
+
+    orig = self.mock(
+        task_result, 'update_task_counts_async', update_task_counts_async)
+    self.assertEqual(
+        State.COMPLETED,
+        _bot_update_task(run_result.key, exit_code=0, duration=0.1))
+    self.execute_tasks()
+    self.mock(task_result, 'update_task_counts_async', orig)
+    self.assertEqual(1, task_scheduler.cron_task_bot_distribution())
+
+    # It is repaired.
+    self.mock_now(self.now, 2 * 3601)
+    self.assertEqual(0, task_scheduler.cron_task_bot_distribution())
+    self.assertEqual(0, task_queues.TaskDimensionsCounted.query().count())
+
+  def test_cron_task_bot_distribution_uncounted(self):
+    gae_ts_mon.reset_for_unittest()
+    fields = {'pool': u'default'}
+
+    # The first update of the counts is lost, or the task was scheduled before
+    # the tasks were counted.
+    @ndb.tasklet
+    def update_task_counts_async(_request):
+      raise ndb.Return(False)
+      yield  # pylint: disable=unreachable
+
+    orig = self.mock(
+        task_result, 'update_task_counts_async', update_task_counts_async)
+    self._quick_schedule(1)
+    self.mock(task_result, 'update_task_counts_async', orig)
+    self.assertEqual(0, task_queues.TaskDimensionsCounted.query().count())
+
+    # It is counted right away.
+    self.assertEqual(1, task_scheduler.cron_task_bot_distribution())
+    counted = task_queues.TaskDimensionsCounted.query().get()
+    self.assertEqual('pending', counted.state)
+    distribution = ts_mon_metrics._task_bots_runnable.get(fields=fields)
+    self.assertEqual(1, distribution.count)
+
   def test_ensure_active_slice_nonpending(self):
     # Non-PENDING task cannot have active slice set.
     r = self._quick_schedule(1)
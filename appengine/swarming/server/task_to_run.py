@@ -31,7 +31,9 @@ Graph of the schema:
 
 import collections
 import datetime
+import heapq
 import logging
+import threading
 import time
 
 from google.appengine.api import datastore_errors
@@ -40,6 +42,9 @@ from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from components import utils
+
+import ts_mon_metrics
+
 from server import bot_management
 from server import config
 from server import task_pack
@@ -161,6 +166,34 @@ class TaskToRun(ndb.Model):
 ### Private functions.
 
 
+# Number of TaskToRun fetched per page for each dimensions_hash queue.
+_PAGE_SIZE = 10
+
+
+# When the number of buffered items of a queue falls to this value, the next
+# page of this queue is fetched.
+_PREFETCH_THRESHOLD = 2
+
+
+# Number of TaskToRun candidates validated together by _validate_tasks_async().
+# The candidates are still yielded in priority order.
+_VALIDATION_BATCH_SIZE = 10
+
+
+# Maximum number of _validate_tasks_async() batches in flight.
+_VALIDATION_MAX_BATCHES = 5
+
+
+# Seconds during which a queue found empty by this instance is trusted to stay
+# empty. Tasks enqueued by other instances are only seen by this instance after
+# this delay, so this bounds the scheduling latency added by the index.
+_EMPTY_QUEUE_TTL_SECS = 5.
+
+
+# Maximum number of queues tracked by _PendingQueuesIndex.
+_PENDING_QUEUES_INDEX_MAX_SIZE = 50000
+
+
 def _gen_queue_number(dimensions_hash, timestamp, priority):
   """Generates a 63 bit packed value used for TaskToRun.queue_number.
 
@@ -245,14 +278,6 @@ def _memcache_to_run_key(to_run_key):
       task_to_run_key_slice_index(to_run_key))
 
 
-@ndb.tasklet
-def _lookup_cache_is_taken_async(to_run_key):
-  """Queries the quick lookup cache to reduce DB operations."""
-  key = _memcache_to_run_key(to_run_key)
-  neg = yield ndb.get_context().memcache_get(key, namespace='task_to_run')
-  raise ndb.Return(bool(neg))
-
-
 class _QueryStats(object):
   """Statistics for a yield_next_available_task_to_dispatch() loop."""
   broken = 0
@@ -262,62 +287,195 @@ class _QueryStats(object):
   ignored = 0
   no_queue = 0
   real_mismatch = 0
+  # Number of memcache and Datastore RPCs issued to validate the candidates.
+  rpcs = 0
   total = 0
 
   def __str__(self):
     return (
         '%d total, %d exp %d no_queue, %d hash mismatch, %d cache negative, '
-        '%d dimensions mismatch, %d ignored, %d broken') % (
+        '%d dimensions mismatch, %d ignored, %d broken, %d RPCs') % (
             self.total, self.expired, self.no_queue, self.hash_mismatch,
-            self.cache_lookup, self.real_mismatch, self.ignored, self.broken)
+            self.cache_lookup, self.real_mismatch, self.ignored, self.broken,
+            self.rpcs)
+
+
+class _PendingQueuesIndex(object):
+  """Process-local index of the dimensions_hash queues known to be empty.
+
+  The Datastore is the source of truth. This index only lets a polling bot skip
+  the query of a queue that was recently found empty by this instance and in
+  which this instance didn't enqueue a TaskToRun since. Other instances may
+  enqueue tasks in the meantime, so an empty queue is only trusted for
+  _EMPTY_QUEUE_TTL_SECS before being queried again.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    # dimensions_hash -> utils.time_time() when the queue was found empty.
+    self._empty = {}
+    # dimensions_hash -> [number of TaskToRun enqueued by this instance and not
+    # known to be dequeued yet, utils.time_time() of the last update].
+    self._pending = {}
+    self.hits = 0
+    self.misses = 0
+    self.false_empties = 0
+
+  def filter_queues(self, dimensions_hashes):
+    """Returns the dimensions_hashes that may have pending tasks.
+
+    The queues known to be empty are skipped.
+    """
+    now = utils.time_time()
+    out = []
+    with self.lock:
+      for h in dimensions_hashes:
+        ts = self._empty.get(h)
+        if (ts is not None and now - ts < _EMPTY_QUEUE_TTL_SECS and
+            h not in self._pending):
+          self.hits += 1
+        else:
+          self.misses += 1
+          out.append(h)
+    ts_mon_metrics.on_pending_queues_index(
+        'hit', len(dimensions_hashes) - len(out))
+    ts_mon_metrics.on_pending_queues_index('miss', len(out))
+    return out
+
+  def set_queried(self, dimensions_hash, found):
+    """Records the result of the query of a queue."""
+    now = utils.time_time()
+    with self.lock:
+      was_empty = self._empty.pop(dimensions_hash, None) is not None
+      if found:
+        if was_empty:
+          # The queue was skipped while it may have had pending tasks. It is
+          # either due to another instance enqueuing a task or a stale index.
+          self.false_empties += 1
+          ts_mon_metrics.on_pending_queues_index('false_empty')
+        return
+      p = self._pending.get(dimensions_hash)
+      if p and now - p[1] < _EMPTY_QUEUE_TTL_SECS:
+        # This instance just enqueued a task in this queue, the Datastore index
+        # is likely not updated yet.
+        return
+      self._pending.pop(dimensions_hash, None)
+      if len(self._empty) >= _PENDING_QUEUES_INDEX_MAX_SIZE:
+        self._prune(now)
+      self._empty[dimensions_hash] = now
+
+  def add(self, dimensions_hash, delta):
+    """Records that this instance enqueued or dequeued a TaskToRun."""
+    now = utils.time_time()
+    with self.lock:
+      self._empty.pop(dimensions_hash, None)
+      p = self._pending.get(dimensions_hash)
+      if not p:
+        if delta <= 0:
+          # Dequeued a task enqueued by another instance, there's nothing to
+          # learn from it.
+          return
+        if len(self._pending) >= _PENDING_QUEUES_INDEX_MAX_SIZE:
+          self._prune(now)
+        p = self._pending[dimensions_hash] = [0, now]
+      p[0] += delta
+      p[1] = now
+      if p[0] <= 0:
+        del self._pending[dimensions_hash]
+
+  def reset(self):
+    """Resets the state of the index."""
+    with self.lock:
+      self._empty.clear()
+      self._pending.clear()
+      self.hits = 0
+      self.misses = 0
+      self.false_empties = 0
+
+  def _prune(self, now):
+    """Removes the expired entries. Must be called with the lock held."""
+    for h, ts in self._empty.items():
+      if now - ts >= _EMPTY_QUEUE_TTL_SECS:
+        del self._empty[h]
+    for h, (_, ts) in self._pending.items():
+      if now - ts >= _EMPTY_QUEUE_TTL_SECS:
+        del self._pending[h]
+    # Still too large, start over.
+    if len(self._empty) >= _PENDING_QUEUES_INDEX_MAX_SIZE:
+      self._empty.clear()
+    if len(self._pending) >= _PENDING_QUEUES_INDEX_MAX_SIZE:
+      self._pending.clear()
+
+
+# The actual in-process index of pending queues.
+_pending_queues = _PendingQueuesIndex()
 
 
 @ndb.tasklet
-def _validate_task_async(bot_dimensions, stats, now, to_run):
-  """Validates the TaskToRun and updates stats.
+def _validate_tasks_async(bot_dimensions, stats, now, to_runs):
+  """Validates a batch of TaskToRun and updates stats.
+
+  The negative cache of the whole batch is looked up with a single memcache
+  RPC, then the TaskRequest of the candidates surviving it are fetched with a
+  single Datastore RPC.
 
   Returns:
-    None if the task cannot be reaped by this bot.
-    TaskRequest if this is a good candidate to reap.
+    list of (TaskRequest, TaskToRun) that are good candidates to reap, in the
+    same order as to_runs.
   """
+  stats.total += len(to_runs)
   # TODO(maruel): Create one TaskToRun per TaskRunResult.
-  packed = task_pack.pack_request_key(
-      task_to_run_key_to_request_key(to_run.key)) + '0'
-  stats.total += 1
+  packed = [
+      task_pack.pack_request_key(task_to_run_key_to_request_key(t.key)) + '0'
+      for t in to_runs
+  ]
 
   # Do this after the basic weeding out but before fetching TaskRequest.
-  neg = yield _lookup_cache_is_taken_async(to_run.key)
-  if neg:
-    logging.debug('_validate_task_async(%s): negative cache', packed)
-    stats.cache_lookup += 1
-    raise ndb.Return((None, None))
-
-  # Ok, it's now worth taking a real look at the entity.
-  request = yield task_to_run_key_to_request_key(to_run.key).get_async()
-  props = request.task_slice(to_run.task_slice_index).properties
-
-  # The hash may have conflicts. Ensure the dimensions actually match by
-  # verifying the TaskRequest.
-  #
-  # There's a probability of 2**-31 of conflicts, which is low enough for our
-  # purpose.
-  if not match_dimensions(props.dimensions, bot_dimensions):
-    logging.debug('_validate_task_async(%s): dimensions mismatch', packed)
-    stats.real_mismatch += 1
-    raise ndb.Return((None, None))
-
-  # Expire as the bot polls by returning it, and task_scheduler will handle it.
-  if to_run.expiration_ts < now:
-    logging.debug(
-        '_validate_task_async(%s): expired %s < %s',
-        packed, to_run.expiration_ts, now)
-    stats.expired += 1
-  else:
-    # It's a valid task! Note that in the meantime, another bot may have reaped
-    # it. This is verified one last time in task_scheduler._reap_task() by
-    # calling set_lookup_cache().
-    logging.info('_validate_task_async(%s): ready to reap!', packed)
-  raise ndb.Return((request, to_run))
+  keys = [_memcache_to_run_key(t.key) for t in to_runs]
+  stats.rpcs += 1
+  neg = yield memcache.Client().get_multi_async(keys, namespace='task_to_run')
+  candidates = []
+  for key, p, to_run in zip(keys, packed, to_runs):
+    if neg.get(key):
+      logging.debug('_validate_tasks_async(%s): negative cache', p)
+      stats.cache_lookup += 1
+    else:
+      candidates.append((p, to_run))
+  if not candidates:
+    raise ndb.Return([])
+
+  # Ok, it's now worth taking a real look at the entities.
+  stats.rpcs += 1
+  requests = yield ndb.get_multi_async(
+      task_to_run_key_to_request_key(t.key) for _, t in candidates)
+  out = []
+  for request, (p, to_run) in zip(requests, candidates):
+    props = request.task_slice(to_run.task_slice_index).properties
+
+    # The hash may have conflicts. Ensure the dimensions actually match by
+    # verifying the TaskRequest.
+    #
+    # There's a probability of 2**-31 of conflicts, which is low enough for our
+    # purpose.
+    if not match_dimensions(props.dimensions, bot_dimensions):
+      logging.debug('_validate_tasks_async(%s): dimensions mismatch', p)
+      stats.real_mismatch += 1
+      continue
+
+    # Expire as the bot polls by returning it, and task_scheduler will handle
+    # it.
+    if to_run.expiration_ts < now:
+      logging.debug(
+          '_validate_tasks_async(%s): expired %s < %s',
+          p, to_run.expiration_ts, now)
+      stats.expired += 1
+    else:
+      # It's a valid task! Note that in the meantime, another bot may have
+      # reaped it. This is verified one last time in
+      # task_scheduler._reap_task() by calling set_lookup_cache().
+      logging.info('_validate_tasks_async(%s): ready to reap!', p)
+    out.append((request, to_run))
+  raise ndb.Return(out)
 
 
 def _yield_pages_async(q, size):
@@ -355,10 +513,66 @@ def _get_task_to_run_query(dimensions_hash):
               TaskToRun.queue_number < ((dimensions_hash+1) << 31))
 
 
+class _QueueCursor(object):
+  """Streams the TaskToRun of a single dimensions_hash queue one page at a time.
+
+  Only one page is in flight at a time and the next page is only fetched on
+  demand via prefetch(), so queues that are far from the top of the merge do
+  not cost any additional RPC.
+  """
+  def __init__(self, index, dimensions_hash, ready):
+    self.index = index
+    self.dimensions_hash = dimensions_hash
+    # Buffered TaskToRun, in queue_number order as returned by the query.
+    self.items = collections.deque()
+    # ndb.Future for the page currently being fetched, if any.
+    self.future = None
+    # Set once the queue is known to be empty or not.
+    self.reported = False
+    self._yielder = _yield_pages_async(
+        _get_task_to_run_query(dimensions_hash), _PAGE_SIZE)
+    self._ready = ready
+
+  def prefetch(self):
+    """Fires the fetch of the next page if possible.
+
+    Returns True if a new page is in flight.
+    """
+    if self.future or not self._yielder:
+      return False
+    self.future = next(self._yielder, None)
+    if not self.future:
+      self._yielder = None
+      return False
+    self.future.add_immediate_callback(self._ready.append, self)
+    return True
+
+  def consume(self):
+    """Moves the items of the completed page into the buffer.
+
+    Returns True if the buffer was empty and is now not.
+    """
+    was_empty = not self.items
+    # The ndb.Query ask for a valid queue_number but under load, it happens the
+    # value is not valid anymore.
+    self.items.extend(i for i in self.future.get_result() if i.queue_number)
+    self.future = None
+    return was_empty and bool(self.items)
+
+
 def _yield_potential_tasks(bot_id):
   """Queries all the known task queues in parallel and yields the task in order
   of priority.
 
+  The queues recently found empty by this instance are not queried, see
+  _PendingQueuesIndex.
+
+  This is a k-way merge of the queues: each queue is a sorted stream of
+  TaskToRun (via _QueueCursor) and a heap keyed on
+  _queue_number_order_priority() contains the head of every queue with buffered
+  items. The next page of a queue is only fetched once its buffer runs low,
+  which only happens when the queue's items are at the top of the heap.
+
   The ordering is opportunistic, not strict. There's a risk of not returning
   exactly in the priority order depending on index staleness and query execution
   latency. The number of queries is unbounded.
@@ -373,69 +587,82 @@ def _yield_potential_tasks(bot_id):
   """
   bot_root_key = bot_management.get_root_key(bot_id)
   potential_dimensions_hashes = task_queues.get_queues(bot_root_key)
+  # Skip the queues recently found empty. This is what makes polls from idle
+  # bots cheap.
+  dimensions_hashes = _pending_queues.filter_queues(potential_dimensions_hashes)
   # Note that the default ndb.EVENTUAL_CONSISTENCY is used so stale items may be
   # returned. It's handled specifically by consumers of this function.
   start = time.time()
-  queries = [_get_task_to_run_query(d) for d in potential_dimensions_hashes]
-  yielders = [_yield_pages_async(q, 10) for q in queries]
-  # We do care about the first page of each query so we cannot merge all the
-  # results of every query insensibly.
-  futures = []
+  # Cursors whose page completed, appended by the ndb.Future callbacks.
+  ready = collections.deque()
+  cursors = [
+      _QueueCursor(i, d, ready) for i, d in enumerate(dimensions_hashes)
+  ]
+  # Heap of (priority, cursor index) for each cursor with buffered items. A
+  # cursor is in the heap at most once; the index breaks ties deterministically.
+  heap = []
+  # Number of pages in flight.
+  pending = 0
+  pages = 0
+  yielded = 0
+
+  def push_head(cursor):
+    heapq.heappush(
+        heap, (_queue_number_order_priority(cursor.items[0]), cursor.index))
 
   try:
-    for y in yielders:
-      futures.append(next(y, None))
+    # We do care about the first page of each query so we cannot merge all the
+    # results of every query insensibly.
+    for c in cursors:
+      if c.prefetch():
+        pending += 1
 
-    while (time.time() - start) < 1 and not all(f.done() for f in futures if f):
+    while (time.time() - start) < 1 and len(ready) < pending:
       r = ndb.eventloop.run0()
       if r is None:
         break
       time.sleep(r)
     logging.debug(
-        '_yield_potential_tasks(%s): waited %.3fs for %d items from %d Futures',
-        bot_id, time.time() - start,
-        sum(len(f.get_result()) for f in futures if f.done()),
-        len(futures))
-    # items is a list of TaskToRun. The entities are needed because property
-    # queue_number is used to sort according to each task's priority.
-    items = []
-    for i, f in enumerate(futures):
-      if f and f.done():
-        # The ndb.Future returns a list of up to 10 TaskToRun entities.
-        r = f.get_result()
-        if r:
-          # The ndb.Query ask for a valid queue_number but under load, it
-          # happens the value is not valid anymore.
-          items.extend(i for i in r if i.queue_number)
-          # Prime the next page, in case.
-          futures[i] = next(yielders[i], None)
-
-    # That's going to be our search space for now.
-    items.sort(key=_queue_number_order_priority)
+        '_yield_potential_tasks(%s): waited %.3fs for %d/%d Futures',
+        bot_id, time.time() - start, len(ready), pending)
 
     # It is possible that there is no items yet, in case all futures are taking
     # more than 1 second.
-    # It is possible that all futures are done if every queue has less than 10
-    # task pending.
-    while any(futures) or items:
-      logging.debug(
-          '_yield_potential_tasks(%s): yielding %s items and %s active futures',
-          bot_id, len(items), len(list(filter(bool, futures))))
-      if items:
-        yield items[0]
-        items = items[1:]
-      else:
+    # It is possible that all futures are done if every queue has less than
+    # _PAGE_SIZE task pending.
+    while True:
+      while ready:
+        c = ready.popleft()
+        pending -= 1
+        pages += 1
+        if c.consume():
+          push_head(c)
+          if not c.reported:
+            c.reported = True
+            _pending_queues.set_queried(c.dimensions_hash, True)
+        elif not c.items:
+          # Empty page, e.g. all items were stale. Keep going.
+          if c.prefetch():
+            pending += 1
+          elif not c.reported:
+            c.reported = True
+            _pending_queues.set_queried(c.dimensions_hash, False)
+      if heap:
+        _, i = heapq.heappop(heap)
+        c = cursors[i]
+        item = c.items.popleft()
+        if c.items:
+          push_head(c)
+        # This queue is at the top, make sure its next page is coming.
+        if len(c.items) <= _PREFETCH_THRESHOLD and c.prefetch():
+          pending += 1
+        yielded += 1
+        yield item
+      elif pending:
         # Let activity happen.
         ndb.eventloop.run1()
-      changed = False
-      for i, f in enumerate(futures):
-        if f and f.done():
-          # See loop above for explanation.
-          items.extend(i for i in f.get_result() if i.queue_number)
-          futures[i] = next(yielders[i], None)
-          changed = True
-      if changed:
-        items.sort(key=_queue_number_order_priority)
+      else:
+        break
   except apiproxy_errors.DeadlineExceededError as e:
     # This is normally due to: "The API call datastore_v3.RunQuery() took too
     # long to respond and was cancelled."
@@ -445,6 +672,12 @@ def _yield_potential_tasks(bot_id):
     logging.error(
         'Failed to yield a task due to an RPC timeout. Returning no '
         'task to the bot: %s', e)
+  finally:
+    logging.debug(
+        '_yield_potential_tasks(%s): yielded %d items from %d pages over %d '
+        'queues (%d skipped as empty) in %.3fs', bot_id, yielded, pages,
+        len(cursors), len(potential_dimensions_hashes) - len(cursors),
+        time.time() - start)
 
 
 ### Public API.
@@ -551,6 +784,19 @@ def set_lookup_cache(to_run_key, is_available_to_schedule):
   return memcache.add(key, True, time=cache_lifetime, namespace='task_to_run')
 
 
+def set_queue_pending(request, to_run_key, is_pending):
+  """Updates the in-process index of empty queues when a TaskToRun is enqueued
+  or dequeued by this instance.
+
+  A queue with tasks enqueued by this instance is always queried by
+  yield_next_available_task_to_dispatch(). Queues are only skipped when they
+  were recently found empty, see _PendingQueuesIndex.
+  """
+  props = request.task_slice(task_to_run_key_slice_index(to_run_key)).properties
+  _pending_queues.add(
+      task_queues.hash_dimensions(props.dimensions), 1 if is_pending else -1)
+
+
 def yield_next_available_task_to_dispatch(bot_dimensions):
   """Yields next available (TaskRequest, TaskToRun) in decreasing order of
   priority.
@@ -570,6 +816,7 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
   stats = _QueryStats()
   bot_id = bot_dimensions[u'id'][0]
   futures = collections.deque()
+  batch = []
   try:
     for ttr in _yield_potential_tasks(bot_id):
       duration = (utils.utcnow() - now).total_seconds()
@@ -581,12 +828,15 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
         # search to 40s, it gives 20s to complete the reaping and complete the
         # HTTP request.
         return
-      futures.append(_validate_task_async(bot_dimensions, stats, now, ttr))
+      batch.append(ttr)
+      if len(batch) < _VALIDATION_BATCH_SIZE:
+        continue
+      futures.append(_validate_tasks_async(bot_dimensions, stats, now, batch))
+      batch = []
       while futures:
         # Keep a FIFO or LIFO queue ordering, depending on configuration.
         if futures[0].done():
-          request, task = futures[0].get_result()
-          if request and task:
+          for request, task in futures[0].get_result():
             yield request, task
             # If the code is still executed, it means that the task reaping
             # wasn't successful. Note that this includes expired ones, which is
@@ -594,14 +844,16 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
             stats.ignored += 1
           futures.popleft()
         # Don't batch too much.
-        if len(futures) < 50:
+        if len(futures) < _VALIDATION_MAX_BATCHES:
           break
         futures[0].wait()
 
-    # No more tasks to yield. Empty the pending futures.
+    # No more tasks to yield. Validate the partial batch and empty the pending
+    # futures.
+    if batch:
+      futures.append(_validate_tasks_async(bot_dimensions, stats, now, batch))
     while futures:
-      request, task = futures[0].get_result()
-      if request and task:
+      for request, task in futures[0].get_result():
         yield request, task
         # If the code is still executed, it means that the task reaping
         # wasn't successful. Same as above about expired.
@@ -611,7 +863,7 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
     # Don't leave stray RPCs as much as possible, this can mess up following
     # HTTP handlers.
     ndb.Future.wait_all(futures)
-    # stats output is a bit misleading here, as many _validate_task_async()
+    # stats output is a bit misleading here, as many _validate_tasks_async()
     # could be started yet never yielded.
     logging.debug(
         'yield_next_available_task_to_dispatch(%s) in %.3fs: %s',
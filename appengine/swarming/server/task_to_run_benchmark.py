@@ -0,0 +1,88 @@
+#!/usr/bin/env vpython
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Micro-benchmark of the TaskToRun queues merge done when a bot polls.
+
+The Datastore queries are replaced with a fake in-memory ndb.Query so only the
+cost of the merge in task_to_run._yield_potential_tasks() is measured.
+"""
+
+import argparse
+import logging
+import random
+import sys
+import time
+
+import test_env
+test_env.setup_test_env()
+
+import test_env_handlers
+from server import task_queues
+from server import task_to_run
+
+
+def gen_queries(nb_queues, nb_tasks):
+  """Returns a dict of dimensions_hash to test_env_handlers.FakeQuery.
+
+  nb_tasks TaskToRun are randomly spread across nb_queues queues, each queue
+  sorted by queue_number like the real index.
+  """
+  rnd = random.Random(0)
+  items = {}
+  for _ in range(nb_tasks):
+    h = rnd.randint(1, nb_queues)
+    # Priority in the top 9 bits, then a timestamp.
+    low = (rnd.randint(0, 255) << 22) + rnd.randint(0, 0x3FFFFF)
+    items.setdefault(h, []).append(
+        task_to_run.TaskToRun(queue_number=(h << 31) | low))
+  return {
+      h: test_env_handlers.FakeQuery(sorted(v, key=lambda t: t.queue_number))
+      for h, v in items.items()
+  }
+
+
+def run(nb_queues, nb_tasks, reap):
+  queries = gen_queries(nb_queues, nb_tasks)
+  task_queues.get_queues = lambda _: sorted(queries)
+  task_to_run._get_task_to_run_query = lambda h: queries[h]
+
+  start = time.time()
+  gen = task_to_run._yield_potential_tasks(u'bot1')
+  next(gen)
+  first = time.time() - start
+  # Simulates a bot that has to skip a few candidates before reaping one.
+  for _ in range(reap - 1):
+    next(gen, None)
+  reaped = time.time() - start
+  pages = sum(q.pages for q in queries.values())
+  total = reap + sum(1 for _ in gen)
+  drain = time.time() - start
+  print('%d queues, %d tasks:' % (len(queries), total))
+  print('  first item:   %7.1fms' % (first * 1000.))
+  print('  %4d items:   %7.1fms (%d pages fetched)' % (
+      reap, reaped * 1000., pages))
+  print('  all items:    %7.1fms (%d pages fetched)' % (
+      drain * 1000., sum(q.pages for q in queries.values())))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+  parser.add_argument(
+      '--queues', type=int, default=500, help='Number of dimensions_hash')
+  parser.add_argument(
+      '--tasks', type=int, default=10000, help='Number of pending TaskToRun')
+  parser.add_argument(
+      '--reap', type=int, default=50,
+      help='Number of items consumed to simulate a poll')
+  parser.add_argument('-v', '--verbose', action='store_true')
+  args = parser.parse_args()
+  logging.basicConfig(
+      level=logging.DEBUG if args.verbose else logging.ERROR)
+  run(args.queues, args.tasks, args.reap)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -965,6 +965,131 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
         sorted(expected, key=sort_key),
         sorted(expired_task_to_runs, key=sort_key))
 
+  def test_validate_tasks_async(self):
+    request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'default']}
+    bot_dimensions = {
+        u'id': [u'localhost'],
+        u'os': [u'Windows-3.1.1'],
+        u'pool': [u'default'],
+    }
+    candidates = [
+        self._gen_new_task_to_run(
+            1 if i == 0 else 0,
+            properties=_gen_properties(dimensions=request_dimensions))
+        for i in range(3)
+    ]
+    # The second one is about to be reaped by another bot.
+    task_to_run.set_lookup_cache(candidates[1][1].key, False)
+
+    stats = task_to_run._QueryStats()
+    actual = task_to_run._validate_tasks_async(
+        bot_dimensions, stats, self.now,
+        [to_run for _, to_run in candidates]).get_result()
+    expected = [candidates[0], candidates[2]]
+    self.assertEqual(
+        [(r.key, t.key) for r, t in expected],
+        [(r.key, t.key) for r, t in actual])
+    # One memcache get_multi and one Datastore get_multi.
+    self.assertEqual(2, stats.rpcs)
+    self.assertEqual(3, stats.total)
+    self.assertEqual(1, stats.cache_lookup)
+
+    # All candidates in the negative cache, the TaskRequest are not fetched.
+    task_to_run.set_lookup_cache(candidates[0][1].key, False)
+    stats = task_to_run._QueryStats()
+    actual = task_to_run._validate_tasks_async(
+        bot_dimensions, stats, self.now,
+        [candidates[0][1], candidates[1][1]]).get_result()
+    self.assertEqual([], actual)
+    self.assertEqual(1, stats.rpcs)
+
+  def test_set_queue_pending(self):
+    request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'default']}
+    request = self.mkreq(
+        1, _gen_request(
+            properties=_gen_properties(dimensions=request_dimensions)))
+    bot_dimensions = {
+        u'id': [u'localhost'],
+        u'os': [u'Windows-3.1.1'],
+        u'pool': [u'default'],
+    }
+    index = task_to_run._pending_queues
+    # The queue is queried and found empty.
+    self.assertEqual([], _yield_next_available_task_to_dispatch(bot_dimensions))
+    self.assertEqual((0, 1), (index.hits, index.misses))
+
+    # Enqueue a task without updating the index, like another instance would.
+    to_run = task_to_run.new_task_to_run(request, 0)
+    to_run.put()
+    self.assertEqual([], _yield_next_available_task_to_dispatch(bot_dimensions))
+    self.assertEqual((1, 1), (index.hits, index.misses))
+
+    # Once this instance enqueues in this queue, it is queried again.
+    task_to_run.set_queue_pending(request, to_run.key, True)
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions)))
+    self.assertEqual((1, 2), (index.hits, index.misses))
+    self.assertEqual(0, index.false_empties)
+
+    # Dequeuing it doesn't make the queue empty, it has to be queried.
+    task_to_run.set_queue_pending(request, to_run.key, False)
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions)))
+    self.assertEqual((1, 3), (index.hits, index.misses))
+
+  def test_pending_queues_index_expiration(self):
+    now = 1000.
+    self.mock(utils, 'time_time', lambda: now)
+    index = task_to_run._PendingQueuesIndex()
+    self.assertEqual([1, 2], index.filter_queues([1, 2]))
+    index.set_queried(1, False)
+    index.set_queried(2, True)
+    self.assertEqual([2], index.filter_queues([1, 2]))
+    self.assertEqual((1, 3, 0), (index.hits, index.misses, index.false_empties))
+
+    # Another instance enqueued a task in queue 1; it is found once the entry
+    # expired.
+    now += task_to_run._EMPTY_QUEUE_TTL_SECS
+    self.assertEqual([1, 2], index.filter_queues([1, 2]))
+    index.set_queried(1, True)
+    self.assertEqual(1, index.false_empties)
+
+    # An empty result right after a local enqueue is ignored as the Datastore
+    # index may be stale.
+    index.add(2, 1)
+    index.set_queried(2, False)
+    self.assertEqual([1, 2], index.filter_queues([1, 2]))
+    now += task_to_run._EMPTY_QUEUE_TTL_SECS
+    index.set_queried(2, False)
+    self.assertEqual([1], index.filter_queues([1, 2]))
+
+  def test_yield_potential_tasks_merge(self):
+    # Two queues with interleaved priorities and one with low priority items;
+    # the merge must be globally ordered and only fetch the pages of the queues
+    # reaching the top.
+    queries = {}
+    for h, offset in ((1, 1), (2, 2), (3, 1000)):
+      queries[h] = test_env_handlers.FakeQuery([
+          task_to_run.TaskToRun(queue_number=(h << 31) | (i * 2 + offset))
+          for i in range(25)
+      ])
+    self.mock(task_queues, 'get_queues', lambda _: [1, 2, 3])
+    self.mock(task_to_run, '_get_task_to_run_query', lambda h: queries[h])
+
+    gen = task_to_run._yield_potential_tasks(u'bot1')
+    first = [next(gen) for _ in range(20)]
+    self.assertEqual(
+        range(1, 21),
+        [task_to_run._queue_number_order_priority(t) for t in first])
+    # Queue 3 was never at the top so only its first page was fetched.
+    self.assertEqual(1, queries[3].pages)
+
+    rest = list(gen)
+    actual = [task_to_run._queue_number_order_priority(t) for t in rest]
+    self.assertEqual(sorted(actual), actual)
+    self.assertEqual(75, len(first) + len(rest))
+    self.assertEqual(3, queries[3].pages)
+
   def test_is_reapable(self):
     request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'default']}
     _, to_run = self._gen_new_task_to_run(
@@ -989,7 +1114,14 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
     request = self.mkreq(1, _gen_request())
     to_run_1 = task_to_run.new_task_to_run(request, 0)
     to_run_1.put()
-    lookup = lambda k: task_to_run._lookup_cache_is_taken_async(k).get_result()
+    def lookup(to_run_key):
+      # _validate_tasks_async() skips the TaskToRun in the negative cache. The
+      # others never match the empty bot dimensions.
+      stats = task_to_run._QueryStats()
+      task_to_run._validate_tasks_async(
+          {}, stats, self.now,
+          [task_to_run.TaskToRun(key=to_run_key)]).get_result()
+      return bool(stats.cache_lookup)
     # By default, the negative cache is false, i.e. it is safe to reap the task.
     self.assertEqual(False, lookup(to_run_1.key))
     # Mark to_run_1 as safe to reap.
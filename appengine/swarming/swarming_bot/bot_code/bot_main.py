@@ -88,6 +88,10 @@ SINGLETON = singleton.Singleton(THIS_DIR)
 # Dirname of kvs cache used to store small files from cas.
 _CAS_KVS_CACHE_DB = 'cas_kvs_cache_db'
 
+# The run_isolated process computing the named cache sizes, started by
+# _start_named_cache_sizer().
+_NAMED_CACHE_SIZER = None
+
 # Allowlist files that can be present in the bot's directory. Anything else
 # will be forcibly deleted on startup! Note that 'w' (work) is not in this list,
 # as we want it to be deleted on startup.
@@ -803,7 +807,8 @@ def _clean_cache(botobj):
   up the mess properly.
 
   It will remove unexpected files, remove corrupted files, trim the cache size
-  based on the policies and update state.json.
+  based on the policies and update state.json. Then it starts computing the
+  sizes of the named caches in the background.
   """
   cmd = [
     sys.executable, THIS_FILE, 'run_isolated',
@@ -811,6 +816,11 @@ def _clean_cache(botobj):
     '--log-file', os.path.join(botobj.base_dir, 'logs', 'run_isolated.log'),
   ]
   cmd.extend(_run_isolated_flags(botobj))
+  # Concurrent reads only cause seeks on rotational disks.
+  verify_threads = 1
+  if os_utilities.get_ssd():
+    verify_threads = min(os_utilities.get_num_processors(), 16)
+  cmd.extend(['--cache-verify-threads', str(verify_threads)])
   logging.info('Running: %s', cmd)
   try:
     # Intentionally do not use a timeout, it can take a while to hash 50gb but
@@ -824,6 +834,36 @@ def _clean_cache(botobj):
   except OSError:
     botobj.post_error(
         'swarming_bot.zip internal failure during run_isolated --clean')
+  _start_named_cache_sizer(botobj)
+
+
+def _start_named_cache_sizer(botobj):
+  """Starts run_isolated to compute the sizes of the named caches uninstalled
+  by the last task.
+
+  It takes minutes for large caches, so it is not waited for and the bot polls
+  for its next task right away. The next run_isolated picks up the sizes when
+  trimming the caches.
+  """
+  global _NAMED_CACHE_SIZER
+  if _NAMED_CACHE_SIZER and _NAMED_CACHE_SIZER.poll() is None:
+    logging.info('run_isolated --named-cache-sizes is still running')
+    return
+  cmd = [
+    sys.executable, THIS_FILE, 'run_isolated',
+    '--named-cache-sizes',
+    '--named-cache-root', os.path.join(botobj.base_dir, 'c'),
+    '--log-file',
+    os.path.join(botobj.base_dir, 'logs', 'run_isolated_sizes.log'),
+  ]
+  logging.info('Running: %s', cmd)
+  try:
+    # It logs to its log file, its output is not read.
+    _NAMED_CACHE_SIZER = _Popen(botobj, cmd, stdout=None)
+  except OSError:
+    botobj.post_error(
+        'swarming_bot.zip internal failure during run_isolated '
+        '--named-cache-sizes')
 
 
 def _post_error_task(botobj, error, task_id):
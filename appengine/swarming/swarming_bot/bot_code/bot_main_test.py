@@ -524,7 +524,11 @@ class TestBotMain(TestBotBase):
         expected = [sys.executable, bot_main.THIS_FILE, 'run_isolated']
         self.assertEqual(expected, cmd[:len(expected)])
         self.assertEqual(True, detached)
-        self.assertEqual(subprocess42.PIPE, stdout)
+        if '--named-cache-sizes' in cmd:
+          # Not waited for.
+          self.assertEqual(None, stdout)
+        else:
+          self.assertEqual(subprocess42.PIPE, stdout)
         self.assertEqual(subprocess42.STDOUT, stderr)
         self.assertEqual(subprocess42.PIPE, stdin)
         if sys.platform == 'win32':
@@ -539,6 +543,7 @@ class TestBotMain(TestBotBase):
         self2.returncode = 0
         return '', None
     self.mock(subprocess42, 'Popen', Popen)
+    self.mock(bot_main, '_NAMED_CACHE_SIZER', None)
 
     self.expected_requests([
         (
@@ -1077,6 +1082,50 @@ class TestBotMain(TestBotBase):
 
     self.assertEqual(0, bot_main.main([]))
 
+  def test_clean_cache(self):
+    # run_isolated --clean is waited for, the named cache sizer is not.
+    procs = []
+    class Popen(object):
+      def __init__(self2, cmd, **_kwargs):
+        self2.cmd = cmd
+        self2.returncode = None
+        self2.communicated = False
+        procs.append(self2)
+
+      def communicate(self2, i):
+        self.assertEqual(None, i)
+        self2.communicated = True
+        self2.returncode = 0
+        return '', None
+
+      def poll(self2):
+        return self2.returncode
+    self.mock(subprocess42, 'Popen', Popen)
+    self.mock(bot_main, '_NAMED_CACHE_SIZER', None)
+
+    bot_main._clean_cache(self.bot)
+    self.assertEqual(2, len(procs))
+    self.assertIn('--clean', procs[0].cmd)
+    self.assertTrue(procs[0].communicated)
+    expected = [
+        sys.executable, bot_main.THIS_FILE, 'run_isolated',
+        '--named-cache-sizes',
+        '--named-cache-root', os.path.join(self.bot.base_dir, 'c'),
+    ]
+    self.assertEqual(expected, procs[1].cmd[:len(expected)])
+    self.assertFalse(procs[1].communicated)
+
+    # The sizer is still running, another one is not started.
+    bot_main._clean_cache(self.bot)
+    self.assertEqual(3, len(procs))
+    self.assertIn('--clean', procs[2].cmd)
+
+    # Once it's done, a new one is started.
+    procs[1].returncode = 0
+    bot_main._clean_cache(self.bot)
+    self.assertEqual(5, len(procs))
+    self.assertIn('--named-cache-sizes', procs[4].cmd)
+
   def test_update_lkgbc(self):
     # Create LKGBC with a timestamp from 1h ago.
     lkgbc = os.path.join(self.bot.base_dir, 'swarming_bot.zip')
@@ -14,6 +14,7 @@ import swarming_test_env
 swarming_test_env.setup_test_env()
 
 from google.appengine.api import app_identity
+from google.appengine.ext import ndb
 
 from protorpc.remote import protojson
 import webtest
@@ -37,6 +38,7 @@ from server import large
 from server import pools_config
 from server import realms
 from server import service_accounts
+from server import task_to_run
 
 # Realm permissions used in Swarming.
 _ALL_PERMS = [
@@ -44,6 +46,23 @@ _ALL_PERMS = [
 ]
 
 
+class FakeQuery(object):
+  """Mimics the ndb.Query returned by task_to_run._get_task_to_run_query()."""
+
+  def __init__(self, items):
+    self.items = items
+    self.pages = 0
+
+  def fetch_page_async(self, size, start_cursor=None, deadline=None):
+    # pylint: disable=unused-argument
+    start = start_cursor or 0
+    end = start + size
+    self.pages += 1
+    f = ndb.Future()
+    f.set_result((self.items[start:end], end, end < len(self.items)))
+    return f
+
+
 class AppTestBase(test_case.TestCase):
   APP_DIR = swarming_test_env.APP_DIR
 
@@ -54,6 +73,8 @@ class AppTestBase(test_case.TestCase):
     self.testbed.init_user_stub()
 
     gae_ts_mon.reset_for_unittest(disable=True)
+    # The index of empty queues is process-local, don't leak it across tests.
+    task_to_run._pending_queues.reset()
 
     # By default requests in tests are coming from bot with fake IP.
     # WSGI app that implements auth REST API.
@@ -243,6 +243,17 @@ _bot_auth_successes = gae_ts_mon.CounterMetric(
     ])
 
 
+# Instance-local metric. Metric fields:
+# - result: one of 'hit' (the queue query was skipped as the queue is known to
+#   be empty), 'miss' (the queue had to be queried) or 'false_empty' (a queue
+#   that was considered empty was found to have pending tasks).
+_pending_queues_index = gae_ts_mon.CounterMetric(
+    'swarming/scheduler/pending_queues_index',
+    'Lookups in the in-process index of empty task queues.', [
+        gae_ts_mon.StringField('result'),
+    ])
+
+
 ### Private stuff.
 
 
@@ -503,6 +514,12 @@ def on_bot_auth_success(auth_method, condition):
   })
 
 
+def on_pending_queues_index(result, count=1):
+  """When the in-process index of empty task queues is looked up."""
+  if count:
+    _pending_queues_index.increment_by(count, fields={'result': result})
+
+
 def set_global_metrics(kind, payload=None):
   if kind == 'jobs':
     _set_jobs_metrics(payload)
@@ -324,6 +324,15 @@ class TestMetrics(test_case.TestCase):
         ts_mon_metrics._tasks_slice_expiration_delay.get(
             fields=dict(fields, slice_index=0)).sum)
 
+  def test_on_pending_queues_index(self):
+    ts_mon_metrics.on_pending_queues_index('hit', 3)
+    ts_mon_metrics.on_pending_queues_index('hit')
+    ts_mon_metrics.on_pending_queues_index('miss', 0)
+    self.assertEqual(
+        4, ts_mon_metrics._pending_queues_index.get(fields={'result': 'hit'}))
+    self.assertIsNone(
+        ts_mon_metrics._pending_queues_index.get(fields={'result': 'miss'}))
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
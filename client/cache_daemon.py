@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Serves an isolated cache shared by the bots running on a host.
+
+Each bot otherwise keeps its own DiskContentAddressedCache, so the same items
+are fetched and stored once per bot, and each bot loads and trims its own
+state. The daemon owns a single cache directory; run_isolated.py uses it through
+a Unix socket when passed --cache-daemon, and falls back to its own --cache
+directory when no daemon listens on the socket.
+
+The bots read and write the items in the cache directory themselves, so they
+must run as the same user as the daemon. The daemon only does the bookkeeping:
+- An item is fetched by a single bot at a time, the others wait for it.
+- The items used by a connected bot are pinned, they are not evicted until the
+  bot disconnects.
+- The LRU state is shared and saved, and the cache trimmed, by the daemon.
+
+The protocol is a JSON object per line in each direction. Each connection is a
+session owning its pins and reservations, released when it is closed.
+"""
+
+from __future__ import print_function
+
+__version__ = '0.1'
+
+import collections
+import errno
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+
+from utils import tools
+tools.force_local_third_party()
+
+# third_party/
+from depot_tools import fix_encoding
+import six
+from six.moves import socketserver
+
+# pylint: disable=ungrouped-imports
+import isolateserver
+import local_caching
+from utils import file_path
+from utils import fs
+from utils import logging_utils
+from utils import subprocess42
+
+
+# Version of the protocol, checked by the 'hello' command.
+PROTOCOL_VERSION = 2
+
+
+class CacheDaemonError(Exception):
+  """The daemon failed to process a command."""
+
+
+class SharedContentAddressedCache(local_caching.DiskContentAddressedCache):
+  """DiskContentAddressedCache whose items can be pinned by the bots.
+
+  Pinned items are not evicted. They replace the protection of the items
+  referenced during a run, which is meaningless for a cache used by concurrent
+  runs.
+  """
+
+  def __init__(self, *args, **kwargs):
+    # digest -> number of sessions pinning it. Set before the base class loads
+    # and trims the cache.
+    self._pins = collections.Counter()
+    super(SharedContentAddressedCache, self).__init__(*args, **kwargs)
+
+  def pin(self, digest):
+    with self._lock:
+      self._pins[digest] += 1
+
+  def unpin(self, digest):
+    with self._lock:
+      self._pins[digest] -= 1
+      if not self._pins[digest]:
+        del self._pins[digest]
+
+  def path(self, digest):
+    return self._path(digest)
+
+  def digests(self):
+    with self._lock:
+      return list(self._lru)
+
+  def add(self, digest, size):
+    """Adds an item written in the cache directory by a bot."""
+    with self._lock:
+      self._add(digest, size)
+
+  def _remove_lru_file(self, allow_protected):
+    self._lock.assert_locked()
+    # The pinned items are in use, make them the most recent instead. Once all
+    # the pinned items were skipped, only pinned items are left.
+    skipped = 0
+    while self._lru and self._lru.get_oldest()[0] in self._pins:
+      if skipped == len(self._pins):
+        raise local_caching.NoMoreSpace(
+            'All the %d items of %s are in use' % (
+                len(self._lru), self.cache_dir))
+      self._lru.touch(self._lru.get_oldest()[0])
+      skipped += 1
+    return super(SharedContentAddressedCache, self)._remove_lru_file(True)
+
+
+class _Session(object):
+  """State of a connection."""
+
+  def __init__(self):
+    # Digests pinned by this session.
+    self.pins = set()
+    # Digests this session is writing.
+    self.reserved = set()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+  """Processes the commands of a connection, one per line."""
+
+  def handle(self):
+    session = _Session()
+    try:
+      while True:
+        line = self.rfile.readline()
+        if not line:
+          return
+        reply = self.server.process(session, json.loads(line.decode('utf-8')))
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+    except (IOError, OSError) as e:
+      logging.warning('Connection lost: %s', e)
+    finally:
+      self.server.close_session(session)
+
+
+class CacheServer(socketserver.ThreadingUnixStreamServer):
+  """Serves a SharedContentAddressedCache on a Unix socket."""
+
+  daemon_threads = True
+
+  def __init__(self, socket_path, cache):
+    # The socketserver classes are old style classes on python 2.
+    socketserver.ThreadingUnixStreamServer.__init__(
+        self, socket_path, _Handler)
+    os.chmod(socket_path, 0o600)
+    self.cache = cache
+    # Protects _writing. The cache is not called while holding it.
+    self._cond = threading.Condition()
+    # digest -> session writing it.
+    self._writing = {}
+
+  def process(self, session, request):
+    """Runs one command and returns the reply."""
+    try:
+      handler = getattr(self, '_cmd_' + request.get('cmd', ''), None)
+      if not handler:
+        return {'error': 'Error', 'message': 'Unknown command %r' % request}
+      return handler(session, request)
+    except local_caching.CacheMiss as e:
+      return {'error': 'CacheMiss', 'message': str(e)}
+    except local_caching.NoMoreSpace as e:
+      return {'error': 'NoMoreSpace', 'message': str(e)}
+    except Exception as e:
+      logging.exception('Failed to process %r', request)
+      return {'error': 'Error', 'message': str(e)}
+
+  def close_session(self, session):
+    """Releases the reservations and pins of a closed connection."""
+    for digest in list(session.reserved):
+      # The bot died while writing the item.
+      file_path.try_remove(self.cache.path(digest))
+      self._release(session, digest)
+    for digest in session.pins:
+      self.cache.unpin(digest)
+    session.pins.clear()
+
+  def _pin(self, session, digest):
+    if digest not in session.pins:
+      self.cache.pin(digest)
+      session.pins.add(digest)
+
+  def _release(self, session, digest):
+    with self._cond:
+      session.reserved.discard(digest)
+      del self._writing[digest]
+      self._cond.notify_all()
+
+  # Commands.
+
+  def _cmd_hello(self, _session, request):
+    if request.get('version') != PROTOCOL_VERSION:
+      return {
+          'error': 'Error',
+          'message': 'Unsupported protocol version %s, expected %s' % (
+              request.get('version'), PROTOCOL_VERSION),
+      }
+    return {
+        'cache_dir': self.cache.cache_dir,
+        'policies': vars(self.cache.policies),
+    }
+
+  def _cmd_stats(self, _session, _request):
+    return {
+        'items': len(self.cache),
+        'total_size': self.cache.total_size,
+        'oldest': self.cache.get_oldest(),
+    }
+
+  def _cmd_list(self, _session, _request):
+    return {'digests': self.cache.digests()}
+
+  def _cmd_contains(self, _session, request):
+    return {'present': request['digest'] in self.cache}
+
+  def _cmd_touch(self, session, request):
+    digest = request['digest']
+    self._pin(session, digest)
+    return {'valid': self.cache.touch(digest, request['size'])}
+
+  def _cmd_open(self, session, request):
+    digest = request['digest']
+    self._pin(session, digest)
+    # Verifies the item if it was modified.
+    with self.cache.getfileobj(digest) as f:
+      return {'path': f.name}
+
+  def _cmd_reserve(self, session, request):
+    """Returns the path where to write an item, unless it is already cached.
+
+    Waits for the item if another session is writing it.
+    """
+    digest = request['digest']
+    self._pin(session, digest)
+    with self._cond:
+      while digest in self._writing:
+        self._cond.wait()
+      self._writing[digest] = session
+      session.reserved.add(digest)
+    # touch() may verify the item, so it is called outside of the condition to
+    # not block the other sessions. The sessions reserving the same item wait
+    # for it.
+    try:
+      present = self.cache.touch(digest, local_caching.UNKNOWN_FILE_SIZE)
+    except:
+      self._release(session, digest)
+      raise
+    if present:
+      self._release(session, digest)
+    return {'path': self.cache.path(digest), 'present': present}
+
+  def _cmd_commit(self, session, request):
+    digest = request['digest']
+    assert digest in session.reserved, digest
+    try:
+      self.cache.add(digest, request['size'])
+    finally:
+      self._release(session, digest)
+    return {}
+
+  def _cmd_abort(self, session, request):
+    digest = request['digest']
+    assert digest in session.reserved, digest
+    file_path.try_remove(self.cache.path(digest))
+    self._release(session, digest)
+    return {}
+
+  def _cmd_remove_oldest(self, _session, _request):
+    return {'size': self.cache.remove_oldest()}
+
+  def _cmd_trim(self, _session, _request):
+    return {'evicted': self.cache.trim()}
+
+  def _cmd_save(self, _session, _request):
+    self.cache.save()
+    return {}
+
+
+class _Connection(object):
+  """Connection to the daemon."""
+
+  def __init__(self, socket_path):
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      self._sock.connect(socket_path)
+    except:
+      self._sock.close()
+      raise
+    self._rfile = self._sock.makefile('rb')
+
+  def call(self, request):
+    self._sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+    line = self._rfile.readline()
+    if not line:
+      raise IOError('The cache daemon closed the connection')
+    return json.loads(line.decode('utf-8'))
+
+  def close(self):
+    self._rfile.close()
+    self._sock.close()
+
+
+class DaemonContentAddressedCache(local_caching.ContentAddressedCache):
+  """ContentAddressedCache owned by a CacheServer on the same host.
+
+  The items are read and written directly in the cache directory of the daemon.
+  Each thread uses its own connection, so a thread waiting for an item fetched
+  by another bot doesn't block the others. The items used are pinned until
+  close().
+  """
+
+  def __init__(self, socket_path):
+    self._socket_path = socket_path
+    self._local = threading.local()
+    self._conns = []
+    self._conns_lock = threading.Lock()
+    reply = self._call('hello', version=PROTOCOL_VERSION)
+    super(DaemonContentAddressedCache, self).__init__(
+        six.text_type(reply['cache_dir']))
+    # The policies of the daemon, they can differ from the ones of the bot.
+    self.policies = local_caching.CachePolicies(**reply['policies'])
+
+  def close(self):
+    """Closes the connections, releasing the items pinned."""
+    with self._conns_lock:
+      for conn in self._conns:
+        conn.close()
+      self._conns = []
+    self._local = threading.local()
+
+  # Cache interface implementation.
+
+  def __len__(self):
+    return self._call('stats')['items']
+
+  def __iter__(self):
+    return iter(self._call('list')['digests'])
+
+  def __contains__(self, digest):
+    return self._call('contains', digest=digest)['present']
+
+  @property
+  def total_size(self):
+    return self._call('stats')['total_size']
+
+  def get_oldest(self):
+    return self._call('stats')['oldest']
+
+  def remove_oldest(self):
+    return self._call('remove_oldest')['size']
+
+  def save(self):
+    self._call('save')
+
+  def trim(self):
+    return self._call('trim')['evicted']
+
+  def cleanup(self):
+    # The daemon cleans up the directory when it starts, it can't while bots
+    # are writing into it.
+    self.trim()
+
+  # ContentAddressedCache interface implementation.
+
+  def touch(self, digest, size):
+    return self._call('touch', digest=digest, size=size)['valid']
+
+  def getfileobj(self, digest):
+    path = self._call('open', digest=digest)['path']
+    try:
+      f = fs.open(path, 'rb')
+    except IOError:
+      raise local_caching.CacheMiss(digest)
+    with self._lock:
+      self._used.append(os.fstat(f.fileno()).st_size)
+    return f
+
+  def write(self, digest, content):
+    assert content is not None
+    reply = self._call('reserve', digest=digest)
+    if reply['present']:
+      # Another bot fetched it meanwhile, don't fetch it again.
+      if hasattr(content, 'close'):
+        content.close()
+      return digest
+    path = reply['path']
+    file_path.try_remove(path)
+    try:
+      size = local_caching.file_write(path, content)
+      file_path.set_read_only(path, True)
+    except:
+      file_path.try_remove(path)
+      self._call('abort', digest=digest)
+      raise
+    self._call('commit', digest=digest, size=size)
+    with self._lock:
+      self._added.append(size)
+    return digest
+
+  # Internal functions.
+
+  def _call(self, cmd, **kwargs):
+    conn = getattr(self._local, 'conn', None)
+    if not conn:
+      conn = _Connection(self._socket_path)
+      with self._conns_lock:
+        self._conns.append(conn)
+      self._local.conn = conn
+    kwargs['cmd'] = cmd
+    reply = conn.call(kwargs)
+    error = reply.get('error')
+    if error == 'CacheMiss':
+      raise local_caching.CacheMiss(kwargs['digest'])
+    if error == 'NoMoreSpace':
+      raise local_caching.NoMoreSpace(reply['message'])
+    if error:
+      raise CacheDaemonError(reply['message'])
+    return reply
+
+
+def connect(socket_path):
+  """Returns a DaemonContentAddressedCache, or None if the daemon is not
+  running.
+  """
+  if not hasattr(socket, 'AF_UNIX'):
+    logging.warning('Unix sockets are not supported, not using %s',
+                    socket_path)
+    return None
+  try:
+    return DaemonContentAddressedCache(socket_path)
+  except (CacheDaemonError, IOError, OSError) as e:
+    logging.warning('Cache daemon not available at %s: %s', socket_path, e)
+    return None
+
+
+def _remove_stale_socket(socket_path):
+  """Removes the socket of a dead daemon.
+
+  Returns False if a daemon is listening on it.
+  """
+  if not os.path.exists(socket_path):
+    return True
+  try:
+    _Connection(socket_path).close()
+    return False
+  except (IOError, OSError) as e:
+    if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+      raise
+  os.remove(socket_path)
+  return True
+
+
+def create_option_parser():
+  parser = logging_utils.OptionParserWithLogging(
+      usage='%prog --socket <path> [options]', version=__version__)
+  parser.add_option(
+      '--socket', metavar='PATH',
+      help='Unix socket to listen on, passed to run_isolated.py as '
+      '--cache-daemon')
+  isolateserver.add_cache_options(parser)
+  return parser
+
+
+def main(args):
+  parser = create_option_parser()
+  options, args = parser.parse_args(args)
+  if args:
+    parser.error('Unsupported arguments: %s' % args)
+  if not options.socket:
+    parser.error('--socket is required')
+  if not options.cache:
+    parser.error('--cache is required')
+  if not _remove_stale_socket(options.socket):
+    print('A daemon is already listening on %s' % options.socket,
+          file=sys.stderr)
+    return 1
+
+  cache = SharedContentAddressedCache(
+      six.text_type(os.path.abspath(options.cache)),
+      isolateserver.process_cache_policies(options),
+      trim=True,
+      verify_threads=options.cache_verify_threads)
+  cache.cleanup()
+  server = CacheServer(options.socket, cache)
+
+  def stop(*_):
+    # shutdown() waits for serve_forever() to return, it can't be called from
+    # the signal handler which runs on the same thread.
+    threading.Thread(target=server.shutdown).start()
+
+  logging.info('Serving %s on %s', cache.cache_dir, options.socket)
+  try:
+    with subprocess42.set_signal_handler(subprocess42.STOP_SIGNALS, stop):
+      server.serve_forever()
+  finally:
+    server.server_close()
+    file_path.try_remove(options.socket)
+    cache.save()
+  return 0
+
+
+if __name__ == '__main__':
+  subprocess42.inhibit_os_error_reporting()
+  fix_encoding.fix_encoding()
+  tools.disable_buffering()
+  sys.exit(main(sys.argv[1:]))
@@ -598,7 +598,8 @@ class CompleteState(object):
             filepath,
             collapse_symlinks)
         if 'l' not in meta:
-          meta['h'] = isolated_format.hash_file(filepath, self.saved_state.algo)
+          meta['h'] = isolated_format.hash_file_cached(
+              filepath, self.saved_state.algo)
         self.saved_state.files[infile] = meta
 
   def save_files(self):
@@ -964,6 +965,7 @@ def CMDbatcharchive(parser, args):
   options, args = parser.parse_args(args)
   auth.process_auth_options(parser, options)
   isolateserver.process_isolate_server_options(parser, options, True)
+  isolateserver.process_archive_options(options)
 
   # Validate all incoming options, prepare what needs to be archived as a list
   # of tuples (archival options, working directory).
@@ -1237,6 +1239,7 @@ def process_isolate_options(parser, options, cwd=None, require_isolated=True):
   variables, etc.
   """
   cwd = file_path.get_native_path_case(six.ensure_text(cwd or os.getcwd()))
+  isolateserver.process_archive_options(options)
 
   # Parse --isolated option.
   if options.isolated:
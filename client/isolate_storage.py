@@ -13,6 +13,7 @@ import sys
 import threading
 import time
 import types
+import zlib
 
 from utils import file_path
 from utils import net
@@ -22,6 +23,12 @@ import isolated_format
 # third_party/
 import six
 
+# Optional, only needed for the namespaces using zstd compression.
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
 # Chunk size to use when reading from network stream.
 NET_IO_FILE_CHUNK = 16 * 1024
 
@@ -31,6 +38,190 @@ NET_IO_FILE_CHUNK = 16 * 1024
 DOWNLOAD_READ_TIMEOUT = 60
 
 
+# Items at least this large are compressed with multiple threads by ZstdCodec.
+ZSTD_MULTITHREAD_MIN_SIZE = 16 * 1024 * 1024
+
+
+class Codec(object):
+  """Compression scheme of the content stored in a namespace."""
+
+  # Value of 'compression' sent to the server.
+  name = None
+
+  def compress(self, content_generator, level, size=None):
+    """Reads chunks from |content_generator| and yields compressed chunks.
+
+    Arguments:
+      content_generator: yields the chunks of the content to compress.
+      level: compression level, 0 (content unlikely to compress) to 9, on the
+          zlib scale.
+      size: size of the content, if known.
+    """
+    raise NotImplementedError()
+
+  def decompress(self, content_generator, chunk_size):
+    """Reads compressed data from |content_generator| and yields decompressed
+    chunks no larger than |chunk_size|.
+
+    Raises IOError if data is corrupted or incomplete.
+    """
+    raise NotImplementedError()
+
+
+class IdentityCodec(Codec):
+  """The content is stored as-is."""
+  name = ''
+
+  def compress(self, content_generator, level, size=None):
+    return content_generator
+
+  def decompress(self, content_generator, chunk_size):
+    return content_generator
+
+
+class DeflateCodec(Codec):
+  """zlib deflate compression."""
+  name = 'flate'
+
+  def compress(self, content_generator, level, size=None):
+    compressor = zlib.compressobj(level)
+    for chunk in content_generator:
+      compressed = compressor.compress(chunk)
+      if compressed:
+        yield compressed
+    tail = compressor.flush(zlib.Z_FINISH)
+    if tail:
+      yield tail
+
+  def decompress(self, content_generator, chunk_size):
+    # Decompresses data in small chunks so that zip bomb file doesn't cause
+    # zlib to preallocate huge amount of memory.
+    decompressor = zlib.decompressobj()
+    compressed_size = 0
+    try:
+      for chunk in content_generator:
+        compressed_size += len(chunk)
+        data = decompressor.decompress(chunk, chunk_size)
+        if data:
+          yield data
+        while decompressor.unconsumed_tail:
+          data = decompressor.decompress(
+              decompressor.unconsumed_tail, chunk_size)
+          if data:
+            yield data
+      tail = decompressor.flush()
+      if tail:
+        yield tail
+    except zlib.error as e:
+      raise IOError(
+          'Corrupted zip stream (read %d bytes) - %s' % (compressed_size, e))
+    # Ensure all data was read and decompressed.
+    if decompressor.unused_data or decompressor.unconsumed_tail:
+      raise IOError('Not all data was decompressed')
+
+
+class _GeneratorReader(object):
+  """File-like read() interface over a generator of chunks.
+
+  read() may return less than requested, without copying the chunks.
+  """
+
+  def __init__(self, content_generator):
+    self._iter = iter(content_generator)
+    self._chunk = b''
+    self._offset = 0
+    self.size = 0
+
+  def read(self, size=-1):
+    while self._offset == len(self._chunk):
+      self._chunk = next(self._iter, None)
+      self._offset = 0
+      if self._chunk is None:
+        self._chunk = b''
+        return b''
+      self.size += len(self._chunk)
+    if size < 0:
+      size = len(self._chunk)
+    data = self._chunk[self._offset:self._offset + size]
+    self._offset += len(data)
+    return data
+
+
+class ZstdCodec(Codec):
+  """Zstandard compression.
+
+  It is much faster than deflate for a similar ratio. Large items are compressed
+  with one thread per core. Requires the zstandard module.
+  """
+  name = 'zstd'
+
+  def __init__(self, level=3):
+    """
+    Args:
+      level: zstd compression level used for the content likely to compress.
+          The fastest level is used for the others.
+    """
+    self._level = level
+
+  def _check(self):
+    if not zstandard:
+      raise isolated_format.MappingError(
+          'The zstandard module is required for zstd compressed namespaces')
+
+  def compress(self, content_generator, level, size=None):
+    self._check()
+    threads = 0
+    if size is not None and size >= ZSTD_MULTITHREAD_MIN_SIZE:
+      # One thread per core.
+      threads = -1
+    compressor = zstandard.ZstdCompressor(
+        level=self._level if level else 1, threads=threads).compressobj(
+            size=size if size is not None else -1)
+    for chunk in content_generator:
+      compressed = compressor.compress(chunk)
+      if compressed:
+        yield compressed
+    tail = compressor.flush()
+    if tail:
+      yield tail
+
+  def decompress(self, content_generator, chunk_size):
+    self._check()
+    reader = _GeneratorReader(content_generator)
+    stream = zstandard.ZstdDecompressor().stream_reader(
+        reader, read_across_frames=False)
+    try:
+      while True:
+        # Small chunks, so that a zip bomb doesn't use a huge amount of memory.
+        data = stream.read(chunk_size)
+        if not data:
+          break
+        yield data
+    except zstandard.ZstdError as e:
+      raise IOError(
+          'Corrupted zstd stream (read %d bytes) - %s' % (reader.size, e))
+    # Ensure all data was read and decompressed.
+    if reader.read(1):
+      raise IOError('Not all data was decompressed')
+
+
+# Codecs, keyed by the namespace suffix selecting them. Namespaces without any
+# of these suffixes store the content as-is. '-gzip' is a misnomer kept for
+# compatibility, it is deflate.
+CODECS = {
+    '-deflate': DeflateCodec(),
+    '-gzip': DeflateCodec(),
+    '-zstd': ZstdCodec(),
+}
+
+
+def get_codec(namespace):
+  """Returns the Codec used to store content in |namespace|."""
+  for suffix, codec in CODECS.items():
+    if namespace.endswith(suffix):
+      return codec
+  return IdentityCodec()
+
 
 class ServerRef(object):
   """ServerRef is a reference to the remote cache.
@@ -43,7 +234,7 @@ class ServerRef(object):
       url: URL of isolate service to use shared cloud based storage.
       namespace: isolate namespace to operate in, also defines hashing and
         compression scheme used, e.g. namespace names that end with '-gzip'
-        store compressed data.
+        store compressed data. See CODECS.
     """
     assert file_path.is_url(url) or not url, url
     self._url = url.rstrip('/')
@@ -56,7 +247,7 @@ class ServerRef(object):
     if self.namespace.startswith('sha512-'):
       self._hash_algo = hashlib.sha512
       self._hash_algo_name = 'sha-512'
-    self._is_with_compression = self.namespace.endswith(('-gzip', '-deflate'))
+    self._codec = get_codec(self.namespace)
 
   @property
   def url(self):
@@ -75,6 +266,11 @@ class ServerRef(object):
   def hash_algo_name(self):
     return self._hash_algo_name
 
+  @property
+  def codec(self):
+    """Codec used to compress the content stored in |namespace|."""
+    return self._codec
+
   @property
   def is_with_compression(self):
     """True if given |namespace| stores compressed objects.
@@ -82,7 +278,7 @@ class ServerRef(object):
     This means that this is the responsibility of the client to compress the
     data *before* uploading and decompress *after* downloading.
     """
-    return self._is_with_compression
+    return not isinstance(self._codec, IdentityCodec)
 
 
 class Item(object):
@@ -290,7 +486,7 @@ class IsolateServer(StorageApi):
     self._server_ref = server_ref
     algo_name = server_ref.hash_algo_name
     self._namespace_dict = {
-        'compression': 'flate' if server_ref.is_with_compression else '',
+        'compression': server_ref.codec.name,
         'digest_hash': algo_name,
         'namespace': server_ref.namespace,
     }
@@ -346,7 +542,11 @@ class IsolateServer(StorageApi):
           'Invalid response while fetching %s: %s' % (digest, response))
 
     # for GS entities
-    connection = net.url_open(response['url'])
+    kwargs = {}
+    if offset:
+      # Only fetch the tail of the content.
+      kwargs['headers'] = {'Range': 'bytes=%d-' % offset}
+    connection = net.url_open(response['url'], **kwargs)
     if not connection:
       raise IOError(
           'Failed to download %s / %s' % (self.server_ref.namespace, digest))
@@ -379,8 +579,20 @@ class IsolateServer(StorageApi):
       if size is not None and last_byte_index + 1 != size:
         raise IOError('Incomplete response. Content-Range: %s' % content_range)
 
+    # The connection may be closed before the whole content is received, without
+    # any error. Detect it so that the fetch can be resumed.
+    expected = connection.get_header('Content-Length')
+    if connection.get_header('Content-Encoding'):
+      # Content-Length is the size of the encoded content.
+      expected = None
+    received = 0
     for data in connection.iter_content(NET_IO_FILE_CHUNK):
+      received += len(data)
       yield data
+    if expected is not None and received < int(expected):
+      raise IOError(
+          'Connection lost while fetching %s / %s, received %d of %s bytes' %
+          (self.server_ref.namespace, digest, received, expected))
 
   def push(self, item, push_state, content=None):
     assert isinstance(item, Item)
@@ -11,6 +11,7 @@ import os
 import re
 import stat
 import sys
+import time
 
 import six
 
@@ -39,9 +40,50 @@ SUPPORTED_ALGOS = {
 SUPPORTED_ALGOS_REVERSE = dict((v, k) for k, v in SUPPORTED_ALGOS.items())
 
 
+# Hex digest length to hashing algorithm.
+_ALGOS_BY_DIGEST_LENGTH = dict(
+    (2 * v().digest_size, v) for v in SUPPORTED_ALGOS.values())
+
+
 SUPPORTED_FILE_TYPES = ['basic', 'tar']
 
 
+# Files at least this large may be stored as a list of content defined chunks,
+# see chunk_file(). An edit in such a file then only changes the chunks around
+# the edit instead of the whole file.
+CHUNKED_FILE_MIN_SIZE = 16 * 1024 * 1024
+
+
+# Bounds of the chunk sizes. CHUNK_AVG_SIZE must be a power of 2.
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_AVG_SIZE = 1024 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+
+
+# Number of trailing bytes that influence the rolling hash at any position.
+_GEAR_WINDOW = 64
+_GEAR_MASK = (1 << 64) - 1
+
+
+def _gen_gear_table():
+  """Returns the 256 pseudo random 64 bits values used by the rolling hash.
+
+  It must never change, otherwise the chunk boundaries and thus the chunk
+  digests of every file would change.
+  """
+  return [
+      int(hashlib.sha256(str(i).encode()).hexdigest()[:16], 16)
+      for i in range(256)
+  ]
+
+
+_GEAR = _gen_gear_table()
+
+
+# utils.digest_cache.DigestCache used by hash_file_cached(), if any.
+_digest_cache = None
+
+
 class IsolatedError(ValueError):
   """Generic failure to load a .isolated file."""
   pass
@@ -58,6 +100,14 @@ def is_valid_hash(value, algo):
   return bool(re.match(r'^[a-fA-F0-9]{%d}$' % size, value))
 
 
+def get_hash_algo_from_digest(digest):
+  """Returns the hashing algorithm matching the length of a hex digest.
+
+  Returns None if no supported algorithm matches.
+  """
+  return _ALGOS_BY_DIGEST_LENGTH.get(len(digest))
+
+
 def hash_file(filepath, algo):
   """Calculates the hash of a file without reading it all in memory at once.
 
@@ -73,6 +123,94 @@ def hash_file(filepath, algo):
   return digest.hexdigest()
 
 
+def set_digest_cache(cache):
+  """Sets the utils.digest_cache.DigestCache used by hash_file_cached().
+
+  Returns the previous one.
+  """
+  global _digest_cache
+  previous = _digest_cache
+  _digest_cache = cache
+  return previous
+
+
+def hash_file_cached(filepath, algo):
+  """Like hash_file() but first looks up the digest cache, if any.
+
+  Only use for files whose content isn't being verified, since the digest
+  cache trusts the file stat.
+  """
+  cache = _digest_cache
+  if not cache:
+    return hash_file(filepath, algo)
+  algo_name = SUPPORTED_ALGOS_REVERSE[algo]
+  now = time.time()
+  filestats = fs.stat(filepath)
+  digest = cache.get(filepath, algo_name, filestats)
+  if not digest:
+    digest = hash_file(filepath, algo)
+    cache.set(filepath, algo_name, filestats, digest, now)
+  return digest
+
+
+def _find_chunk_boundary(buf, min_size, max_size, threshold):
+  """Returns the size of the first chunk in the bytearray |buf|.
+
+  Uses a gear rolling hash; a boundary is found when the hash is lower than
+  |threshold|. The bytes before min_size - _GEAR_WINDOW cannot influence the
+  hash at min_size so they are skipped.
+  """
+  end = min(len(buf), max_size)
+  if end <= min_size:
+    return end
+  gear = _GEAR
+  h = 0
+  for i in range(max(0, min_size - _GEAR_WINDOW), min_size):
+    h = ((h << 1) + gear[buf[i]]) & _GEAR_MASK
+  for i in range(min_size, end):
+    h = ((h << 1) + gear[buf[i]]) & _GEAR_MASK
+    if h < threshold:
+      return i + 1
+  return end
+
+
+def chunk_file(
+    filepath, algo, min_size=CHUNK_MIN_SIZE, avg_size=CHUNK_AVG_SIZE,
+    max_size=CHUNK_MAX_SIZE):
+  """Splits a file in content defined chunks and hashes them.
+
+  Chunk boundaries only depend on the content close to them, so inserting or
+  removing bytes in a file only changes the chunks around the edit.
+
+  Returns:
+    tuple(hex digest of the whole file, list of [hex digest, size] for each
+    chunk). The list is the 'c' entry of a file in a .isolated file.
+  """
+  assert 0 < min_size < avg_size < max_size, (min_size, avg_size, max_size)
+  assert not avg_size & (avg_size - 1), avg_size
+  # Probability of a boundary at each position is 1/avg_size.
+  threshold = 1 << (64 - avg_size.bit_length() + 1)
+  file_digest = algo()
+  chunks = []
+  buf = bytearray()
+  eof = False
+  with fs.open(filepath, 'rb') as f:
+    while True:
+      while not eof and len(buf) < max_size:
+        data = f.read(max(DISK_FILE_CHUNK, max_size - len(buf)))
+        if not data:
+          eof = True
+        buf.extend(data)
+      if not buf:
+        break
+      size = _find_chunk_boundary(buf, min_size, max_size, threshold)
+      chunk = bytes(buf[:size])
+      del buf[:size]
+      file_digest.update(chunk)
+      chunks.append([algo(chunk).hexdigest(), size])
+  return file_digest.hexdigest(), chunks
+
+
 class IsolatedFile(object):
   """Represents a single parsed .isolated file."""
 
@@ -271,11 +409,13 @@ def expand_directory_and_symlink(indir, relfile, denylist, follow_symlinks):
     if relfile.startswith(u'.' + os.path.sep):
       relfile = relfile[2:]
     try:
-      for filename in fs.listdir(infile):
-        inner_relfile = os.path.join(relfile, filename)
+      # scandir() returns the file type with the directory entries, which saves
+      # a stat() per entry.
+      for entry in fs.scandir(infile):
+        inner_relfile = os.path.join(relfile, entry.name)
         if denylist and denylist(inner_relfile):
           continue
-        if fs.isdir(os.path.join(indir, inner_relfile)):
+        if entry.is_dir():
           inner_relfile += os.path.sep
         # Apply recursively.
         for i, is_symlink in expand_directory_and_symlink(
@@ -472,6 +612,17 @@ def load_isolated(content, algo):
             if subsubvalue not in SUPPORTED_FILE_TYPES:
               raise IsolatedError('Expected one of \'%s\', got %r' % (
                   ', '.join(sorted(SUPPORTED_FILE_TYPES)), subsubvalue))
+          elif subsubkey == 'c':
+            if not isinstance(subsubvalue, list) or not subsubvalue:
+              raise IsolatedError(
+                  'Expected non-empty list, got %r' % subsubvalue)
+            for chunk in subsubvalue:
+              if (not isinstance(chunk, list) or len(chunk) != 2 or
+                  not isinstance(chunk[0], six.string_types) or
+                  not is_valid_hash(chunk[0], algo) or
+                  not isinstance(chunk[1], six.integer_types)):
+                raise IsolatedError(
+                    'Expected [%s, size], got %r' % (algo_name, chunk))
           else:
             raise IsolatedError('Unknown subsubkey %s' % subsubkey)
         if bool('h' in subvalue) == bool('l' in subvalue):
@@ -490,6 +641,15 @@ def load_isolated(content, algo):
           raise IsolatedError(
               'Cannot use \'m\' (mode) and \'l\' (link), got: %r' %
               subvalue)
+        if 'c' in subvalue:
+          if subvalue.get('t', 'basic') != 'basic':
+            raise IsolatedError(
+                'Cannot use \'c\' (chunks) and \'t\' (type), got: %r' %
+                subvalue)
+          if sum(c[1] for c in subvalue['c']) != subvalue.get('s'):
+            raise IsolatedError(
+                'Sum of \'c\' (chunks) sizes must be \'s\' (size), got: %r' %
+                subvalue)
 
     elif key == 'includes':
       if not isinstance(value, list):
@@ -7,9 +7,12 @@
 
 from __future__ import print_function
 
+import atexit
 import collections
 import errno
 import functools
+import heapq
+import itertools
 import logging
 import optparse
 import os
@@ -20,7 +23,6 @@ import sys
 import tarfile
 import threading
 import time
-import zlib
 
 from utils import net
 from utils import tools
@@ -38,6 +40,7 @@ import auth
 import isolated_format
 import isolate_storage
 import local_caching
+from utils import digest_cache
 from utils import file_path
 from utils import fs
 from utils import logging_utils
@@ -59,18 +62,34 @@ ISOLATE_PROTOCOL_VERSION = '1.0'
 DEADLOCK_TIMEOUT = 5 * 60
 
 
-# The number of files to check the isolate server per /pre-upload query.
-# All files are sorted by likelihood of a change in the file content
-# (currently file size is used to estimate this: larger the file -> larger the
-# possibility it has changed). Then first ITEMS_PER_CONTAINS_QUERIES[0] files
-# are taken and send to '/pre-upload', then next ITEMS_PER_CONTAINS_QUERIES[1],
-# and so on. Numbers here is a trade-off; the more per request, the lower the
-# effect of HTTP round trip latency and TCP-level chattiness. On the other hand,
-# larger values cause longer lookups, increasing the initial latency to start
-# uploading, which is especially an issue for large files. This value is
-# optimized for the "few thousands files to look up with minimal number of large
-# files missing" case.
-ITEMS_PER_CONTAINS_QUERIES = (20, 20, 50, 50, 50, 100)
+# Number of times in a row Storage resumes a fetch that fails without making
+# progress. A fetch that fails after fetching some content is resumed at the
+# offset it reached instead of restarting from zero.
+FETCH_RESUME_ATTEMPTS = 5
+
+
+# Bounds of the number of items per /preupload lookup. Batches start small so
+# the first uploads start early, then grow while the round trip dominates the
+# duration of a lookup, see _LookupBatcher. The server accepts up to 1000 items
+# per lookup.
+CONTAINS_MIN_ITEMS = 20
+CONTAINS_MAX_ITEMS = 1000
+
+
+# A batch is looked up as soon as its items total this many bytes, so that the
+# upload of large files, the most likely to have changed, starts early.
+CONTAINS_MAX_BYTES = 64 * 1024 * 1024
+
+
+# Maximum number of concurrent /preupload lookups. A partial batch is looked up
+# as soon as the enumeration of the items stalls, unless this many lookups are
+# already pending.
+CONTAINS_MAX_IN_FLIGHT = 4
+
+
+# Maximum number of concurrent uploads. The pending uploads are started largest
+# first.
+PUSH_MAX_IN_FLIGHT = threading_utils.IOAutoRetryThreadPool.MAX_WORKERS
 
 
 # A list of already compressed extension types that should not receive any
@@ -97,6 +116,17 @@ ALREADY_COMPRESSED_TYPES = [
 DELAY_BETWEEN_UPDATES_IN_SECS = 30
 
 
+# Number of threads hashing the files found when archiving a directory. hashlib
+# releases the GIL while hashing, so the files are hashed in parallel.
+HASHING_THREADS = min(max(threading_utils.num_processors(), 2), 16)
+
+
+# Number of files already in the cache mapped per putfile thread pool task.
+# Mapping a cached file is a few syscalls, so batching them amortizes the
+# thread pool overhead.
+MAP_CACHED_FILES_BATCH_SIZE = 100
+
+
 DEFAULT_DENYLIST = (
     # Temporary vim or python files.
     r'^.+\.(?:pyc|swp)$',
@@ -105,6 +135,10 @@ DEFAULT_DENYLIST = (
 )
 
 
+# Path -> utils.digest_cache.DigestCache opened by process_archive_options().
+_digest_caches = {}
+
+
 class Error(Exception):
   """Generic runtime error."""
   pass
@@ -192,7 +226,9 @@ def putfile(srcfileobj, dstpath, file_mode=None, size=-1, use_symlink=False):
   """Put srcfileobj at the given dstpath with given mode.
 
   The function aims to do this as efficiently as possible while still allowing
-  any possible file like object be given.
+  any possible file like object be given. When a file backed by a path has to be
+  copied, file_path.copy_file_content() keeps the data in the kernel when
+  possible.
 
   Creating a tree of hardlinks has a few drawbacks:
   - tmpfs cannot be used for the scratch space. The tree has to be on the same
@@ -258,14 +294,7 @@ def putfile(srcfileobj, dstpath, file_mode=None, size=-1, use_symlink=False):
 
 def zip_compress(content_generator, level=7):
   """Reads chunks from |content_generator| and yields zip compressed chunks."""
-  compressor = zlib.compressobj(level)
-  for chunk in content_generator:
-    compressed = compressor.compress(chunk)
-    if compressed:
-      yield compressed
-  tail = compressor.flush(zlib.Z_FINISH)
-  if tail:
-    yield tail
+  return isolate_storage.DeflateCodec().compress(content_generator, level)
 
 
 def zip_decompress(
@@ -277,31 +306,15 @@ def zip_decompress(
 
   Raises IOError if data is corrupted or incomplete.
   """
-  decompressor = zlib.decompressobj()
-  compressed_size = 0
-  try:
-    for chunk in content_generator:
-      compressed_size += len(chunk)
-      data = decompressor.decompress(chunk, chunk_size)
-      if data:
-        yield data
-      while decompressor.unconsumed_tail:
-        data = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
-        if data:
-          yield data
-    tail = decompressor.flush()
-    if tail:
-      yield tail
-  except zlib.error as e:
-    raise IOError(
-        'Corrupted zip stream (read %d bytes) - %s' % (compressed_size, e))
-  # Ensure all data was read and decompressed.
-  if decompressor.unused_data or decompressor.unconsumed_tail:
-    raise IOError('Not all data was decompressed')
+  return isolate_storage.DeflateCodec().decompress(
+      content_generator, chunk_size)
 
 
 def _get_zip_compression_level(filename):
-  """Given a filename calculates the ideal zip compression level to use."""
+  """Given a filename calculates the ideal compression level to use.
+
+  The level is on the zlib scale, see isolate_storage.Codec.compress().
+  """
   file_ext = os.path.splitext(filename)[1].lower()
   # TODO(csharp): Profile to find what compression level works best.
   return 0 if file_ext in ALREADY_COMPRESSED_TYPES else 7
@@ -319,8 +332,13 @@ def create_directories(base_directory, files):
   for d in sorted(directories):
     if d:
       abs_d = os.path.join(base_directory, d)
-      if not fs.isdir(abs_d):
+      # Try to create the directory first; the output directory is usually
+      # empty so this saves a stat() per directory.
+      try:
         fs.mkdir(abs_d)
+      except OSError as e:
+        if e.errno != errno.EEXIST or not fs.isdir(abs_d):
+          raise
 
 
 def _create_symlinks(base_directory, files):
@@ -389,7 +407,7 @@ class FileItem(isolate_storage.Item):
   @property
   def digest(self):
     if not self._digest:
-      self._digest = isolated_format.hash_file(self._path, self._algo)
+      self._digest = isolated_format.hash_file_cached(self._path, self._algo)
     return self._digest
 
   @property
@@ -405,6 +423,41 @@ class FileItem(isolate_storage.Item):
     return file_read(self.path)
 
 
+class ChunkItem(isolate_storage.Item):
+  """A slice of a file to push to Storage.
+
+  Used for the chunks of a large file, see isolated_format.chunk_file().
+  """
+
+  def __init__(self, path, offset, digest, size, high_priority=False):
+    super(ChunkItem, self).__init__(
+        digest,
+        size,
+        high_priority,
+        compression_level=_get_zip_compression_level(path))
+    self._path = path
+    self._offset = offset
+
+  @property
+  def path(self):
+    return self._path
+
+  @property
+  def offset(self):
+    return self._offset
+
+  def content(self):
+    with fs.open(self._path, 'rb') as f:
+      f.seek(self._offset)
+      remaining = self.size
+      while remaining:
+        data = f.read(min(remaining, isolated_format.DISK_FILE_CHUNK))
+        if not data:
+          raise IOError('%s is shorter than expected' % self._path)
+        remaining -= len(data)
+        yield data
+
+
 class TarBundle(isolate_storage.Item):
   """Tarfile to push to Storage.
 
@@ -527,6 +580,42 @@ class BufferItem(isolate_storage.Item):
     return [self._buffer]
 
 
+class _LookupBatcher(object):
+  """Sizes the batches of items looked up with StorageApi.contains().
+
+  The maximum number of items per batch doubles while the lookups of full
+  batches take less than twice the fastest lookup seen so far, as the round trip
+  then dominates their duration. It halves when they take more than 4 times as
+  long. Thread safe.
+  """
+
+  def __init__(self, min_items=None, max_items=None, max_bytes=None):
+    self._min_items = min_items or CONTAINS_MIN_ITEMS
+    self._max_items = max_items or CONTAINS_MAX_ITEMS
+    self._max_bytes = max_bytes or CONTAINS_MAX_BYTES
+    self._lock = threading.Lock()
+    self._fastest = None
+    self.items = self._min_items
+
+  def is_full(self, nb_items, size):
+    """Returns True if a batch of |nb_items| totaling |size| bytes is full."""
+    return nb_items >= self.items or size >= self._max_bytes
+
+  def lookup_done(self, nb_items, duration):
+    """Records the |duration| of the lookup of |nb_items|."""
+    with self._lock:
+      if self._fastest is None or duration < self._fastest:
+        self._fastest = duration
+      if nb_items * 2 < self.items:
+        # Partial batches looked up because the enumeration stalled are not
+        # representative.
+        return
+      if duration <= 2 * self._fastest:
+        self.items = min(self.items * 2, self._max_items)
+      elif duration > 4 * self._fastest:
+        self.items = max(self.items // 2, self._min_items)
+
+
 class Storage(object):
   """Efficiently downloads or uploads large set of files via StorageApi.
 
@@ -617,10 +706,10 @@ class Storage(object):
 
     It figures out what items are missing from the server and uploads only them.
 
-    It uses 3 threads internally:
-    - One to create batches based on a timeout
-    - One to dispatch the /contains RPC and field the missing entries
-    - One to field the /push RPC
+    It uses 2 threads internally:
+    - One to create batches and dispatch the /contains RPCs, which field the
+      missing entries
+    - One to field the /push RPC, largest items first
 
     The main threads enumerates 'items' and pushes to the first thread. Then it
     join() all the threads, waiting for them to complete.
@@ -628,20 +717,18 @@ class Storage(object):
         (enumerate items of Item, this can be slow as disk is traversed)
               |
               v
-    _create_items_batches_thread       Thread #1
-        (generates list(Item), every 3s or 20~100 items)
-              |
-              v
-      _do_lookups_thread               Thread #2
+      _do_lookups_thread               Thread #1
+        (batches of 20~1000 items, sent as soon as a lookup can be started
+         and no more item is ready, up to 4 lookups in parallel)
          |         |
          v         v
      (missing)  (was on server)
          |
          v
-    _handle_missing_thread             Thread #3
+    _handle_missing_thread             Thread #2
           |
           v
-      (upload Item, append to uploaded)
+      (upload Item, largest first, append to uploaded)
 
     Arguments:
       items: list of isolate_storage.Item instances that represents data to
@@ -655,75 +742,71 @@ class Storage(object):
       The first exception being raised in the worker threads.
     """
     incoming = Queue.Queue()
-    batches_to_lookup = Queue.Queue()
     missing = Queue.Queue()
     uploaded = []
     exc_channel = threading_utils.TaskChannel()
 
-    def _create_items_batches_thread():
-      """Creates batches for /contains RPC lookup from individual items.
-
-      Input: incoming
-      Output: batches_to_lookup
-      """
-      try:
-        batch_size_index = 0
-        batch_size = ITEMS_PER_CONTAINS_QUERIES[batch_size_index]
-        batch = []
-        while not self._aborted:
-          try:
-            item = incoming.get(True, timeout=3)
-            if item:
-              batch.append(item)
-          except Queue.Empty:
-            item = False
-          if len(batch) == batch_size or (not item and batch):
-            if len(batch) == batch_size:
-              batch_size_index += 1
-              batch_size = ITEMS_PER_CONTAINS_QUERIES[
-                  min(batch_size_index, len(ITEMS_PER_CONTAINS_QUERIES)-1)]
-            batches_to_lookup.put(batch)
-            batch = []
-          if item is None:
-            break
-      except Exception:
-        exc_channel.send_exception()
-      finally:
-        # Unblock the next pipeline.
-        batches_to_lookup.put(None)
-
     def _do_lookups_thread():
-      """Enqueues all the /contains RPCs and emits the missing items.
+      """Batches the items and enqueues the /contains RPCs.
 
-      Input: batches_to_lookup
-      Output: missing, to_upload
+      The RPCs emit the missing items.
+
+      Input: incoming
+      Output: missing
       """
       try:
         channel = threading_utils.TaskChannel()
+        batcher = _LookupBatcher()
         def _contains(b):
           if self._aborted:
             raise Aborted()
-          return self._storage_api.contains(b)
+          start = time.time()
+          missing_items = self._storage_api.contains(b)
+          batcher.lookup_done(len(b), time.time() - start)
+          for missing_item, push_state in missing_items.items():
+            missing.put((missing_item, push_state))
 
+        batch = []
+        batch_size = 0
         pending_contains = 0
+        idle = False
+        done = False
         while not self._aborted:
-          batch = batches_to_lookup.get()
-          if batch is None:
-            break
-          self.net_thread_pool.add_task_with_channel(
-              channel, threading_utils.PRIORITY_HIGH, _contains, batch)
-          pending_contains += 1
-          while pending_contains and not self._aborted:
+          # Collect the finished lookups. Wait for one if no other lookup can
+          # be started.
+          while pending_contains:
+            wait = pending_contains >= CONTAINS_MAX_IN_FLIGHT
             try:
-              v = channel.next(timeout=0)
+              channel.next(timeout=None if wait else 0)
             except threading_utils.TaskChannel.Timeout:
               break
             pending_contains -= 1
-            for missing_item, push_state in v.items():
-              missing.put((missing_item, push_state))
+          if batch and (
+              done or idle or batcher.is_full(len(batch), batch_size)):
+            self.net_thread_pool.add_task_with_channel(
+                channel, threading_utils.PRIORITY_HIGH, _contains, batch)
+            pending_contains += 1
+            batch = []
+            batch_size = 0
+            idle = False
+            continue
+          if done:
+            break
+          try:
+            # Only wait for more items if there is no partial batch to look up.
+            item = incoming.get(not batch, timeout=1)
+          except Queue.Empty:
+            # The enumeration of the items stalled, look up the partial batch
+            # right away.
+            idle = bool(batch)
+            continue
+          if item is None:
+            done = True
+          else:
+            batch.append(item)
+            batch_size += item.size
         while pending_contains and not self._aborted:
-          for missing_item, push_state in channel.next().items():
-            missing.put((missing_item, push_state))
+          channel.next()
           pending_contains -= 1
       except Exception:
         exc_channel.send_exception()
@@ -732,7 +815,7 @@ class Storage(object):
         missing.put((None, None))
 
     def _handle_missing_thread():
-      """Sends the missing items to the uploader.
+      """Sends the missing items to the uploader, largest first.
 
       Input: missing
       Output: uploaded
@@ -740,38 +823,55 @@ class Storage(object):
       try:
         with threading_utils.DeadlockDetector(DEADLOCK_TIMEOUT) as detector:
           channel = threading_utils.TaskChannel()
+          # Heap of the missing items to push. The counter breaks ties, since
+          # items are not comparable.
+          to_push = []
+          counter = itertools.count()
           pending_upload = 0
+          done = False
           while not self._aborted:
+            # Take all the missing items already known, so the largest one is
+            # pushed first. Only wait for one if there is nothing to push.
             try:
-              missing_item, push_state = missing.get(True, timeout=5)
-              if missing_item is None:
-                break
-              self._async_push(channel, missing_item, push_state, verify_push)
-              pending_upload += 1
+              while not done:
+                missing_item, push_state = missing.get(
+                    not to_push and pending_upload < PUSH_MAX_IN_FLIGHT,
+                    timeout=5)
+                if missing_item is None:
+                  done = True
+                else:
+                  heapq.heappush(to_push, (
+                      not missing_item.high_priority, -missing_item.size,
+                      next(counter), missing_item, push_state))
             except Queue.Empty:
               pass
             detector.ping()
-            while not self._aborted and pending_upload:
+            while to_push and pending_upload < PUSH_MAX_IN_FLIGHT:
+              _, _, _, missing_item, push_state = heapq.heappop(to_push)
+              self._async_push(channel, missing_item, push_state, verify_push)
+              pending_upload += 1
+            # Collect the finished uploads. Wait for one if no other upload
+            # can be started, or if all of them are started.
+            while pending_upload and not self._aborted:
+              wait = (
+                  pending_upload >= PUSH_MAX_IN_FLIGHT or
+                  (done and not to_push))
               try:
-                item = channel.next(timeout=0)
+                item = channel.next(timeout=None if wait else 0)
               except threading_utils.TaskChannel.Timeout:
                 break
               uploaded.append(item)
               pending_upload -= 1
-              logging.debug('Uploaded %d; %d pending: %s (%d)', len(uploaded),
-                            pending_upload, item.digest, item.size)
-          while not self._aborted and pending_upload:
-            item = channel.next()
-            uploaded.append(item)
-            pending_upload -= 1
-            logging.debug(
-                'Uploaded %d; %d pending: %s (%d)',
-                len(uploaded), pending_upload, item.digest, item.size)
+              logging.debug(
+                  'Uploaded %d; %d pending: %s (%d)',
+                  len(uploaded), pending_upload, item.digest, item.size)
+              detector.ping()
+            if done and not to_push and not pending_upload:
+              break
       except Exception:
         exc_channel.send_exception()
 
     threads = [
-        threading.Thread(target=_create_items_batches_thread),
         threading.Thread(target=_do_lookups_thread),
         threading.Thread(target=_handle_missing_thread),
     ]
@@ -863,7 +963,8 @@ class Storage(object):
       try:
         if self._aborted:
           raise Aborted()
-        stream = zip_compress(item.content(), item.compression_level)
+        stream = self.server_ref.codec.compress(
+            item.content(), item.compression_level, item.size)
         # In Python3, zlib.compress returns a byte object instead of str.
         data = six.b('').join(stream)
       except Exception as exc:
@@ -899,12 +1000,39 @@ class Storage(object):
       assert pushed is item
     return item
 
+  def _fetch_resumable(self, digest, size):
+    """Yields the content of |digest| as stored, resuming on transient errors.
+
+    The content is streamed to the decompressor, FetchStreamVerifier and the
+    sink, e.g. into the cache directory, while it is fetched. When the fetch
+    fails after some content was received, it is resumed at the offset reached
+    with a range request, so the content already received is kept. A fetch
+    failing before anything is received is retried from scratch by the
+    net_thread_pool.
+    """
+    offset = 0
+    stalled = 0
+    while True:
+      start = offset
+      try:
+        for data in self._storage_api.fetch(digest, size, offset):
+          offset += len(data)
+          yield data
+        return
+      except IOError as e:
+        stalled = stalled + 1 if offset == start else 0
+        if self._aborted or not offset or stalled >= FETCH_RESUME_ATTEMPTS:
+          raise
+        logging.warning(
+            'Failed to fetch %s at offset %d, resuming: %s', digest, offset, e)
+
   def _fetch(self, digest, size, sink):
     try:
       # Prepare reading pipeline.
-      stream = self._storage_api.fetch(digest, size, 0)
+      stream = self._fetch_resumable(digest, size)
       if self.server_ref.is_with_compression:
-        stream = zip_decompress(stream, isolated_format.DISK_FILE_CHUNK)
+        stream = self.server_ref.codec.decompress(
+            stream, isolated_format.DISK_FILE_CHUNK)
       # Run |stream| through verifier that will assert its size.
       verifier = FetchStreamVerifier(stream, self.server_ref.hash_algo, digest,
                                      size)
@@ -990,6 +1118,10 @@ class FetchQueue(object):
         self._channel, priority, digest, size,
         functools.partial(self.cache.write, digest))
 
+  def is_fetched(self, digest):
+    """Returns True if |digest| is in the cache and not being fetched."""
+    return digest in self._fetched
+
   def wait_on(self, digest):
     """Updates digests to be waited on by 'wait'."""
     # Calculate once the already fetched items. These will be retrieved first.
@@ -1241,8 +1373,12 @@ class IsolatedBundle(object):
       if filepath not in self.files:
         self.files[filepath] = properties
 
-        # Preemptively request hashed files.
-        if 'h' in properties:
+        # Preemptively request hashed files. Only the chunks of a chunked file
+        # are stored.
+        if 'c' in properties:
+          for digest, size in properties['c']:
+            fetch_queue.add(digest, size, threading_utils.PRIORITY_MED)
+        elif 'h' in properties:
           fetch_queue.add(
               properties['h'], properties['s'], threading_utils.PRIORITY_MED)
 
@@ -1283,6 +1419,10 @@ def _map_file(dst, digest, props, cache, use_symlinks):
   threaded file putting.
   """
   with tools.Profiler("_map_file for %s" % dst):
+    if 'c' in props:
+      _map_chunked_file(dst, props, cache)
+      return
+
     with cache.getfileobj(digest) as srcfileobj:
       filetype = props.get('t', 'basic')
 
@@ -1319,6 +1459,29 @@ def _map_file(dst, digest, props, cache, use_symlinks):
         raise isolated_format.IsolatedError('Unknown file type %r' % filetype)
 
 
+def _map_chunked_file(dst, props, cache):
+  """Reassembles a chunked file at |dst| from its chunks in |cache|."""
+  with fs.open(dst, 'wb') as dstfileobj:
+    for digest, size in props['c']:
+      with cache.getfileobj(digest) as srcfileobj:
+        fileobj_copy(dstfileobj, srcfileobj, size)
+  # Ignore all bits apart from the user.
+  fs.chmod(dst, (props.get('m') or 0o500) & 0o700)
+
+
+def _map_files(outdir, files, cache, use_symlinks):
+  """Maps a batch of files whose content is in |cache|.
+
+  Arguments:
+    outdir: output directory.
+    files: list of (path relative to |outdir|, props).
+  """
+  for filepath, props in files:
+    _map_file(
+        os.path.join(outdir, filepath), props.get('h'), props, cache,
+        use_symlinks)
+
+
 def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks,
                    filter_cb=None):
   """Aggressively downloads the .isolated file(s), then download all the files.
@@ -1361,29 +1524,58 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks,
     # Load all *.isolated and start loading rest of the files.
     bundle.fetch(fetch_queue, isolated_hash, algo)
 
-  with tools.Profiler('GetRest'):
+  with tools.Profiler('CreateDirectories'):
     # Create file system hierarchy.
     file_path.ensure_tree(outdir)
     create_directories(outdir, bundle.files)
-    _create_symlinks(outdir, bundle.files.items())
 
     # Ensure working directory exists.
     cwd = os.path.normpath(os.path.join(outdir, bundle.relative_cwd))
     file_path.ensure_tree(cwd)
 
-    # Multimap: digest -> list of pairs (path, props).
-    remaining = {}
-    for filepath, props in bundle.files.items():
-      if 'h' in props:
-        remaining.setdefault(props['h'], []).append((filepath, props))
-        fetch_queue.wait_on(props['h'])
+  with tools.Profiler('CreateSymlinks'):
+    _create_symlinks(outdir, bundle.files.items())
+
+  # Files whose content was already in the cache before the fetch. They are
+  # mapped right away in batches without waiting on the FetchQueue.
+  warm = []
+  # Multimap: digest -> list of pairs (path, props). A chunked file is listed
+  # under each of its chunks.
+  remaining = {}
+  # Chunked file path -> digests of its chunks not yet fetched.
+  missing_chunks = {}
+  for filepath, props in bundle.files.items():
+    if 'c' in props:
+      digests = set(c[0] for c in props['c'])
+      if all(fetch_queue.is_fetched(d) for d in digests):
+        warm.append((filepath, props))
+        continue
+      missing_chunks[filepath] = digests
+      for digest in digests:
+        remaining.setdefault(digest, []).append((filepath, props))
+        fetch_queue.wait_on(digest)
+    elif 'h' in props:
+      if fetch_queue.is_fetched(props['h']):
+        warm.append((filepath, props))
+        continue
+      remaining.setdefault(props['h'], []).append((filepath, props))
+      fetch_queue.wait_on(props['h'])
+
+  with threading_utils.ThreadPool(2, 32, 32) as putfile_thread_pool:
+    with tools.Profiler('MapCachedFiles'):
+      logging.info('Mapping cached files (%d of them)...', len(warm))
+      for i in range(0, len(warm), MAP_CACHED_FILES_BATCH_SIZE):
+        putfile_thread_pool.add_task(
+            threading_utils.PRIORITY_HIGH, _map_files, outdir,
+            warm[i:i + MAP_CACHED_FILES_BATCH_SIZE], cache, use_symlinks)
+      putfile_thread_pool.join()
 
-    # Now block on the remaining files to be downloaded and mapped.
-    logging.info('Retrieving remaining files (%d of them)...',
-        fetch_queue.pending_count)
-    last_update = time.time()
+    with tools.Profiler('GetRest'):
+      # Now block on the remaining files to be downloaded and mapped.
+      logging.info('Retrieving remaining files (%d of them)...',
+          fetch_queue.pending_count)
+      last_update = time.time()
 
-    with threading_utils.ThreadPool(2, 32, 32) as putfile_thread_pool:
       with threading_utils.DeadlockDetector(DEADLOCK_TIMEOUT) as detector:
         while remaining:
           detector.ping()
@@ -1394,6 +1586,12 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks,
           # Create the files in the destination using item in cache as the
           # source.
           for filepath, props in remaining.pop(digest):
+            if 'c' in props:
+              # A chunked file is mapped once all its chunks are in the cache.
+              missing_chunks[filepath].discard(digest)
+              if missing_chunks[filepath]:
+                continue
+              del missing_chunks[filepath]
             fullpath = os.path.join(outdir, filepath)
 
             putfile_thread_pool.add_task(threading_utils.PRIORITY_HIGH,
@@ -1424,9 +1622,35 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks,
   return bundle
 
 
-def _directory_to_metadata(root, algo, denylist):
+def _hash_file_item(item, relpath):
+  """Hashes a FileItem on the hashing thread pool."""
+  return [(item, relpath, item.meta)]
+
+
+def _chunk_file_item(filepath, relpath, algo, high_priority):
+  """Splits a file in ChunkItem on the hashing thread pool."""
+  meta = isolated_format.file_to_metadata(filepath, False)
+  meta['h'], meta['c'] = isolated_format.chunk_file(filepath, algo)
+  out = []
+  offset = 0
+  for digest, size in meta['c']:
+    out.append(
+        (ChunkItem(filepath, offset, digest, size, high_priority), relpath,
+         meta))
+    offset += size
+  return out
+
+
+def _directory_to_metadata(root, algo, denylist, chunked=False):
   """Yields every file and/or symlink found.
 
+  The files are hashed on a thread pool while the directory is walked, and are
+  yielded as soon as they are hashed, so the order is not deterministic.
+
+  If |chunked| is True, files of at least CHUNKED_FILE_MIN_SIZE bytes are split
+  in content defined chunks and one ChunkItem is yielded per chunk, all with the
+  same relpath and metadata.
+
   Yields:
     tuple(FileItem, relpath, metadata)
     For a symlink, FileItem is None.
@@ -1434,36 +1658,64 @@ def _directory_to_metadata(root, algo, denylist):
   # Current tar file bundle, if any.
   root = file_path.get_native_path_case(root)
   bundle = TarBundle(root, algo)
-  for relpath, issymlink in isolated_format.expand_directory_and_symlink(
-      root,
-      u'.' + os.path.sep,
-      denylist,
-      follow_symlinks=(sys.platform != 'win32')):
-
-    filepath = os.path.join(root, relpath)
-    if issymlink:
-      # TODO(maruel): Do not call this.
-      meta = isolated_format.file_to_metadata(filepath, False)
-      yield None, relpath, meta
-      continue
+  # Receives lists of tuple(FileItem, relpath, metadata) from the hashers.
+  channel = threading_utils.TaskChannel()
+  pending = 0
+  with threading_utils.ThreadPool(
+      1, HASHING_THREADS, 0, 'hash') as hash_thread_pool:
+    for relpath, issymlink in isolated_format.expand_directory_and_symlink(
+        root,
+        u'.' + os.path.sep,
+        denylist,
+        follow_symlinks=(sys.platform != 'win32')):
+
+      # Yield the files already hashed without blocking the walk.
+      while pending:
+        try:
+          hashed = channel.next(timeout=0)
+        except threading_utils.TaskChannel.Timeout:
+          break
+        pending -= 1
+        for i, p, m in hashed:
+          yield i, p, m
+
+      filepath = os.path.join(root, relpath)
+      if issymlink:
+        # TODO(maruel): Do not call this.
+        meta = isolated_format.file_to_metadata(filepath, False)
+        yield None, relpath, meta
+        continue
 
-    prio = relpath.endswith('.isolated')
-    if bundle.try_add(FileItem(path=filepath, algo=algo, high_priority=prio)):
-      # The file was added to the current pending tarball and won't be archived
-      # individually.
-      continue
+      prio = relpath.endswith('.isolated')
+      if bundle.try_add(FileItem(path=filepath, algo=algo, high_priority=prio)):
+        # The file was added to the current pending tarball and won't be
+        # archived individually.
+        continue
+
+      # Flush and reset the bundle.
+      for i, p, m in bundle.yield_item_path_meta():
+        yield i, p, m
+      bundle = TarBundle(root, algo)
+
+      # Hash the file individually.
+      item = FileItem(path=filepath, algo=algo, size=None, high_priority=prio)
+      if chunked and item.size >= isolated_format.CHUNKED_FILE_MIN_SIZE:
+        task = channel.wrap_task(_chunk_file_item)
+        args = (filepath, relpath, algo, prio)
+      else:
+        task = channel.wrap_task(_hash_file_item)
+        args = (item, relpath)
+      hash_thread_pool.add_task(threading_utils.PRIORITY_MED, task, *args)
+      pending += 1
 
-    # Flush and reset the bundle.
     for i, p, m in bundle.yield_item_path_meta():
       yield i, p, m
-    bundle = TarBundle(root, algo)
-
-    # Yield the file individually.
-    item = FileItem(path=filepath, algo=algo, size=None, high_priority=prio)
-    yield item, relpath, item.meta
 
-  for i, p, m in bundle.yield_item_path_meta():
-    yield i, p, m
+    while pending:
+      hashed = channel.next()
+      pending -= 1
+      for i, p, m in hashed:
+        yield i, p, m
 
 
 def _print_upload_stats(items, missing):
@@ -1488,17 +1740,18 @@ def _print_upload_stats(items, missing):
                cache_miss_size * 100. / total_size if total_size else 0)
 
 
-def _enqueue_dir(dirpath, denylist, hash_algo, hash_algo_name):
+def _enqueue_dir(dirpath, denylist, hash_algo, hash_algo_name, chunked=False):
   """Called by archive_files_to_storage for a directory.
 
   Create an .isolated file.
 
   Yields:
-    FileItem for every file found, plus one for the .isolated file itself.
+    FileItem for every file found (or ChunkItem for every chunk of a chunked
+    file), plus one for the .isolated file itself.
   """
   files = {}
   for item, relpath, meta in _directory_to_metadata(dirpath, hash_algo,
-                                                    denylist):
+                                                    denylist, chunked):
     # item is None for a symlink.
     files[relpath] = meta
     if item:
@@ -1521,7 +1774,8 @@ def _enqueue_dir(dirpath, denylist, hash_algo, hash_algo_name):
 def _archive_files_to_storage_internal(storage,
                                        files,
                                        denylist,
-                                       verify_push=False):
+                                       verify_push=False,
+                                       chunked=False):
   """Stores every entry into remote storage and returns stats.
 
   Arguments:
@@ -1531,6 +1785,8 @@ def _archive_files_to_storage_internal(storage,
           Duplicates are skipped.
     denylist: function that returns True if a file should be omitted.
     verify_push: verify files are uploaded correctly by fetching from server.
+    chunked: store large files found in directories as content defined chunks,
+          so that only the modified chunks are uploaded on the next archival.
 
   Returns:
     tuple(OrderedDict(path: hash), list(FileItem cold), list(FileItem hot)).
@@ -1572,7 +1828,7 @@ def _archive_files_to_storage_internal(storage,
           # Uploading a whole directory.
           item = None
           for item in _enqueue_dir(filepath, denylist, hash_algo,
-                                   hash_algo_name):
+                                   hash_algo_name, chunked):
             channel.send_result(item)
             items_found.append(item)
             # The very last item will be the .isolated file.
@@ -1627,7 +1883,8 @@ def _archive_files_to_storage_internal(storage,
 
 # TODO(crbug.com/1073832):
 # remove this if process leak in coverage build was fixed.
-def archive_files_to_storage(storage, files, denylist, verify_push=False):
+def archive_files_to_storage(
+    storage, files, denylist, verify_push=False, chunked=False):
   """Calls _archive_files_to_storage_internal with retry.
 
   Arguments:
@@ -1648,7 +1905,7 @@ def archive_files_to_storage(storage, files, denylist, verify_push=False):
   while True:
     try:
       return _archive_files_to_storage_internal(storage, files, denylist,
-                                                verify_push)
+                                                verify_push, chunked)
     except Exception:
       if backoff > 100:
         raise
@@ -1676,8 +1933,14 @@ def CMDarchive(parser, args):
   """
   add_isolate_server_options(parser)
   add_archive_options(parser)
+  parser.add_option(
+      '--chunked',
+      action='store_true',
+      help='Store large files found in directories as content defined chunks, '
+      'so that only the modified chunks are uploaded next time')
   options, files = parser.parse_args(args)
   process_isolate_server_options(parser, options, True)
+  process_archive_options(options)
   server_ref = isolate_storage.ServerRef(
       options.isolate_server, options.namespace)
   if files == ['-']:
@@ -1688,7 +1951,8 @@ def CMDarchive(parser, args):
   denylist = tools.gen_denylist(options.blacklist)
   try:
     with get_storage(server_ref) as storage:
-      results, _cold, _hot = archive_files_to_storage(storage, files, denylist)
+      results, _cold, _hot = archive_files_to_storage(
+          storage, files, denylist, chunked=options.chunked)
   except (Error, local_caching.NoMoreSpace) as e:
     parser.error(e.args[0])
   print('\n'.join('%s %s' % (h, f) for f, h in results.items()))
@@ -1791,6 +2055,24 @@ def add_archive_options(parser):
       default=list(DEFAULT_DENYLIST),
       help='List of regexp to use as denylist filter when uploading '
       'directories')
+  parser.add_option(
+      '--digest-cache',
+      metavar='FILE',
+      default=os.environ.get('ISOLATE_DIGEST_CACHE'),
+      help='SQLite database caching the digest of the files archived, keyed '
+      'on their stat. It can be shared by concurrent processes. Defaults to '
+      '$ISOLATE_DIGEST_CACHE')
+
+
+def process_archive_options(options):
+  """Handles options added with 'add_archive_options'."""
+  if not options.digest_cache:
+    return
+  path = os.path.abspath(options.digest_cache)
+  if path not in _digest_caches:
+    _digest_caches[path] = digest_cache.DigestCache(path)
+    atexit.register(_digest_caches[path].close)
+  isolated_format.set_digest_cache(_digest_caches[path])
 
 
 def add_isolate_server_options(parser):
@@ -1855,22 +2137,40 @@ def add_cache_options(parser):
       default=100000,
       help='Trim if more than this number of items are in the cache '
       'default=%default')
+  cache_group.add_option(
+      '--sharded-cache',
+      action='store_true',
+      help='Store the cached files in 256 subdirectories instead of a flat '
+      'directory. An existing cache is migrated on the fly.')
+  cache_group.add_option(
+      '--cache-verify-threads',
+      type='int',
+      metavar='NNN',
+      default=1,
+      help='Number of threads used to verify the modified files in the cache '
+      'when cleaning it up. Only use more than one on SSDs. default=%default')
   parser.add_option_group(cache_group)
 
 
+def process_cache_policies(options):
+  """Returns the CachePolicies of the options added by add_cache_options()."""
+  return local_caching.CachePolicies(
+      options.max_cache_size,
+      options.min_free_space,
+      options.max_items,
+      # 3 weeks.
+      max_age_secs=21 * 24 * 60 * 60,
+      sharded=options.sharded_cache)
+
+
 def process_cache_options(options, trim, **kwargs):
   if options.cache:
-    policies = local_caching.CachePolicies(
-        options.max_cache_size,
-        options.min_free_space,
-        options.max_items,
-        # 3 weeks.
-        max_age_secs=21 * 24 * 60 * 60)
-
     # |options.cache| path may not exist until DiskContentAddressedCache()
     # instance is created.
     return local_caching.DiskContentAddressedCache(
-        six.text_type(os.path.abspath(options.cache)), policies, trim, **kwargs)
+        six.text_type(os.path.abspath(options.cache)),
+        process_cache_policies(options), trim,
+        verify_threads=options.cache_verify_threads, **kwargs)
   return local_caching.MemoryContentAddressedCache()
 
 
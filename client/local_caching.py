@@ -6,12 +6,14 @@
 
 import errno
 import io
+import json
 import logging
 import os
 import random
 import string
 import subprocess
 import sys
+import threading
 import time
 
 from utils import file_path
@@ -70,6 +72,39 @@ def is_valid_file(path, size):
   return True
 
 
+def _named_cache_size(value):
+  """Returns the size of a NamedCache LRU entry (rel_path, size).
+
+  Entries in the pre-v2 format are only the relative path, they are upgraded
+  right after loading.
+  """
+  if isinstance(value, (list, tuple)):
+    size = value[1]
+    if isinstance(size, six.integer_types):
+      return size
+  return 0
+
+
+def _is_shard(name):
+  """Returns True if name is a shard directory of the sharded layout."""
+  return len(name) == 2 and all(c in string.hexdigits for c in name)
+
+
+def _ensure_mode(entry, mode):
+  """Changes the mode of a DirEntry, only if needed."""
+  if entry.stat(follow_symlinks=False).st_mode & 0o777 != mode:
+    fs.chmod(entry.path, mode)
+
+
+def _is_modified(mtime, timestamp):
+  """Returns True if a cached file was modified after its LRU timestamp.
+
+  LRU timestamps are rounded to the second so a file written right before being
+  added to the LRU can have a slightly more recent mtime.
+  """
+  return mtime >= timestamp + 1
+
+
 def trim_caches(caches, path, min_free_space, max_age_secs):
   """Trims multiple caches.
 
@@ -106,6 +141,51 @@ def trim_caches(caches, path, min_free_space, max_age_secs):
   return total
 
 
+def compute_named_cache_sizes(cache_dir):
+  """Computes the sizes of the named caches whose size is pending.
+
+  It is meant to run in a process of its own that nobody waits for, while other
+  processes use the NamedCache. So it only reads NamedCache.SIZES_FILE and
+  writes one file per cache in NamedCache.COMPUTED_DIR, which the NamedCache
+  picks up on its next trim().
+
+  Returns:
+    Number of sizes computed.
+  """
+  sizes_file = os.path.join(cache_dir, NamedCache.SIZES_FILE)
+  computed_dir = os.path.join(cache_dir, NamedCache.COMPUTED_DIR)
+  try:
+    with fs.open(sizes_file, 'rb') as f:
+      sizes = json.loads(f.read().decode('utf-8'))
+    pending = sizes['pending']
+    all_hints = sizes['hints']
+  except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+    logging.info('NamedCache: no size to compute: %s', e)
+    return 0
+  computed = 0
+  for name, rel_cache in sorted(pending.items()):
+    dst = os.path.join(computed_dir, rel_cache + u'.json')
+    if fs.isfile(dst):
+      continue
+    abs_cache = os.path.join(cache_dir, rel_cache)
+    size, hints = file_path.get_recursive_size_with_hints(
+        abs_cache, all_hints.get(name, {}))
+    logging.info('NamedCache: size of %r is %s', name, size)
+    try:
+      file_path.ensure_tree(computed_dir)
+      file_path.atomic_replace(
+          dst,
+          json.dumps({'name': name, 'size': size, 'hints': hints},
+                     sort_keys=True, separators=(',', ':')).encode('utf-8'))
+    except (IOError, OSError) as e:
+      # The NamedCache removed COMPUTED_DIR in the meantime. The size is
+      # computed again by the next call.
+      logging.warning('NamedCache: failed to save the size of %r: %s', name, e)
+      continue
+    computed += 1
+  return computed
+
+
 class NamedCacheError(Exception):
   """Named cache specific error."""
 
@@ -116,7 +196,9 @@ class NoMoreSpace(Exception):
 
 
 class CachePolicies(object):
-  def __init__(self, max_cache_size, min_free_space, max_items, max_age_secs):
+  def __init__(
+      self, max_cache_size, min_free_space, max_items, max_age_secs,
+      sharded=False):
     """Common caching policies for the multiple caches (isolated, named, cipd).
 
     Arguments:
@@ -129,11 +211,16 @@ class CachePolicies(object):
     - max_age_secs: Maximum age an item is kept in the cache until it is
                     automatically evicted. Having a lot of dead luggage slows
                     everything down.
+    - sharded: Store the items of a DiskContentAddressedCache in 256
+               subdirectories named after the first two characters of the
+               digest instead of in a flat directory. A cache in the other
+               layout is migrated on the fly.
     """
     self.max_cache_size = max_cache_size
     self.min_free_space = min_free_space
     self.max_items = max_items
     self.max_age_secs = max_age_secs
+    self.sharded = sharded
 
   def __str__(self):
     return ('CachePolicies(max_cache_size=%s (%.3f GiB); max_items=%s; '
@@ -305,8 +392,8 @@ class MemoryContentAddressedCache(ContentAddressedCache):
     """
     super(MemoryContentAddressedCache, self).__init__(None)
     self._file_mode_mask = file_mode_mask
-    # Items in a LRU lookup dict(digest: size).
-    self._lru = lru.LRUDict()
+    # Items in a LRU lookup dict(digest: data).
+    self._lru = lru.LRUDict(size_fn=len)
 
   # Cache interface implementation.
 
@@ -325,15 +412,11 @@ class MemoryContentAddressedCache(ContentAddressedCache):
   @property
   def total_size(self):
     with self._lock:
-      return sum(len(i) for i in self._lru.values())
+      return self._lru.total_size
 
   def get_oldest(self):
     with self._lock:
-      try:
-        # (key, (value, ts))
-        return self._lru.get_oldest()[1][1]
-      except KeyError:
-        return None
+      return self._lru.oldest_timestamp
 
   def remove_oldest(self):
     with self._lock:
@@ -386,27 +469,42 @@ class MemoryContentAddressedCache(ContentAddressedCache):
 
 
 class DiskContentAddressedCache(ContentAddressedCache):
-  """Stateful LRU cache in a flat hash table in a directory.
+  """Stateful LRU cache in a hash table in a directory.
+
+  The items are stored either in a flat directory as <cache_dir>/<digest> or, if
+  policies.sharded is set, as <cache_dir>/<digest[:2]>/<digest[2:]>.
 
-  Saves its state as json file.
+  Saves its state as json file. For large caches, the modifications are appended
+  to a journal file which is periodically compacted into the json file, see
+  lru.LRUDict.
   """
   STATE_FILE = u'state.json'
-
-  def __init__(self, cache_dir, policies, trim, time_fn=None):
+  JOURNAL_FILE = u'state.journal'
+  # Maximum time and amount of data cleanup() spends verifying the items that
+  # were modified. The remaining ones are verified by getfileobj().
+  VERIFY_TIME_BUDGET_SECS = 60.
+  VERIFY_BYTES_BUDGET = 20 * 1024 * 1024 * 1024
+
+  def __init__(
+      self, cache_dir, policies, trim, time_fn=None, verify_threads=1):
     """
     Arguments:
       cache_dir: directory where to place the cache.
       policies: CachePolicies instance, cache retention policies.
       trim: if True to enforce |policies| right away.
           It can be done later by calling trim() explicitly.
+      verify_threads: number of threads used by cleanup() to verify the items.
+          Concurrent reads only help on SSDs.
     """
     # All protected methods (starting with '_') except _path should be called
     # with self._lock held.
     super(DiskContentAddressedCache, self).__init__(cache_dir)
     self.policies = policies
     self.state_file = os.path.join(cache_dir, self.STATE_FILE)
+    self.journal_file = os.path.join(cache_dir, self.JOURNAL_FILE)
+    self.verify_threads = verify_threads
     # Items in a LRU lookup dict(digest: size).
-    self._lru = lru.LRUDict()
+    self._lru = lru.LRUDict(size_fn=int)
     # Current cached free disk space. It is updated by self._trim().
     file_path.ensure_tree(self.cache_dir)
     self._free_disk = file_path.get_free_space(self.cache_dir)
@@ -438,15 +536,11 @@ class DiskContentAddressedCache(ContentAddressedCache):
   @property
   def total_size(self):
     with self._lock:
-      return sum(self._lru.values())
+      return self._lru.total_size
 
   def get_oldest(self):
     with self._lock:
-      try:
-        # (key, (value, ts))
-        return self._lru.get_oldest()[1][1]
-      except KeyError:
-        return None
+      return self._lru.oldest_timestamp
 
   def remove_oldest(self):
     with self._lock:
@@ -475,27 +569,49 @@ class DiskContentAddressedCache(ContentAddressedCache):
       fs.chmod(self.cache_dir, 0o700)
       # Ensure that all files listed in the state still exist and add new ones.
       previous = set(self._lru)
-      # It'd be faster if there were a readdir() function.
-      for filename in fs.listdir(self.cache_dir):
-        if filename == self.STATE_FILE:
-          fs.chmod(os.path.join(self.cache_dir, filename), 0o600)
+      shards = []
+      for entry in fs.scandir(self.cache_dir):
+        filename = entry.name
+        if filename in (self.STATE_FILE, self.JOURNAL_FILE):
+          _ensure_mode(entry, 0o600)
+          continue
+        if _is_shard(filename) and entry.is_dir(follow_symlinks=False):
+          shards.append(filename)
           continue
-        if filename in previous:
-          fs.chmod(os.path.join(self.cache_dir, filename), 0o400)
+        if filename in previous and entry.is_file(follow_symlinks=False):
+          _ensure_mode(entry, 0o400)
+          if self.policies.sharded:
+            # Flat layout item.
+            self._migrate_item(filename)
           previous.remove(filename)
           continue
 
         # An untracked file. Delete it.
         logging.warning('Removing unknown file %s from cache', filename)
-        p = self._path(filename)
-        if fs.isdir(p):
-          try:
-            file_path.rmtree(p)
-          except OSError:
-            pass
-        else:
-          file_path.try_remove(p)
-        continue
+        self._remove_unknown(entry.path)
+
+      if shards:
+        # Scanning the shards is I/O bound, do it concurrently.
+        with threading_utils.ThreadPool(
+            1, min(len(shards), 16), 0, 'cleanup') as pool:
+          # previous is updated as the shards are scanned.
+          known = frozenset(previous)
+          for shard in shards:
+            pool.add_task(0, self._cleanup_shard, shard, known)
+          for shard, found, unknown in pool.iter_results():
+            for digest in found:
+              if not self.policies.sharded:
+                # Sharded layout item.
+                self._migrate_item(digest)
+              previous.discard(digest)
+            for p in unknown:
+              logging.warning('Removing unknown file %s from cache', p)
+              self._remove_unknown(p)
+            if not self.policies.sharded:
+              try:
+                fs.rmdir(os.path.join(self.cache_dir, shard))
+              except OSError:
+                pass
 
       if previous:
         # Filter out entries that were not found.
@@ -504,23 +620,19 @@ class DiskContentAddressedCache(ContentAddressedCache):
           self._lru.pop(filename)
         self._save()
 
-    # Verify hash of every single item to detect corruption. the corrupted
-    # files will be evicted.
+    # Verify the hash of the items modified since they were added to detect
+    # corruption. The corrupted files will be evicted. Only check the items
+    # whose mtime is more recent than their timestamp in state.json to not take
+    # too long.
+    with self._lock:
+      modified = [
+          (digest, size)
+          for digest, (size, timestamp) in self._lru._items.items()
+          if _is_modified(self._get_mtime(digest), timestamp)
+      ]
+    if modified:
+      self._verify_items(modified)
     with self._lock:
-      for digest, (_, timestamp) in list(self._lru._items.items()):
-        # verify only if the mtime is grather than the timestamp in state.json
-        # to avoid take too long time.
-        if self._get_mtime(digest) <= timestamp:
-          continue
-        logging.warning('Item has been modified. item: %s', digest)
-        if self._is_valid_hash(digest):
-          # Update timestamp in state.json
-          self._lru.touch(digest)
-          continue
-        # remove corrupted file from LRU and file system
-        self._lru.pop(digest)
-        self._delete_file(digest, UNKNOWN_FILE_SIZE)
-        logging.error('Deleted corrupted item: %s', digest)
       self._save()
 
   # ContentAddressedCache interface implementation.
@@ -534,11 +646,14 @@ class DiskContentAddressedCache(ContentAddressedCache):
 
     Returns False if the file is missing or invalid.
 
-    Note that is doesn't compute the hash so it could still be corrupted if the
-    file size didn't change.
+    The hash is only computed if the file was modified after it was added and
+    it wasn't verified yet, e.g. cleanup() ran out of budget. So it could still
+    be corrupted if the file size didn't change.
     """
     # Do the check outside the lock.
     looks_valid = is_valid_file(self._path(digest), size)
+    if not looks_valid and self._migrate_item(digest):
+      looks_valid = is_valid_file(self._path(digest), size)
 
     # Update its LRU position.
     with self._lock:
@@ -552,6 +667,15 @@ class DiskContentAddressedCache(ContentAddressedCache):
         # Exists but not in the LRU anymore.
         self._delete_file(digest, size)
         return False
+      _, timestamp = self._lru._items[digest]
+    if _is_modified(self._get_mtime(digest), timestamp):
+      # Verify it before bumping its timestamp, which would hide the
+      # modification from getfileobj() and the next cleanup().
+      if not self._verify_item(digest, size)[1]:
+        return False
+    with self._lock:
+      if digest not in self._lru:
+        return False
       self._lru.touch(digest)
       self._protected = self._protected or digest
     return True
@@ -560,16 +684,29 @@ class DiskContentAddressedCache(ContentAddressedCache):
     try:
       f = fs.open(self._path(digest), 'rb')
     except IOError:
-      raise CacheMiss(digest)
+      if not self._migrate_item(digest):
+        raise CacheMiss(digest)
+      try:
+        f = fs.open(self._path(digest), 'rb')
+      except IOError:
+        raise CacheMiss(digest)
     with self._lock:
       try:
-        self._used.append(self._lru[digest])
+        size, timestamp = self._lru._items[digest]
       except KeyError:
         # If the digest is not actually in _lru, assume it is a cache miss.
         # Existing file will be overwritten by whoever uses the cache and added
         # to _lru.
         f.close()
         raise CacheMiss(digest)
+    if _is_modified(os.fstat(f.fileno()).st_mtime, timestamp):
+      # The item was not verified by cleanup(), e.g. it ran out of budget. Do
+      # it now, outside the lock.
+      if not self._verify_item(digest, size)[1]:
+        f.close()
+        raise CacheMiss(digest)
+    with self._lock:
+      self._used.append(size)
     return f
 
   def write(self, digest, content):
@@ -614,7 +751,8 @@ class DiskContentAddressedCache(ContentAddressedCache):
     else:
       # Load state of the cache.
       try:
-        self._lru = lru.LRUDict.load(self.state_file)
+        self._lru = lru.LRUDict.load(
+            self.state_file, self.journal_file, size_fn=int)
       except ValueError as err:
         logging.error('Failed to load cache state: %s' % (err,))
         # Don't want to keep broken cache dir.
@@ -634,9 +772,10 @@ class DiskContentAddressedCache(ContentAddressedCache):
       if fs.isdir(d):
         # Necessary otherwise the file can't be created.
         file_path.set_read_only(d, False)
-    if fs.isfile(self.state_file):
-      file_path.set_read_only(self.state_file, False)
-    self._lru.save(self.state_file)
+    for p in (self.state_file, self.journal_file):
+      if fs.isfile(p):
+        file_path.set_read_only(p, False)
+    self._lru.save(self.state_file, self.journal_file)
 
   def _trim(self):
     """Trims anything we don't know, make sure enough free space exists."""
@@ -646,20 +785,13 @@ class DiskContentAddressedCache(ContentAddressedCache):
     # Trim old items.
     if self.policies.max_age_secs:
       cutoff = self._lru.time_fn() - self.policies.max_age_secs
-      while self._lru:
-        oldest = self._lru.get_oldest()
-        # (key, (data, ts)
-        if oldest[1][1] >= cutoff:
-          break
+      while self._lru and self._lru.oldest_timestamp < cutoff:
         evicted.append(self._remove_lru_file(True))
 
     # Ensure maximum cache size.
     if self.policies.max_cache_size:
-      total_size = sum(self._lru.values())
-      while total_size > self.policies.max_cache_size:
-        e = self._remove_lru_file(True)
-        evicted.append(e)
-        total_size -= e
+      while self._lru.total_size > self.policies.max_cache_size:
+        evicted.append(self._remove_lru_file(True))
 
     # Ensure maximum number of items in the cache.
     if self.policies.max_items and len(self._lru) > self.policies.max_items:
@@ -676,7 +808,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
       evicted.append(self._remove_lru_file(True))
 
     if evicted:
-      total_usage = sum(self._lru.values())
+      total_usage = self._lru.total_size
       usage_percent = 0.
       if total_usage:
         usage_percent = 100. * float(total_usage) / self.policies.max_cache_size
@@ -690,10 +822,70 @@ class DiskContentAddressedCache(ContentAddressedCache):
     self._save()
     return evicted
 
-  def _path(self, digest):
-    """Returns the path to one item."""
+  def _path(self, digest, sharded=None):
+    """Returns the path to one item.
+
+    sharded defaults to the layout specified in the policies.
+    """
+    if sharded is None:
+      sharded = self.policies.sharded
+    if sharded:
+      return os.path.join(self.cache_dir, digest[:2], digest[2:])
     return os.path.join(self.cache_dir, digest)
 
+  def _migrate_item(self, digest):
+    """Moves an item stored in the other layout to the one in the policies.
+
+    It can be called without the lock held.
+
+    Returns:
+      True if the item was moved.
+    """
+    src = self._path(digest, not self.policies.sharded)
+    if not fs.isfile(src):
+      return False
+    dst = self._path(digest)
+    try:
+      file_path.ensure_tree(os.path.dirname(dst))
+      fs.rename(src, dst)
+    except OSError as e:
+      logging.warning('Failed to move %s to %s: %s', src, dst, e)
+      return False
+    return True
+
+  def _cleanup_shard(self, shard, known):
+    """Lists the items of one shard directory and fixes their mode.
+
+    Runs in a thread pool without the lock held.
+
+    Arguments:
+      shard: name of the shard directory.
+      known: frozenset of the digests in the LRU.
+
+    Returns:
+      tuple(shard, list of the known digests found, list of unknown paths).
+    """
+    found = []
+    unknown = []
+    for entry in fs.scandir(os.path.join(self.cache_dir, shard)):
+      digest = shard + entry.name
+      if digest in known and entry.is_file(follow_symlinks=False):
+        _ensure_mode(entry, 0o400)
+        found.append(digest)
+      else:
+        unknown.append(entry.path)
+    return shard, found, unknown
+
+  def _remove_unknown(self, path):
+    """Removes an unknown file or directory from the cache directory."""
+    if fs.isdir(path) and not fs.islink(path):
+      try:
+        file_path.rmtree(path)
+      except OSError:
+        pass
+    else:
+      file_path.try_remove(path)
+
   def _remove_lru_file(self, allow_protected):
     """Removes the latest recently used file and returns its size.
 
@@ -703,7 +895,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
     try:
       digest, _ = self._lru.get_oldest()
       if not allow_protected and digest == self._protected:
-        total_size = sum(self._lru.values())
+        total_size = self._lru.total_size
         msg = ('Not enough space to fetch the whole isolated tree.\n'
                ' %s\n  cache=%d bytes (%.3f GiB), %d items; '
                '%s bytes (%.3f GiB) free_space') % (
@@ -762,11 +954,83 @@ class DiskContentAddressedCache(ContentAddressedCache):
     return  os.path.getmtime(self._path(digest))
 
   def _is_valid_hash(self, digest):
-    """Verify digest with supported hash algos."""
-    for _, algo in isolated_format.SUPPORTED_ALGOS.items():
-      if digest == isolated_format.hash_file(self._path(digest), algo):
-        return True
-    return False
+    """Verifies the content of an item against its digest.
+
+    The hashing algorithm is inferred from the length of the digest.
+    """
+    algo = isolated_format.get_hash_algo_from_digest(digest)
+    if not algo:
+      return False
+    try:
+      return digest == isolated_format.hash_file(self._path(digest), algo)
+    except (IOError, OSError):
+      return False
+
+  def _verify_item(self, digest, size):
+    """Verifies a modified item and updates the LRU accordingly.
+
+    Must be called without the lock held.
+
+    Returns:
+      tuple(digest, True if the item is valid).
+    """
+    logging.warning('Item has been modified. item: %s', digest)
+    valid = self._is_valid_hash(digest)
+    with self._lock:
+      if digest in self._lru:
+        if valid:
+          # Update timestamp in state.json
+          self._lru.touch(digest)
+        else:
+          # remove corrupted file from LRU and file system
+          self._lru.pop(digest)
+          self._delete_file(digest, size)
+          logging.error('Deleted corrupted item: %s', digest)
+    return digest, valid
+
+  def _verify_items(self, items):
+    """Verifies modified items concurrently, within the verification budget.
+
+    The items not verified in time are left as-is, to be verified by
+    getfileobj() when used.
+
+    Arguments:
+      items: list of (digest, size) to verify.
+    """
+    deadline = time.time() + self.VERIFY_TIME_BUDGET_SECS
+    budget_lock = threading.Lock()
+    # Bytes left in the budget, as a list to be updated by the workers.
+    budget = [self.VERIFY_BYTES_BUDGET]
+
+    def verify(digest, size):
+      with budget_lock:
+        if budget[0] < size or time.time() >= deadline:
+          return digest, None
+        budget[0] -= size
+      return self._verify_item(digest, size)
+
+    total_size = sum(size for _, size in items)
+    skipped = 0
+    with tools.Profiler('VerifyItems') as p:
+      p.size = 0
+      with threading_utils.ThreadPool(
+          1, min(self.verify_threads, len(items)), 0, 'verify') as pool:
+        for digest, size in items:
+          pool.add_task(0, verify, digest, size)
+        sizes = dict(items)
+        last_progress = time.time()
+        for i, (digest, valid) in enumerate(pool.iter_results()):
+          if valid is None:
+            skipped += 1
+          else:
+            p.size += sizes[digest]
+          if time.time() - last_progress >= 10:
+            p.progress(i + 1, len(items))
+            last_progress = time.time()
+    if skipped:
+      logging.warning(
+          'Verification budget exhausted after %d bytes out of %d; %d items '
+          'will be verified when used', p.size, total_size, skipped)
 
 
 class NamedCache(Cache):
@@ -781,6 +1045,11 @@ class NamedCache(Cache):
   """
   _DIR_ALPHABET = string.ascii_letters + string.digits
   STATE_FILE = u'state.json'
+  # Sizes being computed and size hints of the caches, see _load_sizes().
+  SIZES_FILE = u'sizes.json'
+  # Sizes computed by compute_named_cache_sizes(), one <rel_cache>.json file
+  # per cache, see _apply_computed_sizes().
+  COMPUTED_DIR = u'sizes'
   NAMED_DIR = u'named'
 
   def __init__(self, cache_dir, policies, time_fn=None):
@@ -796,12 +1065,13 @@ class NamedCache(Cache):
     self._policies = policies
     # LRU {cache_name -> tuple(cache_location, size)}
     self.state_file = os.path.join(cache_dir, self.STATE_FILE)
-    self._lru = lru.LRUDict()
+    self._lru = lru.LRUDict(size_fn=_named_cache_size)
     if not fs.isdir(self.cache_dir):
       fs.makedirs(self.cache_dir)
     elif fs.isfile(self.state_file):
       try:
-        self._lru = lru.LRUDict.load(self.state_file)
+        self._lru = lru.LRUDict.load(
+            self.state_file, size_fn=_named_cache_size)
         for _, size in self._lru.values():
           if not isinstance(size, six.integer_types):
             with open(self.state_file, 'r') as f:
@@ -814,11 +1084,17 @@ class NamedCache(Cache):
             'NamedCache: failed to load named cache state file; obliterating')
         file_path.rmtree(self.cache_dir)
         fs.makedirs(self.cache_dir)
-        self._lru = lru.LRUDict()
+        self._lru = lru.LRUDict(size_fn=_named_cache_size)
       with self._lock:
         self._try_upgrade()
     if time_fn:
       self._lru.time_fn = time_fn
+    self.sizes_file = os.path.join(cache_dir, self.SIZES_FILE)
+    # Loaded lazily by _load_sizes().
+    self._sizes = None
+    self._sizes_dirty = False
+    # {cache_name -> size} of the caches installed by this instance.
+    self._installed = {}
 
   @property
   def available(self):
@@ -868,7 +1144,10 @@ class NamedCache(Cache):
             file_path.ensure_tree(os.path.dirname(dst))
             self._sudo_chown(abs_cache)
             fs.rename(abs_cache, dst)
-            self._remove(name)
+            # The size hints still apply to the directory, keep them for
+            # uninstall().
+            self._remove(name, keep_hints=True)
+            self._installed[name] = size
             return size
 
           logging.warning('- expected directory %r, does not exist', rel_cache)
@@ -897,7 +1176,9 @@ class NamedCache(Cache):
     src must be absolute and unicode. Its content is moved back into the local
     named caches cache.
 
-    Returns the named cache size in bytes.
+    The size of the cache is not computed here, as it can take minutes for
+    large caches. Until compute_named_cache_sizes() computes it, the cache has
+    the size it had when installed.
 
     Raises NamedCacheError if cannot uninstall the cache.
     """
@@ -917,13 +1198,6 @@ class NamedCache(Cache):
           logging.error('- overwriting existing cache!')
           self._remove(name)
 
-        # Calculate the size of the named cache to keep.
-        size = file_path.get_recursive_size(src)
-        logging.info('- Size is %s', size)
-        if size is None:
-          # Do not save a named cache that was deleted.
-          return
-
         # Move the dir and create an entry for the named cache.
         rel_cache = self._allocate_dir()
         abs_cache = os.path.join(self.cache_dir, rel_cache)
@@ -932,8 +1206,13 @@ class NamedCache(Cache):
         self._sudo_chown(src)
         fs.rename(src, abs_cache)
 
+        size = self._installed.pop(name, 0)
         self._lru.add(name, (rel_cache, size))
-        self._added.append(size)
+        self._load_sizes()['pending'][name] = rel_cache
+        self._sizes_dirty = True
+        # Forget a size computed for a previous cache in the same directory.
+        file_path.try_remove(os.path.join(
+            self.cache_dir, self.COMPUTED_DIR, rel_cache + u'.json'))
 
         # Create symlink <cache_dir>/<named>/<name> -> <cache_dir>/<short name>
         # for user convenience.
@@ -952,7 +1231,6 @@ class NamedCache(Cache):
           # UAC is enabled and the user is a filtered administrator account.
           if sys.platform != 'win32':
             raise
-        return size
       except (IOError, OSError) as ex:
         # Raise using the original traceback.
         exc = NamedCacheError(
@@ -987,18 +1265,20 @@ class NamedCache(Cache):
 
   @property
   def total_size(self):
+    """Returns the total size of the caches, see update_sizes()."""
     with self._lock:
-      return sum(size for _rel_path, size in self._lru.values())
+      return self._lru.total_size
 
   def get_oldest(self):
     with self._lock:
-      try:
-        # (key, (value, ts))
-        return self._lru.get_oldest()[1][1]
-      except KeyError:
-        return None
+      return self._lru.oldest_timestamp
 
   def remove_oldest(self):
+    """Removes the oldest cache.
+
+    Returns its size; for a cache whose size is pending, the size it had when
+    installed.
+    """
     with self._lock:
       # TODO(maruel): Update self._added.
       _name, size = self._remove_lru_item()
@@ -1015,11 +1295,28 @@ class NamedCache(Cache):
           self._lru.touch(name)
       self._save()
 
+  def update_sizes(self):
+    """Computes the sizes of the uninstalled caches, blocking until done.
+
+    bot_main instead computes them with run_isolated --named-cache-sizes, in a
+    process it doesn't wait for.
+    """
+    with self._lock:
+      self._save()
+    compute_named_cache_sizes(self.cache_dir)
+    with self._lock:
+      self._apply_computed_sizes()
+      self._save()
+
   def trim(self):
+    # It doesn't wait for the pending sizes: max_cache_size is enforced with the
+    # size the caches had when installed. The actual sizes are enforced by the
+    # next trim() once they are computed.
     evicted = []
     with self._lock:
       if not fs.isdir(self.cache_dir):
         return evicted
+      self._apply_computed_sizes()
 
       # Trim according to maximum number of items.
       if self._policies.max_items:
@@ -1033,10 +1330,7 @@ class NamedCache(Cache):
       # Trim according to maximum age.
       if self._policies.max_age_secs:
         cutoff = self._lru.time_fn() - self._policies.max_age_secs
-        while self._lru:
-          _name, (_data, ts) = self._lru.get_oldest()
-          if ts >= cutoff:
-            break
+        while self._lru and self._lru.oldest_timestamp < cutoff:
           name, size = self._remove_lru_item()
           evicted.append(size)
           logging.info(
@@ -1057,10 +1351,7 @@ class NamedCache(Cache):
 
       # Trim according to maximum total size.
       if self._policies.max_cache_size:
-        while self._lru:
-          total = sum(size for _rel_cache, size in self._lru.values())
-          if total <= self._policies.max_cache_size:
-            break
+        while self._lru.total_size > self._policies.max_cache_size:
           name, size = self._remove_lru_item()
           evicted.append(size)
           logging.info(
@@ -1082,6 +1373,9 @@ class NamedCache(Cache):
         actual = set(fs.listdir(self.cache_dir))
         actual.discard(self.NAMED_DIR)
         actual.discard(self.STATE_FILE)
+        actual.discard(self.SIZES_FILE)
+        actual.discard(self.COMPUTED_DIR)
+        self._apply_computed_sizes()
         expected = {v[0]: k for k, v in self._lru.items()}
         # First, handle the actual cache content.
         # Remove missing entries.
@@ -1136,6 +1430,13 @@ class NamedCache(Cache):
             except (IOError, OSError) as e:
               logging.error('Failed to remove %s: %s', unexpected, e)
               success = False
+
+        # Third, forget the sizes of the caches that are gone.
+        sizes = self._load_sizes()
+        for key in ('pending', 'hints'):
+          for name in set(sizes[key]) - set(self._lru):
+            del sizes[key][name]
+            self._sizes_dirty = True
       finally:
         self._save()
     return success
@@ -1189,13 +1490,18 @@ class NamedCache(Cache):
     raise NamedCacheError(
         'could not allocate a new cache dir, too many cache dirs')
 
-  def _remove(self, name):
+  def _remove(self, name, keep_hints=False):
     """Removes a cache directory and entry.
 
     Returns:
       Number of caches deleted.
     """
     self._lock.assert_locked()
+    sizes = self._load_sizes()
+    if sizes['pending'].pop(name, None) is not None:
+      self._sizes_dirty = True
+    if not keep_hints and sizes['hints'].pop(name, None) is not None:
+      self._sizes_dirty = True
     # First try to remove the alias if it exists.
     named_dir = self._get_named_path(name)
     if fs.islink(named_dir):
@@ -1214,6 +1520,87 @@ class NamedCache(Cache):
     self._lock.assert_locked()
     file_path.ensure_tree(self.cache_dir)
     self._lru.save(self.state_file)
+    if self._sizes_dirty:
+      file_path.atomic_replace(
+          self.sizes_file,
+          json.dumps(self._sizes, sort_keys=True,
+                     separators=(',', ':')).encode('utf-8'))
+      self._sizes_dirty = False
+
+  def _load_sizes(self):
+    """Returns the sizes state, loading it from SIZES_FILE on first use.
+
+    The state is a dict with:
+      'pending': {cache_name -> rel_cache} of the caches whose size is to be
+          computed.
+      'hints': {cache_name -> hints} of file_path.get_recursive_size_with_hints
+          from the last time the size of the cache was computed.
+    """
+    self._lock.assert_locked()
+    if self._sizes is None:
+      self._sizes = {'pending': {}, 'hints': {}}
+      try:
+        with fs.open(self.sizes_file, 'rb') as f:
+          sizes = json.loads(f.read().decode('utf-8'))
+        if isinstance(sizes, dict):
+          for key in self._sizes:
+            if isinstance(sizes.get(key), dict):
+              self._sizes[key] = sizes[key]
+      except (IOError, OSError, ValueError) as e:
+        if fs.exists(self.sizes_file):
+          logging.warning('NamedCache: ignoring invalid sizes file: %s', e)
+      # Drop the entries that don't match the LRU, e.g. when the state file
+      # was saved by a version not knowing about SIZES_FILE.
+      pending = self._sizes['pending']
+      for name, rel_cache in list(pending.items()):
+        if self._lru.get(name, (None,))[0] != rel_cache:
+          del pending[name]
+    return self._sizes
+
+  def _apply_computed_sizes(self):
+    """Applies the sizes computed by compute_named_cache_sizes().
+
+    The sizes of the caches that are not pending anymore are discarded.
+    """
+    self._lock.assert_locked()
+    computed_dir = os.path.join(self.cache_dir, self.COMPUTED_DIR)
+    if not fs.isdir(computed_dir):
+      return
+    sizes = self._load_sizes()
+    for filename in fs.listdir(computed_dir):
+      p = os.path.join(computed_dir, filename)
+      rel_cache, ext = os.path.splitext(filename)
+      try:
+        with fs.open(p, 'rb') as f:
+          computed = json.loads(f.read().decode('utf-8'))
+        name = computed['name']
+        size = computed['size']
+        hints = computed['hints']
+      except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+        logging.warning('NamedCache: ignoring invalid size %s: %s', filename, e)
+        name = None
+      file_path.try_remove(p)
+      if (ext != u'.json' or name is None or
+          sizes['pending'].get(name) != rel_cache):
+        # It was installed or evicted in the meantime.
+        continue
+      del sizes['pending'][name]
+      self._sizes_dirty = True
+      if size is None:
+        sizes['hints'].pop(name, None)
+        self._remove(name)
+      else:
+        if hints:
+          sizes['hints'][name] = hints
+        else:
+          sizes['hints'].pop(name, None)
+        self._lru.replace(name, (rel_cache, size))
+        self._added.append(size)
+    try:
+      fs.rmdir(computed_dir)
+    except OSError:
+      # compute_named_cache_sizes() is writing more sizes.
+      pass
 
   def _get_named_path(self, name):
     return os.path.join(self.cache_dir, self.NAMED_DIR, name)
@@ -69,6 +69,7 @@ import six
 # pylint: disable=ungrouped-imports
 import DEPS
 import auth
+import cache_daemon
 import cipd
 import isolate_storage
 import isolateserver
@@ -1451,6 +1452,12 @@ def create_option_parser():
   # Cache options.
   isolateserver.add_cache_options(parser)
   add_cas_cache_options(parser)
+  parser.add_option(
+      '--cache-daemon',
+      metavar='SOCKET',
+      help='Unix socket of a cache_daemon.py sharing its isolated cache '
+      'between the bots of the host. --cache is used instead when no daemon '
+      'listens on it.')
 
   cipd.add_cipd_options(parser)
 
@@ -1470,6 +1477,12 @@ def create_option_parser():
       '--named-cache-root',
       default='named_caches',
       help='Cache root directory. Default=%default')
+  group.add_option(
+      '--named-cache-sizes',
+      action='store_true',
+      help='Computes the sizes of the named caches uninstalled by the previous '
+      'tasks and returns without executing anything. It can run concurrently '
+      'with a task.')
   parser.add_option_group(group)
 
   group = optparse.OptionGroup(parser, 'Process containment')
@@ -1665,6 +1678,13 @@ def main(args):
   if not file_path.enable_symlink():
     logging.warning('Symlink support is not enabled')
 
+  if options.named_cache_sizes:
+    # Don't load the NamedCache, it could overwrite the state saved by a task
+    # running concurrently.
+    local_caching.compute_named_cache_sizes(
+        six.text_type(os.path.abspath(options.named_cache_root)))
+    return 0
+
   named_cache = process_named_cache_options(parser, options)
   # hint is 0 if there's no named cache.
   hint = _calc_named_cache_hint(named_cache, options.named_caches)
@@ -1680,7 +1700,11 @@ def main(args):
   # TODO(maruel): CIPD caches should be defined at an higher level here too, so
   # they can be cleaned the same way.
 
-  isolate_cache = isolateserver.process_cache_options(options, trim=False)
+  isolate_cache = None
+  if options.cache_daemon:
+    isolate_cache = cache_daemon.connect(options.cache_daemon)
+  if not isolate_cache:
+    isolate_cache = isolateserver.process_cache_options(options, trim=False)
   cas_cache = process_cas_cache_options(options)
 
   caches = []
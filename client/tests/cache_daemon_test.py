@@ -0,0 +1,246 @@
+#!/usr/bin/env vpython3
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+# Mutates sys.path.
+import test_env
+
+import cache_daemon
+import local_caching
+from utils import file_path
+from utils import fs
+
+
+def _digest(content):
+  return hashlib.sha1(content).hexdigest()
+
+
+def _read(cache, digest):
+  with cache.getfileobj(digest) as f:
+    return f.read()
+
+
+@unittest.skipIf(sys.platform == 'win32', 'Unix sockets are not supported')
+class CacheDaemonTest(unittest.TestCase):
+
+  def setUp(self):
+    super(CacheDaemonTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'cache_daemon_test')
+    self.socket_path = os.path.join(self.tempdir, 'socket')
+    self.clients = []
+    self.server = None
+
+  def tearDown(self):
+    for client in self.clients:
+      client.close()
+    if self.server:
+      self.server.shutdown()
+      self.server.server_close()
+    file_path.rmtree(self.tempdir)
+    super(CacheDaemonTest, self).tearDown()
+
+  def start(self, max_items=0):
+    policies = local_caching.CachePolicies(
+        max_cache_size=1024, min_free_space=0, max_items=max_items,
+        max_age_secs=0)
+    self.cache = cache_daemon.SharedContentAddressedCache(
+        os.path.join(self.tempdir, u'cache'), policies, trim=True)
+    self.server = cache_daemon.CacheServer(self.socket_path, self.cache)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def connect(self):
+    client = cache_daemon.connect(self.socket_path)
+    self.assertIsNotNone(client)
+    self.clients.append(client)
+    return client
+
+  def wait_unpinned(self, digest):
+    # The daemon releases the pins of a closed connection asynchronously.
+    while True:
+      with self.cache._lock:
+        if digest not in self.cache._pins:
+          return
+      time.sleep(0.01)
+
+  def test_not_running(self):
+    self.assertIsNone(cache_daemon.connect(self.socket_path))
+
+  def test_shared(self):
+    self.start()
+    bot1 = self.connect()
+    bot2 = self.connect()
+    self.assertEqual(self.cache.cache_dir, bot1.cache_dir)
+    self.assertEqual(1024, bot1.policies.max_cache_size)
+    self.assertEqual(0, bot1.policies.max_items)
+    digest = _digest(b'foo')
+    self.assertNotIn(digest, bot2)
+    self.assertFalse(bot2.touch(digest, 3))
+    bot1.write(digest, [b'f', b'oo'])
+    self.assertEqual([3], bot1.added)
+    self.assertIn(digest, bot2)
+    self.assertEqual([digest], list(bot2))
+    self.assertEqual(1, len(bot2))
+    self.assertEqual(3, bot2.total_size)
+    self.assertTrue(bot2.touch(digest, 3))
+    self.assertEqual(b'foo', _read(bot2, digest))
+    self.assertEqual([3], bot2.used)
+    self.assertEqual([], bot2.added)
+    with self.assertRaises(local_caching.CacheMiss):
+      bot2.getfileobj(_digest(b'bar'))
+
+  def test_single_fetch(self):
+    self.start()
+    bot1 = self.connect()
+    bot2 = self.connect()
+    digest = _digest(b'foo')
+    writing = threading.Event()
+    resume = threading.Event()
+
+    def slow_content():
+      yield b'f'
+      writing.set()
+      resume.wait()
+      yield b'oo'
+
+    thread = threading.Thread(target=bot1.write, args=(digest, slow_content()))
+    thread.start()
+    writing.wait()
+
+    fetched = []
+    def content():
+      fetched.append(True)
+      yield b'foo'
+
+    # bot2 waits for bot1 to write the item, then doesn't fetch it.
+    thread2 = threading.Thread(target=bot2.write, args=(digest, content()))
+    thread2.start()
+    thread2.join(0.1)
+    self.assertTrue(thread2.is_alive())
+    resume.set()
+    thread.join()
+    thread2.join()
+    self.assertEqual([], fetched)
+    self.assertEqual([3], bot1.added)
+    self.assertEqual([], bot2.added)
+    self.assertEqual(b'foo', _read(bot2, digest))
+
+  def test_reserve_while_verifying(self):
+    self.start()
+    bot1 = self.connect()
+    bot2 = self.connect()
+    foo = _digest(b'foo')
+    bot1.write(foo, [b'foo'])
+    verifying = threading.Event()
+    resume = threading.Event()
+    orig_touch = self.cache.touch
+
+    def touch(digest, size):
+      if digest == foo:
+        verifying.set()
+        resume.wait()
+      return orig_touch(digest, size)
+
+    # The cache is created by each test.
+    self.cache.touch = touch
+    fetched = []
+    def content():
+      fetched.append(True)
+      yield b'foo'
+
+    thread = threading.Thread(target=bot1.write, args=(foo, content()))
+    thread.start()
+    verifying.wait()
+    # Other items can be reserved and written while foo is being verified.
+    bar = _digest(b'bar')
+    thread2 = threading.Thread(target=bot2.write, args=(bar, [b'bar']))
+    thread2.start()
+    thread2.join(10)
+    written = not thread2.is_alive()
+    resume.set()
+    thread2.join()
+    self.assertTrue(written)
+    self.assertEqual(b'bar', _read(bot2, bar))
+    thread.join()
+    self.assertEqual([], fetched)
+    self.assertEqual([3, 3], self.cache.added)
+
+  def test_failed_write(self):
+    self.start()
+    bot = self.connect()
+    digest = _digest(b'foo')
+
+    def content():
+      yield b'f'
+      raise IOError('Connection lost')
+
+    with self.assertRaises(IOError):
+      bot.write(digest, content())
+    self.assertNotIn(digest, bot)
+    self.assertFalse(fs.exists(self.cache.path(digest)))
+    # The reservation was released.
+    bot.write(digest, [b'foo'])
+    self.assertEqual(b'foo', _read(bot, digest))
+
+  def test_disconnected_while_writing(self):
+    self.start()
+    digest = _digest(b'foo')
+    conn = cache_daemon._Connection(self.socket_path)
+    reply = conn.call({'cmd': 'reserve', 'digest': digest})
+    self.assertFalse(reply['present'])
+    with fs.open(reply['path'], 'wb') as f:
+      f.write(b'f')
+    conn.close()
+    # The partial item is removed when the session is closed.
+    bot = self.connect()
+    bot.write(digest, [b'foo'])
+    self.assertEqual(b'foo', _read(bot, digest))
+
+  def test_pinned(self):
+    self.start(max_items=1)
+    bot1 = self.connect()
+    bot2 = self.connect()
+    foo = _digest(b'foo')
+    bar = _digest(b'bar')
+    bot1.write(foo, [b'foo'])
+    bot2.write(bar, [b'bar'])
+    bot2.close()
+    self.wait_unpinned(bar)
+    # foo is the oldest but it is still in use by bot1.
+    self.assertEqual([3], bot2.trim())
+    self.assertEqual([foo], list(bot2))
+    bot1.close()
+    self.wait_unpinned(foo)
+    baz = _digest(b'baz')
+    bot2.write(baz, [b'baz'])
+    self.assertEqual([3], bot2.trim())
+    self.assertEqual([baz], list(bot2))
+
+  def test_all_pinned(self):
+    self.start(max_items=1)
+    bot = self.connect()
+    bot.write(_digest(b'foo'), [b'foo'])
+    bot.write(_digest(b'bar'), [b'bar'])
+    with self.assertRaises(local_caching.NoMoreSpace):
+      bot.trim()
+
+  def test_protocol_version(self):
+    self.start()
+    conn = cache_daemon._Connection(self.socket_path)
+    reply = conn.call({'cmd': 'hello', 'version': 0})
+    conn.close()
+    self.assertEqual('Error', reply['error'])
+
+
+if __name__ == '__main__':
+  test_env.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env vpython3
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+# Mutates sys.path.
+import test_env
+
+from utils import digest_cache
+from utils import fs
+
+
+class DigestCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    super(DigestCacheTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'digest_cache_test')
+    self.db_path = os.path.join(self.tempdir, u'cache', u'digests.db')
+    self.path = os.path.join(self.tempdir, u'file')
+    self._write(b'foo')
+    # Far enough from the file modification to not be racy.
+    self.now = time.time() + 60
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+    super(DigestCacheTest, self).tearDown()
+
+  def _write(self, content):
+    with fs.open(self.path, 'wb') as f:
+      f.write(content)
+
+  def test_get_set(self):
+    cache = digest_cache.DigestCache(self.db_path)
+    stat = fs.stat(self.path)
+    self.assertIsNone(cache.get(self.path, 'sha-1', stat))
+    cache.set(self.path, 'sha-1', stat, 'abc', self.now)
+    self.assertEqual('abc', cache.get(self.path, 'sha-1', stat))
+    self.assertIsNone(cache.get(self.path, 'sha-256', stat))
+    self.assertEqual(1, cache.hits)
+    self.assertEqual(2, cache.misses)
+    cache.close()
+
+  def test_persisted(self):
+    cache = digest_cache.DigestCache(self.db_path)
+    stat = fs.stat(self.path)
+    cache.set(self.path, 'sha-1', stat, 'abc', self.now)
+    cache.close()
+    cache = digest_cache.DigestCache(self.db_path)
+    self.assertEqual('abc', cache.get(self.path, 'sha-1', stat))
+    cache.close()
+
+  def test_shared(self):
+    cache1 = digest_cache.DigestCache(self.db_path)
+    cache2 = digest_cache.DigestCache(self.db_path)
+    stat = fs.stat(self.path)
+    cache1.set(self.path, 'sha-1', stat, 'abc', self.now)
+    self.assertIsNone(cache2.get(self.path, 'sha-1', stat))
+    cache1.flush()
+    self.assertEqual('abc', cache2.get(self.path, 'sha-1', stat))
+    cache1.close()
+    cache2.close()
+
+  def test_modified(self):
+    cache = digest_cache.DigestCache(self.db_path)
+    stat = fs.stat(self.path)
+    cache.set(self.path, 'sha-1', stat, 'abc', self.now)
+    cache.flush()
+    self._write(b'barbaz')
+    self.assertIsNone(cache.get(self.path, 'sha-1', fs.stat(self.path)))
+    # Same size, different mtime.
+    os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+    self.assertIsNone(cache.get(self.path, 'sha-1', fs.stat(self.path)))
+    cache.close()
+
+  def test_racy(self):
+    cache = digest_cache.DigestCache(self.db_path)
+    stat = fs.stat(self.path)
+    cache.set(self.path, 'sha-1', stat, 'abc', stat.st_mtime + 1)
+    self.assertIsNone(cache.get(self.path, 'sha-1', stat))
+    cache.close()
+
+  def test_schema_version(self):
+    cache = digest_cache.DigestCache(self.db_path)
+    stat = fs.stat(self.path)
+    cache.set(self.path, 'sha-1', stat, 'abc', self.now)
+    cache.close()
+    conn = sqlite3.connect(self.db_path)
+    conn.execute('PRAGMA user_version=%d' % (digest_cache.SCHEMA_VERSION + 1))
+    conn.close()
+    cache = digest_cache.DigestCache(self.db_path)
+    self.assertIsNone(cache.get(self.path, 'sha-1', stat))
+    cache.close()
+
+
+if __name__ == '__main__':
+  test_env.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env vpython3
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Benchmarks the strategies to copy a tree of files.
+
+This is what isolateserver.putfile() does when mapping writable files out of
+the cache. Every strategy of file_path.copy_file_content() is compared with
+shutil.copy2() and with the copy through Python file objects, on each
+directory given. With --loopback, filesystem images are created and mounted
+in a temporary directory first, which requires root.
+"""
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Mutates sys.path.
+import test_env
+
+import isolateserver
+from utils import file_path
+from utils import fs
+
+
+def copy_fileobj(dst, src):
+  with fs.open(src, 'rb') as srcfileobj:
+    with fs.open(dst, 'wb') as dstfileobj:
+      isolateserver.fileobj_copy(dstfileobj, srcfileobj)
+
+
+def copy_strategy(strategy):
+  return lambda dst, src: file_path.copy_file_content(dst, src, [strategy])
+
+
+def get_methods():
+  """Returns the list of (name, function) to benchmark."""
+  out = [
+      ('shutil.copy2', lambda dst, src: fs.copy2(src, dst)),
+      ('fileobj_copy', copy_fileobj),
+  ]
+  for strategy, _ in file_path._COPY_FUNCTIONS:
+    out.append((strategy, copy_strategy(strategy)))
+  out.append(('copy_file_content', file_path.copy_file_content))
+  return out
+
+
+def run(root, nb_files, size):
+  src = os.path.join(root, u'src')
+  fs.mkdir(src)
+  try:
+    content = os.urandom(size)
+    for i in range(nb_files):
+      with fs.open(os.path.join(src, u'%d' % i), 'wb') as f:
+        f.write(content)
+    print('%s: %d files of %d bytes' % (root, nb_files, size))
+    for name, copy in get_methods():
+      dst = os.path.join(root, u'dst')
+      fs.mkdir(dst)
+      try:
+        start = time.time()
+        for i in range(nb_files):
+          copy(os.path.join(dst, u'%d' % i), os.path.join(src, u'%d' % i))
+        duration = time.time() - start
+        print('  %-18s %8.1fms %8.1fMiB/s' % (
+            name, duration * 1000.,
+            nb_files * size / 1024. / 1024. / duration))
+      except OSError as e:
+        print('  %-18s unsupported: %s' % (name, e))
+      finally:
+        file_path.rmtree(dst)
+  finally:
+    file_path.rmtree(src)
+
+
+def mount_loopback(tempdir, fstype, size_mb):
+  """Creates and mounts a filesystem image, returns its mount point."""
+  image = os.path.join(tempdir, fstype + '.img')
+  mount_point = os.path.join(tempdir, fstype)
+  with open(image, 'wb') as f:
+    f.truncate(size_mb * 1024 * 1024)
+  subprocess.check_call(['mkfs.' + fstype, '-q', image])
+  os.mkdir(mount_point)
+  subprocess.check_call(['mount', '-o', 'loop', image, mount_point])
+  return mount_point
+
+
+def main():
+  parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+  parser.add_argument(
+      '--dir', action='append', default=[],
+      help='Directory to run the benchmark in, can be specified multiple '
+      'times. Defaults to the temporary directory and /dev/shm (tmpfs)')
+  parser.add_argument(
+      '--loopback', action='append', default=[], metavar='FSTYPE',
+      help='Also run the benchmark on a loopback image of this filesystem, '
+      'e.g. ext4, xfs or btrfs. Requires root')
+  parser.add_argument(
+      '--files', type=int, default=2000, help='Number of files')
+  parser.add_argument(
+      '--size', type=int, default=64, help='Size of each file in KiB')
+  parser.add_argument('-v', '--verbose', action='store_true')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+
+  dirs = args.dir
+  if not dirs:
+    dirs = [tempfile.gettempdir()]
+    if os.path.isdir('/dev/shm'):
+      dirs.append('/dev/shm')
+  tempdirs = []
+  mounts = []
+  try:
+    for d in dirs:
+      tempdirs.append(tempfile.mkdtemp(prefix=u'file_path_benchmark', dir=d))
+    roots = tempdirs[:]
+    if args.loopback:
+      tempdirs.append(tempfile.mkdtemp(prefix=u'file_path_benchmark'))
+      image_size_mb = max(64, 3 * args.files * args.size // 1024)
+      for fstype in args.loopback:
+        mounts.append(mount_loopback(tempdirs[-1], fstype, image_size_mb))
+      roots.extend(mounts)
+    for root in roots:
+      run(root, args.files, args.size * 1024)
+  finally:
+    for m in mounts:
+      subprocess.check_call(['umount', m])
+    for d in tempdirs:
+      file_path.rmtree(d)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -4,6 +4,7 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import errno
 import getpass
 import io
 import os
@@ -185,6 +186,76 @@ class FilePathTest(auto_stub.TestCase):
     # Do not raise OSError with errno.EEXIST
     file_path.ensure_tree(dir_foo, 0o777)
 
+  def test_copy_file_content(self):
+    src = os.path.join(self.tempdir, u'src')
+    dst = os.path.join(self.tempdir, u'dst')
+    write_content(src, b'foo' * 100000)
+    strategy = file_path.copy_file_content(dst, src)
+    self.assertIn(strategy, (
+        file_path.COPY_REFLINK, file_path.COPY_FILE_RANGE,
+        file_path.COPY_SENDFILE, file_path.COPY_READ_WRITE))
+    with fs.open(dst, 'rb') as f:
+      self.assertEqual(b'foo' * 100000, f.read())
+
+  def test_copy_file_content_fallback(self):
+    calls = []
+    def unsupported(dst_fd, _src_fd, _size):
+      calls.append('unsupported')
+      os.write(dst_fd, b'partial')
+      raise OSError(errno.EXDEV, 'Cross-device link')
+    self.mock(file_path, '_COPY_FUNCTIONS', [
+        ('unsupported', unsupported),
+        (file_path.COPY_READ_WRITE, file_path._copy_read_write),
+    ])
+    self.mock(file_path, '_copy_strategy_cache', {})
+    src = os.path.join(self.tempdir, u'src')
+    write_content(src, b'foo')
+    for i in range(2):
+      dst = os.path.join(self.tempdir, u'dst%d' % i)
+      self.assertEqual(
+          file_path.COPY_READ_WRITE, file_path.copy_file_content(dst, src))
+      with fs.open(dst, 'rb') as f:
+        self.assertEqual(b'foo', f.read())
+    # The unsupported strategy is only probed once.
+    self.assertEqual(['unsupported'], calls)
+
+  @unittest.skipUnless(
+      hasattr(os, 'copy_file_range'), 'copy_file_range() is not supported')
+  def test_copy_file_content_short_copy(self):
+    copy_file_range = os.copy_file_range
+    calls = []
+    def short_copy(src_fd, dst_fd, count, offset_src, offset_dst):
+      calls.append(offset_src)
+      if offset_src:
+        # The kernel stops early.
+        return 0
+      return copy_file_range(src_fd, dst_fd, 100, offset_src, offset_dst)
+    self.mock(os, 'copy_file_range', short_copy)
+    src = os.path.join(self.tempdir, u'src')
+    dst = os.path.join(self.tempdir, u'dst')
+    write_content(src, b'foo' * 100000)
+    self.assertEqual(
+        file_path.COPY_FILE_RANGE,
+        file_path.copy_file_content(
+            dst, src, strategies=[file_path.COPY_FILE_RANGE]))
+    # The remainder was copied with read()/write().
+    self.assertEqual([0, 100], calls)
+    with fs.open(dst, 'rb') as f:
+      self.assertEqual(b'foo' * 100000, f.read())
+
+  def test_copy_file_content_error(self):
+    def fail(_dst_fd, _src_fd, _size):
+      raise OSError(errno.EACCES, 'Permission denied')
+    self.mock(file_path, '_COPY_FUNCTIONS', [
+        ('fail', fail),
+        (file_path.COPY_READ_WRITE, file_path._copy_read_write),
+    ])
+    self.mock(file_path, '_copy_strategy_cache', {})
+    src = os.path.join(self.tempdir, u'src')
+    write_content(src, b'foo')
+    with self.assertRaises(OSError):
+      file_path.copy_file_content(os.path.join(self.tempdir, u'dst'), src)
+
   def test_rmtree_unicode(self):
     subdir = os.path.join(self.tempdir, 'hi')
     fs.mkdir(subdir)
@@ -487,6 +558,54 @@ class FilePathTest(auto_stub.TestCase):
     self.mock(file_path, '_use_scandir', lambda: True)
     self._check_get_recursive_size()
 
+  def test_get_recursive_size_with_hints(self):
+    nested_dir = os.path.join(self.tempdir, u'dir1', u'dir2')
+    os.makedirs(nested_dir)
+    with open(os.path.join(self.tempdir, u'1'), 'w') as f:
+      f.write('0')
+    with open(os.path.join(nested_dir, u'4'), 'w') as f:
+      f.write('0123')
+    if sys.platform != 'win32':
+      os.symlink(nested_dir, os.path.join(self.tempdir, u'symlink_dir'))
+
+    # Hints are only kept for directories not modified recently.
+    now = time.time()
+    self.mock(time, 'time', lambda: now)
+    size, hints = file_path.get_recursive_size_with_hints(self.tempdir, {})
+    self.assertEqual(5, size)
+    self.assertEqual({}, hints)
+    self.mock(time, 'time', lambda: now + 10)
+    size, hints = file_path.get_recursive_size_with_hints(self.tempdir, {})
+    self.assertEqual(5, size)
+    self.assertEqual(
+        {u'', os.path.join(u'dir1'), os.path.join(u'dir1', u'dir2')},
+        set(hints))
+    self.assertEqual(
+        [os.stat(nested_dir).st_mtime, 4, []],
+        hints[os.path.join(u'dir1', u'dir2')])
+
+    # An unmodified directory is not listed again, so a file modified in place
+    # is not accounted for.
+    with open(os.path.join(nested_dir, u'4'), 'w') as f:
+      f.write('012345')
+    self.assertEqual(
+        (5, hints),
+        file_path.get_recursive_size_with_hints(self.tempdir, hints))
+
+    # A new file changes the mtime of its directory.
+    with open(os.path.join(self.tempdir, u'2'), 'w') as f:
+      f.write('01')
+    os.utime(self.tempdir, (now - 10, now - 10))
+    size, new_hints = file_path.get_recursive_size_with_hints(
+        self.tempdir, hints)
+    self.assertEqual(7, size)
+    self.assertEqual(3, new_hints[u''][1])
+
+    self.assertEqual(
+        (None, None),
+        file_path.get_recursive_size_with_hints(
+            os.path.join(self.tempdir, u'missing'), {}))
+
 
 if __name__ == '__main__':
   test_env.main()
@@ -172,6 +172,22 @@ class FSTest(unittest.TestCase):
     with self.assertRaises(OSError):
       fs.readlink(os.path.join(self.tempdir, 'not_there'))
 
+  def test_scandir(self):
+    # The file types are returned with the entries, without following the
+    # symlinks.
+    fs.mkdir(os.path.join(self.tempdir, 'dir'))
+    write_content(os.path.join(self.tempdir, 'file'), b'hello')
+    fs.symlink('dir', os.path.join(self.tempdir, 'ld'))
+    actual = sorted(
+        (e.name, e.is_dir(follow_symlinks=False), e.is_symlink())
+        for e in fs.scandir(self.tempdir))
+    expected = [
+      ('dir', True, False),
+      ('file', False, False),
+      ('ld', False, True),
+    ]
+    self.assertEqual(expected, actual)
+
 
 if __name__ == '__main__':
   test_env.main()
@@ -24,9 +24,9 @@ class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
     self.end_headers()
     self.wfile.write(json.dumps(data).encode())
 
-  def send_octet_stream(self, data, headers=None):
+  def send_octet_stream(self, data, headers=None, status=200):
     """Sends a binary response."""
-    self.send_response(200)
+    self.send_response(status)
     self.send_header('Content-type', 'application/octet-stream')
     for key, value in (headers or {}).items():
       self.send_header(key, value)
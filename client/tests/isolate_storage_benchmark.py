@@ -0,0 +1,105 @@
+#!/usr/bin/env vpython3
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Benchmarks the compression and decompression throughput of the codecs.
+
+Each codec of isolate_storage is run at several levels on the files of a
+directory, as Storage does when pushing and fetching items in a namespace
+with compression. Level 0 is what already compressed files use.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+# Mutates sys.path.
+import test_env
+
+import isolate_storage
+import isolated_format
+from utils import fs
+
+
+def load_files(root, max_size):
+  """Returns the content of the files in |root|, up to |max_size| bytes."""
+  out = []
+  total = 0
+  for dirpath, dirnames, filenames in fs.walk(root):
+    dirnames.sort()
+    for filename in sorted(filenames):
+      p = os.path.join(dirpath, filename)
+      if not fs.isfile(p) or fs.islink(p):
+        continue
+      with fs.open(p, 'rb') as f:
+        out.append(f.read())
+      total += len(out[-1])
+      if total >= max_size:
+        return out
+  return out
+
+
+def split(content):
+  """Returns the chunks read from a file, as Storage does."""
+  chunk_size = isolated_format.DISK_FILE_CHUNK
+  return [
+      content[i:i + chunk_size] for i in range(0, len(content), chunk_size)
+  ]
+
+
+def run(name, codec, level, files):
+  size = sum(len(f) for f in files)
+  start = time.time()
+  compressed = [
+      b''.join(codec.compress(split(f), level, len(f))) for f in files
+  ]
+  compress_duration = time.time() - start
+  start = time.time()
+  for c in compressed:
+    for _ in codec.decompress(split(c), isolated_format.DISK_FILE_CHUNK):
+      pass
+  decompress_duration = time.time() - start
+  compressed_size = sum(len(c) for c in compressed)
+  print('  %-8s %5d  %6.1f%%  compress %8.1fMiB/s  decompress %8.1fMiB/s' % (
+      name, level, 100. * compressed_size / size,
+      size / 1024. / 1024. / compress_duration,
+      size / 1024. / 1024. / decompress_duration))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+  parser.add_argument(
+      '--dir', default=test_env.CLIENT_DIR,
+      help='Directory containing the files to compress, defaults to the '
+      'client directory')
+  parser.add_argument(
+      '--size', type=int, default=64,
+      help='Maximum number of MiB to load from the directory')
+  parser.add_argument(
+      '--large', action='store_true',
+      help='Compress the files as a single large item, as done with a large '
+      'output file. zstd then uses one thread per core')
+  args = parser.parse_args()
+
+  files = load_files(args.dir, args.size * 1024 * 1024)
+  if args.large:
+    files = [b''.join(files)]
+  print('%d files, %.1fMiB, from %s' % (
+      len(files), sum(len(f) for f in files) / 1024. / 1024., args.dir))
+  run('identity', isolate_storage.IdentityCodec(), 0, files)
+  deflate = isolate_storage.DeflateCodec()
+  for level in (0, 1, 6, 7, 9):
+    run('deflate', deflate, level, files)
+  if not isolate_storage.zstandard:
+    print('  zstd     skipped, the zstandard module is not installed')
+    return 0
+  run('zstd', isolate_storage.ZstdCodec(), 0, files)
+  for level in (1, 3, 6, 9, 19):
+    run('zstd', isolate_storage.ZstdCodec(level), level, files)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,80 @@
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""In-memory isolate_storage.StorageApi, without any network involved."""
+
+import threading
+import time
+
+import isolate_storage
+
+
+class FakeStorageApi(isolate_storage.StorageApi):
+  """Keeps the items in memory and counts the bytes transferred.
+
+  The content is stored as pushed, so it is compressed when the namespace of
+  |server_ref| is.
+
+  Each RPC can be delayed by a round trip |latency| in seconds, and the content
+  transferred over a link of |bandwidth| bytes per second shared by all the
+  RPCs.
+  """
+
+  def __init__(self, server_ref, latency=0, bandwidth=None):
+    super(FakeStorageApi, self).__init__()
+    self._server_ref = server_ref
+    self._latency = latency
+    self._bandwidth = bandwidth
+    self._lock = threading.Lock()
+    # Time at which the link is done transferring the content already sent.
+    self._link_busy_until = 0
+    # Digest -> content.
+    self.contents = {}
+    self.bytes_pushed = 0
+    self.bytes_fetched = 0
+    self.items_pushed = 0
+    self.items_fetched = 0
+    self.contains_calls = 0
+
+  @property
+  def server_ref(self):
+    return self._server_ref
+
+  def _transfer(self, size):
+    """Sleeps for the round trip and the transfer of |size| bytes."""
+    end = time.time() + self._latency
+    if self._bandwidth:
+      with self._lock:
+        start = max(time.time(), self._link_busy_until)
+        self._link_busy_until = start + float(size) / self._bandwidth
+        end = max(end, self._link_busy_until)
+    delay = end - time.time()
+    if delay > 0:
+      time.sleep(delay)
+
+  def fetch(self, digest, size, offset):
+    with self._lock:
+      content = self.contents.get(digest)
+      if content is None:
+        raise IOError('%s is not in the storage' % digest)
+      content = content[offset:]
+      self.bytes_fetched += len(content)
+      self.items_fetched += 1
+    self._transfer(len(content))
+    yield content
+
+  def push(self, item, push_state, content=None):
+    content = b''.join(item.content() if content is None else content)
+    self._transfer(len(content))
+    with self._lock:
+      self.contents[item.digest] = content
+      self.bytes_pushed += len(content)
+      self.items_pushed += 1
+
+  def contains(self, items):
+    # Each digest is sent as 40 hex characters plus some overhead.
+    self._transfer(len(items) * 100)
+    with self._lock:
+      self.contains_calls += 1
+      return {i: None for i in items if i.digest not in self.contents}
@@ -9,7 +9,11 @@ import unittest
 # Mutates sys.path.
 import test_env
 
+# third_party/
+from depot_tools import auto_stub
+
 import isolate_storage
+import isolated_format
 
 
 class HashAlgoNameTest(unittest.TestCase):
@@ -30,5 +34,75 @@ class HashAlgoNameTest(unittest.TestCase):
       self.assertIs(expected, server_ref.hash_algo, namespace)
 
 
+class CodecTest(auto_stub.TestCase):
+
+  def test_get_codec(self):
+    pairs = [
+      ('default', isolate_storage.IdentityCodec),
+      ('default-gzip', isolate_storage.DeflateCodec),
+      ('sha1-flat', isolate_storage.IdentityCodec),
+      ('sha256-deflate', isolate_storage.DeflateCodec),
+      ('sha256-zstd', isolate_storage.ZstdCodec),
+      ('sha512-zstd', isolate_storage.ZstdCodec),
+    ]
+    for namespace, expected in pairs:
+      server_ref = isolate_storage.ServerRef('http://localhost:0', namespace)
+      self.assertIsInstance(server_ref.codec, expected, namespace)
+      self.assertEqual(
+          expected is not isolate_storage.IdentityCodec,
+          server_ref.is_with_compression, namespace)
+
+  def run_codec(self, codec):
+    original = [str(x).encode() for x in range(0, 1000)]
+    for level in (0, 7):
+      compressed = list(codec.compress(iter(original), level))
+      processed = codec.decompress(iter(compressed), 100)
+      self.assertEqual(b''.join(original), b''.join(processed))
+
+  def test_identity(self):
+    self.run_codec(isolate_storage.IdentityCodec())
+
+  def test_deflate(self):
+    self.run_codec(isolate_storage.DeflateCodec())
+
+  @unittest.skipIf(not isolate_storage.zstandard, 'zstandard is required')
+  def test_zstd(self):
+    self.run_codec(isolate_storage.ZstdCodec())
+
+  @unittest.skipIf(not isolate_storage.zstandard, 'zstandard is required')
+  def test_zstd_multithread(self):
+    self.mock(isolate_storage, 'ZSTD_MULTITHREAD_MIN_SIZE', 1024)
+    codec = isolate_storage.ZstdCodec()
+    original = b''.join(
+        hashlib.sha256(str(i).encode()).digest() for i in range(1000))
+    compressed = list(codec.compress([original], 7, len(original)))
+    self.assertEqual(original, b''.join(codec.decompress(compressed, 1000)))
+
+  @unittest.skipIf(not isolate_storage.zstandard, 'zstandard is required')
+  def test_zstd_bomb(self):
+    codec = isolate_storage.ZstdCodec()
+    original = b'\x00' * 100000
+    bomb = b''.join(codec.compress([original], 7))
+    decompressed = []
+    for chunk in codec.decompress([bomb], 1000):
+      self.assertLessEqual(len(chunk), 1000)
+      decompressed.append(chunk)
+    self.assertEqual(original, b''.join(decompressed))
+
+  @unittest.skipIf(not isolate_storage.zstandard, 'zstandard is required')
+  def test_zstd_bad(self):
+    codec = isolate_storage.ZstdCodec()
+    compressed = b''.join(codec.compress([b'foo'], 7))
+    for data in (b'Im not a zstd file', compressed + b'Im not a zstd file'):
+      with self.assertRaises(IOError):
+        b''.join(codec.decompress([data], 1000))
+
+  def test_zstd_missing(self):
+    self.mock(isolate_storage, 'zstandard', None)
+    codec = isolate_storage.ZstdCodec()
+    with self.assertRaises(isolated_format.MappingError):
+      b''.join(codec.compress([b'foo'], 7))
+
+
 if __name__ == '__main__':
   test_env.main()
@@ -19,6 +19,7 @@ import test_env
 from depot_tools import auto_stub
 
 import isolated_format
+from utils import digest_cache
 from utils import file_path
 from utils import fs
 from utils import tools
@@ -143,6 +144,13 @@ class SymlinkTest(unittest.TestCase):
 
 
 class TestIsolated(auto_stub.TestCase):
+  def test_get_hash_algo_from_digest(self):
+    for algo in isolated_format.SUPPORTED_ALGOS.values():
+      self.assertEqual(
+          algo,
+          isolated_format.get_hash_algo_from_digest(algo(b'a').hexdigest()))
+    self.assertIsNone(isolated_format.get_hash_algo_from_digest(u'0123'))
+
   def test_load_isolated_empty(self):
     m = isolated_format.load_isolated('{}', isolateserver_fake.ALGO)
     self.assertEqual({}, m)
@@ -234,6 +242,143 @@ class TestIsolated(auto_stub.TestCase):
     isolated_format.save_isolated('foo', data)
     self.assertEqual([('foo', data, True)], calls)
 
+  def test_load_isolated_chunked_good(self):
+    h = u'0123456789abcdef0123456789abcdef01234567'
+    data = {
+      u'files': {
+        u'a': {
+          u'c': [[h, 2], [h, 3]],
+          u'h': h,
+          u'm': 123,
+          u's': 5,
+        },
+      },
+      u'version': isolated_format.ISOLATED_FILE_VERSION,
+    }
+    m = isolated_format.load_isolated(json.dumps(data), isolateserver_fake.ALGO)
+    self.assertEqual(data, m)
+
+  def test_load_isolated_chunked_bad(self):
+    h = u'0123456789abcdef0123456789abcdef01234567'
+    for props in (
+        # Sizes don't add up.
+        {u'c': [[h, 2], [h, 2]], u'h': h, u's': 5},
+        # Chunked tarball.
+        {u'c': [[h, 5]], u'h': h, u's': 5, u't': u'tar'},
+        # Invalid chunks.
+        {u'c': [], u'h': h, u's': 0},
+        {u'c': [[h]], u'h': h, u's': 5},
+        {u'c': [[u'bad', 5]], u'h': h, u's': 5},
+        {u'c': [[5, h]], u'h': h, u's': 5},
+        {u'c': [[h, u'5']], u'h': h, u's': 5},
+    ):
+      data = {
+        u'files': {u'a': props},
+        u'version': isolated_format.ISOLATED_FILE_VERSION,
+      }
+      with self.assertRaises(isolated_format.IsolatedError):
+        isolated_format.load_isolated(json.dumps(data), isolateserver_fake.ALGO)
+
+
+class ChunkFileTest(unittest.TestCase):
+  # Small sizes to keep the test fast.
+  SIZES = {'min_size': 256, 'avg_size': 1024, 'max_size': 4096}
+
+  def setUp(self):
+    super(ChunkFileTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'isolated_format')
+
+  def tearDown(self):
+    try:
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(ChunkFileTest, self).tearDown()
+
+  @staticmethod
+  def gen_content(size):
+    """Returns deterministic pseudo random content."""
+    return b''.join(
+        hashlib.sha256(str(i).encode()).digest() for i in range(size // 32))
+
+  def chunk(self, content):
+    p = os.path.join(self.tempdir, u'file')
+    with fs.open(p, 'wb') as f:
+      f.write(content)
+    digest, chunks = isolated_format.chunk_file(p, ALGO, **self.SIZES)
+    self.assertEqual(ALGO(content).hexdigest(), digest)
+    # The chunks cover the file exactly.
+    offset = 0
+    for chunk_digest, size in chunks:
+      self.assertEqual(
+          ALGO(content[offset:offset + size]).hexdigest(), chunk_digest)
+      offset += size
+    self.assertEqual(len(content), offset)
+    return chunks
+
+  def test_empty(self):
+    self.assertEqual([], self.chunk(b''))
+
+  def test_small(self):
+    self.assertEqual([[ALGO(b'a').hexdigest(), 1]], self.chunk(b'a'))
+
+  def test_bounds(self):
+    chunks = self.chunk(self.gen_content(64 * 1024))
+    self.assertGreater(len(chunks), 8)
+    for _, size in chunks[:-1]:
+      self.assertGreater(size, self.SIZES['min_size'])
+      self.assertLessEqual(size, self.SIZES['max_size'])
+    # Content without boundary is cut at the maximum size.
+    self.assertEqual(
+        [self.SIZES['max_size']] * 4,
+        [s for _, s in self.chunk(b'\0' * 4 * self.SIZES['max_size'])])
+
+  def test_insertion(self):
+    content = self.gen_content(64 * 1024)
+    before = self.chunk(content)
+    after = self.chunk(content[:32 * 1024] + b'inserted' + content[32 * 1024:])
+    # Only the chunks around the insertion differ; the boundaries after it are
+    # found again.
+    self.assertLessEqual(len([c for c in after if c not in before]), 2)
+    self.assertEqual(before[:10], after[:10])
+    self.assertEqual(before[-10:], after[-10:])
+
+
+class HashFileCachedTest(unittest.TestCase):
+
+  def setUp(self):
+    super(HashFileCachedTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'isolated_format')
+    self.cache = digest_cache.DigestCache(
+        os.path.join(self.tempdir, u'digests.db'))
+    self.previous = isolated_format.set_digest_cache(self.cache)
+
+  def tearDown(self):
+    try:
+      isolated_format.set_digest_cache(self.previous)
+      self.cache.close()
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(HashFileCachedTest, self).tearDown()
+
+  def test_hash_file_cached(self):
+    p = os.path.join(self.tempdir, u'file')
+    with fs.open(p, 'wb') as f:
+      f.write(b'foo')
+    # Make the file old enough to not be racy.
+    os.utime(p, (0, 0))
+    expected = ALGO(b'foo').hexdigest()
+    self.assertEqual(expected, isolated_format.hash_file_cached(p, ALGO))
+    self.assertEqual(0, self.cache.hits)
+    self.assertEqual(expected, isolated_format.hash_file_cached(p, ALGO))
+    self.assertEqual(1, self.cache.hits)
+    # Modifying the file invalidates the entry.
+    with fs.open(p, 'wb') as f:
+      f.write(b'bar')
+    os.utime(p, (0, 0))
+    self.assertEqual(
+        ALGO(b'bar').hexdigest(), isolated_format.hash_file_cached(p, ALGO))
+    self.assertEqual(1, self.cache.hits)
+
 
 if __name__ == '__main__':
   test_env.main()
@@ -0,0 +1,279 @@
+#!/usr/bin/env vpython3
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Benchmarks archiving and fetching directories.
+
+- transfer: the bytes transferred across successive builds. Each build slightly
+  modifies a large file, then archives the directory to an in-memory storage
+  and fetches it back into a warm cache, as a bot running the next build would
+  do. This is done with and without content defined chunking.
+- hashing: walking and hashing a large output directory, as done when archiving
+  it, with one hashing thread and with HASHING_THREADS.
+- upload: Storage.upload_items() against a server with a simulated latency and
+  bandwidth, with fixed size /contains batches looked up one at a time and
+  with the adaptive batches.
+"""
+
+import argparse
+import binascii
+import hashlib
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Mutates sys.path.
+import test_env
+
+import isolate_storage
+import isolate_storage_fake
+import isolateserver
+import local_caching
+from utils import file_path
+from utils import fs
+from utils import threading_utils
+
+
+def gen_content(rnd, size):
+  return binascii.unhexlify('%0*x' % (size * 2, rnd.getrandbits(size * 8)))
+
+
+def modify(rnd, content, nb_edits):
+  """Returns content with a few small insertions, deletions and overwrites."""
+  for _ in range(nb_edits):
+    offset = rnd.randint(0, len(content))
+    edit = gen_content(rnd, rnd.randint(1, 4096))
+    kind = rnd.choice(('insert', 'delete', 'overwrite'))
+    if kind == 'insert':
+      content = content[:offset] + edit + content[offset:]
+    elif kind == 'delete':
+      content = content[:offset] + content[offset + len(edit):]
+    else:
+      content = content[:offset] + edit + content[offset + len(edit):]
+  return content
+
+
+def run_transfer(builds, tempdir, chunked):
+  server_ref = isolate_storage.ServerRef('http://localhost:1', 'default')
+  storage_api = isolate_storage_fake.FakeStorageApi(server_ref)
+  cache = local_caching.MemoryContentAddressedCache()
+  src = os.path.join(tempdir, u'src')
+  out = os.path.join(tempdir, u'out')
+  print('chunked=%s' % chunked)
+  for i, content in enumerate(builds):
+    if fs.isdir(src):
+      file_path.rmtree(src)
+    fs.mkdir(src)
+    with fs.open(os.path.join(src, u'big'), 'wb') as f:
+      f.write(content)
+    with fs.open(os.path.join(src, u'small'), 'wb') as f:
+      f.write(b'build %d' % i)
+
+    pushed = storage_api.bytes_pushed
+    fetched = storage_api.bytes_fetched
+    with isolateserver.Storage(storage_api) as storage:
+      start = time.time()
+      results, _cold, _hot = isolateserver.archive_files_to_storage(
+          storage, [src], None, chunked=chunked)
+      archive_duration = time.time() - start
+      start = time.time()
+      isolateserver.fetch_isolated(results[src], storage, cache, out, False)
+      fetch_duration = time.time() - start
+    file_path.rmtree(out)
+    print('  build %d: pushed %9d bytes in %5.2fs, fetched %9d bytes in '
+          '%5.2fs' % (
+              i, storage_api.bytes_pushed - pushed, archive_duration,
+              storage_api.bytes_fetched - fetched, fetch_duration))
+  print('  total:   pushed %9d bytes,          fetched %9d bytes' % (
+      storage_api.bytes_pushed, storage_api.bytes_fetched))
+
+
+def cmd_transfer(args, tempdir):
+  rnd = random.Random(0)
+  builds = [gen_content(rnd, args.size * 1024 * 1024)]
+  for _ in range(args.builds - 1):
+    builds.append(modify(rnd, builds[-1], args.edits))
+  run_transfer(builds, tempdir, False)
+  run_transfer(builds, tempdir, True)
+
+
+def make_output_dir(root, nb_files, total_size):
+  """Creates nb_files distinct files totaling total_size bytes."""
+  size = total_size // nb_files
+  block = os.urandom(size)
+  for i in range(nb_files):
+    d = os.path.join(root, u'%d' % (i // 1000))
+    if not i % 1000:
+      fs.mkdir(d)
+    with fs.open(os.path.join(d, u'%d' % i), 'wb') as f:
+      # Make each file unique.
+      f.write(b'%08d' % i)
+      f.write(block[8:])
+
+
+def run_hashing(root, nb_threads):
+  isolateserver.HASHING_THREADS = nb_threads
+  nb_files = 0
+  total_size = 0
+  first = None
+  start = time.time()
+  for item, _relpath, _meta in isolateserver._directory_to_metadata(
+      root, hashlib.sha1, None):
+    if first is None:
+      first = time.time() - start
+    nb_files += 1
+    total_size += item.size
+  duration = time.time() - start
+  print('  %2d threads: %6d files in %7.2fs, %7.1fMiB/s, first item after '
+        '%6.1fms' % (
+            nb_threads, nb_files, duration,
+            total_size / 1024. / 1024. / duration, first * 1000.))
+
+
+def cmd_hashing(args, tempdir):
+  root = os.path.join(tempdir, u'out')
+  fs.mkdir(root)
+  make_output_dir(root, args.files, args.size * 1024 * 1024)
+  print('%d files, %dMiB' % (args.files, args.size))
+  # The first run warms up the OS page cache, if the directory fits in it.
+  hashing_threads = isolateserver.HASHING_THREADS
+  for nb_threads in (hashing_threads, 1, hashing_threads):
+    run_hashing(root, nb_threads)
+
+
+class UploadItem(isolate_storage.Item):
+  """Item of |size| null bytes, with a fake digest unique to |index|."""
+
+  def __init__(self, index, size):
+    super(UploadItem, self).__init__(
+        digest=hashlib.sha1(b'%d' % index).hexdigest(), size=size)
+
+  def content(self):
+    for offset in range(0, self.size, 1024 * 1024):
+      yield b'\0' * min(1024 * 1024, self.size - offset)
+
+
+def gen_upload_items(rnd, nb_files):
+  """Returns mostly small items, with a few large ones."""
+  out = []
+  for i in range(nb_files):
+    if rnd.random() < 0.02:
+      size = rnd.randint(1024 * 1024, 16 * 1024 * 1024)
+    else:
+      size = rnd.randint(0, 64 * 1024)
+    out.append(UploadItem(i, size))
+  return out
+
+
+def enumerate_items(items, hash_speed):
+  """Yields the items as if they were hashed at |hash_speed| bytes/s."""
+  for item in items:
+    time.sleep(float(item.size) / hash_speed)
+    yield item
+
+
+def run_upload(items, missing, args, latency, name, constants):
+  server_ref = isolate_storage.ServerRef('http://localhost:1', 'default')
+  storage_api = isolate_storage_fake.FakeStorageApi(
+      server_ref, latency, args.bandwidth * 1024 * 1024)
+  for item in items:
+    if item not in missing:
+      storage_api.contents[item.digest] = b''
+  old = {k: getattr(isolateserver, k) for k in constants}
+  try:
+    for k, v in constants.items():
+      setattr(isolateserver, k, v)
+    start = time.time()
+    with isolateserver.Storage(storage_api) as storage:
+      uploaded = storage.upload_items(
+          enumerate_items(items, args.hash_speed * 1024 * 1024))
+    duration = time.time() - start
+  finally:
+    for k, v in old.items():
+      setattr(isolateserver, k, v)
+  assert len(uploaded) == len(missing), (len(uploaded), len(missing))
+  print('  %-10s %7.2fs, %4d lookups' % (
+      name, duration, storage_api.contains_calls))
+
+
+def cmd_upload(args, _tempdir):
+  rnd = random.Random(0)
+  items = gen_upload_items(rnd, args.files)
+  missing = set(i for i in items if rnd.random() < args.missing)
+  print('%d files, %dMiB, %d missing totaling %dMiB, hashed at %dMiB/s, '
+        'link of %dMiB/s' % (
+            len(items), sum(i.size for i in items) / 1024 / 1024,
+            len(missing), sum(i.size for i in missing) / 1024 / 1024,
+            args.hash_speed, args.bandwidth))
+  fixed = {
+      'CONTAINS_MIN_ITEMS': 100,
+      'CONTAINS_MAX_ITEMS': 100,
+      'CONTAINS_MAX_BYTES': 2**62,
+      'CONTAINS_MAX_IN_FLIGHT': 1,
+      'PUSH_MAX_IN_FLIGHT': threading_utils.IOAutoRetryThreadPool.MAX_WORKERS,
+  }
+  for latency in args.latency:
+    print('%dms round trip' % (latency * 1000))
+    run_upload(items, missing, args, latency, 'fixed', fixed)
+    run_upload(items, missing, args, latency, 'adaptive', {})
+
+
+def main():
+  parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+  parser.add_argument('-v', '--verbose', action='store_true')
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+  transfer = subparsers.add_parser(
+      'transfer', help='Bytes transferred across successive builds')
+  transfer.set_defaults(func=cmd_transfer)
+  transfer.add_argument(
+      '--size', type=int, default=32, help='Size of the large file in MiB')
+  transfer.add_argument(
+      '--builds', type=int, default=4, help='Number of successive builds')
+  transfer.add_argument(
+      '--edits', type=int, default=3, help='Number of edits per build')
+  hashing = subparsers.add_parser(
+      'hashing',
+      help='Walking and hashing a large output directory, e.g. '
+      '--files 100000 --size 20480 for 100k files totaling 20GiB')
+  hashing.set_defaults(func=cmd_hashing)
+  hashing.add_argument(
+      '--files', type=int, default=10000, help='Number of files')
+  hashing.add_argument(
+      '--size', type=int, default=2048, help='Total size in MiB')
+  upload = subparsers.add_parser(
+      'upload', help='Uploading many items with a simulated network')
+  upload.set_defaults(func=cmd_upload)
+  upload.add_argument(
+      '--files', type=int, default=2000, help='Number of files')
+  upload.add_argument(
+      '--missing', type=float, default=0.1,
+      help='Fraction of the files missing on the server')
+  upload.add_argument(
+      '--latency', type=float, action='append',
+      help='Round trip time in seconds, can be specified multiple times. '
+      'Defaults to 0.01 and 0.1')
+  upload.add_argument(
+      '--bandwidth', type=int, default=100, help='Bandwidth in MiB/s')
+  upload.add_argument(
+      '--hash-speed', type=int, default=500,
+      help='Speed at which the files are enumerated, in MiB/s')
+  args = parser.parse_args()
+  if args.command == 'upload' and not args.latency:
+    args.latency = [0.01, 0.1]
+  logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+
+  tempdir = tempfile.mkdtemp(prefix=u'isolateserver_benchmark')
+  try:
+    args.func(args, tempdir)
+  finally:
+    file_path.rmtree(tempdir)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -77,6 +77,29 @@ class FakeIsolateServerHandler(httpserver.Handler):
         self.server.contents.setdefault(namespace, {})[d] = content
     self.send_json({'ok': True})
 
+  def _send_gcs_content(self, digest, content):
+    """Sends |content|, or its range requested by the Range header."""
+    offset = 0
+    status = 200
+    headers = {}
+    range_header = self.headers.get('Range')
+    if range_header:
+      offset = int(re.match(r'^bytes=(\d+)-$', range_header).group(1))
+      status = 206
+      headers['Content-Range'] = 'bytes %d-%d/%d' % (
+          offset, len(content) - 1, len(content))
+    self.server.fetches.append((digest, offset))
+    content = content[offset:]
+    headers['Content-Length'] = str(len(content))
+    failures = self.server.fetch_failures.get(digest)
+    if not failures:
+      self.send_octet_stream(content, headers=headers, status=status)
+      return
+    # Simulates a connection lost after sending this many bytes.
+    content = content[:failures.pop(0)]
+    self.send_octet_stream(content, headers=headers, status=status)
+    self.close_connection = True
+
   ### Faked HTTP Methods
 
   def do_GET(self):
@@ -91,7 +114,7 @@ class FakeIsolateServerHandler(httpserver.Handler):
     elif self.path.startswith('/FAKE_GCS/'):
       namespace, h = self.path[len('/FAKE_GCS/'):].split('/', 1)
       content = self.server.contents.get(namespace, {}).get(h)
-      self.send_octet_stream(content)
+      self._send_gcs_content(h, content)
     else:
       raise NotImplementedError(self.path)
 
@@ -146,7 +169,7 @@ class FakeIsolateServerHandler(httpserver.Handler):
         return
 
       if data and not self.server.store_hash_instead:
-        data = base64.b64encode(data).decode()
+        data = base64.b64encode(data[request['offset']:]).decode()
 
       self.send_json({
           'content': data,
@@ -191,6 +214,11 @@ class FakeIsolateServer(httpserver.Server):
     super(FakeIsolateServer, self).__init__()
     self._server.contents = {}
     self._server.store_hash_instead = False
+    # (digest, offset) of the content fetched from GCS.
+    self._server.fetches = []
+    # Digest -> list of the number of bytes to send before dropping the
+    # connection, one per fetch from GCS.
+    self._server.fetch_failures = {}
 
   def store_hash_instead(self):
     """Stops saving content in memory. Used to test large files."""
@@ -200,6 +228,14 @@ class FakeIsolateServer(httpserver.Server):
   def contents(self):
     return self._server.contents
 
+  @property
+  def fetches(self):
+    return self._server.fetches
+
+  def inject_fetch_failures(self, digest, sizes):
+    """Drops the next fetches of |digest| from GCS after |sizes| bytes."""
+    self._server.fetch_failures[digest] = list(sizes)
+
   def add_content_compressed(self, namespace, content):
     assert not self._server.store_hash_instead
     h = hash_content(content)
@@ -6,6 +6,7 @@
 from __future__ import print_function
 
 import base64
+import functools
 import hashlib
 import json
 import logging
@@ -14,6 +15,8 @@ import os
 import sys
 import tarfile
 import tempfile
+import threading
+import time
 import unittest
 import zlib
 
@@ -24,6 +27,7 @@ import six
 # Mutates sys.path.
 import test_env
 
+import isolate_storage_fake
 import isolateserver_fake
 import net_utils
 
@@ -369,7 +373,10 @@ class StorageTest(TestCase):
     six.assertCountEqual(self, missing, result)
     self.assertEqual(4, len(items))
     self.assertEqual(2, len(missing))
-    self.assertEqual([items], storage_api.contains_calls)
+    # The items may be looked up in more than one batch if their enumeration
+    # stalls.
+    six.assertCountEqual(
+        self, items, [i for call in storage_api.contains_calls for i in call])
     six.assertCountEqual(self, ((items[2], 123, items[2].content()[0]),
                                 (items[3], 456, items[3].content()[0])),
                          storage_api.push_calls)
@@ -381,6 +388,103 @@ class StorageTest(TestCase):
     result = storage.upload_items(())
     self.assertEqual([], result)
 
+  def test_upload_items_stalled(self):
+    server_ref = isolate_storage.ServerRef('http://localhost:1', 'default')
+    items = [
+        isolateserver.BufferItem(b'%d' % i, server_ref.hash_algo)
+        for i in range(3)
+    ]
+    storage_api = MockedStorageApi(server_ref, {})
+    storage = isolateserver.Storage(storage_api)
+
+    def gen():
+      yield items[0]
+      # The first item is looked up without waiting for the next ones.
+      while not storage_api.contains_calls:
+        time.sleep(0.01)
+      for i in items[1:]:
+        yield i
+
+    self.assertEqual([], storage.upload_items(gen()))
+    self.assertEqual([items[0]], storage_api.contains_calls[0])
+    six.assertCountEqual(
+        self, items[1:],
+        [i for call in storage_api.contains_calls[1:] for i in call])
+
+  def test_upload_items_largest_first(self):
+    self.mock(isolateserver, 'PUSH_MAX_IN_FLIGHT', 1)
+    server_ref = isolate_storage.ServerRef('http://localhost:1', 'default')
+    items = [
+        isolateserver.BufferItem(b'a' * size, server_ref.hash_algo)
+        for size in (1, 30, 5, 100, 20)
+    ]
+    first_push = threading.Event()
+
+    def push_side_effect():
+      # Give time to the other missing items to be queued.
+      if not first_push.is_set():
+        first_push.set()
+        time.sleep(0.1)
+
+    storage_api = MockedStorageApi(
+        server_ref, {i.digest: None for i in items}, push_side_effect)
+    storage = isolateserver.Storage(storage_api)
+    storage.upload_items(items)
+    sizes = [item.size for item, _, _ in storage_api.push_calls]
+    six.assertCountEqual(self, [1, 30, 5, 100, 20], sizes)
+    self.assertEqual(sorted(sizes[1:], reverse=True), sizes[1:])
+
+  def test_lookup_batcher(self):
+    batcher = isolateserver._LookupBatcher(10, 80, 1000)
+    self.assertEqual(10, batcher.items)
+    self.assertFalse(batcher.is_full(9, 999))
+    self.assertTrue(batcher.is_full(10, 0))
+    self.assertTrue(batcher.is_full(1, 1000))
+    # Lookups of full batches as fast as the fastest one grow the batches.
+    batcher.lookup_done(10, 1.)
+    self.assertEqual(20, batcher.items)
+    batcher.lookup_done(20, 1.5)
+    self.assertEqual(40, batcher.items)
+    # Partial batches are ignored.
+    batcher.lookup_done(5, 1.)
+    self.assertEqual(40, batcher.items)
+    batcher.lookup_done(40, 1.)
+    batcher.lookup_done(80, 1.)
+    self.assertEqual(80, batcher.items)
+    # Slow lookups shrink the batches.
+    batcher.lookup_done(80, 3.)
+    self.assertEqual(80, batcher.items)
+    batcher.lookup_done(80, 5.)
+    self.assertEqual(40, batcher.items)
+    for _ in range(5):
+      batcher.lookup_done(40, 5.)
+    self.assertEqual(10, batcher.items)
+
+  def test_upload_and_fetch_codecs(self):
+    namespaces = ['default', 'default-gzip']
+    if isolate_storage.zstandard:
+      namespaces.append('default-zstd')
+    for namespace in namespaces:
+      server_ref = isolate_storage.ServerRef('http://localhost:1', namespace)
+      storage_api = isolate_storage_fake.FakeStorageApi(server_ref)
+      items = [
+          isolateserver.BufferItem(b'a' * 1000, server_ref.hash_algo),
+          isolateserver.BufferItem(b'b', server_ref.hash_algo),
+      ]
+      with isolateserver.Storage(storage_api) as storage:
+        self.assertEqual(
+            set(items), set(storage.upload_items(items)), namespace)
+        for item in items:
+          if namespace == 'default':
+            self.assertEqual(
+                item.content()[0], storage_api.contents[item.digest])
+          else:
+            self.assertNotEqual(
+                item.content()[0], storage_api.contents[item.digest])
+          fetched = []
+          storage._fetch(item.digest, item.size, fetched.extend)
+          self.assertEqual(item.content()[0], b''.join(fetched), namespace)
+
   def test_async_push(self):
     for use_zip in (False, True):
       item = FakeItem(b'1234567')
@@ -511,6 +615,37 @@ class StorageTest(TestCase):
       self.assertEqual(os.path.join(self.tempdir, filename), pushed_item.path)
       self.assertEqual(files_content[filename], pushed_content)
 
+  def test_directory_to_metadata(self):
+    files = {u'%d' % i: b'content %d' % i for i in range(20)}
+    self.make_tree(files)
+    hash_threads = set()
+    hash_file = isolated_format.hash_file
+    def _hash_file(filepath, algo):
+      hash_threads.add(threading.current_thread())
+      return hash_file(filepath, algo)
+    self.mock(isolated_format, 'hash_file', _hash_file)
+    actual = {
+        relpath: (item.digest, meta['h'], meta['s'])
+        for item, relpath, meta in isolateserver._directory_to_metadata(
+            self.tempdir, hashlib.sha1, None)
+    }
+    expected = {
+        relpath: (hashlib.sha1(c).hexdigest(), hashlib.sha1(c).hexdigest(),
+                  len(c)) for relpath, c in files.items()
+    }
+    self.assertEqual(expected, actual)
+    # The files are hashed on the hashing threads.
+    self.assertNotIn(threading.current_thread(), hash_threads)
+
+  def test_directory_to_metadata_error(self):
+    self.make_tree({u'a': b'a', u'b': b'b'})
+    def _hash_file(_filepath, _algo):
+      raise IOError('Oops')
+    self.mock(isolated_format, 'hash_file', _hash_file)
+    with self.assertRaises(IOError):
+      list(isolateserver._directory_to_metadata(
+          self.tempdir, hashlib.sha1, None))
+
   @unittest.skipIf(sys.platform == 'win32', 'crbug.com/1148174')
   def test_archive_files_to_storage_symlink(self):
     link_path = os.path.join(self.tempdir, u'link')
@@ -594,7 +729,7 @@ class IsolateServerStorageApiTest(TestCase):
     response = data
     return (
         '%s/some/gs/url/%s/%s' % (server_ref.url, server_ref.namespace, item),
-        {},
+        {'headers': request_headers},
         response,
         response_headers,
     )
@@ -1004,6 +1139,191 @@ class IsolateServerStorageSmokeTest(unittest.TestCase):
     self._archive_smoke(512*1024*1024)
 
 
+class FetchResumeSmokeTest(unittest.TestCase):
+  """Tests resuming fetches from a fake server dropping connections."""
+  # These tests fail when running with other tests
+  # Need to run in test_seq.py
+  no_run = 1
+
+  def setUp(self):
+    super(FetchResumeSmokeTest, self).setUp()
+    self.server = isolateserver_fake.FakeIsolateServer()
+    # Large enough to be fetched from the fake GCS.
+    self.content = b''.join(
+        hashlib.sha256(str(i).encode()).digest() for i in range(10000))
+
+  def tearDown(self):
+    try:
+      self.server.close()
+    finally:
+      super(FetchResumeSmokeTest, self).tearDown()
+
+  def fetch(self, namespace, digest):
+    storage = isolateserver.get_storage(
+        isolate_storage.ServerRef(self.server.url, namespace))
+    cache = local_caching.MemoryContentAddressedCache()
+    queue = isolateserver.FetchQueue(storage, cache)
+    queue.add(digest, len(self.content))
+    queue.wait_on(digest)
+    self.assertEqual(digest, queue.wait())
+    with cache.getfileobj(digest) as f:
+      return f.read()
+
+  def test_resume(self):
+    digest = self.server.add_content('default', self.content)
+    self.server.inject_fetch_failures(digest, [100000, 50000])
+    self.assertEqual(self.content, self.fetch('default', digest))
+    self.assertEqual(
+        [(digest, 0), (digest, 100000), (digest, 150000)],
+        self.server.fetches)
+
+  def test_resume_gzip(self):
+    digest = self.server.add_content_compressed('default-gzip', self.content)
+    self.server.inject_fetch_failures(digest, [1000])
+    self.assertEqual(self.content, self.fetch('default-gzip', digest))
+    self.assertEqual([(digest, 0), (digest, 1000)], self.server.fetches)
+
+  def test_resume_stalled(self):
+    digest = self.server.add_content('default', self.content)
+    self.server.inject_fetch_failures(digest, [1000, 0, 0])
+    with mock.patch.object(isolateserver, 'FETCH_RESUME_ATTEMPTS', 2):
+      self.assertEqual(self.content, self.fetch('default', digest))
+    # After 2 resumes without progress, the fetch is restarted.
+    self.assertEqual(
+        [(digest, 0), (digest, 1000), (digest, 1000), (digest, 0)],
+        self.server.fetches)
+
+
+class ChunkedTest(TestCase):
+  """Tests for archiving and fetching files as content defined chunks."""
+
+  def setUp(self):
+    super(ChunkedTest, self).setUp()
+    # Small sizes to keep the test fast.
+    self.mock(isolated_format, 'CHUNKED_FILE_MIN_SIZE', 16 * 1024)
+    self.mock(
+        isolated_format, 'chunk_file',
+        functools.partial(
+            isolated_format.chunk_file,
+            min_size=256,
+            avg_size=1024,
+            max_size=4096))
+    server_ref = isolate_storage.ServerRef('http://localhost:1', 'default')
+    self.storage_api = isolate_storage_fake.FakeStorageApi(server_ref)
+    self.src = os.path.join(self.tempdir, u'src')
+    fs.mkdir(self.src)
+    # Deterministic pseudo random content.
+    self.big = b''.join(
+        hashlib.sha256(str(i).encode()).digest() for i in range(2048))
+    self.write(u'big', self.big)
+    self.write(u'small', b'small')
+
+  def write(self, name, content):
+    with fs.open(os.path.join(self.src, name), 'wb') as f:
+      f.write(content)
+
+  def archive(self):
+    """Archives self.src and returns the .isolated file hash and content."""
+    with isolateserver.Storage(self.storage_api) as storage:
+      results, _cold, _hot = isolateserver.archive_files_to_storage(
+          storage, [self.src], None, chunked=True)
+    isolated_hash = results[self.src]
+    return isolated_hash, json.loads(self.storage_api.contents[isolated_hash])
+
+  def test_archive(self):
+    _, isolated = self.archive()
+    big = isolated['files']['big']
+    self.assertEqual(hashlib.sha1(self.big).hexdigest(), big['h'])
+    self.assertEqual(len(self.big), big['s'])
+    self.assertGreater(len(big['c']), 8)
+    self.assertNotIn('c', isolated['files']['small'])
+    # Only the chunks are stored.
+    self.assertNotIn(big['h'], self.storage_api.contents)
+    for digest, size in big['c']:
+      self.assertEqual(size, len(self.storage_api.contents[digest]))
+
+  def test_archive_modified(self):
+    self.archive()
+    pushed = self.storage_api.bytes_pushed
+    self.write(u'big', self.big[:1000] + b'inserted' + self.big[1000:])
+    self.archive()
+    # The .isolated file and the chunks around the insertion.
+    self.assertLess(
+        self.storage_api.bytes_pushed - pushed, len(self.big) // 4)
+
+  def test_fetch(self):
+    isolated_hash, isolated = self.archive()
+    cache = local_caching.MemoryContentAddressedCache()
+    outdir = os.path.join(self.tempdir, u'out')
+    with isolateserver.Storage(self.storage_api) as storage:
+      isolateserver.fetch_isolated(isolated_hash, storage, cache, outdir, False)
+    with fs.open(os.path.join(outdir, u'big'), 'rb') as f:
+      self.assertEqual(self.big, f.read())
+    with fs.open(os.path.join(outdir, u'small'), 'rb') as f:
+      self.assertEqual(b'small', f.read())
+    # The cache holds the chunks, not the reassembled file.
+    self.assertNotIn(isolated['files']['big']['h'], cache)
+    for digest, _ in isolated['files']['big']['c']:
+      self.assertIn(digest, cache)
+
+
+class FetchIsolatedTest(TestCase):
+  """Tests fetch_isolated() with an in-memory storage."""
+
+  def setUp(self):
+    super(FetchIsolatedTest, self).setUp()
+    server_ref = isolate_storage.ServerRef('http://localhost:1', 'default')
+    self.storage_api = isolate_storage_fake.FakeStorageApi(server_ref)
+    self.cache = local_caching.MemoryContentAddressedCache()
+    self.files = {
+        os.path.join(u'a', u'b', u'%d' % i): b'content %d' % i
+        for i in range(250)
+    }
+    self.files[u'c'] = b'content 0'
+    self.make_tree(self.files)
+    with isolateserver.Storage(self.storage_api) as storage:
+      results, _cold, _hot = isolateserver.archive_files_to_storage(
+          storage, [self.tempdir], None)
+    self.isolated_hash = results[self.tempdir]
+
+  def fetch(self, outdir):
+    with isolateserver.Storage(self.storage_api) as storage:
+      isolateserver.fetch_isolated(
+          self.isolated_hash, storage, self.cache, outdir, False)
+    for path, content in self.files.items():
+      with fs.open(os.path.join(outdir, path), 'rb') as f:
+        self.assertEqual(content, f.read())
+
+  def test_cold(self):
+    self.fetch(os.path.join(self.tempdir, u'out'))
+    # The .isolated file and the 250 different files.
+    self.assertEqual(251, self.storage_api.items_fetched)
+
+  def test_warm(self):
+    self.fetch(os.path.join(self.tempdir, u'out1'))
+    fetched = self.storage_api.items_fetched
+    calls = []
+    map_files = isolateserver._map_files
+    def _map_files(outdir, files, cache, use_symlinks):
+      calls.append(files)
+      map_files(outdir, files, cache, use_symlinks)
+    self.mock(isolateserver, '_map_files', _map_files)
+    self.fetch(os.path.join(self.tempdir, u'out2'))
+    self.assertEqual(fetched, self.storage_api.items_fetched)
+    # All the files are mapped in batches.
+    self.assertEqual(
+        [isolateserver.MAP_CACHED_FILES_BATCH_SIZE] * 2 + [51],
+        sorted((len(c) for c in calls), reverse=True))
+
+  def test_create_directories(self):
+    isolateserver.create_directories(self.tempdir, self.files)
+    with fs.open(os.path.join(self.tempdir, u'd'), 'wb') as f:
+      f.write(b'not a directory')
+    with self.assertRaises(OSError):
+      isolateserver.create_directories(
+          self.tempdir, [os.path.join(u'd', u'e')])
+
+
 class IsolateServerDownloadTest(TestCase):
   def _url_read_json(self, url, **kwargs):
     """Current _url_read_json mock doesn't respect identical URLs."""
@@ -0,0 +1,186 @@
+#!/usr/bin/env vpython3
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Benchmarks operations on large local caches.
+
+- Trimming a cache down to its max_cache_size. The LRU state is populated in
+  memory without creating the actual files, so that only the eviction
+  accounting is measured.
+- Startup and cleanup() of a DiskContentAddressedCache with the flat and the
+  sharded layouts.
+- NamedCache.uninstall() of a large named cache, and the computation of its
+  size with and without the size hints of the previous computation.
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import time
+
+# Mutates sys.path.
+import test_env
+
+import local_caching
+from utils import file_path
+
+import six
+
+
+def run_disk_cache(nb_items, tempdir):
+  size = 1024
+  policies = local_caching.CachePolicies(
+      max_cache_size=nb_items * size // 2,
+      min_free_space=0,
+      max_items=0,
+      max_age_secs=0)
+  cache = local_caching.DiskContentAddressedCache(tempdir, policies, trim=False)
+  with cache._lock:
+    for i in range(nb_items):
+      cache._lru.add(u'%040x' % i, size)
+    # Do not measure the state serialization.
+    cache._save = lambda: None
+    start = time.time()
+    evicted = cache._trim()
+    duration = time.time() - start
+  print('DiskContentAddressedCache: trimmed %d of %d items in %.1fms' % (
+      len(evicted), nb_items, duration * 1000.))
+
+
+def run_memory_cache(nb_items):
+  data = b'0' * 1024
+  cache = local_caching.MemoryContentAddressedCache()
+  for i in range(nb_items):
+    cache._lru.add(u'%040x' % i, data)
+  max_cache_size = nb_items * len(data) // 2
+  start = time.time()
+  nb_evicted = 0
+  # Same loop as local_caching.trim_caches() does across caches.
+  while cache.total_size > max_cache_size:
+    cache.get_oldest()
+    cache.remove_oldest()
+    nb_evicted += 1
+  duration = time.time() - start
+  print('MemoryContentAddressedCache: trimmed %d of %d items in %.1fms' % (
+      nb_evicted, nb_items, duration * 1000.))
+
+
+def _get_layout_policies(sharded):
+  return local_caching.CachePolicies(
+      max_cache_size=0,
+      min_free_space=0,
+      max_items=0,
+      max_age_secs=0,
+      sharded=sharded)
+
+
+def run_layout(nb_files, sharded, tempdir):
+  cache_dir = os.path.join(tempdir, 'sharded' if sharded else 'flat')
+  # Timestamps in the future skip the hash verification in cleanup().
+  cache = local_caching.DiskContentAddressedCache(
+      cache_dir, _get_layout_policies(sharded), trim=False,
+      time_fn=lambda: 2**31)
+  for i in range(nb_files):
+    data = b'%d' % i
+    cache.write(six.text_type(hashlib.sha1(data).hexdigest()), [data])
+  cache.save()
+
+  start = time.time()
+  cache = local_caching.DiskContentAddressedCache(
+      cache_dir, _get_layout_policies(sharded), trim=True)
+  startup = time.time() - start
+  start = time.time()
+  cache.cleanup()
+  cleanup = time.time() - start
+  print('%-7s layout, %d files: startup %7.1fms  cleanup %7.1fms' % (
+      'sharded' if sharded else 'flat', nb_files, startup * 1000.,
+      cleanup * 1000.))
+
+
+def _gen_tree(root, nb_files):
+  """Creates a tree of nb_files empty files, 100 per directory.
+
+  The directories are given an old mtime, as if the tree was not modified
+  recently.
+  """
+  dirs = []
+  for i in range(0, nb_files, 100):
+    d = os.path.join(root, u'%02d' % (i // 100000), u'%04d' % (i // 100 % 1000))
+    os.makedirs(d)
+    dirs.append(d)
+    for j in range(min(100, nb_files - i)):
+      open(os.path.join(d, u'%02d' % j), 'wb').close()
+  old = time.time() - 3600
+  for d in dirs + [os.path.dirname(d) for d in dirs] + [root]:
+    os.utime(d, (old, old))
+  return dirs
+
+
+def run_named_cache(nb_files, tempdir):
+  cache_dir = os.path.join(tempdir, u'named')
+  dest = os.path.join(tempdir, u'dest')
+  policies = _get_layout_policies(False)
+  cache = local_caching.NamedCache(cache_dir, policies)
+  cache.install(dest, u'cache')
+  dirs = _gen_tree(dest, nb_files)
+
+  start = time.time()
+  file_path.get_recursive_size(dest)
+  full = time.time() - start
+
+  start = time.time()
+  cache.uninstall(dest, u'cache')
+  uninstall = time.time() - start
+  start = time.time()
+  cache.update_sizes()
+  first = time.time() - start
+
+  # Simulate a task touching a few directories.
+  cache.install(dest, u'cache')
+  for d in dirs[::max(1, len(dirs) // 10)]:
+    with open(os.path.join(d, u'new'), 'wb') as f:
+      f.write(b'a')
+  cache.uninstall(dest, u'cache')
+  start = time.time()
+  cache.update_sizes()
+  hinted = time.time() - start
+  print('NamedCache, %d files:' % nb_files)
+  print('  get_recursive_size():          %9.1fms' % (full * 1000.))
+  print('  uninstall():                   %9.1fms' % (uninstall * 1000.))
+  print('  size without hints:            %9.1fms' % (first * 1000.))
+  print('  size with hints, 10 dirs new:  %9.1fms' % (hinted * 1000.))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+  parser.add_argument(
+      '--items', type=int, default=500000,
+      help='Number of entries in the cache before trimming')
+  parser.add_argument(
+      '--files', type=int, default=100000,
+      help='Number of files in the cache to compare the directory layouts')
+  parser.add_argument(
+      '--named-files', type=int, default=1000000,
+      help='Number of files in the named cache')
+  parser.add_argument('-v', '--verbose', action='store_true')
+  args = parser.parse_args()
+  logging.basicConfig(
+      level=logging.DEBUG if args.verbose else logging.ERROR)
+  tempdir = tempfile.mkdtemp(prefix=u'local_caching_benchmark')
+  try:
+    run_disk_cache(args.items, tempdir)
+    run_memory_cache(args.items)
+    for sharded in (False, True):
+      run_layout(args.files, sharded, tempdir)
+    run_named_cache(args.named_files, tempdir)
+  finally:
+    file_path.rmtree(tempdir)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -109,19 +109,22 @@ class TestCase(auto_stub.TestCase):
         f.write(data)
       cache.uninstall(dest_dir, name)
       self.assertFalse(fs.exists(dest_dir))
+      cache.update_sizes()
       return name
     self.fail('Unexpected cache type %r' % cache)
     return None
 
 
 def _get_policies(
-    max_cache_size=0, min_free_space=0, max_items=0, max_age_secs=0):
+    max_cache_size=0, min_free_space=0, max_items=0, max_age_secs=0,
+    sharded=False):
   """Returns a CachePolicies with only the policy we want to enforce."""
   return local_caching.CachePolicies(
       max_cache_size=max_cache_size,
       min_free_space=min_free_space,
       max_items=max_items,
-      max_age_secs=max_age_secs)
+      max_age_secs=max_age_secs,
+      sharded=sharded)
 
 
 class CacheTestMixin(object):
@@ -397,6 +400,142 @@ class DiskContentAddressedCacheTest(TestCase, ContentAddressedCacheTestMixin):
                          (fs.listdir(cache.cache_dir)))
     six.assertCountEqual(self, [(h_b, (1, mtime_b))], cache._lru._items.items())
 
+  def test_cleanup_disk_verify_threads(self):
+    self._free_disk = 1100
+    cache = local_caching.DiskContentAddressedCache(
+        self.cache_dir(), _get_policies(min_free_space=1000), trim=True,
+        verify_threads=4)
+    valid = []
+    for i in range(20):
+      data = b'%d' % i
+      h = self._algo(data).hexdigest()
+      if i % 2:
+        cache.write(h, [data])
+        valid.append(h)
+      else:
+        # Corrupted.
+        cache.write(h, [b'x'])
+    # All the files are more recent than the mocked time.
+    cache.cleanup()
+    six.assertCountEqual(self, valid, list(cache._lru))
+    six.assertCountEqual(
+        self, valid + [cache.STATE_FILE], fs.listdir(cache.cache_dir))
+
+  def test_cleanup_disk_verify_budget(self):
+    self._free_disk = 1003
+    cache = self.get_cache(_get_policies(min_free_space=1000))
+    h_a = self._algo(b'a').hexdigest()
+    cache.write(h_a, [b'A'])
+    h_b = self._algo(b'b').hexdigest()
+    cache.write(h_b, [b'b'])
+    h_c = self._algo(b'c').hexdigest()
+    cache.write(h_c, [b'c'])
+
+    # Only one item can be verified by cleanup(), the corrupted one.
+    self.mock(cache, 'VERIFY_BYTES_BUDGET', 1)
+    cache.cleanup()
+    self.assertEqual([h_b, h_c], list(cache._lru))
+
+    h_d = self._algo(b'd').hexdigest()
+    cache.write(h_d, [b'D'])
+    self.mock(cache, 'VERIFY_BYTES_BUDGET', 0)
+    cache.cleanup()
+    self.assertEqual([h_b, h_c, h_d], list(cache._lru))
+
+    # The remaining items are verified when used.
+    with cache.getfileobj(h_b) as f:
+      self.assertEqual(b'b', f.read())
+    with self.assertRaises(local_caching.CacheMiss):
+      cache.getfileobj(h_d)
+    self.assertEqual([h_c, h_b], list(cache._lru))
+    six.assertCountEqual(
+        self, [h_b, h_c, cache.STATE_FILE], fs.listdir(cache.cache_dir))
+
+  def test_touch_verify_budget(self):
+    self._free_disk = 1003
+    cache = self.get_cache(_get_policies(min_free_space=1000))
+    h_a = self._algo(b'a').hexdigest()
+    cache.write(h_a, [b'A'])
+    h_b = self._algo(b'b').hexdigest()
+    cache.write(h_b, [b'b'])
+    self.mock(
+        local_caching.DiskContentAddressedCache, 'VERIFY_BYTES_BUDGET', 0)
+    cache.cleanup()
+
+    # touch() verifies the items cleanup() skipped before bumping their
+    # timestamp, so getfileobj() doesn't return the corrupted one.
+    cache = self.get_cache(_get_policies(min_free_space=1000))
+    self.assertEqual(False, cache.touch(h_a, 1))
+    with self.assertRaises(local_caching.CacheMiss):
+      cache.getfileobj(h_a)
+    self.assertEqual(True, cache.touch(h_b, 1))
+    with cache.getfileobj(h_b) as f:
+      self.assertEqual(b'b', f.read())
+    self.assertEqual([h_b], list(cache._lru))
+    six.assertCountEqual(
+        self, [h_b, cache.STATE_FILE], fs.listdir(cache.cache_dir))
+
+  def test_sharded(self):
+    cache = self.get_cache(_get_policies(sharded=True))
+    h_foo = self._algo(b'foo').hexdigest()
+    cache.write(h_foo, [b'foo'])
+    self.assertEqual(
+        sorted([h_foo[:2], cache.STATE_FILE]),
+        sorted(fs.listdir(cache.cache_dir)))
+    self.assertEqual(
+        [h_foo[2:]], fs.listdir(os.path.join(cache.cache_dir, h_foo[:2])))
+    with cache.getfileobj(h_foo) as f:
+      self.assertEqual(b'foo', f.read())
+    self.assertTrue(cache.touch(h_foo, 3))
+
+    # An unknown file in a shard is deleted, a missing one is evicted.
+    h_a = self._algo(b'a').hexdigest()
+    h_b = self._algo(b'b').hexdigest()
+    cache.write(h_b, [b'b'])
+    local_caching.file_write(
+        os.path.join(cache.cache_dir, h_a[:2], h_a[2:]), [b'a'])
+    file_path.remove(os.path.join(cache.cache_dir, h_b[:2], h_b[2:]))
+    cache.cleanup()
+    self.assertEqual([h_foo], list(cache._lru))
+    self.assertEqual(
+        [h_foo[2:]], fs.listdir(os.path.join(cache.cache_dir, h_foo[:2])))
+    self.assertEqual([], fs.listdir(os.path.join(cache.cache_dir, h_a[:2])))
+
+  def test_sharded_migration(self):
+    cache = self.get_cache(_get_policies())
+    h_a = self._algo(b'a').hexdigest()
+    h_b = self._algo(b'b').hexdigest()
+    h_c = self._algo(b'c').hexdigest()
+    cache.write(h_a, [b'a'])
+    cache.write(h_b, [b'b'])
+    cache.write(h_c, [b'c'])
+    cache.save()
+
+    # Switch to the sharded layout. The items are migrated when accessed.
+    cache = self.get_cache(_get_policies(sharded=True))
+    with cache.getfileobj(h_a) as f:
+      self.assertEqual(b'a', f.read())
+    self.assertTrue(cache.touch(h_b, 1))
+    self.assertEqual(
+        sorted([h_a[:2], h_b[:2], h_c, cache.STATE_FILE]),
+        sorted(fs.listdir(cache.cache_dir)))
+    # And the rest on cleanup.
+    cache.cleanup()
+    self.assertEqual(
+        sorted([h_a[:2], h_b[:2], h_c[:2], cache.STATE_FILE]),
+        sorted(fs.listdir(cache.cache_dir)))
+    self.assertEqual(3, len(cache))
+
+    # And back to the flat layout.
+    cache = self.get_cache(_get_policies())
+    cache.cleanup()
+    self.assertEqual(
+        sorted([h_a, h_b, h_c, cache.STATE_FILE]),
+        sorted(fs.listdir(cache.cache_dir)))
+    self.assertEqual(3, len(cache))
+    with cache.getfileobj(h_c) as f:
+      self.assertEqual(b'c', f.read())
+
   def test_policies_active_trimming(self):
     # Start with a larger cache, add many object.
     # Reload the cache with smaller policies, the cache should be trimmed on
@@ -549,11 +688,15 @@ class NamedCacheTest(TestCase, CacheTestMixin):
     write_file(os.path.join(a_path, u'x'), b'x')
     write_file(os.path.join(b_path, u'y'), b'y')
 
-    self.assertEqual(1, cache.uninstall(a_path, u'1'))
-    self.assertEqual(1, cache.uninstall(b_path, u'2'))
-    self.assertEqual(0, cache.uninstall(c_path, u'3'))
+    cache.uninstall(a_path, u'1')
+    cache.uninstall(b_path, u'2')
+    cache.uninstall(c_path, u'3')
+    cache.update_sizes()
+    self.assertEqual(1, cache._lru['1'][1])
+    self.assertEqual(1, cache._lru['2'][1])
+    self.assertEqual(0, cache._lru['3'][1])
 
-    self.assertEqual(5, len(fs.listdir(cache.cache_dir)))
+    self.assertEqual(6, len(fs.listdir(cache.cache_dir)))
     path1 = os.path.join(cache.cache_dir, cache._lru['1'][0])
     self.assertEqual(b'x', read_file(os.path.join(path1, u'x')))
     path2 = os.path.join(cache.cache_dir, cache._lru['2'][0])
@@ -579,7 +722,8 @@ class NamedCacheTest(TestCase, CacheTestMixin):
 
     self.assertEqual(0, cache.install(a_path, u'1'))
     write_file(os.path.join(dest_dir, u'a', u'x'), b'x')
-    self.assertEqual(1, cache.uninstall(a_path, u'1'))
+    cache.uninstall(a_path, u'1')
+    cache.update_sizes()
 
     # Test starts here.
     self.assertEqual(1, cache.install(a_path, u'1'))
@@ -587,7 +731,7 @@ class NamedCacheTest(TestCase, CacheTestMixin):
     self.assertEqual({'a', 'b'}, set(fs.listdir(dest_dir)))
     self.assertFalse(cache.available)
     self.assertEqual(
-        sorted([cache.NAMED_DIR, cache.STATE_FILE]),
+        sorted([cache.NAMED_DIR, cache.SIZES_FILE, cache.STATE_FILE]),
         sorted(fs.listdir(cache.cache_dir)))
     self.assertEqual(
         [], fs.listdir(os.path.join(cache.cache_dir, cache.NAMED_DIR)))
@@ -596,10 +740,13 @@ class NamedCacheTest(TestCase, CacheTestMixin):
     write_file(os.path.join(a_path, 'x'), b'x2')
     write_file(os.path.join(b_path, 'y'), b'y')
 
-    self.assertEqual(2, cache.uninstall(a_path, '1'))
-    self.assertEqual(1, cache.uninstall(b_path, '2'))
+    cache.uninstall(a_path, '1')
+    cache.uninstall(b_path, '2')
+    cache.update_sizes()
+    self.assertEqual(2, cache._lru['1'][1])
+    self.assertEqual(1, cache._lru['2'][1])
 
-    self.assertEqual(4, len(fs.listdir(cache.cache_dir)))
+    self.assertEqual(5, len(fs.listdir(cache.cache_dir)))
     path1 = os.path.join(cache.cache_dir, cache._lru['1'][0])
     self.assertEqual(b'x2', read_file(os.path.join(path1, 'x')))
     path2 = os.path.join(cache.cache_dir, cache._lru['2'][0])
@@ -658,12 +805,15 @@ class NamedCacheTest(TestCase, CacheTestMixin):
     self.assertEqual(0, cache.install(dest_dir, u'1'))
     with fs.open(os.path.join(dest_dir, u'hi'), 'wb') as f:
       f.write(b'hello')
-    self.assertEqual(5, cache.uninstall(dest_dir, u'1'))
+    cache.uninstall(dest_dir, u'1')
     self.assertEqual(
         [u'1'], fs.listdir(os.path.join(cache.cache_dir, cache.NAMED_DIR)))
+    cache.update_sizes()
     self.assertEqual(True, cache.cleanup())
     self.assertEqual(5, cache.install(dest_dir, u'1'))
-    self.assertEqual(5, cache.uninstall(dest_dir, u'1'))
+    cache.uninstall(dest_dir, u'1')
+    cache.update_sizes()
+    self.assertEqual(5, cache.total_size)
     self.assertEqual(
         [u'1'], fs.listdir(os.path.join(cache.cache_dir, cache.NAMED_DIR)))
     self.assertEqual(
@@ -684,12 +834,16 @@ class NamedCacheTest(TestCase, CacheTestMixin):
     # This depends on the inner format as generated by NamedCache.
     entry_dir_name = v[0]
     self.assertEqual(
-        sorted([entry_dir_name, cache.NAMED_DIR, cache.STATE_FILE]),
+        sorted([
+          entry_dir_name, cache.NAMED_DIR, cache.SIZES_FILE, cache.STATE_FILE,
+        ]),
         sorted(fs.listdir(cache.cache_dir)))
 
     cache.save()
     self.assertEqual(
-        sorted([entry_dir_name, cache.NAMED_DIR, cache.STATE_FILE]),
+        sorted([
+          entry_dir_name, cache.NAMED_DIR, cache.SIZES_FILE, cache.STATE_FILE,
+        ]),
         sorted(fs.listdir(cache.cache_dir)))
     with fs.open(os.path.join(cache.cache_dir, cache.STATE_FILE)) as f:
       new_content = json.load(f)
@@ -741,9 +895,114 @@ class NamedCacheTest(TestCase, CacheTestMixin):
         fs.islink(os.path.join(cache.cache_dir, cache.NAMED_DIR, '1')))
     self.assertEqual(True, cache.cleanup())
     self.assertEqual(
-        sorted([cache.NAMED_DIR, cache.STATE_FILE, cache._lru[u'1'][0]]),
+        sorted([
+          cache.NAMED_DIR, cache.SIZES_FILE, cache.STATE_FILE,
+          cache._lru[u'1'][0],
+        ]),
         sorted(fs.listdir(cache.cache_dir)))
 
+  def test_uninstall_pending_size(self):
+    # The size is not computed on uninstall. Evicting doesn't wait for it.
+    def get_size(path, hints):
+      self.fail('Unexpected sizing of %s %s' % (path, hints))
+    self.mock(file_path, 'get_recursive_size_with_hints', get_size)
+
+    cache = self.get_cache(_get_policies())
+    dest_dir = os.path.join(self.tempdir, 'dest')
+    self.assertEqual(0, cache.install(dest_dir, u'1'))
+    write_file(os.path.join(dest_dir, u'x'), b'xx')
+    cache.uninstall(dest_dir, u'1')
+    self.assertEqual(0, cache.total_size)
+    with fs.open(cache.sizes_file, 'rb') as f:
+      self.assertEqual({u'1': cache._lru[u'1'][0]}, json.load(f)['pending'])
+
+    self._free_disk = 1
+    self.assertEqual(
+        [0],
+        local_caching.trim_caches(
+            [cache], self.tempdir, min_free_space=2, max_age_secs=0))
+    self.assertEqual(3, self._free_disk)
+    self.assertEqual(0, len(cache))
+    self.assertEqual(
+        0, local_caching.compute_named_cache_sizes(cache.cache_dir))
+
+  def test_trim_pending_size(self):
+    # trim() enforces max_cache_size with the size the cache had when installed,
+    # without waiting for the actual size.
+    cache = self.get_cache(_get_policies(max_cache_size=4))
+    dest_dir = os.path.join(self.tempdir, 'dest')
+    cache.install(dest_dir, u'1')
+    write_file(os.path.join(dest_dir, u'x'), b'xxxxx')
+    cache.uninstall(dest_dir, u'1')
+    cache.update_sizes()
+    self.assertEqual(5, cache.total_size)
+
+    def get_size(path, hints):
+      self.fail('Unexpected sizing of %s %s' % (path, hints))
+    self.mock(file_path, 'get_recursive_size_with_hints', get_size)
+    self.assertEqual(5, cache.install(dest_dir, u'1'))
+    fs.remove(os.path.join(dest_dir, u'x'))
+    cache.uninstall(dest_dir, u'1')
+    self.assertEqual([5], cache.trim())
+    self.assertEqual(0, len(cache))
+
+  def test_compute_named_cache_sizes(self):
+    # The sizes are computed by another process while the cache is in use, and
+    # applied by the next trim(), reusing the size hints.
+    cache = self.get_cache(_get_policies(max_cache_size=10))
+    dest_dir = os.path.join(self.tempdir, 'dest')
+    cache.install(dest_dir, u'1')
+    write_file(os.path.join(dest_dir, u'x'), b'xx')
+    fs.mkdir(os.path.join(dest_dir, u'sub'))
+    write_file(os.path.join(dest_dir, u'sub', u'y'), b'yyy')
+    cache.uninstall(dest_dir, u'1')
+    self.assertEqual(0, cache.total_size)
+
+    # Directories modified in the last seconds get no size hint.
+    self._now = fs.stat(cache.state_file).st_mtime + 10
+    calls = []
+    def get_size(path, hints):
+      calls.append(hints)
+      return old_get_size(path, hints)
+    old_get_size = self.mock(
+        file_path, 'get_recursive_size_with_hints', get_size)
+    self.assertEqual(
+        1, local_caching.compute_named_cache_sizes(cache.cache_dir))
+    # Already computed.
+    self.assertEqual(
+        0, local_caching.compute_named_cache_sizes(cache.cache_dir))
+    self.assertEqual(0, cache.total_size)
+    self.assertEqual([], cache.trim())
+    self.assertEqual(5, cache.total_size)
+    self.assertEqual([{}], calls)
+    self.assertFalse(
+        fs.exists(os.path.join(cache.cache_dir, cache.COMPUTED_DIR)))
+
+    self.assertEqual(5, cache.install(dest_dir, u'1'))
+    cache.uninstall(dest_dir, u'1')
+    cache.update_sizes()
+    self.assertEqual(5, cache.total_size)
+    self.assertEqual(2, len(calls))
+    self.assertEqual({u'', u'sub'}, set(calls[1]))
+
+    cache = self.get_cache(_get_policies(max_cache_size=4))
+    self.assertEqual([5], cache.trim())
+
+  def test_compute_named_cache_sizes_installed(self):
+    # A size computed for a cache installed in the meantime is discarded.
+    cache = self.get_cache(_get_policies())
+    dest_dir = os.path.join(self.tempdir, 'dest')
+    cache.install(dest_dir, u'1')
+    write_file(os.path.join(dest_dir, u'x'), b'xx')
+    cache.uninstall(dest_dir, u'1')
+    self.assertEqual(
+        1, local_caching.compute_named_cache_sizes(cache.cache_dir))
+    self.assertEqual(0, cache.install(dest_dir, u'1'))
+    self.assertEqual([], cache.trim())
+    self.assertEqual(0, len(cache))
+    self.assertFalse(
+        fs.exists(os.path.join(cache.cache_dir, cache.COMPUTED_DIR)))
+
   @unittest.skipIf(sys.platform == 'win32', 'crbug.com/1148174')
   def test_cleanup_missing(self):
     # cleanup() detects a missing item.
@@ -903,6 +1162,7 @@ class FnTest(TestCase):
   def _verify_named_cache(self, cache, short_names, items):
     # Named cache verification. Ensures the cache contain the expected data.
     actual = read_tree(cache.cache_dir)
+    actual.pop(cache.SIZES_FILE, None)
     # There's assumption about json encoding format but here it's good enough.
     expected = {
         os.path.join(short_names[n], u'hello'): _gen_data(n) for n in items
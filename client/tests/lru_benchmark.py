@@ -0,0 +1,83 @@
+#!/usr/bin/env vpython3
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Benchmarks saving and loading the LRUDict state of a large cache.
+
+Compares a full rewrite of the state file with appending to the journal after
+a few modifications, as done by DiskContentAddressedCache after each task.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Mutates sys.path.
+import test_env
+
+from utils import lru
+
+
+def _gen_lru(nb_items):
+  lru_dict = lru.LRUDict()
+  for i in range(nb_items):
+    lru_dict.add(u'%040x' % i, 1024 + i)
+  return lru_dict
+
+
+def _timeit(fn):
+  start = time.time()
+  fn()
+  return (time.time() - start) * 1000.
+
+
+def run(nb_items, nb_changes, tempdir):
+  state_file = os.path.join(tempdir, u'state.json')
+  journal_file = os.path.join(tempdir, u'state.journal')
+  lru_dict = _gen_lru(nb_items)
+
+  # Without journal.
+  full_save = _timeit(lambda: lru_dict.save(state_file))
+  full_load = _timeit(lambda: lru.LRUDict.load(state_file))
+
+  # With journal. The first save is a full snapshot.
+  lru_dict = _gen_lru(nb_items)
+  lru_dict.save(state_file, journal_file)
+  for i in range(nb_changes):
+    lru_dict.touch(u'%040x' % (i * 7 % nb_items))
+  journal_save = _timeit(lambda: lru_dict.save(state_file, journal_file))
+  journal_load = _timeit(lambda: lru.LRUDict.load(state_file, journal_file))
+
+  print('%d items, %d changes:' % (nb_items, nb_changes))
+  print('  save: full %9.1fms  journal %9.1fms' % (full_save, journal_save))
+  print('  load: full %9.1fms  journal %9.1fms' % (full_load, journal_load))
+  print('  size: state %8dkb  journal %8dkb' % (
+      os.stat(state_file).st_size / 1024,
+      os.stat(journal_file).st_size / 1024))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+  parser.add_argument(
+      '--items', type=int, action='append',
+      help='Number of entries in the cache; can be specified multiple times. '
+           'Defaults to 10k, 100k and 1M')
+  parser.add_argument(
+      '--changes', type=int, default=100,
+      help='Number of entries touched between two saves')
+  args = parser.parse_args()
+  tempdir = tempfile.mkdtemp(prefix=u'lru_benchmark')
+  try:
+    for nb_items in (args.items or [10000, 100000, 1000000]):
+      run(nb_items, args.changes, tempdir)
+  finally:
+    shutil.rmtree(tempdir)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
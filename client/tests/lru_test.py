@@ -5,6 +5,7 @@
 
 import json
 import os
+import shutil
 import tempfile
 import unittest
 
@@ -125,6 +126,18 @@ class LRUDictTest(unittest.TestCase):
     with self.assertRaises(KeyError):
       lru_dict.touch(4)
 
+  def test_replace(self):
+    lru_dict = lru.LRUDict(size_fn=len)
+    lru_dict.time_fn = lambda: 1
+    lru_dict.add('ka', 'va')
+    lru_dict.add('kb', 'vb')
+    lru_dict.replace('ka', 'va*')
+    self.assert_same_data([('ka', 'va*'), ('kb', 'vb')], lru_dict)
+    self.assertEqual(('ka', ('va*', 1)), lru_dict.get_oldest())
+    self.assertEqual(5, lru_dict.total_size)
+    with self.assertRaises(KeyError):
+      lru_dict.replace('kc', 'vc')
+
   def test_timestamp(self):
     """Tests get_oldest, pop_oldest."""
     lru_dict = lru.LRUDict()
@@ -143,6 +156,53 @@ class LRUDictTest(unittest.TestCase):
     self.assertEqual(lru_dict.get_oldest(), ('kb', ('vb', 1)))
     self.assertEqual(lru_dict.pop_oldest(), ('kb', ('vb', 1)))
 
+  def test_oldest_timestamp(self):
+    lru_dict = lru.LRUDict()
+    self.assertIsNone(lru_dict.oldest_timestamp)
+    now = 0
+    lru_dict.time_fn = lambda: now
+    lru_dict.add('ka', 'va')
+    now += 1
+    lru_dict.add('kb', 'vb')
+    self.assertEqual(0, lru_dict.oldest_timestamp)
+    lru_dict.touch('ka')
+    self.assertEqual(1, lru_dict.oldest_timestamp)
+    lru_dict.pop_oldest()
+    lru_dict.pop_oldest()
+    self.assertIsNone(lru_dict.oldest_timestamp)
+
+  def test_total_size(self):
+    self.assertEqual(0, _prepare_lru_dict([(1, 'one')]).total_size)
+    lru_dict = lru.LRUDict(size_fn=len)
+    lru_dict.add('ka', 'a')
+    lru_dict.add('kb', 'bb')
+    lru_dict.add('kc', 'ccc')
+    self.assertEqual(6, lru_dict.total_size)
+    # Replaced.
+    lru_dict.add('ka', 'aaaa')
+    self.assertEqual(9, lru_dict.total_size)
+    lru_dict.touch('kb')
+    self.assertEqual(9, lru_dict.total_size)
+    lru_dict.pop('kb')
+    self.assertEqual(7, lru_dict.total_size)
+    lru_dict.pop_oldest()
+    self.assertEqual(4, lru_dict.total_size)
+    lru_dict.transform(lambda k, v: v + '*')
+    self.assertEqual(5, lru_dict.total_size)
+
+  def test_total_size_load(self):
+    lru_dict = lru.LRUDict(size_fn=int)
+    lru_dict.add(u'ka', 1)
+    lru_dict.add(u'kb', 2)
+    handle, tmp_name = tempfile.mkstemp(prefix=u'lru_test')
+    os.close(handle)
+    try:
+      lru_dict.save(tmp_name)
+      self.assertEqual(0, lru.LRUDict.load(tmp_name).total_size)
+      self.assertEqual(3, lru.LRUDict.load(tmp_name, size_fn=int).total_size)
+    finally:
+      os.unlink(tmp_name)
+
   def test_transform(self):
     lru_dict = lru.LRUDict()
     lru_dict.add('ka', 'va')
@@ -213,5 +273,141 @@ class LRUDictTest(unittest.TestCase):
       ]))
 
 
+class LRUDictJournalTest(unittest.TestCase):
+  def setUp(self):
+    super(LRUDictJournalTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'lru_test')
+    self.state_file = os.path.join(self.tempdir, u'state.json')
+    self.journal_file = os.path.join(self.tempdir, u'state.journal')
+    self.old_min_items = lru.LRUDict.JOURNAL_MIN_ITEMS
+    lru.LRUDict.JOURNAL_MIN_ITEMS = 2
+
+  def tearDown(self):
+    lru.LRUDict.JOURNAL_MIN_ITEMS = self.old_min_items
+    shutil.rmtree(self.tempdir)
+    super(LRUDictJournalTest, self).tearDown()
+
+  def save(self, lru_dict):
+    return lru_dict.save(self.state_file, self.journal_file)
+
+  def load(self):
+    return lru.LRUDict.load(self.state_file, self.journal_file)
+
+  def read_journal(self):
+    with open(self.journal_file) as f:
+      return [json.loads(l) for l in f.read().splitlines()]
+
+  def test_journal(self):
+    lru_dict = _prepare_lru_dict(
+        [(u'1', 'one'), (u'2', 'two'), (u'3', 'three')])
+    # The first save is a full snapshot.
+    self.assertTrue(self.save(lru_dict))
+    self.assertFalse(os.path.exists(self.journal_file))
+    with open(self.state_file) as f:
+      generation = json.load(f)['generation']
+
+    # Following saves are appended to the journal.
+    lru_dict.touch(u'1')
+    lru_dict.pop(u'2')
+    self.assertTrue(self.save(lru_dict))
+    self.assertFalse(self.save(lru_dict))
+    journal = self.read_journal()
+    self.assertEqual({'generation': generation}, journal[0])
+    self.assertEqual([['t', '1', journal[1][2]], ['d', '2']], journal[1:])
+
+    lru_dict = self.load()
+    self.assertEqual([(u'3', u'three'), (u'1', u'one')], list(lru_dict.items()))
+    lru_dict.add(u'4', 'four')
+    self.assertTrue(self.save(lru_dict))
+    self.assertEqual(4, len(self.read_journal()))
+    self.assertEqual(
+        [(u'3', u'three'), (u'1', u'one'), (u'4', u'four')],
+        list(self.load().items()))
+    # The journal is accounted for in total_size.
+    lru_dict = lru.LRUDict.load(self.state_file, self.journal_file, size_fn=len)
+    self.assertEqual(12, lru_dict.total_size)
+
+  def test_compaction(self):
+    lru_dict = _prepare_lru_dict([(u'1', 'one'), (u'2', 'two')])
+    self.save(lru_dict)
+    lru_dict.touch(u'1')
+    lru_dict.touch(u'2')
+    self.save(lru_dict)
+    self.assertTrue(os.path.exists(self.journal_file))
+    # The journal would have more records than items, it is compacted.
+    lru_dict.touch(u'1')
+    self.save(lru_dict)
+    self.assertFalse(os.path.exists(self.journal_file))
+    self.assertEqual(
+        [(u'2', u'two'), (u'1', u'one')], list(self.load().items()))
+
+  def test_small_no_journal(self):
+    lru_dict = _prepare_lru_dict([(u'1', 'one')])
+    self.save(lru_dict)
+    lru_dict.touch(u'1')
+    self.save(lru_dict)
+    self.assertFalse(os.path.exists(self.journal_file))
+    with open(self.state_file) as f:
+      self.assertNotIn('generation', json.load(f))
+
+  def test_truncated_journal(self):
+    lru_dict = _prepare_lru_dict(
+        [(u'1', 'one'), (u'2', 'two'), (u'3', 'three')])
+    self.save(lru_dict)
+    lru_dict.pop(u'1')
+    self.save(lru_dict)
+    # Simulates a crash while appending a record.
+    with open(self.journal_file, 'a') as f:
+      f.write('["d","')
+    lru_dict = self.load()
+    self.assertEqual([(u'2', u'two'), (u'3', u'three')], list(lru_dict.items()))
+    # It is compacted right away.
+    self.assertTrue(self.save(lru_dict))
+    self.assertFalse(os.path.exists(self.journal_file))
+    self.assertEqual(
+        [(u'2', u'two'), (u'3', u'three')], list(self.load().items()))
+
+  def test_corrupted_journal(self):
+    lru_dict = _prepare_lru_dict(
+        [(u'1', 'one'), (u'2', 'two'), (u'3', 'three')])
+    self.save(lru_dict)
+    lru_dict.pop(u'1')
+    self.save(lru_dict)
+    with open(self.journal_file, 'a') as f:
+      f.write('["d","1"]\n["t","2",1]\n')
+    # Deleting a missing key in the middle of the journal.
+    with self.assertRaises(ValueError):
+      self.load()
+
+  def test_stale_journal(self):
+    lru_dict = _prepare_lru_dict(
+        [(u'1', 'one'), (u'2', 'two'), (u'3', 'three')])
+    self.save(lru_dict)
+    lru_dict.pop(u'1')
+    self.save(lru_dict)
+    # Simulates an older client rewriting the state without a generation.
+    _prepare_lru_dict([(u'1', 'one'), (u'2', 'two'), (u'3', 'three')]).save(
+        self.state_file)
+    self.assertTrue(os.path.exists(self.journal_file))
+    self.assertEqual(
+        [(u'1', u'one'), (u'2', u'two'), (u'3', u'three')],
+        list(self.load().items()))
+
+  def test_migration(self):
+    # A state saved without a journal is loaded as-is then compacted with a
+    # generation on the next save.
+    _prepare_lru_dict([(u'1', 'one'), (u'2', 'two'), (u'3', 'three')]).save(
+        self.state_file)
+    lru_dict = self.load()
+    lru_dict.touch(u'1')
+    self.save(lru_dict)
+    self.assertFalse(os.path.exists(self.journal_file))
+    with open(self.state_file) as f:
+      self.assertIn('generation', json.load(f))
+    self.assertEqual(
+        [(u'2', u'two'), (u'3', u'three'), (u'1', u'one')],
+        list(self.load().items()))
+
+
 if __name__ == '__main__':
   test_env.main()
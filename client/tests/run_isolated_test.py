@@ -851,6 +851,15 @@ class RunIsolatedTest(RunIsolatedTestBase):
         kvs_dir,
     ]
 
+    # A named cache whose size is pending. --clean doesn't wait for its sizing.
+    named_cache = local_caching.NamedCache(
+        six.text_type(named_cache_dir),
+        local_caching.CachePolicies(0, 0, 0, 0))
+    put_to_named_cache(named_cache, u'foo', u'bar', b'baz')
+    def get_size(path, hints):
+      self.fail('Unexpected sizing of %s %s' % (path, hints))
+    self.mock(file_path, 'get_recursive_size_with_hints', get_size)
+
     def trim_caches_mock(caches, root_dir, min_free_space, max_age_secs):
       self.assertEqual(root_dir, isolated_cache_dir)
       self.assertEqual(min_free_space, min_free_space)
@@ -894,6 +903,29 @@ class RunIsolatedTest(RunIsolatedTestBase):
       # kvs dir should be removed.
       fs.stat(kvs_dir)
 
+  def test_main_named_cache_sizes(self):
+    named_cache_dir = six.text_type(os.path.join(self.tempdir, 'named_cache'))
+    named_cache = local_caching.NamedCache(
+        named_cache_dir, local_caching.CachePolicies(0, 0, 0, 0))
+    put_to_named_cache(named_cache, u'foo', u'bar', b'baz')
+    with fs.open(named_cache.state_file, 'rb') as f:
+      state = f.read()
+
+    cmd = [
+        '--no-log',
+        '--named-cache-sizes',
+        '--named-cache-root',
+        named_cache_dir,
+    ]
+    self.assertEqual(0, run_isolated.main(cmd))
+    # The state is left to the processes using the named cache, they pick up
+    # the sizes.
+    with fs.open(named_cache.state_file, 'rb') as f:
+      self.assertEqual(state, f.read())
+    self.assertEqual(0, named_cache.total_size)
+    self.assertEqual([], named_cache.trim())
+    self.assertEqual(3, named_cache.total_size)
+
   def test_modified_cwd(self):
     self._run_tha_test(command=['../out/some.exe', 'arg'], relative_cwd='some')
     self.assertEqual(
@@ -0,0 +1,157 @@
+# Copyright 2020 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Persistent cache of file digests, keyed on the file stat.
+
+It is stored in a SQLite database so it can be shared by concurrent processes
+archiving overlapping trees.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from utils import fs
+
+
+# Version of the database schema. A database with a different version is
+# recreated.
+SCHEMA_VERSION = 1
+
+
+# Number of new entries kept in memory before they are written to the database.
+_FLUSH_SIZE = 1000
+
+
+# Files modified less than this number of nanoseconds before they were hashed
+# are not cached. The file system timestamp granularity can be coarse, so a file
+# modified again right after it was hashed could keep the same stat.
+_RACY_NS = 2 * 1000 * 1000 * 1000
+
+
+def _ns(stat_result, name):
+  """Returns a timestamp of a stat result in nanoseconds."""
+  value = getattr(stat_result, name + '_ns', None)
+  if value is None:
+    value = int(getattr(stat_result, name) * 1e9)
+  return value
+
+
+def _key(filepath, algo_name, stat_result):
+  return (
+      filepath, algo_name, stat_result.st_ino, stat_result.st_size,
+      _ns(stat_result, 'st_mtime'), _ns(stat_result, 'st_ctime'))
+
+
+class DigestCache(object):
+  """Maps (path, inode, size, mtime, ctime) of a file to its digest.
+
+  Thread safe. New entries are buffered in memory and written by flush() or
+  close(), in a single transaction. The database uses write-ahead logging, so
+  other processes can keep reading while one writes.
+  """
+
+  def __init__(self, db_path):
+    self._db_path = db_path
+    self._lock = threading.Lock()
+    # Pending new entries; key -> digest.
+    self._new = {}
+    self.hits = 0
+    self.misses = 0
+    self._conn = self._open()
+
+  @property
+  def db_path(self):
+    return self._db_path
+
+  def _open(self):
+    dirname = os.path.dirname(self._db_path)
+    if dirname and not fs.isdir(dirname):
+      fs.makedirs(dirname)
+    conn = sqlite3.connect(
+        fs.extend(self._db_path), timeout=60, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version != SCHEMA_VERSION:
+      with conn:
+        conn.execute('DROP TABLE IF EXISTS digests')
+        conn.execute(
+            'CREATE TABLE digests ('
+            'path TEXT NOT NULL, '
+            'algo TEXT NOT NULL, '
+            'inode INTEGER NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'mtime_ns INTEGER NOT NULL, '
+            'ctime_ns INTEGER NOT NULL, '
+            'digest TEXT NOT NULL, '
+            'PRIMARY KEY (path, algo))')
+        conn.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+    return conn
+
+  def get(self, filepath, algo_name, stat_result):
+    """Returns the digest of the file if it didn't change, None otherwise."""
+    key = _key(filepath, algo_name, stat_result)
+    with self._lock:
+      digest = self._new.get(key)
+      if digest is None:
+        try:
+          row = self._conn.execute(
+              'SELECT digest FROM digests WHERE path=? AND algo=? AND '
+              'inode=? AND size=? AND mtime_ns=? AND ctime_ns=?',
+              key).fetchone()
+        except sqlite3.Error as e:
+          # The cache is only an optimization.
+          logging.warning('Failed to read %s: %s', self._db_path, e)
+          row = None
+        digest = row[0] if row else None
+      if digest is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+      return digest
+
+  def set(self, filepath, algo_name, stat_result, digest, now=None):
+    """Records the digest of a file hashed at |now|.
+
+    |stat_result| must be the stat of the file before it was hashed.
+    """
+    now_ns = int((now or time.time()) * 1e9)
+    if now_ns - _ns(stat_result, 'st_mtime') < _RACY_NS:
+      return
+    with self._lock:
+      self._new[_key(filepath, algo_name, stat_result)] = digest
+      if len(self._new) >= _FLUSH_SIZE:
+        self._flush()
+
+  def flush(self):
+    """Writes the new entries to the database."""
+    with self._lock:
+      self._flush()
+
+  def close(self):
+    with self._lock:
+      if not self._conn:
+        return
+      self._flush()
+      self._conn.close()
+      self._conn = None
+    logging.info(
+        'DigestCache(%s): %d hits, %d misses', self._db_path, self.hits,
+        self.misses)
+
+  def _flush(self):
+    if not self._new:
+      return
+    try:
+      with self._conn:
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [k + (v,) for k, v in self._new.items()])
+    except sqlite3.Error as e:
+      # The cache is only an optimization.
+      logging.warning('Failed to update %s: %s', self._db_path, e)
+    self._new = {}
@@ -44,6 +44,8 @@ if sys.platform == 'win32':
   from ctypes import windll  # pylint: disable=ungrouped-imports
 elif sys.platform == 'darwin':
   from utils import macos
+elif sys.platform.startswith('linux'):
+  import fcntl
 
 
 if sys.platform == 'win32':
@@ -867,9 +869,155 @@ def hardlink(source, link_name):
     fs.link(source, link_name)
 
 
+# Strategies used by copy_file_content(), from the fastest to the slowest.
+COPY_REFLINK = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+COPY_SENDFILE = 'sendfile'
+COPY_READ_WRITE = 'read_write'
+
+
+# ioctl sharing the extents of a file with another file, supported by btrfs and
+# xfs. From linux/fs.h.
+_FICLONE = 0x40049409
+
+
+# errno values meaning that a copy strategy doesn't work for a pair of files.
+_COPY_UNSUPPORTED_ERRNOS = frozenset(
+    getattr(errno, name)
+    for name in ('EBADF', 'EINVAL', 'ENOSYS', 'ENOTTY', 'EOPNOTSUPP', 'EXDEV')
+    if hasattr(errno, name))
+
+
+# (source st_dev, destination st_dev) -> index in _COPY_FUNCTIONS of the first
+# strategy that worked between these two filesystems.
+_copy_strategy_cache = {}
+
+
+def _copy_reflink(dst_fd, src_fd, _size):
+  fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+
+
+def _copy_file_range(dst_fd, src_fd, size):
+  offset = 0
+  while offset < size:
+    copied = os.copy_file_range(src_fd, dst_fd, size - offset, offset, offset)
+    if not copied:
+      _copy_remainder(dst_fd, src_fd, offset)
+      return
+    offset += copied
+
+
+def _copy_sendfile(dst_fd, src_fd, size):
+  offset = 0
+  while offset < size:
+    copied = os.sendfile(dst_fd, src_fd, offset, size - offset)
+    if not copied:
+      _copy_remainder(dst_fd, src_fd, offset)
+      return
+    offset += copied
+
+
+def _copy_read_write(dst_fd, src_fd, _size):
+  while True:
+    data = os.read(src_fd, 1024 * 1024)
+    if not data:
+      break
+    while data:
+      data = data[os.write(dst_fd, data):]
+
+
+def _copy_remainder(dst_fd, src_fd, offset):
+  """Copies the data from offset to the end of the file with read()/write().
+
+  The kernel copies can stop before the expected size, e.g. when the file
+  shrank or on filesystems that don't report their file sizes.
+  """
+  logging.debug('Copying the remainder from offset %d', offset)
+  os.lseek(src_fd, offset, os.SEEK_SET)
+  os.lseek(dst_fd, offset, os.SEEK_SET)
+  _copy_read_write(dst_fd, src_fd, None)
+
+
+def _get_copy_functions():
+  """Returns the list of (strategy, function) supported on this platform."""
+  out = []
+  if sys.platform.startswith('linux'):
+    out.append((COPY_REFLINK, _copy_reflink))
+    if hasattr(os, 'copy_file_range'):
+      out.append((COPY_FILE_RANGE, _copy_file_range))
+    if hasattr(os, 'sendfile'):
+      out.append((COPY_SENDFILE, _copy_sendfile))
+  out.append((COPY_READ_WRITE, _copy_read_write))
+  return out
+
+
+_COPY_FUNCTIONS = _get_copy_functions()
+
+
+def copy_file_content(outfile, infile, strategies=None):
+  """Copies the content of |infile| to the new file |outfile|.
+
+  On Linux, first tries to reflink the file, which shares its extents instead
+  of copying the data on btrfs and xfs, then copy_file_range() and sendfile(),
+  which copy in the kernel, then falls back to read()/write(). The first
+  strategy that works is remembered for each pair of filesystems, so the
+  unsupported strategies are only probed once.
+
+  Arguments:
+    outfile: path of the file to create.
+    infile: path of the file to copy.
+    strategies: if set, restricts the strategies that can be used.
+
+  Returns:
+    The strategy used.
+  """
+  functions = [
+      (i, name, func) for i, (name, func) in enumerate(_COPY_FUNCTIONS)
+      if strategies is None or name in strategies
+  ]
+  assert functions, strategies
+  with fs.open(infile, 'rb') as src:
+    with fs.open(outfile, 'wb') as dst:
+      src_fd = src.fileno()
+      dst_fd = dst.fileno()
+      src_stat = os.fstat(src_fd)
+      # Same as is_same_filesystem() without stat'ing the paths again.
+      key = (src_stat.st_dev, os.fstat(dst_fd).st_dev)
+      start = _copy_strategy_cache.get(key, 0) if strategies is None else 0
+      for index, name, func in functions:
+        if index < start:
+          continue
+        if name == COPY_REFLINK and key[0] != key[1]:
+          # Extents can only be shared within a filesystem.
+          continue
+        try:
+          func(dst_fd, src_fd, src_stat.st_size)
+        except (IOError, OSError) as e:
+          if (e.errno not in _COPY_UNSUPPORTED_ERRNOS or
+              index == functions[-1][0]):
+            raise
+          logging.debug('%s is not supported for %s: %s', name, outfile, e)
+          # Start over with the next strategy.
+          os.ftruncate(dst_fd, 0)
+          os.lseek(dst_fd, 0, os.SEEK_SET)
+          os.lseek(src_fd, 0, os.SEEK_SET)
+          continue
+        if src_stat.st_size and strategies is None:
+          # An empty file doesn't tell whether the strategy works.
+          _copy_strategy_cache[key] = index
+        return name
+  raise OSError(
+      'None of %s could copy %s' % (
+          ', '.join(name for _, name, _ in functions), infile))
+
+
 def readable_copy(outfile, infile):
   """Makes a copy of the file that is readable by everyone."""
-  fs.copy2(infile, outfile)
+  if sys.platform.startswith('linux'):
+    copy_file_content(outfile, infile)
+    fs.copystat(infile, outfile)
+  else:
+    fs.copy2(infile, outfile)
   fs.chmod(
       outfile,
       fs.stat(outfile).st_mode | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
@@ -1247,9 +1395,73 @@ def get_recursive_size(path):
     return None
 
 
+def get_recursive_size_with_hints(path, hints):
+  """Returns the total data size for the specified path, reusing size hints.
+
+  A directory whose mtime equals the one in its hint is not listed again; the
+  size of its files and its subdirectories are taken from the hint. The mtime
+  of a directory changes when an entry is added, removed or renamed in it, but
+  not when a file is modified in place, which isn't accounted for.
+
+  Directories modified within the last two seconds get no hint, as they could
+  be modified again without their mtime changing.
+
+  Arguments:
+    path: directory to size.
+    hints: dict {relative directory path: [mtime, size of its files, [names of
+        its subdirectories]]} as returned by a previous call, or an empty dict.
+
+  Returns:
+    tuple(total size, new hints), or (None, None) on failure.
+  """
+  start = time.time()
+  total = 0
+  reused = 0
+  new_hints = {}
+  stack = [u'']
+  try:
+    while stack:
+      rel = stack.pop()
+      abs_dir = os.path.join(path, rel) if rel else path
+      mtime = fs.lstat(abs_dir).st_mtime
+      hint = hints.get(rel)
+      if hint and hint[0] == mtime:
+        _, size, subdirs = hint
+        reused += 1
+      else:
+        size = 0
+        subdirs = []
+        for name in fs.listdir(abs_dir):
+          st = fs.lstat(os.path.join(abs_dir, name))
+          if stat.S_ISLNK(st.st_mode) or _is_reparse_point(st):
+            continue
+          if stat.S_ISDIR(st.st_mode):
+            subdirs.append(name)
+          else:
+            size += st.st_size
+      if mtime < start - 2:
+        new_hints[rel] = [mtime, size, subdirs]
+      total += size
+      stack.extend(os.path.join(rel, d) if rel else d for d in subdirs)
+  except (IOError, OSError, UnicodeEncodeError):
+    logging.exception('Exception while getting the size of %s', path)
+    return None, None
+  logging.debug(
+      'get_recursive_size_with_hints: traversed %s took %s seconds. '
+      'dirs: %d, reused: %d', path, time.time() - start, len(new_hints),
+      reused)
+  return total, new_hints
+
+
 ## Private code.
 
 
+def _is_reparse_point(st):
+  """Returns True if the stat result is of a Windows junction."""
+  # FILE_ATTRIBUTE_REPARSE_POINT. st_file_attributes only exists on Windows.
+  return bool(getattr(st, 'st_file_attributes', 0) & 0x400)
+
+
 def _use_scandir():
   # Use scandir in windows for faster execution.
   # Do not use in other OS due to crbug.com/989409
@@ -16,6 +16,7 @@ from utils import tools
 tools.force_local_third_party()
 
 # third_party/
+from scandir import scandir as _scandir
 import six
 from six.moves import builtins
 
@@ -429,6 +430,13 @@ def unlink(path):
   return remove(path)
 
 
+def scandir(path):
+  """Returns an iterator of the DirEntry in path."""
+  if six.PY3:
+    return os.scandir(extend(path))
+  return _scandir.scandir(extend(path))
+
+
 ## shutil
 
 
@@ -436,6 +444,10 @@ def copy2(src, dst):
   return shutil.copy2(extend(src), extend(dst))
 
 
+def copystat(src, dst):
+  return shutil.copystat(extend(src), extend(dst))
+
+
 def rmtree(path, *args, **kwargs):
   return shutil.rmtree(extend(path), *args, **kwargs)
 
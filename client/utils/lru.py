@@ -6,11 +6,28 @@
 
 import collections
 import json
+import os
+import random
 import time
 
+from utils import file_path
+
 CURRENT_VERSION = 3
 
 
+def _new_generation(previous):
+  """Returns a new random generation id for a state file with a journal.
+
+  It is random instead of incremental so a journal left behind by another
+  process, e.g. an older client which doesn't know about journals, can't
+  accidentally match.
+  """
+  while True:
+    generation = random.randint(1, 2**31)
+    if generation != previous:
+      return generation
+
+
 class LRUDict(object):
   """Dictionary that can evict least recently used items.
 
@@ -21,7 +38,23 @@ class LRUDict(object):
   That is, the first item in self._items is the oldest item.
 
   Can also store its state as *.json file on disk.
+
+  When a size_fn is specified, the sum of the sizes of all the values is
+  maintained incrementally and is available as total_size in O(1).
+
+  When a journal file is used along the state file, only the modifications done
+  since the last save are appended to the journal, as one json record per line:
+  - ["a", key, value, timestamp] for add()
+  - ["t", key, timestamp] for touch()
+  - ["d", key] for pop() and pop_oldest()
+  The state file is rewritten (compacted) once the journal has more records
+  than there are items. Both files are tagged with a generation id so that a
+  journal left behind by an interrupted compaction is ignored.
   """
+  # Minimum number of items to use the journal. Smaller states are cheaper to
+  # rewrite in full.
+  JOURNAL_MIN_ITEMS = 1000
+
   @staticmethod
   def time_fn():
     """Called to determine current timestamp when adding an entry.
@@ -30,12 +63,27 @@ class LRUDict(object):
     """
     return int(round(time.time()))
 
-  def __init__(self):
+  def __init__(self, size_fn=None):
+    """Args:
+      size_fn: function returning the size of a value, used to maintain
+          total_size. If None, total_size is always 0.
+    """
     # Ordered key -> (value, timestamp) mapping,
     # newest items at the bottom.
     self._items = collections.OrderedDict()
+    self._size_fn = size_fn
+    # Sum of self._size_fn(value) for all the items.
+    self._total_size = 0
     # True if was modified after loading.
     self._dirty = True
+    # Generation of the state file as saved on disk, None if it doesn't have a
+    # journal.
+    self._generation = None
+    # Records to append to the journal on the next save(), None if the state
+    # file must be rewritten instead.
+    self._journal = None
+    # Number of records in the journal on disk.
+    self._journal_size = 0
 
   def __nonzero__(self):
     """False if dict is empty."""
@@ -57,10 +105,25 @@ class LRUDict(object):
     """Returns value for |key| or raises KeyError if not found."""
     return self._items[key][0]
 
+  @property
+  def total_size(self):
+    """Sum of the sizes of all the values, as returned by size_fn."""
+    return self._total_size
+
+  @property
+  def oldest_timestamp(self):
+    """Timestamp of the oldest item, or None if the dict is empty."""
+    for item in self._items.values():
+      return item[1]
+    return None
+
   @classmethod
-  def load(cls, state_file):
+  def load(cls, state_file, journal_file=None, size_fn=None):
     """Loads previously saved state and returns LRUDict in that state.
 
+    If journal_file is specified, the records in it are replayed on top of the
+    state file. size_fn is passed to the LRUDict constructor.
+
     Raises ValueError if state file is corrupted.
     """
 
@@ -84,7 +147,7 @@ class LRUDict(object):
     if not isinstance(state_items, list):
       raise ValueError(
           'Broken state file %s, items should be json list' % (state_file,))
-    lru = cls()
+    lru = cls(size_fn)
     # Items are stored oldest to newest. Put them back in the same order.
     for item in state_items:
       if not isinstance(item, list) or len(item) != 2:
@@ -108,28 +171,67 @@ class LRUDict(object):
 
     # Now state from the file corresponds to state in the memory.
     lru._dirty = False
+    if journal_file:
+      lru._generation = state.get('generation')
+      lru._replay_journal(journal_file)
+    lru._update_total_size()
     return lru
 
-  def save(self, state_file):
-    """Saves cache state to a file if it was modified."""
+  def save(self, state_file, journal_file=None):
+    """Saves cache state to a file if it was modified.
+
+    If journal_file is specified, the modifications may be appended to it
+    instead of rewriting state_file.
+    """
     if not self._dirty:
       return False
 
-    with open(state_file, 'w') as f:
+    use_journal = bool(journal_file) and (
+        len(self._items) >= self.JOURNAL_MIN_ITEMS)
+    if (use_journal and self._generation is not None and
+        self._journal is not None and
+        self._journal_size + len(self._journal) <= len(self._items)):
+      self._append_journal(journal_file)
+    elif use_journal:
+      # Compact. Start a new generation before deleting the journal, so that
+      # the old journal is ignored if the process dies in between.
+      self._generation = _new_generation(self._generation)
       contents = {
+          'generation': self._generation,
           'version': CURRENT_VERSION,
           'items': list(self._items.items()),
       }
-      json.dump(contents, f, sort_keys=True, separators=(',', ':'))
+      file_path.atomic_replace(
+          state_file,
+          json.dumps(contents, sort_keys=True,
+                     separators=(',', ':')).encode('utf-8'))
+      self._remove_journal(journal_file)
+      self._journal = []
+    else:
+      with open(state_file, 'w') as f:
+        contents = {
+            'version': CURRENT_VERSION,
+            'items': list(self._items.items()),
+        }
+        json.dump(contents, f, sort_keys=True, separators=(',', ':'))
+      if journal_file:
+        self._remove_journal(journal_file)
+      self._generation = None
+      self._journal = None
 
     self._dirty = False
     return True
 
   def add(self, key, value):
     """Adds or replaces a |value| for |key|, marks it as most recently used."""
-    self._items.pop(key, None)
-    self._items[key] = (value, self.time_fn())
+    previous = self._items.pop(key, None)
+    if previous is not None:
+      self._total_size -= self._size(previous[0])
+    ts = self.time_fn()
+    self._items[key] = (value, ts)
+    self._total_size += self._size(value)
     self._dirty = True
+    self._log(['a', key, value, ts])
 
   def get(self, key, default=None):
     """Returns value for |key| or |default| if not found."""
@@ -141,8 +243,22 @@ class LRUDict(object):
 
     Raises KeyError if |key| is not in the dict.
     """
-    self._items[key] = (self._items.pop(key)[0], self.time_fn())
+    ts = self.time_fn()
+    self._items[key] = (self._items.pop(key)[0], ts)
+    self._dirty = True
+    self._log(['t', key, ts])
+
+  def replace(self, key, value):
+    """Replaces the |value| for |key| without changing its position.
+
+    Raises KeyError if |key| is not in the dict.
+    """
+    previous, ts = self._items[key]
+    self._items[key] = (value, ts)
+    self._total_size += self._size(value) - self._size(previous)
     self._dirty = True
+    # Not representable in the journal, the state file has to be rewritten.
+    self._journal = None
 
   def pop(self, key):
     """Removes item from the dict, returns its value.
@@ -150,7 +266,9 @@ class LRUDict(object):
     Raises KeyError if |key| is not in the dict.
     """
     item = self._items.pop(key)
+    self._total_size -= self._size(item[0])
     self._dirty = True
+    self._log(['d', key])
     return item[0]
 
   def get_oldest(self):
@@ -170,7 +288,9 @@ class LRUDict(object):
     Raises KeyError if dict is empty.
     """
     item = self._items.popitem(last=False)
+    self._total_size -= self._size(item[1][0])
     self._dirty = True
+    self._log(['d', item[0]])
     return item
 
   def items(self):
@@ -187,4 +307,100 @@ class LRUDict(object):
     """Updates the data format and saves immediately."""
     for key, (val, timestamp) in self._items.items():
       self._items[key] = (mutator(key, val), timestamp)
+    self._update_total_size()
     self._dirty = True
+    # Everything changed, the state file has to be rewritten.
+    self._journal = None
+
+  def _size(self, value):
+    return self._size_fn(value) if self._size_fn else 0
+
+  def _update_total_size(self):
+    """Recalculates self._total_size from scratch."""
+    self._total_size = sum(self._size(val) for val, _ in self._items.values())
+
+  def _log(self, record):
+    """Records a modification to be appended to the journal on save()."""
+    if self._journal is None:
+      return
+    if len(self._journal) >= max(len(self._items), self.JOURNAL_MIN_ITEMS):
+      # The state file will be compacted anyway, stop accumulating.
+      self._journal = None
+      return
+    self._journal.append(record)
+
+  def _replay_journal(self, journal_file):
+    """Applies the records of journal_file on top of the loaded state.
+
+    A journal from another generation is ignored. A truncated last record, e.g.
+    the process died while appending to the journal, is ignored. In both cases
+    the state file will be compacted on the next save().
+
+    Raises ValueError if the journal is corrupted.
+    """
+    try:
+      with open(journal_file, 'r') as f:
+        lines = f.read().split('\n')
+    except IOError:
+      # No journal; a first journal will be started on the next save().
+      if self._generation is not None:
+        self._journal = []
+      return
+    try:
+      header = json.loads(lines[0])
+    except ValueError:
+      header = None
+    if (self._generation is None or not isinstance(header, dict) or
+        header.get('generation') != self._generation):
+      return
+    # The last line is empty unless the last write was interrupted.
+    records = lines[1:]
+    complete = not records or not records[-1]
+    for i, line in enumerate(records):
+      if not line and i == len(records) - 1:
+        break
+      try:
+        record = json.loads(line)
+        op = record[0]
+        key = record[1]
+        if op == 'a':
+          self._items.pop(key, None)
+          self._items[key] = (record[2], record[3])
+        elif op == 't':
+          self._items[key] = (self._items.pop(key)[0], record[2])
+        elif op == 'd':
+          self._items.pop(key)
+        else:
+          raise ValueError('unknown record')
+      except (IndexError, KeyError, TypeError, ValueError) as e:
+        if i == len(records) - 1:
+          complete = False
+          break
+        raise ValueError(
+            'Broken journal file %s at record %d: %s' % (journal_file, i, e))
+      self._journal_size += 1
+    if complete:
+      self._journal = []
+    else:
+      # Trailing garbage must not be appended to; compact at next save().
+      self._dirty = True
+
+  def _append_journal(self, journal_file):
+    """Appends the pending records to the journal."""
+    with open(journal_file, 'a' if self._journal_size else 'w') as f:
+      if not self._journal_size:
+        f.write(json.dumps({'generation': self._generation}) + '\n')
+      for record in self._journal:
+        f.write(json.dumps(record, separators=(',', ':')) + '\n')
+      f.flush()
+      os.fsync(f.fileno())
+    self._journal_size += len(self._journal)
+    self._journal = []
+
+  def _remove_journal(self, journal_file):
+    """Deletes the journal, if any."""
+    self._journal_size = 0
+    try:
+      os.remove(journal_file)
+    except OSError:
+      pass
@@ -29,10 +29,15 @@ _caches_lock = threading.Lock()
 
 
 class Profiler(object):
-  """Context manager that records time spend inside its body."""
+  """Context manager that records time spend inside its body.
+
+  If the body sets self.size to the amount of bytes processed, the throughput
+  is logged too.
+  """
   def __init__(self, name):
     self.name = name
     self.start_time = None
+    self.size = None
 
   def __enter__(self):
     self.start_time = time.time()
@@ -40,8 +45,26 @@ class Profiler(object):
 
   def __exit__(self, _exc_type, _exec_value, _traceback):
     time_taken = time.time() - self.start_time
-    logging.info('Profiling: Section %s took %3.3f seconds',
-                 self.name, time_taken)
+    if self.size is None:
+      logging.info('Profiling: Section %s took %3.3f seconds',
+                   self.name, time_taken)
+    else:
+      logging.info('Profiling: Section %s took %3.3f seconds; %s',
+                   self.name, time_taken, self._throughput(time_taken))
+
+  def progress(self, done, total):
+    """Logs the progress of the section so far."""
+    time_taken = time.time() - self.start_time
+    msg = 'Profiling: Section %s at %d/%d after %3.3f seconds'
+    if self.size is None:
+      logging.info(msg, self.name, done, total, time_taken)
+    else:
+      logging.info(msg + '; %s', self.name, done, total, time_taken,
+                   self._throughput(time_taken))
+
+  def _throughput(self, time_taken):
+    return '%d bytes, %.1f MiB/s' % (
+        self.size, self.size / 1024. / 1024. / max(time_taken, 0.001))
 
 
 class ProfileCounter(object):